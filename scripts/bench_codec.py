@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+消息编解码基准测试
+对比原路径（asdict + json.dumps / request.json()）与 utils.messages.codec
+使用方式: python scripts/bench_codec.py [-n 次数]
+"""
+
+import argparse
+import json
+import os
+import sys
+import timeit
+from dataclasses import asdict
+
+# 添加 src 目录到 Python 路径
+src_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+if src_dir not in sys.path:
+    sys.path.insert(0, src_dir)
+
+from utils.messages import codec
+from utils.messages.server import (
+    ServerMessage,
+    ServerMessageContent,
+    ToolRequestDetail,
+    MESSAGE_TYPE_ANSWER,
+    MESSAGE_TYPE_TOOL_REQUEST,
+)
+
+
+def _answer_chunk() -> ServerMessage:
+    return ServerMessage(
+        type=MESSAGE_TYPE_ANSWER,
+        session_id="session-1",
+        query_msg_id="local-msg-1",
+        reply_id="0f8fad5b-d9cb-469f-a165-70867728950e",
+        msg_id="7c9e6679-7425-40de-944b-e07fc1f90ae7",
+        sequence_id=42,
+        finish=False,
+        content=ServerMessageContent(answer="需"),
+        log_id="20260101000000000000000000000000",
+    )
+
+
+def _tool_request() -> ServerMessage:
+    return ServerMessage(
+        type=MESSAGE_TYPE_TOOL_REQUEST,
+        session_id="session-1",
+        query_msg_id="local-msg-1",
+        reply_id="0f8fad5b-d9cb-469f-a165-70867728950e",
+        msg_id="7c9e6679-7425-40de-944b-e07fc1f90ae7",
+        sequence_id=43,
+        finish=True,
+        content=ServerMessageContent(
+            tool_request=ToolRequestDetail(
+                tool_call_id="call_1",
+                tool_name="search",
+                parameters={"search": {"query": "需求文档模板", "top_k": 5}},
+            )
+        ),
+        log_id="20260101000000000000000000000000",
+    )
+
+
+def _request_body() -> bytes:
+    prompt = [{"type": "text", "content": {"text": "帮我写一个登录页面的需求文档" * 20}}]
+    prompt += [
+        {"type": "upload_file", "content": {"upload_file": {
+            "file_name": f"spec_{i}.pdf", "file_path": "", "url": f"https://example.com/spec_{i}.pdf"}}}
+        for i in range(5)
+    ]
+    return json.dumps({
+        "type": "query",
+        "project_id": "p1",
+        "session_id": "s1",
+        "local_msg_id": "m1",
+        "content": {"query": {"prompt": prompt}},
+    }, ensure_ascii=False).encode("utf-8")
+
+
+def _legacy_sse(sm: ServerMessage) -> bytes:
+    return f"event: message\ndata: {json.dumps(asdict(sm), ensure_ascii=False, default=str)}\n\n".encode("utf-8")
+
+
+def _legacy_decode(raw: bytes):
+    return json.loads(raw)  # request.json()
+
+
+def _bench(name: str, fn, number: int):
+    seconds = min(timeit.repeat(fn, number=number, repeat=5))
+    print(f"{name:<40} {seconds / number * 1e6:8.2f} us/op")
+    return seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark message codecs")
+    parser.add_argument("-n", type=int, default=20000, help="iterations per run")
+    args = parser.parse_args()
+
+    print(f"orjson: {'yes' if codec.orjson else 'no'}, ormsgpack: {'yes' if codec.ormsgpack else 'no'}")
+    cases = [("answer chunk", _answer_chunk()), ("tool request", _tool_request())]
+    for label, sm in cases:
+        print(f"-- encode {label}")
+        legacy = _bench("legacy asdict + json.dumps", lambda: _legacy_sse(sm), args.n)
+        new = _bench("codec.SSE_WIRE.frame", lambda: codec.SSE_WIRE.frame(sm), args.n)
+        print(f"{'speedup':<40} {legacy / new:8.2f}x")
+        if codec.ormsgpack:
+            _bench("codec.MSGPACK_WIRE.frame", lambda: codec.MSGPACK_WIRE.frame(sm), args.n)
+
+    raw = _request_body()
+    print(f"-- decode request body ({len(raw)} bytes)")
+    legacy = _bench("legacy json.loads", lambda: _legacy_decode(raw), args.n)
+    new = _bench("codec.loads", lambda: codec.loads(raw), args.n)
+    print(f"{'speedup':<40} {legacy / new:8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
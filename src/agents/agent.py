@@ -1,8 +1,9 @@
 import os
 import json
-from typing import Annotated
+from typing import Annotated, Any, Dict
 from langchain.agents import create_agent
 from langchain_openai import ChatOpenAI
+from langchain_core.runnables import ensure_config
 from langgraph.graph import MessagesState
 from langgraph.graph.message import add_messages
 from langchain_core.messages import AnyMessage
@@ -11,6 +12,9 @@ from storage.memory.memory_saver import get_memory_saver
 
 LLM_CONFIG = "config/agent_llm_config.json"
 
+# 请求级 header 通过 RunnableConfig["configurable"][HEADERS_CONFIG_KEY] 传入
+HEADERS_CONFIG_KEY = "default_headers"
+
 # 默认保留最近 20 轮对话 (40 条消息)
 MAX_MESSAGES = 40
 
@@ -21,22 +25,42 @@ def _windowed_messages(old, new):
 class AgentState(MessagesState):
     messages: Annotated[list[AnyMessage], _windowed_messages]
 
-def build_agent(ctx=None):
+
+class ConfigHeadersChatOpenAI(ChatOpenAI):
+    """
+    从当前 RunnableConfig 读取请求级 header 的 ChatOpenAI
+
+    编译后的 agent 在进程内复用，ctx 相关的 header 不能在构建时写死，
+    改为每次请求时从 configurable 中取出，作为 extra_headers 发送
+    """
+
+    def _get_request_payload(self, input_, *, stop=None, **kwargs):
+        payload = super()._get_request_payload(input_, stop=stop, **kwargs)
+        headers = ensure_config().get("configurable", {}).get(HEADERS_CONFIG_KEY)
+        if headers:
+            payload["extra_headers"] = {**(payload.get("extra_headers") or {}), **headers}
+        return payload
+
+
+def get_config_path() -> str:
     workspace_path = os.getenv("COZE_WORKSPACE_PATH", "/workspace/projects")
-    config_path = os.path.join(workspace_path, LLM_CONFIG)
-    
-    with open(config_path, 'r', encoding='utf-8') as f:
-        cfg = json.load(f)
-    
-    api_key = os.getenv("COZE_WORKLOAD_IDENTITY_API_KEY")
-    base_url = os.getenv("COZE_INTEGRATION_MODEL_BASE_URL")
-    
-    llm = ChatOpenAI(
+    return os.path.join(workspace_path, LLM_CONFIG)
+
+
+def run_configurable(ctx) -> Dict[str, Any]:
+    """请求级的 configurable 参数，配合缓存的 agent 使用"""
+    return {HEADERS_CONFIG_KEY: default_headers(ctx)} if ctx else {}
+
+
+def build_agent_from_config(cfg: Dict[str, Any], ctx=None):
+    llm = ConfigHeadersChatOpenAI(
         model=cfg['config'].get("model"),
-        api_key=api_key,
-        base_url=base_url,
+        api_key=os.getenv("COZE_WORKLOAD_IDENTITY_API_KEY"),
+        base_url=os.getenv("COZE_INTEGRATION_MODEL_BASE_URL"),
         temperature=cfg['config'].get('temperature', 0.7),
         streaming=True,
+        # 流式输出时返回 usage_metadata，用于统计 token 用量
+        stream_usage=True,
         timeout=cfg['config'].get('timeout', 600),
         extra_body={
             "thinking": {
@@ -45,7 +69,7 @@ def build_agent(ctx=None):
         },
         default_headers=default_headers(ctx) if ctx else {}
     )
-    
+
     return create_agent(
         model=llm,
         system_prompt=cfg.get("sp"),
@@ -53,3 +77,10 @@ def build_agent(ctx=None):
         checkpointer=get_memory_saver(),
         state_schema=AgentState,
     )
+
+
+def build_agent(ctx=None):
+    with open(get_config_path(), 'r', encoding='utf-8') as f:
+        cfg = json.load(f)
+
+    return build_agent_from_config(cfg, ctx)
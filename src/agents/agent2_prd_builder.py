@@ -46,6 +46,8 @@ def build_agent(ctx=None):
         "temperature": cfg['config'].get('temperature', 0.6),
         "max_tokens": cfg['config'].get('max_completion_tokens', 8000),
         "timeout": cfg['config'].get('timeout', 600),
+        # 流式输出时返回 usage_metadata，用于统计 token 用量
+        "stream_usage": True,
     }
 
     # 如果启用 thinking 模式，使用支持 extended thinking 的模型
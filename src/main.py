@@ -1,31 +1,35 @@
 import argparse
 import asyncio
+import importlib
 import json
 import traceback
+import weakref
 import logging
-from typing import Any, Dict, Iterable, AsyncIterable, AsyncGenerator, Optional
-import threading
-import contextvars
-import cozeloop
+import os
+from typing import Any, Dict, Iterable, AsyncIterable, AsyncGenerator, Optional, Set
 import uvicorn
 import time
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import StreamingResponse, JSONResponse, PlainTextResponse
 from langchain_core.runnables import RunnableConfig
-from langgraph.graph import StateGraph, END
 from langgraph.graph.state import CompiledStateGraph
 
 from coze_coding_utils.runtime_ctx.context import new_context, Context
 from utils.helper import graph_helper
 from utils.log.node_log import LOG_FILE
-from utils.log.write_log import setup_logging, request_context
+from utils.log.async_writer import close_log_writers, get_log_writer_stats
+from utils.log.rotation import get_sink_stats
+from utils.log.write_log import setup_logging, request_context, body_preview, get_logging_stats
 from utils.log.config import LOG_LEVEL
+from utils.messages import codec
 from utils.messages.server import (
     create_message_end_dict,
     create_message_error_dict,
+    message_end_code,
     MESSAGE_END_CODE_CANCELED,
+    MESSAGE_END_CODE_SUCCESS,
 )
-from utils.error import ErrorClassifier, classify_error
+from utils.error import ErrorClassifier
 
 setup_logging(
     log_file=LOG_FILE,
@@ -39,44 +43,135 @@ setup_logging(
 logger = logging.getLogger(__name__)
 from utils.helper.agent_helper import (
     to_stream_input,
+    ato_stream_input,
     to_client_message,
     agent_iter_server_messages,
+    agent_aiter_server_messages,
 )
-from utils.log.parser import LangGraphParser
+from utils.helper.stream_pool import get_stream_pool
+from utils.messages.coalesce import coalesce_answer_deltas
+from utils.helper.replay_buffer import SSE_REPLAY_ENABLED, replay_registry, parse_last_event_id
+from utils.helper.idempotency import idempotency_key, idempotency_registry, IdempotencyEntry
+from utils.helper.run_registry import enable_run_registry, get_run_registry
+from utils.helper.prefork import register_post_fork, register_worker_exit, resolve_workers, serve_prefork
+from utils.helper.admission import (
+    ADMISSION_ENABLED,
+    AdmissionRejected,
+    AdmissionTicket,
+    get_admission_controller,
+)
+from utils.helper.cancellation import (
+    CancellationToken,
+    CancellationCallbackHandler,
+    RunCancelledError,
+    CANCEL_REASON_USER,
+    CANCEL_REASON_TIMEOUT,
+    CANCEL_REASON_DISCONNECT,
+    get_cancellation_stats,
+)
+from utils.helper.metrics import COUNTER, GAUGE, METRICS_ENABLED, MetricsMiddleware, get_metrics
+from utils.file.cache import get_attachment_cache
+from utils.file.parser_pool import get_parser_pool
+from storage.memory.memory_saver import get_checkpointer_pool_stats
 from utils.log.err_trace import extract_core_stack
-from utils.log.loop_trace import init_run_config, init_agent_config
+from utils.log.loop_trace import init_run_config, init_agent_config, reinit_tracer
+from utils.log.trace_flusher import get_trace_flusher, close_trace_flusher
+from utils.log.chrome_trace import chrome_trace_requested, header_requested
 
 
 # 超时配置常量
 TIMEOUT_SECONDS = 900  # 15分钟
 
+AGENT_MODULE = "agents.agent"
+
+# 流式执行引擎: async 使用 graph.astream 原生异步；thread 强制走有界线程池的同步流
+STREAM_ENGINE = os.getenv("STREAM_ENGINE", "async")
+
+# 续传模式下返回 run_id 的响应头，重连时也可通过该请求头携带 run_id
+RUN_ID_HEADER = "X-Run-Id"
+# 续传模式下在后台执行的流任务（持有强引用，避免任务被回收）
+_replay_pumps: Set[asyncio.Task] = set()
+
 class GraphService:
     def __init__(self):
         if not graph_helper.is_agent_proj():
             self.graph = graph_helper.get_graph_instance("graphs.graph")
+            # 启动时为每个节点准备单节点 graph 和出入参 Schema
+            self.nodes = graph_helper.NodeRegistry(self.graph)
 
         # 用于跟踪正在运行的任务（使用asyncio.Task）
         self.running_tasks: Dict[str, asyncio.Task] = {}
+        # 与 running_tasks 对应的取消令牌，注入到 graph callbacks 中中断工作线程和模型流
+        self.cancel_tokens: Dict[str, CancellationToken] = {}
         # 错误分类器
         self.error_classifier = ErrorClassifier()
 
     
     def _get_graph(self, ctx=Context):
         if graph_helper.is_agent_proj():
-            return graph_helper.get_agent_instance("agents.agent", ctx)
+            # 已编译的 agent 进程内复用，请求级 header 通过 _configurable 传入
+            return graph_helper.get_cached_agent_instance(AGENT_MODULE, ctx)
         else:
             return self.graph
+
+    def track_task(self, run_id: str, task: asyncio.Task):
+        """登记正在执行的任务；多 worker 模式下同时登记到跨进程的 run 登记表"""
+        self.running_tasks[run_id] = task
+        registry = get_run_registry()
+        if registry is not None:
+            registry.register(run_id)
+
+    def untrack_task(self, run_id: str):
+        if self.running_tasks.pop(run_id, None) is not None:
+            registry = get_run_registry()
+            if registry is not None:
+                registry.unregister(run_id)
+
+    def preload(self):
+        """fork 前预加载 graph/agent 模块，由 worker 通过写时复制共享"""
+        if graph_helper.is_agent_proj():
+            importlib.import_module(AGENT_MODULE)
+
+    def _register_cancel_token(self, run_id: str, run_config: RunnableConfig) -> CancellationToken:
+        token = CancellationToken(run_id)
+        self.cancel_tokens[run_id] = token
+        callbacks = run_config.get("callbacks")
+        if callbacks is None:
+            run_config["callbacks"] = [CancellationCallbackHandler(token)]
+        else:
+            callbacks.append(CancellationCallbackHandler(token))
+        return token
+
+    def _release_cancel_token(self, run_id: str):
+        token = self.cancel_tokens.pop(run_id, None)
+        if token is not None:
+            token.finish()
+
+    def signal_cancel(self, run_id: str, reason: str) -> bool:
+        """向 run 的取消令牌发出取消信号，返回是否找到令牌"""
+        token = self.cancel_tokens.get(run_id)
+        if token is None:
+            return False
+        token.cancel(reason)
+        return True
+
+    @staticmethod
+    def _configurable(thread_id: str, ctx=Context) -> Dict[str, Any]:
+        configurable: Dict[str, Any] = {"thread_id": thread_id}
+        if graph_helper.is_agent_proj():
+            configurable.update(graph_helper.get_agent_run_configurable(AGENT_MODULE, ctx))
+        return configurable
     
     
     @staticmethod
-    def _sse_event(data: Any) -> str:
-        return f"event: message\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+    def _sse_event(data: Any) -> bytes:
+        return codec.SSE_WIRE.frame(data)
 
     # 流式运行（原始迭代器）：本地调用使用
     def stream(self, payload: Dict[str, Any], run_config: RunnableConfig, ctx=Context) -> Iterable[Any]:
         client_msg, session_id = to_client_message(payload)
         run_config["recursion_limit"] = 100
-        run_config["configurable"] = {"thread_id": session_id}
+        run_config["configurable"] = self._configurable(session_id, ctx)
         stream_input = to_stream_input(client_msg)
         t0 = time.time()
         try:
@@ -132,13 +227,14 @@ class GraphService:
             graph = self._get_graph(ctx)
             # custom tracer
             run_config = init_run_config(graph, ctx)
-            run_config["configurable"] = {"thread_id": ctx.run_id}
+            run_config["configurable"] = self._configurable(ctx.run_id, ctx)
+            self._register_cancel_token(run_id, run_config)
 
             # 直接调用，LangGraph会在当前任务上下文中执行
             # 如果当前任务被取消，LangGraph的执行也会被取消
             return await graph.ainvoke(payload, config=run_config, context=ctx)
 
-        except asyncio.CancelledError:
+        except (asyncio.CancelledError, RunCancelledError):
             logger.info(f"Run {run_id} was cancelled")
             return {"status": "cancelled", "run_id": run_id, "message": "Execution was cancelled"}
         except Exception as e:
@@ -154,12 +250,20 @@ class GraphService:
             raise
         finally:
             # 清理任务记录
-            self.running_tasks.pop(run_id, None)
+            self.untrack_task(run_id)
+            self._release_cancel_token(run_id)
 
-    # 流式运行（SSE 格式化）：HTTP 路由使用
-    async def stream_sse(self, payload: Dict[str, Any], ctx=None) -> AsyncGenerator[str, None]:
+    # 流式运行（SSE 格式化）
+    async def stream_sse(self, payload: Dict[str, Any], ctx=None, wire=codec.SSE_WIRE) -> AsyncGenerator[bytes, None]:
         if ctx is None:
             ctx = new_context(method="stream_sse")
+        async for chunk in self.stream_events(payload, ctx):
+            yield wire.frame(chunk)
+
+    # 流式运行（未编码的消息对象）：HTTP 路由按输出格式统一编帧
+    async def stream_events(self, payload: Dict[str, Any], ctx=None) -> AsyncGenerator[Any, None]:
+        if ctx is None:
+            ctx = new_context(method="stream_events")
 
         run_id = ctx.run_id
         logger.info(f"Starting stream with run_id: {run_id}")
@@ -168,17 +272,33 @@ class GraphService:
             run_config = init_agent_config(graph, ctx)
         else:
             run_config = init_run_config(graph, ctx)  # vibeflow
+        cancel_token = self._register_cancel_token(run_id, run_config)
 
+        # 可选：合并同一 msg_id 的连续 answer 增量，减少 SSE 帧数
+        chunks = coalesce_answer_deltas(
+            self.astream(payload, graph, run_config=run_config, ctx=ctx, cancel_token=cancel_token)
+        )
+        completed = False
+        metrics = get_metrics()
+        metrics.inc("active_streams")
         try:
-            async for chunk in self.astream(payload, graph, run_config=run_config, ctx=ctx):
-                yield self._sse_event(chunk)
+            async for chunk in chunks:
+                yield chunk
+            completed = True
         finally:
+            if not completed:
+                # 未正常结束：客户端断开或任务被取消，中断仍在进行的模型请求
+                cancel_token.cancel(CANCEL_REASON_DISCONNECT)
+            await chunks.aclose()
             # 清理任务记录
-            self.running_tasks.pop(run_id, None)
-            cozeloop.flush()
+            self.untrack_task(run_id)
+            self._release_cancel_token(run_id)
+            get_trace_flusher().finish(run_id)
+            metrics.inc("active_streams", -1)
 
     # 取消执行 - 使用asyncio的标准方式
-    def cancel_run(self, run_id: str, ctx: Optional[Context] = None) -> Dict[str, Any]:
+    def cancel_run(self, run_id: str, ctx: Optional[Context] = None,
+                   reason: str = CANCEL_REASON_USER) -> Dict[str, Any]:
         """
         取消指定run_id的执行
 
@@ -186,6 +306,8 @@ class GraphService:
         LangGraph会在节点之间检查CancelledError,实现优雅的取消。
         """
         logger.info(f"Attempting to cancel run_id: {run_id}")
+        # 先通知取消令牌，中断工作线程中的 graph 执行和模型流
+        self.signal_cancel(run_id, reason)
 
         # 查找对应的任务
         if run_id in self.running_tasks:
@@ -208,6 +330,16 @@ class GraphService:
                     "message": "Task has already completed"
                 }
         else:
+            # 多 worker 模式：任务可能在其他 worker 上，转发取消请求
+            registry = get_run_registry()
+            owner = registry.request_cancel(run_id, reason) if registry is not None else None
+            if owner is not None:
+                logger.info(f"Cancellation forwarded to worker {owner} for run_id: {run_id}")
+                return {
+                    "status": "success",
+                    "run_id": run_id,
+                    "message": f"Cancellation signal forwarded to worker {owner}"
+                }
             logger.warning(f"No active task found for run_id: {run_id}")
             return {
                 "status": "not_found",
@@ -220,18 +352,8 @@ class GraphService:
         if ctx is None or Context.run_id == "":
             ctx = new_context(method="node_run")
 
-        node_func, input_cls, output_cls = graph_helper.get_graph_node_func_with_inout(self.graph.get_graph(), node_id)
-        if node_func is None or input_cls is None:
-            raise KeyError(f"node_id '{node_id}' not found")
         assert self.graph is not None, "Graph is not initialized"
-        parser = LangGraphParser(self.graph)
-        metadata = parser.get_node_metadata(node_id) or {}
-
-        _g = StateGraph(input_cls, input_schema=input_cls, output_schema=output_cls)
-        _g.add_node("sn", node_func, metadata=metadata)
-        _g.set_entry_point("sn")
-        _g.add_edge("sn", END)
-        _graph = _g.compile()
+        _graph = self.nodes.get(node_id).graph
 
         run_config = init_run_config(_graph, ctx)
         return await _graph.ainvoke(payload, config=run_config)
@@ -240,84 +362,99 @@ class GraphService:
     def graph_inout_schema(self) -> Any:
         if graph_helper.is_agent_proj():
             return {"input_schema": {}, "output_schema": {}}
-        _graph_input = self.graph.get_input_schema()
-        _graph_output = self.graph.get_output_schema()
+        return self.nodes.graph_schema
 
-        return {"input_schema": _graph_input.model_json_schema(), "output_schema": _graph_output.model_json_schema()}
-
-    async def astream(self, payload: Dict[str, Any], graph: CompiledStateGraph, run_config: RunnableConfig, ctx=Context) -> AsyncIterable[Any]:
+    async def astream(self, payload: Dict[str, Any], graph: CompiledStateGraph, run_config: RunnableConfig, ctx=Context,
+                      cancel_token: Optional[CancellationToken] = None) -> AsyncIterable[Any]:
         client_msg, session_id = to_client_message(payload)
         run_config["recursion_limit"] = 100
-        run_config["configurable"] = {"thread_id": session_id}
-        stream_input = to_stream_input(client_msg)
-
-        # 使用后台线程拉取同步流，并通过事件循环安全地推送到异步队列
-        loop = asyncio.get_running_loop()
-        q: asyncio.Queue = asyncio.Queue()
-        context = contextvars.copy_context()
+        run_config["configurable"] = self._configurable(session_id, ctx)
+        stream_input = await ato_stream_input(client_msg)
         start_time = time.time()
-        def producer():
-            try:
-                items = graph.stream(stream_input, stream_mode="messages", config=run_config, context=ctx)
-                server_msgs_iter = agent_iter_server_messages(
-                    items,
-                    session_id=client_msg.session_id,
-                    query_msg_id=client_msg.local_msg_id,
-                    local_msg_id=client_msg.local_msg_id,
-                    run_id=ctx.run_id,
-                    log_id=ctx.logid,
-                )
-                last_seq = 0
-                for sm in server_msgs_iter:
-                    # 主动检查执行时间，及时中断
-                    if time.time() - start_time > TIMEOUT_SECONDS:
-                        logger.error(f"Agent execution timeout after {TIMEOUT_SECONDS}s for run_id: {ctx.run_id}")
-                        timeout_msg = create_message_end_dict(
-                            code="TIMEOUT",
-                            message=f"Execution timeout: exceeded {TIMEOUT_SECONDS} seconds",
-                            session_id=client_msg.session_id,
-                            query_msg_id=client_msg.local_msg_id,
-                            log_id=ctx.logid,
-                            time_cost_ms=int((time.time() - start_time) * 1000),
-                            reply_id=getattr(sm, 'reply_id', ''),
-                            sequence_id=last_seq + 1,
-                        )
-                        loop.call_soon_threadsafe(q.put_nowait, timeout_msg)
-                        return
-                    loop.call_soon_threadsafe(q.put_nowait, sm.dict())
-                    last_seq = sm.sequence_id
-            except Exception as ex:
-                # 使用错误分类器获取错误码
-                err = classify_error(ex, {"node_name": "astream"})
-                end_msg = create_message_end_dict(
-                    code=str(err.code),
-                    message=err.message,
-                    session_id=client_msg.session_id,
-                    query_msg_id=client_msg.local_msg_id,
-                    log_id=ctx.logid,
-                    time_cost_ms=int((time.time() - start_time) * 1000),
-                    reply_id="",
-                    sequence_id=last_seq + 1,
-                )
-                loop.call_soon_threadsafe(q.put_nowait, end_msg)
-            finally:
-                loop.call_soon_threadsafe(q.put_nowait, None)
-
-        threading.Thread(target=lambda: context.run(producer), daemon=True).start()
 
+        if STREAM_ENGINE == "async" and callable(getattr(graph, "astream", None)):
+            items = graph.astream(stream_input, stream_mode="messages", config=run_config, context=ctx)
+        else:
+            # 只支持同步流的 graph：在有界线程池中执行，通过有界队列回传，读得慢时阻塞生产者
+            items = get_stream_pool().iterate(
+                lambda: graph.stream(stream_input, stream_mode="messages", config=run_config, context=ctx)
+            )
+        server_msgs_iter = agent_aiter_server_messages(
+            items,
+            session_id=client_msg.session_id,
+            query_msg_id=client_msg.local_msg_id,
+            local_msg_id=client_msg.local_msg_id,
+            run_id=ctx.run_id,
+            log_id=ctx.logid,
+        )
+        last_seq = 0
         try:
-            while True:
-                item = await q.get()
-                if item is None:
-                    break
-                yield item
+            async for sm in server_msgs_iter:
+                if cancel_token is not None and cancel_token.cancelled:
+                    raise asyncio.CancelledError()
+                # 主动检查执行时间，及时中断
+                if time.time() - start_time > TIMEOUT_SECONDS:
+                    logger.error(f"Agent execution timeout after {TIMEOUT_SECONDS}s for run_id: {ctx.run_id}")
+                    if cancel_token is not None:
+                        cancel_token.cancel(CANCEL_REASON_TIMEOUT)
+                    yield create_message_end_dict(
+                        code="TIMEOUT",
+                        message=f"Execution timeout: exceeded {TIMEOUT_SECONDS} seconds",
+                        session_id=client_msg.session_id,
+                        query_msg_id=client_msg.local_msg_id,
+                        log_id=ctx.logid,
+                        time_cost_ms=int((time.time() - start_time) * 1000),
+                        reply_id=getattr(sm, 'reply_id', ''),
+                        sequence_id=last_seq + 1,
+                    )
+                    return
+                yield sm
+                last_seq = sm.sequence_id
         except asyncio.CancelledError:
             logger.info(f"Stream cancelled for run_id: {ctx.run_id}")
             raise
+        except Exception as ex:
+            # 使用错误分类器获取错误码
+            err = self.error_classifier.classify(ex, {"node_name": "astream"})
+            yield create_message_end_dict(
+                code=str(err.code),
+                message=err.message,
+                session_id=client_msg.session_id,
+                query_msg_id=client_msg.local_msg_id,
+                log_id=ctx.logid,
+                time_cost_ms=int((time.time() - start_time) * 1000),
+                reply_id="",
+                sequence_id=last_seq + 1,
+            )
+        finally:
+            # 显式关闭上游迭代器，让图执行（或工作线程）尽快停止
+            await server_msgs_iter.aclose()
+            aclose = getattr(items, "aclose", None)
+            if aclose is not None:
+                await aclose()
 
 
 service = GraphService()
 app = FastAPI()
+# 请求量与耗时：按路由模板统计，流式响应按整个流的时长
+app.add_middleware(MetricsMiddleware, routes=("/run", "/stream_run", "/node_run/{node_id}"))
+
+
+@app.on_event("shutdown")
+async def flush_log_writers():
+    # prefork worker 通过 os._exit 退出，不会执行 atexit，需在这里写完剩余的节点日志和 trace
+    close_log_writers()
+    close_trace_flusher()
+
+
+@app.on_event("startup")
+async def start_cancel_forwarding():
+    # 多 worker 模式：轮询其他 worker 转发过来的取消请求
+    registry = get_run_registry()
+    if registry is not None:
+        app.state.cancel_poller = asyncio.create_task(
+            registry.poll_cancels(lambda run_id, reason: service.cancel_run(run_id, reason=reason))
+        )
 
 
 @app.post("/run")
@@ -334,25 +471,44 @@ async def http_run(request: Request) -> Dict[str, Any]:
     ctx = new_context(method="run", headers=request.headers)
     run_id = ctx.run_id
     request_context.set(ctx)
+    # X-Chrome-Trace: 1 时导出本次 run 的 Chrome trace
+    chrome_trace_requested.set(header_requested(request.headers))
 
     logger.info(
         f"Received request for /run: "
         f"run_id={run_id}, "
         f"query={dict(request.query_params)}, "
-        f"body={body_text}"
+        f"body={body_preview(raw_body)}"
     )
 
+    idem_key = None
+    ticket = None
     try:
-        payload = await request.json()
+        payload = codec.loads(raw_body)
+
+        # 幂等键：相同请求执行中则附着到原任务，已完成则直接返回缓存结果
+        idem_key = idempotency_key(request.headers, "run", payload)
+        if idem_key is not None:
+            entry = idempotency_registry.lookup(idem_key)
+            if entry is not None:
+                attached = await _attach_run(entry)
+                if attached is not None:
+                    return attached
+            idempotency_registry.register(idem_key, run_id)
+
+        ticket = await _admit("run", ctx, payload)
 
         # 创建任务并记录 - 这是关键，让我们可以通过run_id取消任务
         task = asyncio.create_task(service.run(payload, ctx))
-        service.running_tasks[run_id] = task
+        service.track_task(run_id, task)
+        if idem_key is not None:
+            idempotency_registry.mark_started(idem_key, run_id)
 
         try:
             result = await asyncio.wait_for(task, timeout=float(TIMEOUT_SECONDS))
         except asyncio.TimeoutError:
             logger.error(f"Run execution timeout after {TIMEOUT_SECONDS}s for run_id: {run_id}")
+            service.signal_cancel(run_id, CANCEL_REASON_TIMEOUT)
             task.cancel()
             try:
                 result = await task
@@ -367,12 +523,18 @@ async def http_run(request: Request) -> Dict[str, Any]:
             result = {}
         if isinstance(result, dict):
             result["run_id"] = run_id
+            # 只缓存成功结果；错误/取消结果由 finally 中的 release 删除键，重试重新执行
+            if idem_key is not None and result.get("status", "success") == "success":
+                idempotency_registry.complete(idem_key, run_id, result)
         return result
 
-    except json.JSONDecodeError as e:
+    except codec.JSONDecodeError as e:
         logger.error(f"JSON decode error in http_run: {e}, traceback: {traceback.format_exc()}")
         raise HTTPException(status_code=400, detail=f"Invalid JSON format, {extract_core_stack()}")
 
+    except HTTPException:
+        raise
+
     except asyncio.CancelledError:
         logger.info(f"Request cancelled for run_id: {run_id}")
         result = {"status": "cancelled", "run_id": run_id, "message": "Execution was cancelled"}
@@ -394,13 +556,76 @@ async def http_run(request: Request) -> Dict[str, Any]:
             }
         )
     finally:
-        cozeloop.flush()
+        if ticket is not None:
+            ticket.release()
+        if idem_key is not None:
+            idempotency_registry.release(idem_key, run_id)
+        get_trace_flusher().finish(run_id)
+
+
+async def _admit(endpoint: str, ctx: Context, payload: Any) -> Optional[AdmissionTicket]:
+    """按端点和 project_id 申请准入，超出容量时返回 429 + Retry-After"""
+    if not ADMISSION_ENABLED:
+        return None
+    project_id = ctx.project_id or (payload.get("project_id", "") if isinstance(payload, dict) else "")
+    try:
+        return await get_admission_controller().acquire(endpoint, project_id or "")
+    except AdmissionRejected as e:
+        raise HTTPException(
+            status_code=429,
+            detail={"message": "Server is busy, retry later", "endpoint": e.endpoint, "reason": e.reason},
+            headers={"Retry-After": str(e.retry_after)},
+        )
+
+
+async def _attach_run(entry: IdempotencyEntry) -> Optional[Dict[str, Any]]:
+    """
+    返回幂等键对应的已缓存结果，或等待执行中的原任务（shield 保护，重复请求断开不影响原任务）；
+    原任务仍在准入排队时先等待其开始；原任务未能开始或已不在 running_tasks 中时返回 None，按新请求执行
+    """
+    if not await entry.wait_started(float(TIMEOUT_SECONDS)):
+        return None
+    if entry.finished:
+        if not entry.has_result:
+            return None
+        logger.info(f"Idempotent replay of completed run_id: {entry.run_id}")
+        return dict(entry.result) if isinstance(entry.result, dict) else entry.result
+
+    task = service.running_tasks.get(entry.run_id)
+    if task is None:
+        return None
+    logger.info(f"Attaching duplicate request to in-flight run_id: {entry.run_id}")
+    try:
+        result = await asyncio.wait_for(asyncio.shield(task), timeout=float(TIMEOUT_SECONDS))
+    except asyncio.TimeoutError:
+        return {
+            "status": "timeout",
+            "run_id": entry.run_id,
+            "message": f"Execution timeout: exceeded {TIMEOUT_SECONDS} seconds"
+        }
+    except asyncio.CancelledError:
+        if not task.cancelled():
+            raise
+        return {"status": "cancelled", "run_id": entry.run_id, "message": "Execution was cancelled"}
+    result = dict(result) if isinstance(result, dict) else (result or {})
+    if isinstance(result, dict):
+        result["run_id"] = entry.run_id
+    return result
 
 
 @app.post("/stream_run")
 async def http_stream_run(request: Request):
     ctx = new_context(method="stream_run", headers=request.headers)
     request_context.set(ctx)
+    # X-Chrome-Trace: 1 时导出本次 run 的 Chrome trace
+    chrome_trace_requested.set(header_requested(request.headers))
+
+    # 断线重连：携带 Last-Event-ID 时从回放缓冲区续传，不重新执行
+    if SSE_REPLAY_ENABLED:
+        resumed = _resume_stream(request)
+        if resumed is not None:
+            return resumed
+
     raw_body = await request.body()
     try:
         body_text = raw_body.decode("utf-8")
@@ -414,29 +639,57 @@ async def http_stream_run(request: Request):
         f"Received request for /stream_run: "
         f"run_id={run_id}, "
         f"query={dict(request.query_params)}, "
-        f"body={body_text}"
+        f"body={body_preview(raw_body)}"
     )
 
     try:
-        payload = await request.json()
-    except json.JSONDecodeError as e:
+        payload = codec.loads(raw_body)
+    except codec.JSONDecodeError as e:
         logger.error(f"JSON decode error in http_stream_run: {e}, traceback: {traceback.format_exc()}")
         raise HTTPException(status_code=400, detail=f"Invalid JSON format:{extract_core_stack()}")
 
+    # 默认 SSE；内部消费者可通过 Accept: application/x-msgpack 获取长度前缀的 msgpack 帧
+    wire = codec.select_wire(request.headers.get("accept"))
+
+    # 幂等键：相同请求执行中（或已完成且回放缓冲区仍在）则订阅原 run 的事件流
+    idem_key = idempotency_key(request.headers, "stream_run", payload)
+    if idem_key is not None:
+        entry = idempotency_registry.lookup(idem_key)
+        if entry is not None:
+            attached = await _attach_stream(entry)
+            if attached is not None:
+                return attached
+        idempotency_registry.register(idem_key, run_id)
+
+    try:
+        # 流式响应在生成器结束时才归还槽位
+        ticket = await _admit("stream_run", ctx, payload)
+    except HTTPException:
+        if idem_key is not None:
+            idempotency_registry.release(idem_key, run_id)
+        raise
+    if idem_key is not None and not SSE_REPLAY_ENABLED:
+        idempotency_registry.mark_started(idem_key, run_id)
+
     # 包装stream_sse为可取消的任务
     async def cancellable_stream():
         # 将真正的流式任务登记到 running_tasks，确保 /cancel 能定位到它
         task = asyncio.current_task()
         if task:
-            service.running_tasks[run_id] = task
+            service.track_task(run_id, task)
             logger.info(f"Registered streaming task for run_id: {run_id}")
 
         client_msg, _ = to_client_message(payload)
         t0 = time.time()
 
+        end_code = None
         try:
-            async for chunk in service.stream_sse(payload, ctx):
+            async for chunk in service.stream_events(payload, ctx):
+                end_code = message_end_code(chunk)
                 yield chunk
+            # 只有以成功的 message_end 结束才保留幂等键；超时/错误结束由 finally 中的 release 删除
+            if idem_key is not None and end_code == MESSAGE_END_CODE_SUCCESS:
+                idempotency_registry.complete(idem_key, run_id)
         except asyncio.CancelledError:
             logger.info(f"Stream cancelled for run_id: {run_id}")
             end_msg = create_message_end_dict(
@@ -449,7 +702,7 @@ async def http_stream_run(request: Request):
                 reply_id="",
                 sequence_id=1,
             )
-            yield service._sse_event(end_msg)
+            yield end_msg
             raise
         except Exception as ex:
             # 使用错误分类器获取错误码
@@ -468,12 +721,107 @@ async def http_stream_run(request: Request):
                 sequence_id=1,
                 local_msg_id=client_msg.local_msg_id,
             )
-            yield service._sse_event(error_msg)
+            yield error_msg
+        finally:
+            if ticket is not None:
+                ticket.release()
+            if idem_key is not None:
+                idempotency_registry.release(idem_key, run_id)
+
+    if SSE_REPLAY_ENABLED:
+        # 执行放到后台任务并写入回放缓冲区，响应只是缓冲区的一个订阅者，
+        # 客户端断开后执行继续，grace 时间内无人重连才取消
+        buffer = replay_registry.create(run_id, wire, on_expired=lambda rid: service.cancel_run(rid, reason=CANCEL_REASON_DISCONNECT))
+        if idem_key is not None:
+            idempotency_registry.mark_started(idem_key, run_id)
+
+        async def pump():
+            try:
+                async for chunk in cancellable_stream():
+                    buffer.append(chunk)
+            finally:
+                buffer.finish()
+                if ticket is not None:
+                    ticket.release()
+
+        task = asyncio.create_task(pump())
+        _replay_pumps.add(task)
+        task.add_done_callback(_replay_pumps.discard)
+        return StreamingResponse(
+            buffer.subscribe(), media_type=wire.media_type, headers={RUN_ID_HEADER: run_id}
+        )
 
+    async def framed_stream():
+        chunks = cancellable_stream()
+        try:
+            async for chunk in chunks:
+                yield wire.frame(chunk)
+        finally:
+            await chunks.aclose()
+            # 生成器未启动即被关闭时 cancellable_stream 的 finally 不会执行
+            if ticket is not None:
+                ticket.release()
+            if idem_key is not None:
+                idempotency_registry.release(idem_key, run_id)
+
+    stream = framed_stream()
+    if idem_key is not None:
+        # 响应未开始发送即被丢弃时生成器不会运行，其 finally 不会释放幂等键；回收时兜底删除
+        weakref.finalize(stream, idempotency_registry.release, idem_key, run_id)
     # 注意：StreamingResponse会在后台运行generator
-    response = StreamingResponse(cancellable_stream(), media_type="text/event-stream")
+    response = StreamingResponse(stream, media_type=wire.media_type)
     return response
 
+
+async def _attach_stream(entry: IdempotencyEntry) -> Optional[StreamingResponse]:
+    """
+    开启续传时从头订阅原 run 的回放缓冲区；未开启续传时无法共享执行中的流，返回 409。
+    原请求仍在准入排队时先等待其开始，未能开始时返回 None，按新请求执行。
+    未开启续传时原请求通过准入后、响应生成器登记任务前 running_tasks 中还没有该 run，
+    因此只看幂等条目是否结束：未结束的键在流结束（或生成器被回收）时才会 release
+    """
+    if not await entry.wait_started(float(TIMEOUT_SECONDS)):
+        return None
+    buffer = replay_registry.get(entry.run_id) if SSE_REPLAY_ENABLED else None
+    if buffer is not None:
+        logger.info(f"Attaching duplicate stream request to run_id: {entry.run_id}")
+        return StreamingResponse(
+            buffer.subscribe(), media_type=buffer.wire.media_type, headers={RUN_ID_HEADER: entry.run_id}
+        )
+    if not entry.finished:
+        raise HTTPException(
+            status_code=409,
+            detail={"message": "A request with the same idempotency key is in progress", "run_id": entry.run_id},
+        )
+    return None
+
+
+def _resume_stream(request: Request) -> Optional[StreamingResponse]:
+    """
+    Last-Event-ID 为 "<run_id>:<seq>"，或纯 seq 配合 run_id 查询参数 / X-Run-Id 头；
+    缓冲区不存在或已淘汰所需事件时返回 None，按新请求执行
+    """
+    last_event_id = request.headers.get("last-event-id")
+    if not last_event_id:
+        return None
+    run_id = request.query_params.get("run_id") or request.headers.get(RUN_ID_HEADER)
+    parsed = parse_last_event_id(last_event_id, run_id)
+    if parsed is None:
+        logger.warning(f"Invalid Last-Event-ID: {last_event_id}")
+        return None
+    run_id, after_id = parsed
+    buffer = replay_registry.get(run_id)
+    if buffer is None:
+        logger.info(f"No replay buffer for run_id: {run_id}, starting a new run")
+        return None
+    if not buffer.can_resume_from(after_id):
+        logger.info(f"Replay buffer for run_id: {run_id} no longer holds events after {after_id}, starting a new run")
+        return None
+    logger.info(f"Resuming stream for run_id: {run_id} after event {after_id}")
+    return StreamingResponse(
+        buffer.subscribe(after_id), media_type=buffer.wire.media_type, headers={RUN_ID_HEADER: run_id}
+    )
+
 @app.post("/cancel/{run_id}")
 async def http_cancel(run_id: str, request: Request):
     """
@@ -499,17 +847,20 @@ async def http_node_run(node_id: str, request: Request):
         raise HTTPException(status_code=400, detail=f"Invalid JSON format: {body_text}")
     ctx = new_context(method="node_run", headers=request.headers)
     request_context.set(ctx)
+    # X-Chrome-Trace: 1 时导出本次 run 的 Chrome trace
+    chrome_trace_requested.set(header_requested(request.headers))
     logger.info(
         f"Received request for /node_run/{node_id}: "
         f"query={dict(request.query_params)}, "
-        f"body={body_text}",
+        f"body={body_preview(raw_body)}",
     )
 
     try:
-        payload = await request.json()
-    except json.JSONDecodeError as e:
+        payload = codec.loads(raw_body)
+    except codec.JSONDecodeError as e:
         logger.error(f"JSON decode error in http_node_run: {e}, traceback: {traceback.format_exc()}")
         raise HTTPException(status_code=400, detail=f"Invalid JSON format:{extract_core_stack()}")
+    ticket = await _admit("node_run", ctx, payload)
     try:
         return await service.run_node(node_id, payload, ctx)
     except KeyError:
@@ -531,7 +882,9 @@ async def http_node_run(node_id: str, request: Request):
             }
         )
     finally:
-        cozeloop.flush()
+        if ticket is not None:
+            ticket.release()
+        get_trace_flusher().finish(ctx.run_id)
 
 
 @app.get("/health")
@@ -546,6 +899,98 @@ async def health_check():
         raise HTTPException(status_code=503, detail=str(e))
 
 
+@app.get("/admission")
+async def http_admission_stats():
+    """准入控制状态：各端点并发、排队数、拒绝次数与排队等待时间"""
+    return get_admission_controller().stats()
+
+
+def _collect_service_metrics():
+    """抓取时读取各组件已有的统计，转换为 (指标名, 类型, 样本) 列表"""
+    families = [
+        ("running_tasks", GAUGE, [("", {}, len(service.running_tasks))]),
+    ]
+
+    pool = get_stream_pool().stats()
+    families.append(("stream_pool_workers", GAUGE, [
+        ("", {"state": "active"}, pool["active"]),
+        ("", {"state": "pending"}, pool["pending"]),
+        ("", {"state": "max"}, pool["max_workers"]),
+    ]))
+    families.append(("stream_pool_streams", GAUGE, [("", {}, pool["streams"])]))
+    families.append(("stream_queue_depth", GAUGE, [("", {}, pool["queued_items"])]))
+    families.append(("stream_pool_completed_total", COUNTER, [("", {}, pool["completed"])]))
+
+    admission = get_admission_controller().stats()["endpoints"]
+    families.append(("admission_active", GAUGE, [("", {"endpoint": ep}, s["active"]) for ep, s in admission.items()]))
+    families.append(("admission_queued", GAUGE, [("", {"endpoint": ep}, s["queued"]) for ep, s in admission.items()]))
+    families.append(("admission_admitted_total", COUNTER,
+                     [("", {"endpoint": ep}, s["admitted"]) for ep, s in admission.items()]))
+    families.append(("admission_rejected_total", COUNTER, [
+        ("", {"endpoint": ep, "reason": reason}, count)
+        for ep, s in admission.items() for reason, count in s["rejected"].items()
+    ]))
+
+    cancellations = get_cancellation_stats().to_dict()
+    families.append(("cancellations_total", COUNTER,
+                     [("", {"reason": reason}, count) for reason, count in cancellations["cancellations"].items()]))
+    families.append(("cancelled_tokens_avoided_total", COUNTER, [("", {}, cancellations["tokens_avoided"])]))
+
+    errors = service.error_classifier.get_stats()
+    families.append(("errors_total", COUNTER,
+                     [("", {"category": category}, count) for category, count in errors.by_category.items()]))
+
+    families.append(("idempotency_lookups_total", COUNTER,
+                     [("", {"result": key}, value) for key, value in idempotency_registry.stats.to_dict().items()]))
+    families.append(("checkpointer_pool", GAUGE,
+                     [("", {"stat": key}, value) for key, value in get_checkpointer_pool_stats().items()]))
+
+    logging_stats = get_logging_stats()
+    families.append(("logging_queue_depth", GAUGE, [("", {}, logging_stats["queued"])]))
+    families.append(("logging_dropped_total", COUNTER, [("", {}, logging_stats["dropped"])]))
+    writers = get_log_writer_stats()
+    families.append(("node_log_queue_depth", GAUGE, [("", {"path": path}, w["queued"]) for path, w in writers.items()]))
+    families.append(("node_log_written_total", COUNTER, [("", {"path": path}, w["written"]) for path, w in writers.items()]))
+    families.append(("node_log_dropped_total", COUNTER, [("", {"path": path}, w["dropped"]) for path, w in writers.items()]))
+
+    sinks = get_sink_stats()
+    families.append(("log_rotations_total", COUNTER, [("", {"path": path}, v["rotations"]) for path, v in sinks.items()]))
+    families.append(("log_compress_pending", GAUGE,
+                     [("", {"path": path}, v["compress_pending"]) for path, v in sinks.items()]))
+
+    traces = get_trace_flusher().snapshot()
+    families.append(("traces_total", COUNTER, [
+        ("", {"result": key}, traces[key]) for key in ("sampled", "unsampled", "dropped")
+    ]))
+    families.append(("trace_flush_errors_total", COUNTER, [("", {}, traces["flush_errors"])]))
+
+    attachment_cache = get_attachment_cache()
+    if attachment_cache is not None:
+        families.append(("attachment_cache_total", COUNTER,
+                         [("", {"result": key}, value) for key, value in attachment_cache.snapshot().items()]))
+    parser_pool = get_parser_pool()
+    if parser_pool is not None:
+        parsers = parser_pool.snapshot()
+        families.append(("parser_workers", GAUGE, [
+            ("", {"state": state}, parsers[state]) for state in ("idle", "busy", "max_workers")
+        ]))
+        families.append(("parser_events_total", COUNTER, [
+            ("", {"event": event}, parsers[event]) for event in ("jobs", "spawned", "recycled", "timeouts", "crashes")
+        ]))
+    return families
+
+
+get_metrics().register_collector(_collect_service_metrics)
+
+
+@app.get("/metrics")
+async def http_metrics():
+    """Prometheus 文本格式的运行指标（当前 worker 进程）"""
+    if not METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Metrics disabled")
+    return PlainTextResponse(get_metrics().render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 @app.get(path="/graph_parameter")
 async def http_graph_inout_parameter(request: Request):
     return service.graph_inout_schema()
@@ -556,6 +1001,8 @@ def parse_args():
     parser.add_argument("-n", type=str, default="", help="Node ID for single node run")
     parser.add_argument("-p", type=int, default=5000, help="HTTP server port")
     parser.add_argument("-i", type=str, default="", help="Input JSON string for flow/node mode")
+    parser.add_argument("-w", type=int, default=None,
+                        help="HTTP worker processes (default: HTTP_WORKERS env or 1, 0 = CPU count)")
     return parser.parse_args()
 
 
@@ -571,19 +1018,29 @@ def parse_input(input_str: str) -> Dict[str, Any]:
         # If not valid JSON, treat as plain text
         return {"text": input_str}
 
-def start_http_server(port):
-    workers = 1
+def start_http_server(port, workers=None):
+    workers = resolve_workers(workers)
     reload = False
     if graph_helper.is_dev_env():
         reload = True
+        workers = 1
 
     logger.info(f"Start HTTP Server, Port: {port}, Workers: {workers}")
-    uvicorn.run("main:app", host="0.0.0.0", port=port, reload=reload, workers=workers)
+    if workers == 1:
+        uvicorn.run("main:app", host="0.0.0.0", port=port, reload=reload, workers=workers)
+        return
+
+    # 预派生多 worker：父进程预加载后 fork，跨 worker 取消通过 run 登记表转发
+    registry = enable_run_registry()
+    register_worker_exit(registry.purge_worker)
+    register_post_fork(reinit_tracer)
+    service.preload()
+    serve_prefork(app, "0.0.0.0", port, workers)
 
 if __name__ == "__main__":
     args = parse_args()
     if args.m == "http":
-        start_http_server(args.p)
+        start_http_server(args.p, args.w)
     elif args.m == "flow":
         payload = parse_input(args.i)
         result = asyncio.run(service.run(payload))
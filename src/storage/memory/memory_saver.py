@@ -1,6 +1,6 @@
 from langgraph.checkpoint.memory import MemorySaver
 from langgraph.checkpoint.base import BaseCheckpointSaver
-from typing import Optional, Union
+from typing import Dict, Optional, Union
 import logging
 import time
 
@@ -134,6 +134,17 @@ class MemoryManager:
 
         return self._checkpointer
 
+    def pool_stats(self) -> Dict[str, int]:
+        """连接池统计（psycopg_pool 的 get_stats），未使用连接池时返回空"""
+        get_stats = getattr(self._pool, "get_stats", None)
+        if get_stats is None:
+            return {}
+        try:
+            return dict(get_stats())
+        except Exception as e:
+            logger.warning(f"Failed to get checkpointer pool stats: {e}")
+            return {}
+
 _memory_manager: Optional[MemoryManager] = None
 
 
@@ -142,4 +153,10 @@ def get_memory_saver() -> BaseCheckpointSaver:
     global _memory_manager
     if _memory_manager is None:
         _memory_manager = MemoryManager()
-    return _memory_manager.get_checkpointer()
\ No newline at end of file
+    return _memory_manager.get_checkpointer()
+
+
+def get_checkpointer_pool_stats() -> Dict[str, int]:
+    if _memory_manager is None:
+        return {}
+    return _memory_manager.pool_stats()
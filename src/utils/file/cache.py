@@ -0,0 +1,361 @@
+"""
+附件本地缓存
+
+同一批产品文档、截图会在不同会话中反复上传，每次都重新下载、重新解析。这里：
+- 原始内容按 sha256 存放（内容寻址），相同内容只存一份
+- URL 映射到内容摘要，同时记录 ETag / Last-Modified；再次请求时发条件 GET，304 直接复用本地内容
+- 提取出的文本按 内容摘要 + 解析方式 缓存，不同 URL 的相同文件也只解析一次
+- 元数据放在本机 SQLite（WAL），多 worker 共享；按最近访问时间淘汰，总大小不超过 ATTACHMENT_CACHE_MAX_BYTES
+- 下载使用进程内共享的 requests.Session，复用连接池
+缓存读写失败时只记录日志并按未命中处理，不影响附件读取
+"""
+import hashlib
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, Iterable, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+ATTACHMENT_CACHE_ENABLED = os.getenv("ATTACHMENT_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+ATTACHMENT_CACHE_DIR = os.getenv(
+    "ATTACHMENT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "demand_agent_attachments")
+)
+ATTACHMENT_CACHE_MAX_BYTES = int(os.getenv("ATTACHMENT_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))
+# 在该时长内命中的 URL 不再发条件请求，0 表示每次都重新验证
+ATTACHMENT_CACHE_FRESH_SECONDS = float(os.getenv("ATTACHMENT_CACHE_FRESH_SECONDS", "0"))
+ATTACHMENT_HTTP_POOL_SIZE = int(os.getenv("ATTACHMENT_HTTP_POOL_SIZE", "16"))
+
+# SQLite 锁等待上限（毫秒）
+_BUSY_TIMEOUT_MS = 1000
+
+KIND_BLOB = "blob"
+KIND_TEXT = "text"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS urls (
+    url TEXT PRIMARY KEY,
+    digest TEXT NOT NULL,
+    etag TEXT,
+    last_modified TEXT,
+    validated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS objects (
+    key TEXT PRIMARY KEY,
+    digest TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS objects_access ON objects(last_access);
+"""
+
+
+@dataclass
+class UrlEntry:
+    url: str
+    digest: str
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    validated_at: float = 0.0
+
+    def is_fresh(self) -> bool:
+        return ATTACHMENT_CACHE_FRESH_SECONDS > 0 and time.time() - self.validated_at < ATTACHMENT_CACHE_FRESH_SECONDS
+
+    def conditional_headers(self) -> Dict[str, str]:
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+    @property
+    def has_validator(self) -> bool:
+        return bool(self.etag or self.last_modified)
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    revalidated: int = 0
+    text_hits: int = 0
+    text_misses: int = 0
+    evicted: int = 0
+    errors: int = 0
+
+
+def content_digest(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+
+class _Source:
+    """包装写入的数据来源，记录异常是否由来源（而非缓存写入）抛出"""
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self._chunks = chunks
+        self.failed = False
+
+    def __iter__(self):
+        try:
+            yield from self._chunks
+        except BaseException:
+            self.failed = True
+            raise
+
+
+def _unlink(path: str):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+class AttachmentCache:
+    def __init__(self, root: str = ATTACHMENT_CACHE_DIR, max_bytes: int = ATTACHMENT_CACHE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.stats = CacheStats()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._conn_pid = 0
+        self._lock = threading.Lock()
+
+    def _db(self) -> sqlite3.Connection:
+        # 连接不能跨 fork 使用，按进程惰性创建
+        pid = os.getpid()
+        if self._conn is None or self._conn_pid != pid:
+            os.makedirs(self.root, exist_ok=True)
+            conn = sqlite3.connect(
+                os.path.join(self.root, "index.db"), timeout=_BUSY_TIMEOUT_MS / 1000.0, isolation_level=None,
+                check_same_thread=False,
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SCHEMA)
+            self._conn = conn
+            self._conn_pid = pid
+        return self._conn
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key)
+
+    def blob_path(self, digest: str) -> str:
+        return self._path(digest)
+
+    # URL -> 内容摘要
+
+    def lookup(self, url: str) -> Optional[UrlEntry]:
+        try:
+            with self._lock:
+                row = self._db().execute(
+                    "SELECT digest, etag, last_modified, validated_at FROM urls WHERE url = ?", (url,)
+                ).fetchone()
+        except sqlite3.Error as e:
+            self._error("lookup", e)
+            return None
+        if row is None or not os.path.exists(self.blob_path(row[0])):
+            self.stats.misses += 1
+            return None
+        return UrlEntry(url, *row)
+
+    def bind_url(self, url: str, digest: str, etag: Optional[str], last_modified: Optional[str]):
+        try:
+            with self._lock:
+                self._db().execute(
+                    "INSERT OR REPLACE INTO urls (url, digest, etag, last_modified, validated_at) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (url, digest, etag, last_modified, time.time()),
+                )
+        except sqlite3.Error as e:
+            self._error("bind_url", e)
+
+    def touch_url(self, url: str):
+        """条件请求返回 304 后更新验证时间"""
+        self.stats.revalidated += 1
+        try:
+            with self._lock:
+                self._db().execute("UPDATE urls SET validated_at = ? WHERE url = ?", (time.time(), url))
+        except sqlite3.Error as e:
+            self._error("touch_url", e)
+
+    # 内容寻址的原始内容与提取文本
+
+    def read_blob(self, digest: str) -> Optional[bytes]:
+        data = self._read(digest)
+        if data is None:
+            self.stats.misses += 1
+        else:
+            self.stats.hits += 1
+        return data
+
+    def put_blob(self, content: bytes) -> str:
+        digest = content_digest(content)
+        self._write(digest, digest, KIND_BLOB, [content])
+        return digest
+
+    def put_blob_stream(self, chunks: Iterable[bytes]) -> str:
+        """边下载边写入并计算摘要，用于不需要整体读入内存的大文件"""
+        hasher = hashlib.sha256()
+
+        def hashed():
+            for chunk in chunks:
+                if chunk:
+                    hasher.update(chunk)
+                    yield chunk
+
+        return self._write(None, None, KIND_BLOB, hashed(), hasher=hasher)
+
+    def get_text(self, digest: str, parser: str) -> Optional[str]:
+        data = self._read(f"{digest}.{parser}")
+        if data is None:
+            self.stats.text_misses += 1
+            return None
+        self.stats.text_hits += 1
+        return data.decode("utf-8")
+
+    def put_text(self, digest: str, parser: str, text: str):
+        self._write(f"{digest}.{parser}", digest, KIND_TEXT, [text.encode("utf-8")])
+
+    def _read(self, key: str) -> Optional[bytes]:
+        try:
+            with open(self._path(key), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            self._error("read", e)
+            return None
+        try:
+            with self._lock:
+                self._db().execute("UPDATE objects SET last_access = ? WHERE key = ?", (time.time(), key))
+        except sqlite3.Error as e:
+            self._error("touch", e)
+        return data
+
+    def _write(self, key: Optional[str], digest: Optional[str], kind: str, chunks: Iterable[bytes],
+               hasher=None) -> Optional[str]:
+        """
+        写临时文件后改名，多进程同时写入同一内容时结果一致；key 为 None 时以内容摘要为 key。
+        chunks 抛出的异常（如下载失败）原样向上抛出；缓存自身的读写失败只记录日志并返回 None
+        """
+        source = _Source(chunks)
+        tmp = path = None
+        created = False
+        try:
+            os.makedirs(self.root, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.root, prefix=".tmp-")
+            size = 0
+            with os.fdopen(fd, "wb") as f:
+                for chunk in source:
+                    f.write(chunk)
+                    size += len(chunk)
+            if key is None:
+                key = digest = hasher.hexdigest()
+            path = self._path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            created = not os.path.exists(path)
+            os.replace(tmp, path)
+            tmp = None
+            with self._lock:
+                self._db().execute(
+                    "INSERT OR REPLACE INTO objects (key, digest, kind, size, last_access) VALUES (?, ?, ?, ?, ?)",
+                    (key, digest, kind, size, time.time()),
+                )
+        except BaseException as e:
+            if tmp is not None:
+                _unlink(tmp)
+            elif created:
+                # 文件已改名到位但未登记，不会被淘汰，删除以免占用空间
+                _unlink(path)
+            if source.failed or not isinstance(e, (OSError, sqlite3.Error)):
+                raise
+            self._error("write", e)
+            return None
+        try:
+            self._evict()
+        except (OSError, sqlite3.Error) as e:
+            self._error("evict", e)
+        return key
+
+    def _evict(self):
+        """按最近访问时间淘汰，直到总大小不超过上限；原始内容被淘汰时一并删除指向它的 URL 映射，提取文本按自身的访问时间淘汰"""
+        if self.max_bytes <= 0:
+            return
+        with self._lock:
+            db = self._db()
+            total = db.execute("SELECT COALESCE(SUM(size), 0) FROM objects").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            rows = db.execute("SELECT key, digest, kind, size FROM objects ORDER BY last_access").fetchall()
+            removed = []
+            for key, digest, kind, size in rows:
+                if total <= self.max_bytes:
+                    break
+                removed.append(key)
+                total -= size
+                if kind == KIND_BLOB:
+                    db.execute("DELETE FROM urls WHERE digest = ?", (digest,))
+            db.executemany("DELETE FROM objects WHERE key = ?", [(key,) for key in removed])
+        for key in removed:
+            try:
+                os.unlink(self._path(key))
+            except FileNotFoundError:
+                pass
+        self.stats.evicted += len(removed)
+
+    def _error(self, op: str, e: Exception):
+        self.stats.errors += 1
+        logger.warning(f"Attachment cache {op} failed: {e}")
+
+    def snapshot(self) -> Dict[str, int]:
+        s = self.stats
+        return {
+            "hits": s.hits, "misses": s.misses, "revalidated": s.revalidated,
+            "text_hits": s.text_hits, "text_misses": s.text_misses,
+            "evicted": s.evicted, "errors": s.errors,
+        }
+
+
+_cache: Optional[AttachmentCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_attachment_cache() -> Optional[AttachmentCache]:
+    """获取附件缓存，ATTACHMENT_CACHE_ENABLED=false 时返回 None"""
+    global _cache
+    if not ATTACHMENT_CACHE_ENABLED:
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = AttachmentCache()
+    return _cache
+
+
+_session: Optional[requests.Session] = None
+_session_pid = 0
+_session_lock = threading.Lock()
+
+
+def get_http_session() -> requests.Session:
+    """进程内共享的下载会话，连接池大小与附件并发数匹配（fork 出的 worker 重新创建）"""
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        with _session_lock:
+            if _session is None or _session_pid != os.getpid():
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=ATTACHMENT_HTTP_POOL_SIZE,
+                                      pool_maxsize=ATTACHMENT_HTTP_POOL_SIZE)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                _session = session
+                _session_pid = os.getpid()
+    return _session
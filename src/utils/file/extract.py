@@ -0,0 +1,162 @@
+"""
+按预算流式提取文档文本
+
+原实现一次性提取 PDF 的全部页面（逐页字符串拼接，长文档为平方复杂度），而大部分内容最终放不进 prompt。这里：
+- PDF 按页、DOCX 按段落逐块产出文本，达到字符/token 预算后立即停止，不再解析后续页面
+- 结果用列表拼接，耗时与实际使用的内容成正比
+- 截断时在文本末尾注明已提取的范围（如 12/80 页），模型和日志都能看到哪些内容被省略
+预算由 ATTACHMENT_MAX_CHARS / ATTACHMENT_MAX_TOKENS 配置，0 表示不限制；
+token 数优先用 tiktoken 计算，不可用时按 CJK 字符 1 token、其他字符 4 个 1 token 估算
+"""
+import os
+import re
+import zipfile
+from dataclasses import dataclass
+from typing import IO, Iterable, Iterator, Optional
+from xml.etree import ElementTree
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+ATTACHMENT_MAX_CHARS = int(os.getenv("ATTACHMENT_MAX_CHARS", "100000"))
+ATTACHMENT_MAX_TOKENS = int(os.getenv("ATTACHMENT_MAX_TOKENS", "0"))
+
+TRUNCATION_PREFIX = "[内容已截断"
+
+_W_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_CJK_RE = re.compile(r"[　-〿㐀-䶿一-鿿＀-￯]")
+
+_encoding = None
+_encoding_loaded = False
+
+
+def _get_encoding():
+    """tiktoken 编码首次使用时可能需要联网下载，失败后退回估算"""
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        _encoding_loaded = True
+        if tiktoken is not None:
+            try:
+                _encoding = tiktoken.get_encoding("cl100k_base")
+            except Exception:
+                _encoding = None
+    return _encoding
+
+
+def count_tokens(text: str) -> int:
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+@dataclass
+class TextBudget:
+    max_chars: int = ATTACHMENT_MAX_CHARS
+    max_tokens: int = ATTACHMENT_MAX_TOKENS
+
+    @property
+    def key(self) -> str:
+        """参与提取文本缓存的 key，预算不同的结果分开缓存"""
+        return f"c{self.max_chars}t{self.max_tokens}"
+
+
+@dataclass
+class Extracted:
+    text: str
+    truncated: bool = False
+    units_read: int = 0
+    units_total: Optional[int] = None
+    unit: str = "段"
+
+    def render(self) -> str:
+        if not self.truncated:
+            return self.text
+        if self.units_total is not None:
+            scope = f"已提取 {self.units_read}/{self.units_total} {self.unit}"
+        else:
+            scope = f"已提取前 {self.units_read} {self.unit}"
+        return f"{self.text}\n\n{TRUNCATION_PREFIX}：{scope}，共 {len(self.text)} 字符，其余内容未读取]"
+
+
+def take_within_budget(chunks: Iterable[str], budget: TextBudget, unit: str = "段",
+                       units_total: Optional[int] = None, separator: str = "\n") -> Extracted:
+    """依次消费 chunks，预算用完后停止迭代（不再生成后续块）；最后一块按剩余额度截取"""
+    parts = []
+    chars = tokens = read = 0
+    truncated = False
+    iterator = iter(chunks)
+    for chunk in iterator:
+        if not chunk:
+            read += 1
+            continue
+        if (budget.max_chars > 0 and chars >= budget.max_chars) or \
+                (budget.max_tokens > 0 and tokens >= budget.max_tokens):
+            truncated = True
+            break
+        piece = separator + chunk if parts else chunk
+        read += 1
+        if budget.max_chars > 0 and chars + len(piece) > budget.max_chars:
+            piece = piece[:budget.max_chars - chars]
+            truncated = True
+        if budget.max_tokens > 0:
+            piece_tokens = count_tokens(piece)
+            if tokens + piece_tokens > budget.max_tokens:
+                # 按比例截取，token 数与字符数近似线性
+                piece = piece[:int(len(piece) * (budget.max_tokens - tokens) / piece_tokens)]
+                piece_tokens = count_tokens(piece)
+                truncated = True
+            tokens += piece_tokens
+        parts.append(piece)
+        chars += len(piece)
+        if truncated:
+            break
+    close = getattr(iterator, "close", None)
+    if close is not None:
+        close()
+    return Extracted("".join(parts), truncated, read, units_total, unit)
+
+
+def truncate_text(text: str, budget: TextBudget) -> Extracted:
+    """已经是完整字符串的内容（纯文本、表格、PPT）按同样的预算截断"""
+    if (budget.max_chars <= 0 or len(text) <= budget.max_chars) and budget.max_tokens <= 0:
+        return Extracted(text)
+    lines = text.split("\n")
+    return take_within_budget(lines, budget, unit="行", units_total=len(lines))
+
+
+def iter_pdf_pages(reader) -> Iterator[str]:
+    """按页提取，pypdf 在访问页面时才解析其内容流"""
+    for page in reader.pages:
+        yield page.extract_text() or ""
+
+
+def iter_docx_paragraphs(stream: IO[bytes]) -> Iterator[str]:
+    """直接流式解析 word/document.xml，按文档顺序产出段落（表格单元格内的段落同样逐个产出）"""
+    with zipfile.ZipFile(stream) as archive:
+        with archive.open("word/document.xml") as xml:
+            for event, elem in ElementTree.iterparse(xml, events=("end",)):
+                if elem.tag != _W_NS + "p":
+                    continue
+                text = "".join(
+                    node.text or "" if node.tag == _W_NS + "t" else "\t" if node.tag == _W_NS + "tab" else "\n"
+                    for node in elem.iter()
+                    if node.tag in (_W_NS + "t", _W_NS + "tab", _W_NS + "br")
+                ).strip()
+                # 已处理的段落从树中移除，内存占用与文档长度无关
+                elem.clear()
+                if text:
+                    yield text
+
+
+def extract_pdf(stream: IO[bytes], budget: TextBudget) -> Extracted:
+    import pypdf
+    reader = pypdf.PdfReader(stream)
+    return take_within_budget(iter_pdf_pages(reader), budget, unit="页", units_total=len(reader.pages))
+
+
+def extract_docx(stream: IO[bytes], budget: TextBudget) -> Extracted:
+    return take_within_budget(iter_docx_paragraphs(stream), budget, unit="段", separator="\n\n")
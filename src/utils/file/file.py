@@ -1,15 +1,60 @@
+import json
 import os
+import shutil
+import threading
+import time
 import requests
 import uuid
+import zipfile
 import chardet
+from dataclasses import asdict
 from io import BytesIO
 from typing import Literal,Callable, Any, Optional,Union
 from pydantic import BaseModel, Field, field_validator,PrivateAttr
 from urllib.parse import urlparse
 from pptx import Presentation
 
+from utils.file.cache import get_attachment_cache, get_http_session, content_digest
+from utils.file.parser_pool import get_parser_pool
+from utils.file.extract import Extracted, TextBudget, extract_docx, extract_pdf, truncate_text
+from utils.file.spreadsheet import MODE_SUMMARY, SPREADSHEET_MODE, spreadsheet_cache_key, summarize_spreadsheet
+
 MAX_FILE_SIZE = 10 * 1024 * 1024
 
+# 解析逻辑或缓存格式变化时修改，使已缓存的提取文本失效
+PARSER_VERSION = "v4"
+_PARSE_ERROR_PREFIXES = ("[暂不支持", "[解析", "[PPT解析失败]", "[Error]")
+
+
+class ByteBudget:
+    """
+    多个附件共享的下载字节预算，按块扣减，超出后抛 BudgetExceeded
+    并发下载时线程安全
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def charge(self, n: int):
+        with self._lock:
+            if self.limit > 0 and self.used + n > self.limit:
+                raise BudgetExceeded(f"附件总大小超过限制 {self.limit} bytes，已中断。")
+            self.used += n
+
+    @property
+    def remaining(self) -> Optional[int]:
+        if self.limit <= 0:
+            return None
+        with self._lock:
+            return max(self.limit - self.used, 0)
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
 class File(BaseModel):
     """
     通用文件对象，支持自动类型推断和路径管理
@@ -102,16 +147,37 @@ class FileOps:
         return file_obj.url
 
     @staticmethod
-    def _get_bytes_stream(file_obj:File) -> tuple[bytes, str]:
+    def _get_bytes_stream(file_obj:File, budget: Optional[ByteBudget] = None,
+                          deadline: Optional[float] = None) -> tuple[bytes, str]:
         """
         获取文件内容和后缀, 5MB大小限制检查, 超出抛异常
+        budget: 多个附件共享的总字节预算; deadline: time.monotonic() 截止时刻，超时中断下载
         """
         _, ext = infer_file_category(file_obj.url)
 
         if file_obj.is_remote:
+            timeout = 60
+            if deadline is not None:
+                timeout = max(min(timeout, deadline - time.monotonic()), 0.1)
+
+            # 命中缓存时先读出本地内容，再发条件请求，304 直接使用
+            cache = get_attachment_cache()
+            entry = cache.lookup(file_obj.url) if cache is not None else None
+            cached = cache.read_blob(entry.digest) if entry is not None else None
+            if cached is not None and entry.is_fresh():
+                if budget is not None:
+                    budget.charge(len(cached))
+                return cached, ext
+            headers = entry.conditional_headers() if cached is not None else {}
+
             try:
                 # stream=True: 此时只下载 Headers，连接保持打开，还没下载 Body
-                with requests.get(file_obj.url, stream=True, timeout=60) as resp:
+                with get_http_session().get(file_obj.url, headers=headers, stream=True, timeout=timeout) as resp:
+                    if resp.status_code == 304 and cached is not None:
+                        cache.touch_url(file_obj.url)
+                        if budget is not None:
+                            budget.charge(len(cached))
+                        return cached, ext
                     resp.raise_for_status()
 
                     content_length = resp.headers.get('Content-Length')
@@ -119,6 +185,9 @@ class FileOps:
                         raise Exception(
                             f"文件大小 ({int(content_length)} bytes) 超过限制 5MB，已终止下载。"
                         )
+                    if content_length and budget is not None and budget.remaining is not None \
+                            and int(content_length) > budget.remaining:
+                        raise BudgetExceeded(f"附件总大小超过限制 {budget.limit} bytes，已终止下载。")
 
                     # 场景：Header 缺失 Content-Length 或服务器 Header 欺骗
                     downloaded_content = BytesIO()
@@ -130,10 +199,19 @@ class FileOps:
                             current_size += len(chunk)
                             if current_size > MAX_FILE_SIZE:
                                 raise Exception(f"检测到文件超过 5MB，已中断。")
+                            if budget is not None:
+                                budget.charge(len(chunk))
+                            if deadline is not None and time.monotonic() > deadline:
+                                raise TimeoutError("文件下载超时，已中断。")
                             downloaded_content.write(chunk)
 
                     # 获取完整 bytes
-                    return downloaded_content.getvalue(), ext
+                    content = downloaded_content.getvalue()
+                    if cache is not None:
+                        digest = cache.put_blob(content)
+                        cache.bind_url(file_obj.url, digest, resp.headers.get('ETag'),
+                                       resp.headers.get('Last-Modified'))
+                    return content, ext
 
             except requests.RequestException as e:
                 raise RuntimeError(f"网络请求失败: {e}")
@@ -149,7 +227,10 @@ class FileOps:
             '''
 
             with open(file_obj.url, 'rb') as f:
-                return f.read(), ext
+                content = f.read()
+            if budget is not None:
+                budget.charge(len(content))
+            return content, ext
 
     @staticmethod
     def save_to_local(file_obj: File, filename: str) -> str:
@@ -172,11 +253,31 @@ class FileOps:
             local_path = os.path.join(FileOps.DOWNLOAD_DIR, filename)
 
             headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'}
-            with requests.get(file_obj.url, headers=headers, stream=True, timeout=120) as r:
-                r.raise_for_status()
-                with open(local_path, 'wb') as f:
-                    for chunk in r.iter_content(chunk_size=8192):
-                        f.write(chunk)
+            cache = get_attachment_cache()
+            if cache is None:
+                with get_http_session().get(file_obj.url, headers=headers, stream=True, timeout=120) as r:
+                    r.raise_for_status()
+                    with open(local_path, 'wb') as f:
+                        for chunk in r.iter_content(chunk_size=8192):
+                            f.write(chunk)
+                return local_path
+
+            # 经缓存下载（不读入内存），再复制到目标路径；复制而不是硬链接，调用方修改文件不会污染缓存
+            entry = cache.lookup(file_obj.url)
+            digest = entry.digest if entry is not None else None
+            if entry is None or not entry.is_fresh():
+                if entry is not None:
+                    headers.update(entry.conditional_headers())
+                with get_http_session().get(file_obj.url, headers=headers, stream=True, timeout=120) as r:
+                    if r.status_code == 304 and entry is not None:
+                        cache.touch_url(file_obj.url)
+                    else:
+                        r.raise_for_status()
+                        digest = cache.put_blob_stream(r.iter_content(chunk_size=8192))
+                        if digest is None:
+                            raise RuntimeError("写入附件缓存失败")
+                        cache.bind_url(file_obj.url, digest, r.headers.get('ETag'), r.headers.get('Last-Modified'))
+            shutil.copyfile(cache.blob_path(digest), local_path)
 
             return local_path
         except Exception as e:
@@ -199,33 +300,76 @@ class FileOps:
         """
         try:
             content, ext = FileOps._get_bytes_stream(file_obj)
+            return FileOps.bytes_to_text(file_obj, content, ext)
+        except Exception as e:
+            return f"[FileOps Error] Failed to read content: {str(e)}"
 
-            if ext in ['.pdf', '.doc', '.docx', '.xls', '.xlsx', '.ppt', '.pptx']:
-                return FileOps._parse_document_bytes(file_obj, content, ext)
+    @staticmethod
+    def bytes_to_text(file_obj: File, content: bytes, ext: str, budget: Optional[TextBudget] = None,
+                      timeout: Optional[float] = None) -> str:
+        """
+        已下载内容转文本，文档格式走解析器，其余按探测到的编码解码；超出 budget 的部分截断
+        timeout: 解析进程的等待上限（秒），默认 ATTACHMENT_PARSER_TIMEOUT_SECONDS
+        """
+        return FileOps.bytes_to_extracted(file_obj, content, ext, budget, timeout).render()
 
-            # 默认直接读
-            charset = chardet.detect(content)
-            if 'encoding' in charset:
-                return content.decode(charset['encoding'])
+    @staticmethod
+    def bytes_to_extracted(file_obj: File, content: bytes, ext: str, budget: Optional[TextBudget] = None,
+                           timeout: Optional[float] = None) -> Extracted:
+        """同 bytes_to_text，返回未渲染的结果，调用方可直接读取是否截断、已提取的页数/段数"""
+        budget = budget or TextBudget()
+        if ext in ['.pdf', '.doc', '.docx', '.xls', '.xlsx', '.csv', '.ppt', '.pptx']:
+            # 解析结果按内容摘要缓存，相同文件只解析一次；解析失败的提示不缓存
+            cache = get_attachment_cache()
+            digest = content_digest(content) if cache is not None else None
+            parser_key = f"{PARSER_VERSION}{ext}.{budget.key}"
+            if ext in ['.xls', '.xlsx', '.csv']:
+                parser_key += f".{spreadsheet_cache_key()}"
+            if cache is not None:
+                cached = cache.get_text(digest, parser_key)
+                if cached is not None:
+                    try:
+                        return Extracted(**json.loads(cached))
+                    except (ValueError, TypeError):
+                        pass
+            # 解析在独立进程中执行，不占用服务进程的 GIL
+            pool = get_parser_pool()
+            if pool is not None:
+                if timeout is not None:
+                    extracted = pool.parse(file_obj, content, ext, budget, timeout=timeout)
+                else:
+                    extracted = pool.parse(file_obj, content, ext, budget)
             else:
-                return content.decode('utf-8')
-
-        except Exception as e:
-            return f"[FileOps Error] Failed to read content: {str(e)}"
+                extracted = FileOps._parse_document_bytes(file_obj, content, ext, budget)
+            if cache is not None and not extracted.text.startswith(_PARSE_ERROR_PREFIXES):
+                cache.put_text(digest, parser_key, json.dumps(asdict(extracted), ensure_ascii=False))
+            return extracted
+
+        # 默认直接读
+        charset = chardet.detect(content)
+        if charset.get('encoding'):
+            text = content.decode(charset['encoding'])
+        else:
+            text = content.decode('utf-8')
+        return truncate_text(text, budget)
 
     @staticmethod
-    def _parse_document_bytes(file_obj: File, content: bytes, ext:str) -> str:
+    def _parse_document_bytes(file_obj: File, content: bytes, ext:str, budget: Optional[TextBudget] = None) -> Extracted:
         stream = BytesIO(content)
         text_result = ""
+        budget = budget or TextBudget()
 
         try:
             if ext == '.pdf':
-                import pypdf
-                reader = pypdf.PdfReader(stream)
-                for page in reader.pages:
-                    text_result += page.extract_text() + "\n"
+                # 按页提取，达到预算后不再解析后续页面
+                return extract_pdf(stream, budget)
+            elif ext == '.docx' and zipfile.is_zipfile(stream):
+                return extract_docx(stream, budget)
             elif ext in ['.docx', '.doc']:
                 text_result = read_docx(stream)
+            elif ext in ['.xlsx', '.xls', '.csv'] and SPREADSHEET_MODE == MODE_SUMMARY:
+                # 大表只放摘要（字段统计 + 分层样例行），小表完整内联
+                text_result = summarize_spreadsheet(content, ext)
             elif ext in ['.xlsx', '.xls', '.csv']:
                 import pandas as pd
                 if ext == '.csv':
@@ -236,13 +380,13 @@ class FileOps:
             elif ext in ['.ppt', '.pptx']:
                 text_result = read_ppt(stream)
             else:
-                text_result = f"[暂不支持解析该文档格式: {ext}]"
+                return Extracted(f"[暂不支持解析该文档格式: {ext}]")
         except ImportError as e:
-            text_result = f"[解析库缺失] {e}"
+            return Extracted(f"[解析库缺失] {e}")
         except Exception as e:
-            text_result = f"[解析失败] {e}"
+            return Extracted(f"[解析失败] {e}")
 
-        return text_result
+        return truncate_text(text_result, budget)
 
 def read_docx(cont_stream) -> str:
     """
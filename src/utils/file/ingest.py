@@ -0,0 +1,221 @@
+"""
+附件并发抓取与文本提取
+
+to_stream_input 中的文档附件原本逐个串行下载、解析，多个附件的耗时相加后 graph 才能开始。这里：
+- 在有界线程池中并发执行下载和解析，线程数由 ATTACHMENT_WORKERS 限制，多个请求共用
+- 同一条消息的附件共享总字节预算（ATTACHMENT_MAX_TOTAL_BYTES），超出的附件中断下载并给出提示
+- 每个附件有超时（ATTACHMENT_TIMEOUT_SECONDS，含排队时间），超时后下载循环自行中断，解析进程按剩余时间终止
+- 结果按提交顺序返回，调用方据此保持 prompt 块的原始顺序
+- 每个附件的排队、下载、解析耗时和大小记录到日志
+- 异步调用方使用 aextract_all / aextract_text，等待提取时不阻塞事件循环
+"""
+import asyncio
+import concurrent.futures
+import contextvars
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import List, Optional
+
+from utils.file.file import ByteBudget, BudgetExceeded, File, FileOps
+
+logger = logging.getLogger(__name__)
+
+ATTACHMENT_WORKERS = int(os.getenv("ATTACHMENT_WORKERS", "8"))
+ATTACHMENT_TIMEOUT_SECONDS = float(os.getenv("ATTACHMENT_TIMEOUT_SECONDS", "60"))
+# 单条消息所有附件的下载总字节数上限，0 表示不限制
+ATTACHMENT_MAX_TOTAL_BYTES = int(os.getenv("ATTACHMENT_MAX_TOTAL_BYTES", str(30 * 1024 * 1024)))
+
+STATUS_OK = "ok"
+STATUS_ERROR = "error"
+STATUS_TIMEOUT = "timeout"
+STATUS_OVER_BUDGET = "over_budget"
+
+
+@dataclass
+class AttachmentResult:
+    url: str
+    text: str = ""
+    status: str = STATUS_OK
+    truncated: bool = False
+    size: int = 0
+    queue_ms: int = 0
+    fetch_ms: int = 0
+    parse_ms: int = 0
+    total_ms: int = 0
+
+
+def _ms(seconds: float) -> int:
+    return int(seconds * 1000)
+
+
+def _extract(file_obj: File, budget: ByteBudget, deadline: float, submitted_at: float) -> AttachmentResult:
+    result = AttachmentResult(url=file_obj.url)
+    started = time.monotonic()
+    result.queue_ms = _ms(started - submitted_at)
+    try:
+        if started > deadline:
+            raise TimeoutError("排队超时")
+        content, ext = FileOps._get_bytes_stream(file_obj, budget=budget, deadline=deadline)
+        fetched = time.monotonic()
+        result.size = len(content)
+        result.fetch_ms = _ms(fetched - started)
+        # 解析进程的等待上限取该附件剩余的时间，下载耗时计入同一个超时
+        remaining = deadline - fetched
+        if remaining <= 0:
+            raise TimeoutError("下载完成时已超时")
+        extracted = FileOps.bytes_to_extracted(file_obj, content, ext, timeout=remaining)
+        result.text = extracted.render()
+        result.truncated = extracted.truncated
+        result.parse_ms = _ms(time.monotonic() - fetched)
+    except BudgetExceeded as e:
+        result.status = STATUS_OVER_BUDGET
+        result.text = f"[FileOps Error] {e}"
+    except TimeoutError as e:
+        result.status = STATUS_TIMEOUT
+        result.text = f"[FileOps Error] 附件读取超时: {e}"
+    except Exception as e:
+        result.status = STATUS_ERROR
+        result.text = f"[FileOps Error] Failed to read content: {str(e)}"
+    return result
+
+
+class _Batch:
+    """同一条消息的一批附件：共享字节预算和截止时间"""
+
+    def __init__(self, files: List[File], budget: ByteBudget, timeout: float):
+        self.files = files
+        self.budget = budget
+        self.submitted_at = time.monotonic()
+        self.deadline = self.submitted_at + timeout
+        self.futures: List[concurrent.futures.Future] = []
+
+    def remaining(self) -> float:
+        return max(self.deadline - time.monotonic(), 0)
+
+
+class AttachmentIngestor:
+    def __init__(self, max_workers: int = ATTACHMENT_WORKERS):
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="attachment")
+        self._lock = threading.Lock()
+        self._submitted = 0
+        self._completed = 0
+        self._timeouts = 0
+
+    def _submit(self, files: List[File], timeout: float, max_total_bytes: int) -> "_Batch":
+        batch = _Batch(files, ByteBudget(max_total_bytes), timeout)
+        for file_obj in files:
+            context = contextvars.copy_context()
+            batch.futures.append(self._executor.submit(
+                context.run, _extract, file_obj, batch.budget, batch.deadline, batch.submitted_at
+            ))
+        with self._lock:
+            self._submitted += len(files)
+        return batch
+
+    def _timed_out(self, file_obj: File, timeout: float) -> AttachmentResult:
+        # 工作线程会在下一次读块时检测到 deadline 并退出
+        with self._lock:
+            self._timeouts += 1
+        return AttachmentResult(
+            url=file_obj.url, status=STATUS_TIMEOUT,
+            text=f"[FileOps Error] 附件读取超过 {timeout:g} 秒，已跳过。",
+        )
+
+    def _collected(self, batch: "_Batch", result: AttachmentResult) -> AttachmentResult:
+        result.total_ms = _ms(time.monotonic() - batch.submitted_at)
+        logger.info(
+            f"attachment url={result.url} status={result.status} size={result.size} truncated={result.truncated} "
+            f"queue_ms={result.queue_ms} fetch_ms={result.fetch_ms} parse_ms={result.parse_ms} "
+            f"total_ms={result.total_ms}"
+        )
+        return result
+
+    def _finished(self, batch: "_Batch"):
+        with self._lock:
+            self._completed += len(batch.files)
+        logger.info(
+            f"attachments ingested count={len(batch.files)} bytes={batch.budget.used} "
+            f"elapsed_ms={_ms(time.monotonic() - batch.submitted_at)}"
+        )
+
+    def extract_all(
+            self,
+            files: List[File],
+            timeout: float = ATTACHMENT_TIMEOUT_SECONDS,
+            max_total_bytes: int = ATTACHMENT_MAX_TOTAL_BYTES,
+    ) -> List[AttachmentResult]:
+        """并发提取 files 的文本，结果与 files 一一对应"""
+        if not files:
+            return []
+        batch = self._submit(files, timeout, max_total_bytes)
+        results: List[AttachmentResult] = []
+        for file_obj, future in zip(files, batch.futures):
+            try:
+                result = future.result(timeout=batch.remaining())
+            except concurrent.futures.TimeoutError:
+                future.cancel()
+                result = self._timed_out(file_obj, timeout)
+            results.append(self._collected(batch, result))
+        self._finished(batch)
+        return results
+
+    async def aextract_all(
+            self,
+            files: List[File],
+            timeout: float = ATTACHMENT_TIMEOUT_SECONDS,
+            max_total_bytes: int = ATTACHMENT_MAX_TOTAL_BYTES,
+    ) -> List[AttachmentResult]:
+        """extract_all 的异步版本：等待期间不阻塞事件循环，调用方被取消时撤销尚未开始的任务"""
+        if not files:
+            return []
+        batch = self._submit(files, timeout, max_total_bytes)
+        results: List[AttachmentResult] = []
+        try:
+            for file_obj, future in zip(files, batch.futures):
+                try:
+                    result = await asyncio.wait_for(asyncio.wrap_future(future), batch.remaining())
+                except asyncio.TimeoutError:
+                    result = self._timed_out(file_obj, timeout)
+                results.append(self._collected(batch, result))
+        except asyncio.CancelledError:
+            for future in batch.futures:
+                future.cancel()
+            raise
+        self._finished(batch)
+        return results
+
+    def stats(self):
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "submitted": self._submitted,
+                "completed": self._completed,
+                "timeouts": self._timeouts,
+            }
+
+
+_ingestor: Optional[AttachmentIngestor] = None
+_ingestor_pid = 0
+_ingestor_lock = threading.Lock()
+
+
+def get_attachment_ingestor() -> AttachmentIngestor:
+    """获取进程内的附件提取线程池（fork 出的 worker 重新创建）"""
+    global _ingestor, _ingestor_pid
+    if _ingestor is None or _ingestor_pid != os.getpid():
+        with _ingestor_lock:
+            if _ingestor is None or _ingestor_pid != os.getpid():
+                _ingestor = AttachmentIngestor()
+                _ingestor_pid = os.getpid()
+    return _ingestor
+
+
+async def aextract_text(file_obj: File, timeout: float = ATTACHMENT_TIMEOUT_SECONDS) -> str:
+    """异步提取单个文件的文本（下载在线程池、解析在解析进程中执行）"""
+    results = await get_attachment_ingestor().aextract_all([file_obj], timeout=timeout)
+    return results[0].text
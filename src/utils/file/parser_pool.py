@@ -0,0 +1,260 @@
+"""
+文档解析进程池
+
+pypdf / pandas / docx2python / python-pptx 的解析是 CPU 密集操作，在服务进程内执行时持有 GIL，
+与 token 流式输出争抢 CPU；个别畸形 PDF 会让进程长时间卡住，解析时的内存峰值也不会归还。这里：
+- 解析在独立的 worker 进程中执行（python -m utils.file.parser_pool），不重新导入服务入口
+- 并发数由 ATTACHMENT_PARSER_WORKERS 限制，worker 按需创建并复用
+- 每个 worker 设置内存上限（RLIMIT_AS），每个任务设置 CPU 时间上限（RLIMIT_CPU）和墙钟超时，
+  超限时终止该 worker，只有当前任务失败
+- 每个 worker 处理 ATTACHMENT_PARSER_MAX_JOBS 个任务后退出，释放累积的内存
+- 附件提取线程通过 parse 同步等待，并传入该附件剩余的超时时间；异步调用方使用 aparse
+ATTACHMENT_PARSER_WORKERS=0 时不使用进程池，直接在调用线程中解析
+"""
+import asyncio
+import atexit
+import logging
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+from dataclasses import asdict, dataclass
+from multiprocessing.connection import Connection
+from typing import Any, Dict, List, Optional
+
+from utils.file.extract import Extracted
+
+logger = logging.getLogger(__name__)
+
+ATTACHMENT_PARSER_WORKERS = int(os.getenv("ATTACHMENT_PARSER_WORKERS", str(min(4, os.cpu_count() or 1))))
+ATTACHMENT_PARSER_TIMEOUT_SECONDS = float(os.getenv("ATTACHMENT_PARSER_TIMEOUT_SECONDS", "60"))
+# 单个任务的 CPU 时间上限（秒），0 表示不限制
+ATTACHMENT_PARSER_CPU_SECONDS = int(os.getenv("ATTACHMENT_PARSER_CPU_SECONDS", "30"))
+# 单个 worker 的地址空间上限（MB），0 表示不限制
+ATTACHMENT_PARSER_MAX_MEMORY_MB = int(os.getenv("ATTACHMENT_PARSER_MAX_MEMORY_MB", "2048"))
+ATTACHMENT_PARSER_MAX_JOBS = int(os.getenv("ATTACHMENT_PARSER_MAX_JOBS", "50"))
+
+# worker 以 python -m 启动，需要能导入 utils 包
+_SRC_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@dataclass
+class ParserPoolStats:
+    jobs: int = 0
+    spawned: int = 0
+    recycled: int = 0
+    timeouts: int = 0
+    crashes: int = 0
+
+
+class _Worker:
+    def __init__(self):
+        job_r, job_w = os.pipe()
+        result_r, result_w = os.pipe()
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(p for p in (_SRC_ROOT, env.get("PYTHONPATH")) if p)
+        try:
+            self.process = subprocess.Popen(
+                [sys.executable, "-m", "utils.file.parser_pool", str(job_r), str(result_w)],
+                pass_fds=(job_r, result_w), env=env, stdin=subprocess.DEVNULL,
+            )
+        except BaseException:
+            os.close(job_w)
+            os.close(result_r)
+            raise
+        finally:
+            os.close(job_r)
+            os.close(result_w)
+        self.jobs = Connection(job_w, readable=False)
+        self.results = Connection(result_r, writable=False)
+        self.done = 0
+
+    def alive(self) -> bool:
+        return self.process.poll() is None
+
+    def close(self):
+        for conn in (self.jobs, self.results):
+            try:
+                conn.close()
+            except OSError:
+                pass
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+
+
+def _describe_exit(code: Optional[int]) -> str:
+    if code == -signal.SIGXCPU:
+        return f"超出 CPU 时间限制 ({ATTACHMENT_PARSER_CPU_SECONDS} 秒)"
+    if code == -signal.SIGKILL:
+        return "解析进程被终止（可能超出内存限制）"
+    return f"解析进程异常退出 (exit code {code})"
+
+
+class ParserPool:
+    def __init__(self, max_workers: int = ATTACHMENT_PARSER_WORKERS, max_jobs: int = ATTACHMENT_PARSER_MAX_JOBS):
+        self.max_workers = max_workers
+        self.max_jobs = max_jobs
+        self.stats = ParserPoolStats()
+        self._slots = threading.BoundedSemaphore(max_workers)
+        self._idle: List[_Worker] = []
+        self._busy = 0
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def parse(self, file_obj: Any, content: bytes, ext: str, budget: Any = None,
+              timeout: float = ATTACHMENT_PARSER_TIMEOUT_SECONDS) -> Extracted:
+        """在 worker 进程中执行 FileOps._parse_document_bytes，阻塞等待结果；失败时返回 [解析失败] 提示"""
+        deadline = time.monotonic() + timeout
+        if not self._slots.acquire(timeout=timeout):
+            self._count("timeouts")
+            return Extracted(f"[解析失败] 等待解析进程超过 {timeout:g} 秒")
+        worker = None
+        try:
+            with self._lock:
+                self._busy += 1
+            worker = self._checkout()
+            try:
+                worker.jobs.send((file_obj, content, ext, budget))
+            except OSError:
+                # 空闲期间 worker 已退出
+                self._discard(worker)
+                worker = self._spawn()
+                worker.jobs.send((file_obj, content, ext, budget))
+            self._count("jobs")
+
+            if not worker.results.poll(max(deadline - time.monotonic(), 0)):
+                self._count("timeouts")
+                self._discard(worker)
+                worker = None
+                return Extracted(f"[解析失败] 解析超过 {timeout:g} 秒，已终止")
+            try:
+                extracted = worker.results.recv()
+            except (EOFError, OSError):
+                self._count("crashes")
+                code = worker.process.wait()
+                self._discard(worker)
+                worker = None
+                return Extracted(f"[解析失败] {_describe_exit(code)}")
+
+            worker.done += 1
+            if worker.done >= self.max_jobs:
+                self._count("recycled")
+                self._discard(worker)
+                worker = None
+            return extracted
+        finally:
+            with self._lock:
+                self._busy -= 1
+                if worker is not None and not self._closed:
+                    self._idle.append(worker)
+                    worker = None
+            if worker is not None:
+                self._discard(worker)
+            self._slots.release()
+
+    async def aparse(self, file_obj: Any, content: bytes, ext: str, budget: Any = None,
+                     timeout: float = ATTACHMENT_PARSER_TIMEOUT_SECONDS) -> Extracted:
+        """
+        parse 的异步版本：在线程中等待 worker 结果，不阻塞事件循环。
+        调用方被取消时不等待结果返回，解析仍在 worker 中完成（最长 timeout 秒）后归还 worker
+        """
+        return await asyncio.to_thread(self.parse, file_obj, content, ext, budget, timeout)
+
+    def _count(self, name: str):
+        # parse 在多个提取线程中并发执行，计数需与 snapshot 一起加锁
+        with self._lock:
+            setattr(self.stats, name, getattr(self.stats, name) + 1)
+
+    def _checkout(self) -> _Worker:
+        with self._lock:
+            while self._idle:
+                worker = self._idle.pop()
+                if worker.alive():
+                    return worker
+                worker.close()
+        return self._spawn()
+
+    def _spawn(self) -> _Worker:
+        self._count("spawned")
+        return _Worker()
+
+    @staticmethod
+    def _discard(worker: _Worker):
+        try:
+            worker.close()
+        except Exception as e:
+            logger.warning(f"Failed to stop parser worker: {e}")
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for worker in idle:
+            self._discard(worker)
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            idle, busy, stats = len(self._idle), self._busy, asdict(self.stats)
+        return {"max_workers": self.max_workers, "idle": idle, "busy": busy, **stats}
+
+
+_parser_pool: Optional[ParserPool] = None
+_parser_pool_pid = 0
+_parser_pool_lock = threading.Lock()
+
+
+def get_parser_pool() -> Optional[ParserPool]:
+    """获取文档解析进程池，ATTACHMENT_PARSER_WORKERS=0 时返回 None（fork 出的 worker 重新创建）"""
+    global _parser_pool, _parser_pool_pid
+    if ATTACHMENT_PARSER_WORKERS <= 0:
+        return None
+    if _parser_pool is None or _parser_pool_pid != os.getpid():
+        with _parser_pool_lock:
+            if _parser_pool is None or _parser_pool_pid != os.getpid():
+                _parser_pool = ParserPool()
+                _parser_pool_pid = os.getpid()
+    return _parser_pool
+
+
+def close_parser_pool():
+    if _parser_pool is not None and _parser_pool_pid == os.getpid():
+        _parser_pool.close()
+
+
+atexit.register(close_parser_pool)
+
+
+def _worker_main(job_fd: int, result_fd: int):
+    import resource
+
+    # 结果通过独立管道回传，解析库打印到 stdout 的内容转到 stderr
+    os.dup2(2, 1)
+    if ATTACHMENT_PARSER_MAX_MEMORY_MB > 0:
+        limit = ATTACHMENT_PARSER_MAX_MEMORY_MB * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+    from utils.file.file import FileOps
+
+    jobs = Connection(job_fd, writable=False)
+    results = Connection(result_fd, readable=False)
+    while True:
+        try:
+            file_obj, content, ext, budget = jobs.recv()
+        except EOFError:
+            return
+        if ATTACHMENT_PARSER_CPU_SECONDS > 0:
+            # RLIMIT_CPU 按进程累计，每个任务在已用时间上加配额；超出时内核发送 SIGXCPU 终止进程
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+            soft = int(usage.ru_utime + usage.ru_stime) + ATTACHMENT_PARSER_CPU_SECONDS
+            if hard != resource.RLIM_INFINITY:
+                soft = min(soft, hard)
+            resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+        results.send(FileOps._parse_document_bytes(file_obj, content, ext, budget))
+
+
+if __name__ == "__main__":
+    _worker_main(int(sys.argv[1]), int(sys.argv[2]))
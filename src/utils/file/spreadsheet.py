@@ -0,0 +1,431 @@
+"""
+表格附件摘要
+
+xlsx / csv 附件原本整表读入 pandas 后把 df.to_string() 全部放进 prompt，几万行的导出会变成数 MB 文本，
+模型用不上且拖慢每一轮对话。摘要模式（SPREADSHEET_MODE=summary，默认）下：
+- 逐行流式读取：csv 用标准库 csv 模块，xlsx 用 openpyxl 只读模式，内存占用与行数无关
+- 每个工作表输出行列数、字段类型、逐列统计（空值、唯一值、数值/日期范围、均值、常见值）
+  和分层抽样的样例行（开头 / 中间 / 结尾各一部分，并为低基数字段的每个取值保留一行）
+- 行数不超过 SPREADSHEET_INLINE_ROWS 的小表仍完整内联
+- 每个工作表最多扫描 SPREADSHEET_MAX_ROWS 行，csv 最多读取 SPREADSHEET_MAX_BYTES 字节，超出时注明统计范围
+SPREADSHEET_MODE=full 时保留原来的整表输出（仍受附件文本预算截断）
+"""
+import csv
+import io
+import math
+import os
+import random
+import re
+from collections import Counter, deque
+from datetime import date, datetime, time
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Set, Tuple
+
+import chardet
+
+SPREADSHEET_MODE = os.getenv("SPREADSHEET_MODE", "summary")
+SPREADSHEET_INLINE_ROWS = int(os.getenv("SPREADSHEET_INLINE_ROWS", "50"))
+SPREADSHEET_MAX_ROWS = int(os.getenv("SPREADSHEET_MAX_ROWS", "100000"))
+SPREADSHEET_MAX_BYTES = int(os.getenv("SPREADSHEET_MAX_BYTES", str(20 * 1024 * 1024)))
+SPREADSHEET_SAMPLE_ROWS = int(os.getenv("SPREADSHEET_SAMPLE_ROWS", "20"))
+SPREADSHEET_MAX_SHEETS = int(os.getenv("SPREADSHEET_MAX_SHEETS", "10"))
+SPREADSHEET_MAX_COLUMNS = int(os.getenv("SPREADSHEET_MAX_COLUMNS", "50"))
+
+MODE_SUMMARY = "summary"
+MODE_FULL = "full"
+
+# 单列最多记录的不同取值数，超出后只对已记录的取值计数（常见值为近似结果）
+_DISTINCT_CAP = 1000
+# 唯一值不超过该数的字段作为分层抽样的分组字段
+_GROUP_MAX_VALUES = 20
+_TOP_VALUES = 5
+_CELL_MAX_CHARS = 60
+# 编码探测只看文件开头，避免 chardet 扫描整个文件
+_DETECT_BYTES = 64 * 1024
+
+T_INT = "整数"
+T_FLOAT = "小数"
+T_BOOL = "布尔"
+T_DATE = "日期"
+T_TEXT = "文本"
+
+
+def _kind(value: Any) -> str:
+    if isinstance(value, bool):
+        return T_BOOL
+    if isinstance(value, int):
+        return T_INT
+    if isinstance(value, float):
+        return T_FLOAT
+    if isinstance(value, (datetime, date, time)):
+        return T_DATE
+    return T_TEXT
+
+
+def _fmt_num(value: float) -> str:
+    if isinstance(value, int) or (value.is_integer() and abs(value) < 1e15):
+        return str(int(value))
+    return f"{value:.4f}".rstrip("0").rstrip(".")
+
+
+def _cell(value: Any) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        text = _fmt_num(value) if math.isfinite(value) else str(value)
+    elif isinstance(value, datetime):
+        text = value.date().isoformat() if value.time() == time() else value.isoformat(sep=" ")
+    elif isinstance(value, (date, time)):
+        text = value.isoformat()
+    else:
+        text = str(value)
+    text = text.replace("\r", " ").replace("\n", " ").replace("|", "/")
+    return text if len(text) <= _CELL_MAX_CHARS else text[:_CELL_MAX_CHARS - 1] + "…"
+
+
+_DATE_RE = re.compile(
+    r"(\d{4})[-/.](\d{1,2})[-/.](\d{1,2})(?:[ T](\d{1,2}):(\d{2})(?::(\d{2})(?:\.(\d{1,6}))?)?)?"
+)
+
+
+def _leading_zero(text: str) -> bool:
+    """以 0 开头的数字串（如 007、0123）视为编号，按文本处理"""
+    return len(text) > 1 and text[0] == "0" and text[1].isdigit()
+
+
+def _parse_date(text: str) -> Any:
+    """解析 2024-01-31、2024/1/31、2024-01-31 08:30[:00] 等常见写法，不是日期时返回 None"""
+    match = _DATE_RE.fullmatch(text)
+    if match is None:
+        return None
+    year, month, day, hour, minute, second, fraction = match.groups()
+    try:
+        if hour is None:
+            return date(int(year), int(month), int(day))
+        micro = int(fraction.ljust(6, "0")) if fraction else 0
+        return datetime(int(year), int(month), int(day), int(hour), int(minute), int(second or 0), micro)
+    except ValueError:
+        return None
+
+
+def _coerce(text: str) -> Any:
+    """csv 单元格转为数值或日期，无法识别时保留文本；按文本处理的列由 _CsvRows 逐列决定"""
+    text = text.strip()
+    if not text:
+        return None
+    try:
+        return int(text)
+    except ValueError:
+        pass
+    try:
+        value = float(text)
+    except ValueError:
+        parsed = _parse_date(text)
+        return parsed if parsed is not None else text
+    return value if math.isfinite(value) else text
+
+
+class ColumnStats:
+    def __init__(self, name: str):
+        self.name = name
+        self.count = 0
+        self.nulls = 0
+        self.types: Counter = Counter()
+        self.numeric = 0
+        self.total = 0.0
+        self.num_min: Optional[float] = None
+        self.num_max: Optional[float] = None
+        self.date_min: Any = None
+        self.date_max: Any = None
+        self.values: Counter = Counter()
+        self.overflow = False
+
+    def add(self, value: Any):
+        if value is None or value == "" or (isinstance(value, float) and math.isnan(value)):
+            self.nulls += 1
+            return
+        self.count += 1
+        kind = _kind(value)
+        self.types[kind] += 1
+        if kind in (T_INT, T_FLOAT):
+            self.numeric += 1
+            self.total += value
+            self.num_min = value if self.num_min is None else min(self.num_min, value)
+            self.num_max = value if self.num_max is None else max(self.num_max, value)
+        elif kind == T_DATE:
+            try:
+                self.date_min = value if self.date_min is None else min(self.date_min, value)
+                self.date_max = value if self.date_max is None else max(self.date_max, value)
+            except TypeError:
+                # date 与 datetime 混合时不可比较
+                pass
+
+        # 普通值直接作为 key，展示时再格式化
+        key = value if isinstance(value, (str, int, float)) else _cell(value)
+        if key in self.values or not self.overflow:
+            self.values[key] += 1
+            if len(self.values) > _DISTINCT_CAP:
+                self.overflow = True
+                self.values = Counter(dict(self.values.most_common(_DISTINCT_CAP // 2)))
+
+    @property
+    def kind(self) -> str:
+        if not self.types:
+            return "空"
+        if set(self.types) <= {T_INT, T_FLOAT}:
+            return T_FLOAT if T_FLOAT in self.types else T_INT
+        return self.types.most_common(1)[0][0]
+
+    def describe(self) -> str:
+        parts = [f"非空 {self.count}", f"空值 {self.nulls}"]
+        parts.append(f"唯一值 ≥{_DISTINCT_CAP}" if self.overflow else f"唯一值 {len(self.values)}")
+        if len(self.types) > 1 and set(self.types) - {T_INT, T_FLOAT}:
+            mixed = ", ".join(f"{kind} {count * 100 // self.count}%" for kind, count in self.types.most_common(3))
+            parts.append(f"类型混合: {mixed}")
+        if self.numeric:
+            parts.append(f"范围 {_fmt_num(self.num_min)} ~ {_fmt_num(self.num_max)}")
+            parts.append(f"均值 {_fmt_num(self.total / self.numeric)}")
+        if self.date_min is not None:
+            parts.append(f"范围 {_cell(self.date_min)} ~ {_cell(self.date_max)}")
+        if self.kind in (T_TEXT, T_BOOL) and self.values:
+            top = ", ".join(f"{_cell(value)}({count})" for value, count in self.values.most_common(_TOP_VALUES))
+            parts.append(f"常见值: {top}")
+        return f"- {self.name} ({self.kind}): " + ", ".join(parts)
+
+
+class StratifiedSample:
+    """
+    流式分层抽样：开头 k 行、结尾 k 行（滑动窗口）、中间行从结尾窗口移出的行中蓄水池抽样；
+    另外为每个低基数字段的每个取值保留首次出现的行，最后选唯一值最多的字段作为分组补充样例
+    """
+
+    def __init__(self, size: int, columns: int, seed: int = 0):
+        self.k = max(size // 3, 1)
+        self.head: List[Tuple[int, Sequence[Any]]] = []
+        self.tail: deque = deque(maxlen=self.k)
+        self.middle: List[Tuple[int, Sequence[Any]]] = []
+        self.middle_seen = 0
+        self._rng = random.Random(seed)
+        self.groups: List[Optional[Dict[Any, Tuple[int, Sequence[Any]]]]] = [{} for _ in range(columns)]
+
+    def add(self, index: int, row: Sequence[Any]):
+        for col, value in enumerate(row):
+            first = self.groups[col]
+            if first is None or isinstance(value, (int, float)) or value is None:
+                continue
+            if value not in first:
+                if len(first) >= _GROUP_MAX_VALUES:
+                    self.groups[col] = None
+                    continue
+                first[value] = (index, row)
+
+        if len(self.head) < self.k:
+            self.head.append((index, row))
+            return
+        if len(self.tail) == self.k:
+            self._reservoir(self.tail[0])
+        self.tail.append((index, row))
+
+    def _reservoir(self, item: Tuple[int, Sequence[Any]]):
+        self.middle_seen += 1
+        if len(self.middle) < self.k:
+            self.middle.append(item)
+        else:
+            slot = self._rng.randrange(self.middle_seen)
+            if slot < self.k:
+                self.middle[slot] = item
+
+    def group_column(self) -> Optional[int]:
+        candidates = [(len(first), col) for col, first in enumerate(self.groups) if first and len(first) > 1]
+        return max(candidates)[1] if candidates else None
+
+    def rows(self) -> List[Tuple[int, Sequence[Any]]]:
+        picked = {index: row for index, row in self.head + self.middle + list(self.tail)}
+        group_col = self.group_column()
+        if group_col is not None:
+            for index, row in self.groups[group_col].values():
+                picked.setdefault(index, row)
+        return sorted(picked.items())
+
+
+def _render_rows(header: Sequence[str], rows: Sequence[Tuple[int, Sequence[Any]]], with_index: bool) -> List[str]:
+    lines = [("行号 | " if with_index else "") + " | ".join(header)]
+    for index, row in rows:
+        # 行号从 1 开始且不含表头
+        cells = " | ".join(_cell(value) for value in row)
+        lines.append(f"{index + 1} | {cells}" if with_index else cells)
+    return lines
+
+
+def summarize_sheet(name: str, header: Sequence[Any], rows: Iterator[Sequence[Any]],
+                    max_rows: int = SPREADSHEET_MAX_ROWS, sample_rows: int = SPREADSHEET_SAMPLE_ROWS,
+                    inline_rows: int = SPREADSHEET_INLINE_ROWS, max_columns: int = SPREADSHEET_MAX_COLUMNS) -> str:
+    total_columns = len(header)
+    header = [str(h).strip() if h is not None and str(h).strip() else f"列{i + 1}"
+              for i, h in enumerate(header[:max_columns])]
+    width = len(header)
+    columns = [ColumnStats(h) for h in header]
+    sample = StratifiedSample(sample_rows, width)
+    inline: List[Tuple[int, Sequence[Any]]] = []
+    scanned = 0
+    limited = False
+
+    for row in rows:
+        if not any(value is not None and value != "" for value in row):
+            continue
+        if scanned >= max_rows:
+            limited = True
+            break
+        row = tuple(row[:width]) + (None,) * (width - len(row))
+        for stats, value in zip(columns, row):
+            stats.add(value)
+        sample.add(scanned, row)
+        if len(inline) <= inline_rows:
+            inline.append((scanned, row))
+        scanned += 1
+
+    lines = [f"=== 工作表 {name} ==="]
+    row_desc = f"≥{scanned}（达到扫描上限，以下统计只基于前 {scanned} 行）" if limited else str(scanned)
+    col_desc = f"{total_columns}（只统计前 {width} 列）" if total_columns > width else str(total_columns)
+    lines.append(f"行数: {row_desc}，列数: {col_desc}")
+    if not limited and scanned <= inline_rows:
+        lines.append("[全部数据]")
+        lines.extend(_render_rows(header, inline, with_index=False))
+        return "\n".join(lines)
+
+    lines.append("[字段]")
+    lines.extend(stats.describe() for stats in columns)
+    picked = sample.rows()
+    group_col = sample.group_column()
+    strata = "开头 / 中间 / 结尾" + (f"，{header[group_col]} 的每个取值各一行" if group_col is not None else "")
+    lines.append(f"[样例行]（分层抽样 {len(picked)} 行：{strata}）")
+    lines.extend(_render_rows(header, picked, with_index=True))
+    return "\n".join(lines)
+
+
+class _CsvRows:
+    """
+    逐行读取 csv，读取字节数超过上限时停止并记录。
+    字段类型按列决定：先扫描一遍（同样受行数/字节上限约束），任一值带前导零的列整列按文本处理，
+    避免编号列一部分被转成数值、一部分保留文本
+    """
+
+    def __init__(self, content: bytes, max_bytes: int, max_rows: int = SPREADSHEET_MAX_ROWS):
+        encoding = chardet.detect(content[:_DETECT_BYTES]).get("encoding") or "utf-8"
+        if encoding.lower() == "ascii":
+            encoding = "utf-8"
+        self._content = content
+        self._encoding = encoding
+        self.max_bytes = max_bytes
+        self.max_rows = max_rows
+        self.limited = False
+        self._raw, self._text = self._open()
+        sniff = self._text.read(_DETECT_BYTES)
+        self._text.seek(0)
+        try:
+            self._dialect = csv.Sniffer().sniff(sniff, delimiters=",;\t|")
+        except csv.Error:
+            self._dialect = csv.excel
+        self._reader = csv.reader(self._text, self._dialect)
+        self.text_columns: Set[int] = set()
+
+    def _open(self) -> Tuple[io.BytesIO, io.TextIOWrapper]:
+        raw = io.BytesIO(self._content)
+        return raw, io.TextIOWrapper(raw, encoding=self._encoding, errors="replace", newline="")
+
+    def _records(self, raw: io.BytesIO, reader: Iterator[List[str]]) -> Iterator[List[str]]:
+        for record in reader:
+            # tell() 为底层缓冲读取位置，按块前进，用于限制扫描量足够准确
+            if 0 < self.max_bytes < raw.tell():
+                self.limited = True
+                return
+            yield record
+
+    def _scan_text_columns(self) -> Set[int]:
+        raw, text = self._open()
+        reader = csv.reader(text, self._dialect)
+        next(reader, None)
+        columns: Set[int] = set()
+        for count, record in enumerate(self._records(raw, reader)):
+            # 行数上限由 summarize_sheet 控制，这里多看一行即可
+            if count > self.max_rows:
+                break
+            for col, value in enumerate(record):
+                if col not in columns and _leading_zero(value.strip()):
+                    columns.add(col)
+        self.limited = False
+        return columns
+
+    def header(self) -> List[str]:
+        return next(self._reader, [])
+
+    def __iter__(self) -> Iterator[List[Any]]:
+        text_columns = self.text_columns = self._scan_text_columns()
+        for record in self._records(self._raw, self._reader):
+            yield [(value.strip() or None) if col in text_columns else _coerce(value)
+                   for col, value in enumerate(record)]
+
+
+def _csv_sheets(content: bytes, max_bytes: int,
+                max_rows: int = SPREADSHEET_MAX_ROWS) -> Iterator[Tuple[str, List[Any], Iterator[Sequence[Any]], Any]]:
+    rows = _CsvRows(content, max_bytes, max_rows)
+    yield "CSV", rows.header(), iter(rows), rows
+
+
+def _xlsx_sheets(content: bytes, max_sheets: int,
+                 notes: List[str]) -> Iterator[Tuple[str, List[Any], Iterator[Sequence[Any]], Any]]:
+    import openpyxl
+    workbook = openpyxl.load_workbook(io.BytesIO(content), read_only=True, data_only=True)
+    try:
+        if len(workbook.worksheets) > max_sheets:
+            notes.append(f"（共 {len(workbook.worksheets)} 个工作表，只处理了前 {max_sheets} 个）")
+        for sheet in workbook.worksheets[:max_sheets]:
+            rows = sheet.iter_rows(values_only=True)
+            header: List[Any] = []
+            for row in rows:
+                if any(value is not None for value in row):
+                    header = list(row)
+                    break
+            yield sheet.title, header, rows, None
+    finally:
+        workbook.close()
+
+
+def _xls_sheets(content: bytes, max_sheets: int, max_rows: int,
+                notes: List[str]) -> Iterator[Tuple[str, List[Any], Iterator[Sequence[Any]], Any]]:
+    # 旧版 .xls 没有流式读取接口，按行数上限读入
+    import pandas as pd
+    sheets = pd.read_excel(io.BytesIO(content), sheet_name=None, nrows=max_rows + 1)
+    if len(sheets) > max_sheets:
+        notes.append(f"（共 {len(sheets)} 个工作表，只处理了前 {max_sheets} 个）")
+    for name, df in list(sheets.items())[:max_sheets]:
+        df = df.astype(object).where(df.notna(), None)
+        yield str(name), list(df.columns), df.itertuples(index=False, name=None), None
+
+
+def spreadsheet_cache_key() -> str:
+    """参与提取文本缓存的 key，模式或摘要参数改变后不复用旧结果"""
+    if SPREADSHEET_MODE != MODE_SUMMARY:
+        return MODE_FULL
+    return (f"{MODE_SUMMARY}.v2.i{SPREADSHEET_INLINE_ROWS}r{SPREADSHEET_MAX_ROWS}b{SPREADSHEET_MAX_BYTES}"
+            f"s{SPREADSHEET_SAMPLE_ROWS}h{SPREADSHEET_MAX_SHEETS}c{SPREADSHEET_MAX_COLUMNS}")
+
+
+def summarize_spreadsheet(content: bytes, ext: str) -> str:
+    notes: List[str] = []
+    if ext == ".csv":
+        sheets = _csv_sheets(content, SPREADSHEET_MAX_BYTES, SPREADSHEET_MAX_ROWS)
+    elif ext == ".xls":
+        sheets = _xls_sheets(content, SPREADSHEET_MAX_SHEETS, SPREADSHEET_MAX_ROWS, notes)
+    else:
+        sheets = _xlsx_sheets(content, SPREADSHEET_MAX_SHEETS, notes)
+
+    parts = []
+    for name, header, rows, source in sheets:
+        if not header:
+            parts.append(f"=== 工作表 {name} ===\n（空表）")
+            continue
+        summary = summarize_sheet(name, header, rows)
+        if source is not None and source.limited:
+            summary += f"\n（文件超过 {SPREADSHEET_MAX_BYTES} 字节，只统计了前面部分）"
+        parts.append(summary)
+    return "\n\n".join(parts + notes)
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+测试脚本：附件缓存的条件请求（304）复用、写入失败时的清理，以及按最近访问时间淘汰并删除 URL 映射
+"""
+
+import os
+import sqlite3
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+# 添加src目录到路径
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+for module in ("requests", "chardet", "pptx", "pydantic"):
+    pytest.importorskip(module)
+
+from utils.file import file as file_module
+from utils.file.cache import AttachmentCache, content_digest
+from utils.file.file import File, FileOps
+
+
+def _leftovers(root) -> list:
+    return [name for name in os.listdir(root) if name.startswith(".tmp-")]
+
+
+def _object_keys(cache: AttachmentCache) -> set:
+    return {row[0] for row in cache._db().execute("SELECT key FROM objects")}
+
+
+class _Response:
+    def __init__(self, status_code: int, body: bytes = b"", headers=None):
+        self.status_code = status_code
+        self.body = body
+        self.headers = headers or {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise RuntimeError(f"HTTP {self.status_code}")
+
+    def iter_content(self, chunk_size: int):
+        for i in range(0, len(self.body), chunk_size):
+            yield self.body[i:i + chunk_size]
+
+
+class _Origin:
+    """按 ETag 响应条件请求的源站"""
+
+    def __init__(self, body: bytes, etag: str):
+        self.body = body
+        self.etag = etag
+        self.requests = []
+
+    def get(self, url, headers=None, stream=False, timeout=None):
+        headers = dict(headers or {})
+        self.requests.append(headers)
+        if headers.get("If-None-Match") == self.etag:
+            return _Response(304)
+        return _Response(200, self.body, {"ETag": self.etag, "Content-Length": str(len(self.body))})
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return AttachmentCache(root=str(tmp_path), max_bytes=0)
+
+
+@pytest.fixture
+def origin(monkeypatch, cache):
+    server = _Origin(b"report v1", '"v1"')
+    monkeypatch.setattr(file_module, "get_attachment_cache", lambda: cache)
+    monkeypatch.setattr(file_module, "get_http_session", lambda: server)
+    return server
+
+
+def _fetch() -> bytes:
+    content, ext = FileOps._get_bytes_stream(File(url="https://example.com/report.txt", file_type="document"))
+    assert ext == ".txt"
+    return content
+
+
+def test_not_modified_reuses_cached_blob(cache, origin):
+    assert _fetch() == b"report v1"
+    entry = cache.lookup("https://example.com/report.txt")
+    assert entry.digest == content_digest(b"report v1") and entry.etag == '"v1"'
+    validated_at = entry.validated_at
+
+    time.sleep(0.01)
+    assert _fetch() == b"report v1"
+    assert origin.requests[1] == {"If-None-Match": '"v1"'}
+    assert cache.stats.revalidated == 1
+    assert cache.lookup("https://example.com/report.txt").validated_at > validated_at
+
+
+def test_changed_content_rebinds_url(cache, origin):
+    _fetch()
+    origin.body, origin.etag = b"report v2", '"v2"'
+    assert _fetch() == b"report v2"
+    assert cache.lookup("https://example.com/report.txt").digest == content_digest(b"report v2")
+    assert cache.stats.revalidated == 0
+
+
+def test_missing_blob_is_a_miss(cache, origin):
+    _fetch()
+    os.unlink(cache.blob_path(content_digest(b"report v1")))
+    assert cache.lookup("https://example.com/report.txt") is None
+    assert _fetch() == b"report v1"
+    # 本地内容不存在时不发条件请求
+    assert origin.requests[1] == {}
+
+
+def test_text_cached_per_parser(cache):
+    digest = cache.put_blob(b"data")
+    assert cache.get_text(digest, "v3.pdf") is None
+    cache.put_text(digest, "v3.pdf", "提取的文本")
+    assert cache.get_text(digest, "v3.pdf") == "提取的文本"
+    assert cache.get_text(digest, "v3.docx") is None
+    assert (cache.stats.text_hits, cache.stats.text_misses) == (1, 2)
+
+
+def test_source_failure_propagates_and_cleans_up(cache, tmp_path):
+    def download():
+        yield b"partial"
+        raise RuntimeError("connection reset")
+
+    with pytest.raises(RuntimeError, match="connection reset"):
+        cache.put_blob_stream(download())
+    assert _leftovers(tmp_path) == []
+    assert _object_keys(cache) == set()
+    assert cache.stats.errors == 0
+
+
+class _FailingInsert:
+    """包装 SQLite 连接，登记 objects 时失败"""
+
+    def __init__(self, conn: sqlite3.Connection):
+        self._conn = conn
+
+    def execute(self, sql, *args):
+        if sql.startswith("INSERT OR REPLACE INTO objects"):
+            raise sqlite3.OperationalError("database is locked")
+        return self._conn.execute(sql, *args)
+
+
+def test_index_failure_removes_unregistered_blob(cache, tmp_path, monkeypatch):
+    conn = cache._db()
+    monkeypatch.setattr(cache, "_db", lambda: _FailingInsert(conn))
+    assert cache.put_blob_stream(iter([b"new content"])) is None
+    assert not os.path.exists(cache.blob_path(content_digest(b"new content")))
+    assert _leftovers(tmp_path) == []
+    assert cache.stats.errors == 1
+
+
+def test_index_failure_keeps_existing_blob(cache, monkeypatch):
+    digest = cache.put_blob(b"shared")
+    conn = cache._db()
+    monkeypatch.setattr(cache, "_db", lambda: _FailingInsert(conn))
+    cache.put_blob(b"shared")
+    assert cache.stats.errors == 1
+    # 已登记的文件由之前的写入负责，不能删除
+    assert cache.read_blob(digest) == b"shared"
+
+
+def test_evict_least_recently_used_and_drop_url_mapping(tmp_path):
+    cache = AttachmentCache(root=str(tmp_path), max_bytes=25)
+    digests = []
+    for i, body in enumerate((b"a" * 10, b"b" * 10)):
+        digests.append(cache.put_blob(body))
+        cache.bind_url(f"https://example.com/{i}", digests[-1], None, None)
+        time.sleep(0.01)
+    # 访问第一个，使第二个成为最久未访问的
+    assert cache.read_blob(digests[0]) is not None
+    time.sleep(0.01)
+    cache.put_blob(b"c" * 10)
+
+    assert cache.stats.evicted == 1
+    assert not os.path.exists(cache.blob_path(digests[1]))
+    assert cache.lookup("https://example.com/1") is None
+    assert cache.lookup("https://example.com/0").digest == digests[0]
+    assert _object_keys(cache) == {digests[0], content_digest(b"c" * 10)}
+
+
+def test_evicted_text_keeps_blob(tmp_path):
+    cache = AttachmentCache(root=str(tmp_path), max_bytes=25)
+    digest = cache.put_blob(b"a" * 10)
+    cache.put_text(digest, "v3.pdf", "t" * 10)
+    time.sleep(0.01)
+    cache.read_blob(digest)
+    time.sleep(0.01)
+    cache.put_blob(b"b" * 10)
+    # 提取文本按自身访问时间先被淘汰，原始内容和 URL 映射保留
+    assert cache.get_text(digest, "v3.pdf") is None
+    assert cache.read_blob(digest) == b"a" * 10
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, "-q"]))
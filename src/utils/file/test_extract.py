@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+测试脚本：按字符/token 预算提取文本时的截断位置、已读单元数、提前停止迭代，以及 DOCX 段落顺序
+"""
+
+import io
+import sys
+import zipfile
+from pathlib import Path
+
+import pytest
+
+# 添加src目录到路径
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from utils.file import extract
+from utils.file.extract import (
+    TRUNCATION_PREFIX,
+    Extracted,
+    TextBudget,
+    extract_docx,
+    iter_docx_paragraphs,
+    take_within_budget,
+    truncate_text,
+)
+
+_DOCUMENT_XML = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"><w:body>'
+    '{body}</w:body></w:document>'
+)
+
+
+def _p(*runs: str) -> str:
+    return "<w:p>" + "".join(runs) + "</w:p>"
+
+
+def _t(text: str) -> str:
+    return f"<w:r><w:t>{text}</w:t></w:r>"
+
+
+def _docx(body: str) -> io.BytesIO:
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as archive:
+        archive.writestr("word/document.xml", _DOCUMENT_XML.format(body=body))
+    buf.seek(0)
+    return buf
+
+
+@pytest.fixture
+def estimated_tokens(monkeypatch):
+    # 固定使用估算：CJK 字符 1 token，其他字符 4 个 1 token
+    monkeypatch.setattr(extract, "_get_encoding", lambda: None)
+
+
+def test_within_budget_not_truncated():
+    result = take_within_budget(["a", "b", "c"], TextBudget(max_chars=100, max_tokens=0), units_total=3)
+    assert result == Extracted("a\nb\nc", False, 3, 3, "段")
+    assert result.render() == "a\nb\nc"
+
+
+def test_char_budget_cuts_last_chunk():
+    result = take_within_budget(["aaaa", "bbbb", "cccc"], TextBudget(max_chars=7, max_tokens=0),
+                                unit="页", units_total=3)
+    # 第二块带分隔符 "\nbbbb"，只放得下 3 个字符
+    assert result.text == "aaaa\nbb"
+    assert result.truncated and result.units_read == 2
+    assert result.render().endswith(f"{TRUNCATION_PREFIX}：已提取 2/3 页，共 7 字符，其余内容未读取]")
+
+
+def test_budget_exhausted_exactly_stops_before_next_chunk():
+    result = take_within_budget(["aaaa", "bbbb"], TextBudget(max_chars=4, max_tokens=0))
+    assert result.text == "aaaa"
+    assert result.truncated and result.units_read == 1
+    assert "已提取前 1 段" in result.render()
+
+
+def test_empty_chunks_counted_as_read():
+    result = take_within_budget(["", "a", "", "b"], TextBudget(max_chars=100, max_tokens=0))
+    assert result.text == "a\nb" and result.units_read == 4
+
+
+def test_token_budget_cuts_proportionally(estimated_tokens):
+    # 每个 CJK 字符 1 token
+    result = take_within_budget(["一二三四五", "六七八九十"], TextBudget(max_chars=0, max_tokens=7))
+    assert result.truncated
+    assert extract.count_tokens(result.text) <= 7
+    assert result.text.startswith("一二三四五\n")
+    assert result.units_read == 2
+
+
+def test_token_budget_latin_estimate(estimated_tokens):
+    assert extract.count_tokens("abcdefgh") == 2
+    result = take_within_budget(["a" * 40, "b" * 40], TextBudget(max_chars=0, max_tokens=10))
+    assert result.text == "a" * 40 and result.truncated and result.units_read == 1
+
+
+def test_stops_consuming_after_budget():
+    consumed = []
+    closed = []
+
+    def pages():
+        try:
+            for i in range(100):
+                consumed.append(i)
+                yield "x" * 10
+        finally:
+            closed.append(True)
+
+    result = take_within_budget(pages(), TextBudget(max_chars=25, max_tokens=0), unit="页", units_total=100)
+    assert result.truncated and result.units_read == 3
+    # 截断后不再生成后续页面，并关闭生成器
+    assert consumed == [0, 1, 2]
+    assert closed == [True]
+
+
+def test_truncate_text_by_lines():
+    text = "\n".join(f"line{i}" for i in range(10))
+    assert truncate_text(text, TextBudget(max_chars=1000, max_tokens=0)) == Extracted(text)
+    result = truncate_text(text, TextBudget(max_chars=11, max_tokens=0))
+    assert result.text == "line0\nline1" and result.unit == "行"
+    assert (result.units_read, result.units_total) == (2, 10)
+
+
+def test_docx_paragraphs_in_document_order():
+    body = (
+        _p(_t("标题"))
+        + "<w:tbl><w:tr><w:tc>" + _p(_t("单元格1")) + "</w:tc><w:tc>" + _p(_t("单元格2")) + "</w:tc></w:tr></w:tbl>"
+        + _p(_t("前"), "<w:r><w:tab/></w:r>", _t("后"), "<w:r><w:br/></w:r>", _t("换行"))
+        + _p()
+        + _p(_t("结尾"))
+    )
+    assert list(iter_docx_paragraphs(_docx(body))) == ["标题", "单元格1", "单元格2", "前\t后\n换行", "结尾"]
+
+
+def test_extract_docx_budget():
+    body = "".join(_p(_t(f"段落{i}")) for i in range(50))
+    result = extract_docx(_docx(body), TextBudget(max_chars=20, max_tokens=0))
+    assert result.text.startswith("段落0\n\n段落1\n\n段落2")
+    assert result.truncated and result.units_total is None
+    assert "已提取前" in result.render()
+
+
+def test_bytes_to_extracted_keeps_flag_through_cache(tmp_path, monkeypatch):
+    for module in ("requests", "chardet", "pptx", "pydantic"):
+        pytest.importorskip(module)
+    from utils.file import file as file_module
+    from utils.file.cache import AttachmentCache
+    from utils.file.file import File, FileOps
+
+    cache = AttachmentCache(root=str(tmp_path), max_bytes=0)
+    monkeypatch.setattr(file_module, "get_attachment_cache", lambda: cache)
+    monkeypatch.setattr(file_module, "get_parser_pool", lambda: None)
+    content = _docx("".join(_p(_t(f"段落{i}")) for i in range(50))).getvalue()
+    budget = TextBudget(max_chars=20, max_tokens=0)
+    file_obj = File(url="memory://a.docx", file_type="document")
+
+    first = FileOps.bytes_to_extracted(file_obj, content, ".docx", budget)
+    second = FileOps.bytes_to_extracted(file_obj, content, ".docx", budget)
+    assert cache.stats.text_hits == 1
+    assert second == first and second.truncated
+    assert FileOps.bytes_to_text(file_obj, content, ".docx", budget) == first.render()
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, "-q"]))
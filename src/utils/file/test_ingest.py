@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""
+测试脚本：附件并发提取按提交顺序返回、共享字节预算、排队/下载超时，以及异步调用方取消时撤销未开始的任务
+"""
+
+import asyncio
+import sys
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+# 添加src目录到路径
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+for module in ("requests", "chardet", "pptx", "pydantic"):
+    pytest.importorskip(module)
+
+from utils.file import ingest
+from utils.file.extract import TRUNCATION_PREFIX, Extracted
+from utils.file.file import ByteBudget, File, FileOps
+from utils.file.ingest import (
+    STATUS_ERROR,
+    STATUS_OK,
+    STATUS_OVER_BUDGET,
+    STATUS_TIMEOUT,
+    AttachmentIngestor,
+)
+
+
+class _FakeSource:
+    """按 url 决定下载耗时和大小，并记录每个附件收到的预算对象"""
+
+    def __init__(self, delays=None, sizes=None, gate: threading.Event = None):
+        self.delays = delays or {}
+        self.sizes = sizes or {}
+        self.gate = gate
+        self.budgets = []
+        self.started = []
+
+    def fetch(self, file_obj, budget=None, deadline=None):
+        self.started.append(file_obj.url)
+        self.budgets.append(budget)
+        if self.gate is not None and file_obj.url == "gate.txt":
+            self.gate.wait(5)
+        delay = self.delays.get(file_obj.url, 0)
+        if delay:
+            time.sleep(delay)
+        if file_obj.url == "broken.txt":
+            raise RuntimeError("connection reset")
+        size = self.sizes.get(file_obj.url, 10)
+        # 与真实下载一样按块扣减共享预算
+        for _ in range(size // 10):
+            budget.charge(10)
+        return b"x" * size, ".txt"
+
+
+@pytest.fixture
+def source(monkeypatch):
+    fake = _FakeSource()
+    fake.parse_timeouts = []
+
+    def to_text(file_obj, content, ext, timeout=None):
+        fake.parse_timeouts.append(timeout)
+        return Extracted(f"{file_obj.url}:{len(content)}", truncated=file_obj.url == "long.txt", units_read=1)
+
+    monkeypatch.setattr(FileOps, "_get_bytes_stream", staticmethod(fake.fetch))
+    monkeypatch.setattr(FileOps, "bytes_to_extracted", staticmethod(to_text))
+    return fake
+
+
+def _files(*urls):
+    return [File(url=url, file_type="document") for url in urls]
+
+
+def test_results_follow_submission_order(source):
+    source.delays = {"a.txt": 0.05, "b.txt": 0.0, "c.txt": 0.02}
+    ingestor = AttachmentIngestor(max_workers=3)
+    results = ingestor.extract_all(_files("a.txt", "b.txt", "c.txt"), timeout=5, max_total_bytes=0)
+    assert [r.url for r in results] == ["a.txt", "b.txt", "c.txt"]
+    assert [r.text for r in results] == ["a.txt:10", "b.txt:10", "c.txt:10"]
+    assert all(r.status == STATUS_OK for r in results)
+    assert ingestor.stats()["completed"] == 3
+
+
+def test_byte_budget_shared_across_batch(source):
+    source.sizes = {"a.txt": 60, "b.txt": 60}
+    ingestor = AttachmentIngestor(max_workers=1)
+    results = ingestor.extract_all(_files("a.txt", "b.txt"), timeout=5, max_total_bytes=100)
+    assert [r.status for r in results] == [STATUS_OK, STATUS_OVER_BUDGET]
+    assert "100 bytes" in results[1].text
+    # 同一批附件共用一个预算对象，下一批重新计数
+    assert source.budgets[0] is source.budgets[1]
+    again = ingestor.extract_all(_files("a.txt"), timeout=5, max_total_bytes=100)
+    assert again[0].status == STATUS_OK
+    assert source.budgets[2] is not source.budgets[0]
+
+
+def test_truncation_flag_from_extractor(source):
+    results = AttachmentIngestor(max_workers=2).extract_all(_files("long.txt", "a.txt"), timeout=5)
+    assert [r.truncated for r in results] == [True, False]
+    assert TRUNCATION_PREFIX in results[0].text
+
+
+def test_download_error_reported_per_file(source):
+    results = AttachmentIngestor(max_workers=2).extract_all(_files("broken.txt", "a.txt"), timeout=5)
+    assert [r.status for r in results] == [STATUS_ERROR, STATUS_OK]
+    assert "connection reset" in results[0].text
+
+
+def test_slow_attachment_times_out_without_blocking_others(source):
+    source.delays = {"slow.txt": 0.5}
+    ingestor = AttachmentIngestor(max_workers=2)
+    started = time.monotonic()
+    results = ingestor.extract_all(_files("slow.txt", "a.txt"), timeout=0.1)
+    assert time.monotonic() - started < 0.4
+    assert [r.status for r in results] == [STATUS_TIMEOUT, STATUS_OK]
+    assert ingestor.stats()["timeouts"] == 1
+
+
+def test_queued_past_deadline_not_started(source):
+    source.delays = {"slow.txt": 0.2}
+    ingestor = AttachmentIngestor(max_workers=1)
+    results = ingestor.extract_all(_files("slow.txt", "queued.txt"), timeout=0.05)
+    assert [r.status for r in results] == [STATUS_TIMEOUT, STATUS_TIMEOUT]
+    # 等待中的任务在收集时被撤销，工作线程空闲后不会再去下载
+    ingestor._executor.shutdown(wait=True)
+    assert source.started == ["slow.txt"]
+
+
+def test_parse_limited_to_remaining_time(source):
+    source.delays = {"a.txt": 0.1}
+    results = AttachmentIngestor(max_workers=1).extract_all(_files("a.txt"), timeout=1)
+    assert results[0].status == STATUS_OK
+    # 下载已用掉约 0.1 秒，解析只能用剩下的时间
+    assert 0 < source.parse_timeouts[0] <= 0.9
+
+
+def test_extract_checks_deadline_before_download(source):
+    now = time.monotonic()
+    result = ingest._extract(_files("a.txt")[0], ByteBudget(0), deadline=now - 1, submitted_at=now - 2)
+    assert result.status == STATUS_TIMEOUT
+    assert "排队超时" in result.text
+    assert result.queue_ms >= 2000
+    assert source.started == []
+
+
+def test_async_results_in_order(source):
+    source.delays = {"a.txt": 0.03}
+    results = asyncio.run(AttachmentIngestor(max_workers=2).aextract_all(_files("a.txt", "b.txt"), timeout=5))
+    assert [r.url for r in results] == ["a.txt", "b.txt"]
+
+
+def test_async_cancel_revokes_pending_tasks(source):
+    gate = threading.Event()
+    source.gate = gate
+    ingestor = AttachmentIngestor(max_workers=1)
+
+    async def run():
+        task = asyncio.create_task(ingestor.aextract_all(_files("gate.txt", "b.txt", "c.txt"), timeout=5))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    try:
+        asyncio.run(run())
+    finally:
+        gate.set()
+    ingestor._executor.shutdown(wait=True)
+    # 正在下载的附件继续完成，排队中的附件被撤销
+    assert source.started == ["gate.txt"]
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, "-q"]))
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+测试脚本：解析进程池的 worker 复用、超时终止、异常退出后恢复、按任务数回收与异步接口
+"""
+
+import asyncio
+import io
+import os
+import signal
+import sys
+import threading
+import zipfile
+from pathlib import Path
+
+import pytest
+
+# 添加src目录到路径
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+# worker 进程导入 utils.file.file 及其依赖
+for module in ("requests", "chardet", "pptx", "pydantic"):
+    pytest.importorskip(module)
+
+from utils.file.file import File
+from utils.file.parser_pool import ParserPool
+
+_DOCUMENT_XML = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"><w:body>'
+    '{paragraphs}</w:body></w:document>'
+)
+
+
+def _docx(*paragraphs: str) -> bytes:
+    body = "".join(f"<w:p><w:r><w:t>{text}</w:t></w:r></w:p>" for text in paragraphs)
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as archive:
+        archive.writestr("word/document.xml", _DOCUMENT_XML.format(paragraphs=body))
+    return buf.getvalue()
+
+
+@pytest.fixture
+def pool():
+    pool = ParserPool(max_workers=1, max_jobs=100)
+    yield pool
+    pool.close()
+
+
+def _file() -> File:
+    return File(url="memory://test.docx", file_type="document")
+
+
+def test_parse_in_worker_and_reuse(pool):
+    assert pool.parse(_file(), _docx("第一段", "第二段"), ".docx").text == "第一段\n\n第二段"
+    assert pool.parse(_file(), _docx("again"), ".docx").text == "again"
+    snapshot = pool.snapshot()
+    assert snapshot["spawned"] == 1
+    assert snapshot["jobs"] == 2
+    assert snapshot["idle"] == 1 and snapshot["busy"] == 0
+
+
+def test_truncation_flag_returned(pool):
+    from utils.file.extract import TextBudget
+
+    result = pool.parse(_file(), _docx("第一段", "第二段", "第三段"), ".docx", TextBudget(max_chars=5, max_tokens=0))
+    assert result.truncated and result.text == "第一段\n\n"
+    assert result.units_read == 2
+
+
+def test_unsupported_format_reported(pool):
+    assert pool.parse(_file(), b"data", ".bin").text.startswith("[暂不支持解析该文档格式")
+
+
+def test_timeout_kills_worker_and_next_job_respawns(pool):
+    # 新 worker 启动解释器所需时间远超 1ms，本次任务必然超时
+    result = pool.parse(_file(), _docx("slow"), ".docx", timeout=0.001)
+    assert result.text.startswith("[解析失败]") and not result.truncated
+    assert pool.snapshot()["timeouts"] == 1
+    assert pool.snapshot()["idle"] == 0
+    assert pool.parse(_file(), _docx("ok"), ".docx").text == "ok"
+    assert pool.snapshot()["spawned"] == 2
+
+
+def test_dead_idle_worker_replaced(pool):
+    assert pool.parse(_file(), _docx("a"), ".docx").text == "a"
+    worker = pool._idle[0]
+    os.kill(worker.process.pid, signal.SIGKILL)
+    worker.process.wait()
+    assert pool.parse(_file(), _docx("b"), ".docx").text == "b"
+    assert pool.snapshot()["spawned"] == 2
+
+
+def test_worker_recycled_after_max_jobs():
+    pool = ParserPool(max_workers=1, max_jobs=2)
+    try:
+        for i in range(5):
+            assert pool.parse(_file(), _docx(f"p{i}"), ".docx").text == f"p{i}"
+        snapshot = pool.snapshot()
+        assert snapshot["recycled"] == 2
+        assert snapshot["spawned"] == 3
+    finally:
+        pool.close()
+
+
+def test_async_parse(pool):
+    async def run():
+        return await asyncio.gather(pool.aparse(_file(), _docx("a"), ".docx"), pool.aparse(_file(), _docx("b"), ".docx"))
+
+    assert [r.text for r in asyncio.run(run())] == ["a", "b"]
+    assert pool.snapshot()["jobs"] == 2
+
+
+def test_concurrent_stats_consistent():
+    pool = ParserPool(max_workers=4, max_jobs=3)
+    try:
+        texts = []
+
+        def parse_many():
+            for i in range(6):
+                texts.append(pool.parse(_file(), _docx(f"p{i}"), ".docx").text)
+
+        threads = [threading.Thread(target=parse_many) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        snapshot = pool.snapshot()
+        assert len(texts) == 24 and snapshot["jobs"] == 24
+        # 每个 worker 处理 3 个任务后回收，回收数与任务数一致
+        assert snapshot["recycled"] == 8
+        assert snapshot["spawned"] == snapshot["recycled"] + snapshot["idle"]
+    finally:
+        pool.close()
+
+
+def test_closed_pool_discards_workers(pool):
+    pool.parse(_file(), _docx("a"), ".docx")
+    worker = pool._idle[0]
+    pool.close()
+    assert worker.process.poll() is not None
+    assert pool.snapshot()["idle"] == 0
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, "-q"]))
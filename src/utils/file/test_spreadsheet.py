@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+测试脚本：表格摘要的逐列统计、分层抽样、行数/字节上限，以及 csv 按列决定字段类型和日期解析
+"""
+
+import sys
+from datetime import date, datetime
+from pathlib import Path
+
+import pytest
+
+# 添加src目录到路径
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+pytest.importorskip("chardet")
+
+from utils.file import spreadsheet
+from utils.file.spreadsheet import StratifiedSample, summarize_sheet, summarize_spreadsheet
+
+
+def _csv(header, rows) -> bytes:
+    lines = [",".join(header)] + [",".join(str(v) for v in row) for row in rows]
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def _field(summary: str, name: str) -> str:
+    return next(line for line in summary.splitlines() if line.startswith(f"- {name} ("))
+
+
+def test_small_sheet_inlined():
+    summary = summarize_sheet("S", ["a", "b"], iter([(1, "x"), (2, "y")]), inline_rows=5)
+    assert "行数: 2，列数: 2" in summary
+    assert "[全部数据]" in summary
+    assert summary.splitlines()[-1] == "2 | y"
+
+
+def test_large_sheet_summarized_with_column_stats():
+    rows = ((i, "even" if i % 2 == 0 else "odd", None if i % 10 == 0 else i * 0.5) for i in range(100))
+    summary = summarize_sheet("S", ["id", "kind", "score"], rows, inline_rows=10, sample_rows=9)
+    assert "[字段]" in summary and "[全部数据]" not in summary
+    assert _field(summary, "id") == "- id (整数): 非空 100, 空值 0, 唯一值 100, 范围 0 ~ 99, 均值 49.5"
+    assert "常见值: even(50), odd(50)" in _field(summary, "kind")
+    assert "空值 10" in _field(summary, "score")
+
+
+def test_row_limit_reported():
+    summary = summarize_sheet("S", ["n"], ([i] for i in range(1000)), max_rows=100, inline_rows=10)
+    assert "行数: ≥100（达到扫描上限" in summary
+    assert "非空 100" in _field(summary, "n")
+
+
+def test_blank_header_and_extra_columns():
+    summary = summarize_sheet("S", ["a", None, "c"], iter([(1, 2, 3, 4)]), max_columns=2)
+    assert "列数: 3（只统计前 2 列）" in summary
+    assert "a | 列2" in summary
+
+
+def test_stratified_sample_covers_head_middle_tail_and_groups():
+    sample = StratifiedSample(size=9, columns=2, seed=1)
+    for i in range(1000):
+        # 低基数字段 region 的 "rare" 只出现在中间某一行
+        sample.add(i, (i, "rare" if i == 500 else ("north" if i % 2 else "south")))
+    indexes = [index for index, _ in sample.rows()]
+    assert indexes[:3] == [0, 1, 2]
+    assert indexes[-3:] == [997, 998, 999]
+    assert 500 in indexes
+    assert sample.group_column() == 1
+    middle = [index for index, _ in sample.middle]
+    assert len(middle) == 3 and all(3 <= index < 997 for index in middle)
+
+
+def test_high_cardinality_column_not_used_for_groups():
+    sample = StratifiedSample(size=3, columns=1)
+    for i in range(100):
+        sample.add(i, (f"user-{i}",))
+    assert sample.group_column() is None
+
+
+def test_csv_leading_zero_makes_whole_column_text():
+    content = _csv(["code", "qty"], [(7, 1), ("007", 2), (12, 3)] * 30)
+    summary = summarize_spreadsheet(content, ".csv")
+    code = _field(summary, "code")
+    assert code.startswith("- code (文本)")
+    assert "类型混合" not in code and "范围" not in code
+    assert "常见值: 7(30), 007(30), 12(30)" in code
+    assert _field(summary, "qty").startswith("- qty (整数)")
+
+
+def test_csv_dates_parsed():
+    rows = [(f"2024-01-{d:02d}", f"2024/2/{d} 08:30") for d in range(1, 29)] * 3
+    summary = summarize_spreadsheet(_csv(["day", "at"], rows), ".csv")
+    assert _field(summary, "day").startswith("- day (日期)")
+    assert "范围 2024-01-01 ~ 2024-01-28" in _field(summary, "day")
+    assert "范围 2024-02-01 08:30:00 ~ 2024-02-28 08:30:00" in _field(summary, "at")
+
+
+def test_coerce_cells():
+    assert spreadsheet._coerce(" 42 ") == 42
+    assert spreadsheet._coerce("1.5") == 1.5
+    assert spreadsheet._coerce("") is None
+    assert spreadsheet._coerce("2024-13-01") == "2024-13-01"
+    assert spreadsheet._coerce("2024.3.5") == date(2024, 3, 5)
+    assert spreadsheet._coerce("2024-03-05T10:00:01.5") == datetime(2024, 3, 5, 10, 0, 1, 500000)
+    assert spreadsheet._coerce("nan") == "nan"
+
+
+def test_csv_byte_limit_reported(monkeypatch):
+    monkeypatch.setattr(spreadsheet, "SPREADSHEET_MAX_BYTES", 16 * 1024)
+    content = _csv(["n", "text"], [(i, "x" * 50) for i in range(5000)])
+    summary = summarize_spreadsheet(content, ".csv")
+    assert summary.endswith(f"（文件超过 {16 * 1024} 字节，只统计了前面部分）")
+    scanned = int(_field(summary, "n").split("非空 ")[1].split(",")[0])
+    assert 0 < scanned < 5000
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, "-q"]))
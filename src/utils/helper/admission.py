@@ -0,0 +1,284 @@
+"""
+准入控制
+
+- 每个端点独立的并发上限（/stream_run、/run、/node_run）
+- 两条优先级通道：interactive（流式）与 batch（/run、/node_run）。总并发中为 interactive 预留一部分，
+  batch 无法占用；槽位释放时优先唤醒 interactive 的排队请求
+- 同一通道内按 project_id 轮转唤醒排队请求，可选的单项目并发上限避免单个项目占满端点
+- 排队超时或队列已满时立即拒绝（HTTP 429 + Retry-After），并记录排队等待统计
+"""
+import asyncio
+import logging
+import math
+import os
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Any, Deque, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+LANE_INTERACTIVE = "interactive"
+LANE_BATCH = "batch"
+# 唤醒顺序
+LANE_PRIORITY = (LANE_INTERACTIVE, LANE_BATCH)
+
+# 默认关闭，开启后各端点按下面的上限和排队超时限流
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "false").lower() in ("1", "true", "yes")
+# 所有端点合计的并发上限
+ADMISSION_MAX_CONCURRENCY = int(os.getenv("ADMISSION_MAX_CONCURRENCY", "128"))
+# 为 interactive 通道预留的并发数
+ADMISSION_INTERACTIVE_RESERVED = int(os.getenv("ADMISSION_INTERACTIVE_RESERVED", "32"))
+# 单个项目在一个端点上的并发上限，0 表示不限制
+ADMISSION_PER_PROJECT_LIMIT = int(os.getenv("ADMISSION_PER_PROJECT_LIMIT", "0"))
+# 每个端点的最大排队数
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "256"))
+
+
+@dataclass
+class EndpointPolicy:
+    name: str
+    lane: str
+    limit: int
+    queue_timeout_seconds: float
+
+
+def _policy(name: str, lane: str, limit: str, queue_timeout_ms: str) -> EndpointPolicy:
+    env = name.upper()
+    return EndpointPolicy(
+        name=name,
+        lane=lane,
+        limit=int(os.getenv(f"ADMISSION_{env}_LIMIT", limit)),
+        queue_timeout_seconds=int(os.getenv(f"ADMISSION_{env}_QUEUE_TIMEOUT_MS", queue_timeout_ms)) / 1000.0,
+    )
+
+
+DEFAULT_POLICIES = (
+    _policy("stream_run", LANE_INTERACTIVE, "96", "5000"),
+    _policy("run", LANE_BATCH, "64", "30000"),
+    _policy("node_run", LANE_BATCH, "64", "30000"),
+)
+
+
+class AdmissionRejected(Exception):
+    """超出容量，调用方应返回 429 并带上 Retry-After"""
+
+    def __init__(self, endpoint: str, reason: str, retry_after: int):
+        self.endpoint = endpoint
+        self.reason = reason
+        self.retry_after = retry_after
+        super().__init__(f"Admission rejected for {endpoint}: {reason}")
+
+
+@dataclass
+class EndpointStats:
+    admitted: int = 0
+    rejected: Dict[str, int] = field(default_factory=dict)  # reason -> 次数
+    queued_total: int = 0
+    queue_wait_ms_total: float = 0.0
+    queue_wait_ms_max: float = 0.0
+    hold_seconds_ewma: float = 1.0
+
+    def record_wait(self, wait_ms: float):
+        self.queued_total += 1
+        self.queue_wait_ms_total += wait_ms
+        self.queue_wait_ms_max = max(self.queue_wait_ms_max, wait_ms)
+
+    def record_hold(self, seconds: float):
+        self.hold_seconds_ewma = 0.8 * self.hold_seconds_ewma + 0.2 * seconds
+
+
+class AdmissionTicket:
+    """已获准入的槽位，请求（或流式响应）结束时调用 release()，重复调用无副作用"""
+
+    def __init__(self, controller: "AdmissionController", policy: EndpointPolicy, project_id: str):
+        self._controller = controller
+        self.policy = policy
+        self.project_id = project_id
+        self.admitted_at = time.monotonic()
+        self.queue_wait_ms = 0.0
+        self._released = False
+
+    def release(self):
+        if self._released:
+            return
+        self._released = True
+        self._controller._release(self)
+
+
+class AdmissionController:
+    def __init__(
+            self,
+            policies=DEFAULT_POLICIES,
+            max_concurrency: int = ADMISSION_MAX_CONCURRENCY,
+            interactive_reserved: int = ADMISSION_INTERACTIVE_RESERVED,
+            per_project_limit: int = ADMISSION_PER_PROJECT_LIMIT,
+            max_queue: int = ADMISSION_MAX_QUEUE,
+    ):
+        self.policies: Dict[str, EndpointPolicy] = {p.name: p for p in policies}
+        self.max_concurrency = max_concurrency
+        self.interactive_reserved = min(interactive_reserved, max_concurrency)
+        self.per_project_limit = per_project_limit
+        self.max_queue = max_queue
+
+        self._active: Dict[str, int] = {name: 0 for name in self.policies}
+        self._lane_active: Dict[str, int] = {lane: 0 for lane in LANE_PRIORITY}
+        self._project_active: Dict[Tuple[str, str], int] = {}
+        # endpoint -> project_id -> 排队的 future（按项目轮转唤醒）
+        self._waiters: Dict[str, "OrderedDict[str, Deque[asyncio.Future]]"] = {
+            name: OrderedDict() for name in self.policies
+        }
+        self._queued: Dict[str, int] = {name: 0 for name in self.policies}
+        self._stats: Dict[str, EndpointStats] = {name: EndpointStats() for name in self.policies}
+
+    async def acquire(self, endpoint: str, project_id: str = "") -> AdmissionTicket:
+        policy = self.policies[endpoint]
+        stats = self._stats[endpoint]
+
+        # 已有排队请求时不插队，保证公平
+        if self._queued[endpoint] == 0 and self._can_admit(policy, project_id):
+            return self._grant(policy, project_id)
+
+        if policy.queue_timeout_seconds <= 0:
+            raise self._reject(policy, "capacity")
+        if self._queued[endpoint] >= self.max_queue:
+            raise self._reject(policy, "queue_full")
+
+        loop = asyncio.get_running_loop()
+        fut: asyncio.Future = loop.create_future()
+        self._waiters[endpoint].setdefault(project_id, deque()).append(fut)
+        self._queued[endpoint] += 1
+        t0 = time.monotonic()
+        try:
+            ticket = await asyncio.wait_for(asyncio.shield(fut), timeout=policy.queue_timeout_seconds)
+        except asyncio.TimeoutError:
+            if self._discard_waiter(endpoint, project_id, fut) or not fut.done() or fut.cancelled():
+                raise self._reject(policy, "queue_timeout")
+            # 超时的同时已被分配到槽位：直接使用，否则该槽位不会被归还
+            ticket = fut.result()
+        except asyncio.CancelledError:
+            # 调用方断开：已分配到的槽位要归还
+            if not self._discard_waiter(endpoint, project_id, fut) and fut.done() and not fut.cancelled():
+                fut.result().release()
+            raise
+        ticket.queue_wait_ms = (time.monotonic() - t0) * 1000
+        stats.record_wait(ticket.queue_wait_ms)
+        return ticket
+
+    def _can_admit(self, policy: EndpointPolicy, project_id: str) -> bool:
+        if self._active[policy.name] >= policy.limit:
+            return False
+        if self.per_project_limit > 0 and \
+                self._project_active.get((policy.name, project_id), 0) >= self.per_project_limit:
+            return False
+        total = sum(self._lane_active.values())
+        if total >= self.max_concurrency:
+            return False
+        if policy.lane != LANE_INTERACTIVE and \
+                self._lane_active[policy.lane] >= self.max_concurrency - self.interactive_reserved:
+            return False
+        return True
+
+    def _grant(self, policy: EndpointPolicy, project_id: str) -> AdmissionTicket:
+        self._active[policy.name] += 1
+        self._lane_active[policy.lane] += 1
+        key = (policy.name, project_id)
+        self._project_active[key] = self._project_active.get(key, 0) + 1
+        self._stats[policy.name].admitted += 1
+        return AdmissionTicket(self, policy, project_id)
+
+    def _release(self, ticket: AdmissionTicket):
+        policy = ticket.policy
+        self._active[policy.name] -= 1
+        self._lane_active[policy.lane] -= 1
+        key = (policy.name, ticket.project_id)
+        remaining = self._project_active.get(key, 1) - 1
+        if remaining:
+            self._project_active[key] = remaining
+        else:
+            self._project_active.pop(key, None)
+        self._stats[policy.name].record_hold(time.monotonic() - ticket.admitted_at)
+        self._dispatch()
+
+    def _dispatch(self):
+        """按通道优先级、项目轮转把空出的槽位分配给排队请求"""
+        for lane in LANE_PRIORITY:
+            for policy in self.policies.values():
+                if policy.lane != lane:
+                    continue
+                waiters = self._waiters[policy.name]
+                progressed = True
+                while waiters and progressed:
+                    progressed = False
+                    for project_id in list(waiters.keys()):
+                        if not self._can_admit(policy, project_id):
+                            continue
+                        queue = waiters[project_id]
+                        fut = queue.popleft()
+                        self._queued[policy.name] -= 1
+                        if queue:
+                            # 轮转：本项目移到队尾
+                            waiters.move_to_end(project_id)
+                        else:
+                            del waiters[project_id]
+                        fut.set_result(self._grant(policy, project_id))
+                        progressed = True
+                        break
+
+    def _discard_waiter(self, endpoint: str, project_id: str, fut: asyncio.Future) -> bool:
+        queue = self._waiters[endpoint].get(project_id)
+        if queue is None or fut not in queue:
+            return False
+        queue.remove(fut)
+        if not queue:
+            del self._waiters[endpoint][project_id]
+        self._queued[endpoint] -= 1
+        fut.cancel()
+        return True
+
+    def _reject(self, policy: EndpointPolicy, reason: str) -> AdmissionRejected:
+        stats = self._stats[policy.name]
+        stats.rejected[reason] = stats.rejected.get(reason, 0) + 1
+        # 按平均占用时长估算排在前面的请求全部完成所需时间
+        backlog = self._queued[policy.name] + 1
+        retry_after = max(1, math.ceil(stats.hold_seconds_ewma * backlog / max(policy.limit, 1)))
+        logger.warning(
+            f"Admission rejected: endpoint={policy.name}, reason={reason}, "
+            f"active={self._active[policy.name]}, queued={self._queued[policy.name]}, retry_after={retry_after}s"
+        )
+        return AdmissionRejected(policy.name, reason, retry_after)
+
+    def stats(self) -> Dict[str, Any]:
+        endpoints: Dict[str, Any] = {}
+        for name, policy in self.policies.items():
+            s = self._stats[name]
+            endpoints[name] = {
+                "lane": policy.lane,
+                "limit": policy.limit,
+                "active": self._active[name],
+                "queued": self._queued[name],
+                "admitted": s.admitted,
+                "rejected": dict(s.rejected),
+                "queue_wait_ms_avg": round(s.queue_wait_ms_total / s.queued_total, 2) if s.queued_total else 0.0,
+                "queue_wait_ms_max": round(s.queue_wait_ms_max, 2),
+                "queue_wait_ms_total": round(s.queue_wait_ms_total, 2),
+                "queued_total": s.queued_total,
+            }
+        return {
+            "enabled": ADMISSION_ENABLED,
+            "max_concurrency": self.max_concurrency,
+            "interactive_reserved": self.interactive_reserved,
+            "per_project_limit": self.per_project_limit,
+            "lanes": dict(self._lane_active),
+            "endpoints": endpoints,
+        }
+
+
+_controller: Optional[AdmissionController] = None
+
+
+def get_admission_controller() -> AdmissionController:
+    global _controller
+    if _controller is None:
+        _controller = AdmissionController()
+    return _controller
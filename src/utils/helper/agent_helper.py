@@ -1,10 +1,13 @@
 import uuid
 import json
+import logging
 import os
-from typing import Any, Dict, List, Tuple, Iterator
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple, Iterator
 import time
-from utils.file.file import File, FileOps, infer_file_category
+from utils.file.file import File, infer_file_category
+from utils.file.ingest import AttachmentResult, get_attachment_ingestor
 from utils.error import classify_error
+from utils.helper.cancellation import RunCancelledError
 
 from utils.messages.client import (
     ClientMessage,
@@ -25,14 +28,20 @@ from utils.messages.server import (
     MESSAGE_TYPE_MESSAGE_START,
     MESSAGE_TYPE_MESSAGE_END,
     MESSAGE_END_CODE_SUCCESS,
+    MESSAGE_END_CODE_CANCELED,
     MESSAGE_TYPE_ANSWER,
     MESSAGE_TYPE_TOOL_REQUEST,
     MESSAGE_TYPE_TOOL_RESPONSE,
 )
+from utils.messages.usage import UsageMeter
 
+logger = logging.getLogger(__name__)
 
-def to_stream_input(msg: ClientMessage) -> Dict[str, Any]:
+
+def _prompt_parts(msg: ClientMessage) -> Tuple[List[Optional[Dict[str, Any]]], List[Tuple[int, Any, File]]]:
+    """转换 prompt 块；文档附件先占位，返回 (content_parts, [(占位下标, 附件信息, File), ...])"""
     content_parts = []
+    documents = []
     if msg and msg.content and msg.content.query and msg.content.query.prompt:
         for block in msg.content.query.prompt:
             if block.type == "text" and block.content and block.content.text:
@@ -82,17 +91,36 @@ def to_stream_input(msg: ClientMessage) -> Dict[str, Any]:
                         }
                     )
                 else:
-                    file_content = FileOps.extract_text(file_data)
-                    content_parts.append(
-                        {
-                            "type": "text",
-                            "text": f"file name:{file_info.file_name}, url: {file_info.url}\n\nFile Content:\n{file_content}",
-                        }
-                    )
+                    # 文档先占位，全部块遍历完后并发提取，按原位置回填以保持顺序
+                    documents.append((len(content_parts), file_info, file_data))
+                    content_parts.append(None)
+
+    return content_parts, documents
+
 
+def _fill_documents(content_parts: List[Optional[Dict[str, Any]]], documents: List[Tuple[int, Any, File]],
+                    results: List[AttachmentResult]) -> Dict[str, Any]:
+    for (index, file_info, _), result in zip(documents, results):
+        content_parts[index] = {
+            "type": "text",
+            "text": f"file name:{file_info.file_name}, url: {file_info.url}\n\nFile Content:\n{result.text}",
+        }
     return {"messages": [{"role": "user", "content": content_parts}]}
 
 
+def to_stream_input(msg: ClientMessage) -> Dict[str, Any]:
+    content_parts, documents = _prompt_parts(msg)
+    results = get_attachment_ingestor().extract_all([file_data for _, _, file_data in documents])
+    return _fill_documents(content_parts, documents, results)
+
+
+async def ato_stream_input(msg: ClientMessage) -> Dict[str, Any]:
+    """to_stream_input 的异步版本：等待附件下载和解析时不阻塞事件循环"""
+    content_parts, documents = _prompt_parts(msg)
+    results = await get_attachment_ingestor().aextract_all([file_data for _, _, file_data in documents])
+    return _fill_documents(content_parts, documents, results)
+
+
 def to_client_message(d: Dict[str, Any]) -> Tuple[ClientMessage, str]:
     prompt_list = d.get("content", {}).get("query", {}).get("prompt", [])
     blocks: List[PromptBlock] = []
@@ -278,31 +306,44 @@ def _item_to_server_messages(
     return messages
 
 
-def _iter_body_to_server_messages(
-        items: Iterator[Dict[Any, Dict[str, Any]]],
-        *,
-        session_id: str,
-        query_msg_id: str,
-        reply_id: str,
-        sequence_id_start: int = 1,
-        log_id: str = "",
-) -> Iterator[ServerMessage]:
-    seq = sequence_id_start
-    # Stable msg_id mapping per logical message stream
-    # Keys are derived from meta to keep same msg_id across chunks
-    stable_ids: Dict[Tuple[str, Any], str] = {}
-
-    accumulated_tool_chunks: List[Any] = []
-    accumulated_tool_response_content: Dict[str, str] = {}
-
-    def _flush_tool_chunks(seq_num: int) -> Tuple[List[ServerMessage], int]:
-        nonlocal accumulated_tool_chunks
+class _BodyConverter:
+    """
+    Stateful converter from LangGraph "messages" stream items to ServerMessages.
+
+    Shared by the sync and async iterators so both paths keep identical
+    tool-call merging, sequence numbering and msg_id grouping.
+    """
+
+    def __init__(
+            self,
+            *,
+            session_id: str,
+            query_msg_id: str,
+            reply_id: str,
+            sequence_id_start: int = 1,
+            log_id: str = "",
+            t0: Optional[float] = None,
+    ):
+        self.session_id = session_id
+        self.query_msg_id = query_msg_id
+        self.reply_id = reply_id
+        self.log_id = log_id
+        self.seq = sequence_id_start
+        # Stable msg_id mapping per logical message stream
+        # Keys are derived from meta to keep same msg_id across chunks
+        self.stable_ids: Dict[Tuple[str, Any], str] = {}
+        self.accumulated_tool_chunks: List[Any] = []
+        self.accumulated_tool_response_content: Dict[str, str] = {}
+        # token 用量与 TTFT/token 间延迟，写入 message_end
+        self.usage = UsageMeter(t0)
+
+    def _flush_tool_chunks(self, seq_num: int) -> Tuple[List[ServerMessage], int]:
         msgs: List[ServerMessage] = []
-        if not accumulated_tool_chunks:
+        if not self.accumulated_tool_chunks:
             return msgs, seq_num
 
-        merged_tcs = _merge_tool_call_chunks(accumulated_tool_chunks)
-        accumulated_tool_chunks = []
+        merged_tcs = _merge_tool_call_chunks(self.accumulated_tool_chunks)
+        self.accumulated_tool_chunks = []
         for tc in merged_tcs:
             raw_args = tc.get("args", {})
             if isinstance(raw_args, str):
@@ -327,28 +368,32 @@ def _iter_body_to_server_messages(
             msgs.append(
                 ServerMessage(
                     type=MESSAGE_TYPE_TOOL_REQUEST,
-                    session_id=session_id,
-                    query_msg_id=query_msg_id,
-                    reply_id=reply_id,
+                    session_id=self.session_id,
+                    query_msg_id=self.query_msg_id,
+                    reply_id=self.reply_id,
                     msg_id=str(uuid.uuid4()),
                     sequence_id=seq_num,
                     finish=True,
                     content=content,
-                    log_id=log_id,
+                    log_id=self.log_id,
                 )
             )
             seq_num += 1
         return msgs, seq_num
 
-    for item in items:
+    def feed(self, item: Tuple[Any, Dict[str, Any]]) -> List[ServerMessage]:
         chunk, meta = item
         chunk_type = chunk.__class__.__name__
         is_last = (meta or {}).get("chunk_position") == "last"
         is_streaming = (meta or {}).get("chunk_position") is not None
+        seq = self.seq
 
         msgs_to_yield: List[ServerMessage] = []
         flushed_msgs: List[ServerMessage] = []
 
+        if chunk_type in ("AIMessageChunk", "AIMessage"):
+            self.usage.observe(chunk)
+
         # 0. Flush accumulated tool chunks if we receive something that is NOT an AIMessageChunk
         # OR if we receive an AIMessageChunk but it seems to be a new message (e.g. different id, though hard to track without state)
         # Simplest logic: If we have accumulated chunks, and we get a non-AIMessageChunk, flush.
@@ -361,24 +406,24 @@ def _iter_body_to_server_messages(
         # because usually tool calls and text content are either separate or tool calls come first.
         # But let's be safe: only flush on ToolMessage or if is_last=True on AIMessageChunk.
 
-        if chunk_type == "ToolMessage" and accumulated_tool_chunks:
-            f_msgs, seq = _flush_tool_chunks(seq)
+        if chunk_type == "ToolMessage" and self.accumulated_tool_chunks:
+            f_msgs, seq = self._flush_tool_chunks(seq)
             flushed_msgs.extend(f_msgs)
 
         # 1. Handle AIMessageChunk with tool_call_chunks (Streaming Tool Request)
         if chunk_type == "AIMessageChunk":
             tc_chunks = getattr(chunk, "tool_call_chunks", None)
             if tc_chunks:
-                accumulated_tool_chunks.extend(tc_chunks)
+                self.accumulated_tool_chunks.extend(tc_chunks)
             # If we have accumulated chunks but this chunk has NO tool_call_chunks,
             # it implies the tool definition phase is likely over.
-            elif accumulated_tool_chunks:
-                f_msgs, seq = _flush_tool_chunks(seq)
+            elif self.accumulated_tool_chunks:
+                f_msgs, seq = self._flush_tool_chunks(seq)
                 flushed_msgs.extend(f_msgs)
 
             # Flush if this is the last chunk
-            if is_last and accumulated_tool_chunks:
-                f_msgs, seq = _flush_tool_chunks(seq)
+            if is_last and self.accumulated_tool_chunks:
+                f_msgs, seq = self._flush_tool_chunks(seq)
                 flushed_msgs.extend(f_msgs)
 
         # 2. Handle ToolMessage (Tool Response)
@@ -393,12 +438,12 @@ def _iter_body_to_server_messages(
                 full_result = result
                 should_emit = True
             else:
-                if tcid not in accumulated_tool_response_content:
-                    accumulated_tool_response_content[tcid] = ""
-                accumulated_tool_response_content[tcid] += str(result)
+                if tcid not in self.accumulated_tool_response_content:
+                    self.accumulated_tool_response_content[tcid] = ""
+                self.accumulated_tool_response_content[tcid] += str(result)
 
                 if is_last:
-                    full_result = accumulated_tool_response_content.pop(tcid)
+                    full_result = self.accumulated_tool_response_content.pop(tcid)
                     should_emit = True
 
             if should_emit:
@@ -412,14 +457,14 @@ def _iter_body_to_server_messages(
                 msgs_to_yield.append(
                     ServerMessage(
                         type=MESSAGE_TYPE_TOOL_RESPONSE,
-                        session_id=session_id,
-                        query_msg_id=query_msg_id,
-                        reply_id=reply_id,
+                        session_id=self.session_id,
+                        query_msg_id=self.query_msg_id,
+                        reply_id=self.reply_id,
                         msg_id=str(uuid.uuid4()),
                         sequence_id=seq,
                         finish=True,
                         content=content,
-                        log_id=log_id,
+                        log_id=self.log_id,
                     )
                 )
                 seq += 1
@@ -428,33 +473,26 @@ def _iter_body_to_server_messages(
         if chunk_type != "ToolMessage":
             inner_msgs = _item_to_server_messages(
                 item,
-                session_id=session_id,
-                query_msg_id=query_msg_id,
-                reply_id=reply_id,
+                session_id=self.session_id,
+                query_msg_id=self.query_msg_id,
+                reply_id=self.reply_id,
                 sequence_id_start=seq,
-                log_id=log_id,
+                log_id=self.log_id,
             )
             # Combine: flushed (previous) + inner (current)
             final_msgs = flushed_msgs + inner_msgs
             msgs_to_yield.extend(final_msgs)
-            
+
             if inner_msgs:
                 seq = inner_msgs[-1].sequence_id + 1
         else:
             # For ToolMessage, msgs_to_yield already contains the ToolResponse (from block 2).
-            # We need to prepend flushed_msgs (from block 0).
-            # Note: msgs_to_yield might contain ToolResponse or nothing (if not emitted yet).
-            # But flushed_msgs MUST come before whatever is in msgs_to_yield.
-            # However, msgs_to_yield is a list we are appending to.
-            # So we should insert flushed_msgs at the beginning?
-            # Or better, just construct a new list.
-            
-            # Current content of msgs_to_yield comes from block 2 (Tool Response).
-            # flushed_msgs comes from block 0 (Tool Requests flushed).
+            # flushed_msgs (Tool Requests flushed in block 0) MUST come before it.
             # Order: Tool Request -> Tool Response.
             final_msgs = flushed_msgs + msgs_to_yield
             msgs_to_yield = final_msgs
 
+        self.seq = seq
 
         for m in msgs_to_yield:
             # Derive a stable grouping base for this item
@@ -481,34 +519,50 @@ def _iter_body_to_server_messages(
             else:
                 key = (m.type, group_base)
 
-            if key not in stable_ids:
-                stable_ids[key] = str(uuid.uuid4())
-            m.msg_id = stable_ids[key]
+            if key not in self.stable_ids:
+                self.stable_ids[key] = str(uuid.uuid4())
+            m.msg_id = self.stable_ids[key]
 
-            yield m
+        return msgs_to_yield
 
 
-def iter_server_messages(
+def _iter_body_to_server_messages(
         items: Iterator[Dict[Any, Dict[str, Any]]],
+        *,
+        session_id: str,
+        query_msg_id: str,
+        reply_id: str,
+        sequence_id_start: int = 1,
+        log_id: str = "",
+) -> Iterator[ServerMessage]:
+    converter = _BodyConverter(
+        session_id=session_id,
+        query_msg_id=query_msg_id,
+        reply_id=reply_id,
+        sequence_id_start=sequence_id_start,
+        log_id=log_id,
+    )
+    for item in items:
+        yield from converter.feed(item)
+
+
+def _message_start(
         *,
         session_id: str,
         query_msg_id: str,
         local_msg_id: str,
         run_id: str,
-        sequence_id_start: int = 1,
+        reply_id: str,
+        sequence_id: int,
         log_id: str,
-) -> Iterator[ServerMessage]:
-    t0 = time.time()
-    reply_id = str(uuid.uuid4())
-    start_msg_id = str(uuid.uuid4())
-    # message_start
-    start_sm = ServerMessage(
+) -> ServerMessage:
+    return ServerMessage(
         type=MESSAGE_TYPE_MESSAGE_START,
         session_id=session_id,
         query_msg_id=query_msg_id,
         reply_id=reply_id,
-        msg_id=start_msg_id,
-        sequence_id=sequence_id_start,
+        msg_id=str(uuid.uuid4()),
+        sequence_id=sequence_id,
         finish=True,
         content=ServerMessageContent(
             message_start=MessageStartDetail(
@@ -517,67 +571,171 @@ def iter_server_messages(
         ),
         log_id=log_id,
     )
-    yield start_sm
-    next_seq = sequence_id_start + 1
+
+
+def _log_stream_usage(run_id: str, usage: Dict[str, Any], t_ms: int, code: str, log_id: str) -> None:
+    """流式用量除控制台外也写入节点日志文件，与 graph 模式的流程结束日志一起供分析"""
+    logger.info(f"Stream usage: log_id={log_id}, time_cost_ms={t_ms}, {usage}")
+    # node_log 依赖 langchain/openai 回调，按需导入
+    from utils.log.node_log import log_stream_usage
+
+    log_stream_usage(
+        execution_id=run_id,
+        usage=usage,
+        latency_ms=t_ms,
+        error_code="" if code == MESSAGE_END_CODE_SUCCESS else code,
+        log_id=log_id,
+    )
+
+
+def _message_end(
+        *,
+        session_id: str,
+        query_msg_id: str,
+        reply_id: str,
+        sequence_id: int,
+        log_id: str,
+        t0: float,
+        run_id: str = "",
+        ex: Optional[Exception] = None,
+        usage: Optional[UsageMeter] = None,
+) -> ServerMessage:
+    t_ms = int((time.time() - t0) * 1000)
+    if ex is None:
+        code, message = MESSAGE_END_CODE_SUCCESS, ""
+    elif isinstance(ex, RunCancelledError):
+        # 取消令牌中断了 graph 或模型流：按取消结束，不作为执行错误分类
+        code, message = MESSAGE_END_CODE_CANCELED, str(ex)
+    else:
+        # 使用错误分类器获取错误码
+        err = classify_error(ex, {"node_name": "stream"})
+        code, message = str(err.code), err.message
+    detail = MessageEndDetail(
+        code=code,
+        message=message,
+        token_cost=TokenCost(input_tokens=0, output_tokens=0, total_tokens=0),
+        time_cost_ms=t_ms,
+    )
+    if usage is not None:
+        usage.fill(detail)
+        _log_stream_usage(run_id, usage.to_dict(), t_ms, code, log_id)
+    return ServerMessage(
+        type=MESSAGE_TYPE_MESSAGE_END,
+        session_id=session_id,
+        query_msg_id=query_msg_id,
+        reply_id=reply_id,
+        msg_id=str(uuid.uuid4()),
+        sequence_id=sequence_id,
+        finish=True,
+        content=ServerMessageContent(message_end=detail),
+        log_id=log_id,
+    )
+
+
+def iter_server_messages(
+        items: Iterator[Dict[Any, Dict[str, Any]]],
+        *,
+        session_id: str,
+        query_msg_id: str,
+        local_msg_id: str,
+        run_id: str,
+        sequence_id_start: int = 1,
+        log_id: str,
+) -> Iterator[ServerMessage]:
+    t0 = time.time()
+    reply_id = str(uuid.uuid4())
+    # message_start
+    yield _message_start(
+        session_id=session_id,
+        query_msg_id=query_msg_id,
+        local_msg_id=local_msg_id,
+        run_id=run_id,
+        reply_id=reply_id,
+        sequence_id=sequence_id_start,
+        log_id=log_id,
+    )
+    converter = _BodyConverter(
+        session_id=session_id,
+        query_msg_id=query_msg_id,
+        reply_id=reply_id,
+        sequence_id_start=sequence_id_start + 1,
+        log_id=log_id,
+        t0=t0,
+    )
     last_seq = sequence_id_start
+    error = None
     try:
         # body stream
-        for sm in _iter_body_to_server_messages(
-                items,
-                session_id=session_id,
-                query_msg_id=query_msg_id,
-                reply_id=reply_id,
-                sequence_id_start=next_seq,
-                log_id=log_id,
-        ):
-            yield sm
-            last_seq = sm.sequence_id
-
-        # message_end
-        t_ms = int((time.time() - t0) * 1000)
-        end_sm = ServerMessage(
-            type=MESSAGE_TYPE_MESSAGE_END,
-            session_id=session_id,
-            query_msg_id=query_msg_id,
-            reply_id=reply_id,
-            msg_id=str(uuid.uuid4()),
-            sequence_id=last_seq + 1,
-            finish=True,
-            content=ServerMessageContent(
-                message_end=MessageEndDetail(
-                    code=MESSAGE_END_CODE_SUCCESS,
-                    message="",
-                    token_cost=TokenCost(input_tokens=0, output_tokens=0, total_tokens=0),
-                    time_cost_ms=t_ms,
-                )
-            ),
-            log_id=log_id,
-        )
-        yield end_sm
+        for item in items:
+            for sm in converter.feed(item):
+                yield sm
+                last_seq = sm.sequence_id
     except Exception as ex:
-        # 使用错误分类器获取错误码
-        err = classify_error(ex, {"node_name": "stream"})
-        # message_end
-        t_ms = int((time.time() - t0) * 1000)
-        end_sm = ServerMessage(
-            type=MESSAGE_TYPE_MESSAGE_END,
-            session_id=session_id,
-            query_msg_id=query_msg_id,
-            reply_id=reply_id,
-            msg_id=str(uuid.uuid4()),
-            sequence_id=last_seq + 1,
-            finish=True,
-            content=ServerMessageContent(
-                message_end=MessageEndDetail(
-                    code=str(err.code),
-                    message=err.message,
-                    time_cost_ms=t_ms,
-                    token_cost=TokenCost(input_tokens=0, output_tokens=0, total_tokens=0),
-                )
-            ),
-            log_id=log_id,
-        )
-        yield end_sm
+        error = ex
+    # message_end
+    yield _message_end(
+        session_id=session_id,
+        query_msg_id=query_msg_id,
+        reply_id=reply_id,
+        sequence_id=last_seq + 1,
+        log_id=log_id,
+        t0=t0,
+        run_id=run_id,
+        ex=error,
+        usage=converter.usage,
+    )
+
+
+async def aiter_server_messages(
+        items: AsyncIterator[Tuple[Any, Dict[str, Any]]],
+        *,
+        session_id: str,
+        query_msg_id: str,
+        local_msg_id: str,
+        run_id: str,
+        sequence_id_start: int = 1,
+        log_id: str,
+) -> AsyncIterator[ServerMessage]:
+    """Async counterpart of iter_server_messages for graph.astream(stream_mode="messages")."""
+    t0 = time.time()
+    reply_id = str(uuid.uuid4())
+    yield _message_start(
+        session_id=session_id,
+        query_msg_id=query_msg_id,
+        local_msg_id=local_msg_id,
+        run_id=run_id,
+        reply_id=reply_id,
+        sequence_id=sequence_id_start,
+        log_id=log_id,
+    )
+    converter = _BodyConverter(
+        session_id=session_id,
+        query_msg_id=query_msg_id,
+        reply_id=reply_id,
+        sequence_id_start=sequence_id_start + 1,
+        log_id=log_id,
+        t0=t0,
+    )
+    last_seq = sequence_id_start
+    error = None
+    try:
+        async for item in items:
+            for sm in converter.feed(item):
+                yield sm
+                last_seq = sm.sequence_id
+    except Exception as ex:
+        error = ex
+    yield _message_end(
+        session_id=session_id,
+        query_msg_id=query_msg_id,
+        reply_id=reply_id,
+        sequence_id=last_seq + 1,
+        log_id=log_id,
+        t0=t0,
+        run_id=run_id,
+        ex=error,
+        usage=converter.usage,
+    )
 
 
 def agent_iter_server_messages(
@@ -598,3 +756,23 @@ def agent_iter_server_messages(
         sequence_id_start=1,
         log_id=log_id,
     )
+
+
+def agent_aiter_server_messages(
+        items: AsyncIterator[Tuple[Any, Dict[str, Any]]],
+        *,
+        session_id: str,
+        query_msg_id: str,
+        local_msg_id: str,
+        run_id: str,
+        log_id: str,
+) -> AsyncIterator[ServerMessage]:
+    return aiter_server_messages(
+        items,
+        session_id=session_id,
+        query_msg_id=query_msg_id,
+        local_msg_id=local_msg_id,
+        run_id=run_id,
+        sequence_id_start=1,
+        log_id=log_id,
+    )
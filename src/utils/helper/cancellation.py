@@ -0,0 +1,227 @@
+"""
+协作式取消
+
+asyncio.Task.cancel() 只能打断协程，同步流的工作线程和其中正在进行的模型 HTTP 流不受影响。
+CancellationToken 随 running_tasks 一起登记，并通过 CancellationCallbackHandler 注入到
+graph 的 callbacks 中：
+- 节点/模型调用开始前检查取消状态，已取消则不再发起
+- 模型流式输出每个 token 时检查取消状态，已取消则抛出 RunCancelledError，
+  ChatOpenAI 退出流式读取并关闭上游 HTTP 响应，停止继续计费
+- 节省的 token 按被中断调用的实际输出速率 × 预计剩余输出时长估算，
+  剩余时长取自本进程已完成调用的输出时长（EWMA）；设置了 max tokens 时以剩余额度为上限
+"""
+import asyncio
+import logging
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Any, Dict, Optional
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+logger = logging.getLogger(__name__)
+
+CANCEL_REASON_USER = "cancel"
+CANCEL_REASON_TIMEOUT = "timeout"
+CANCEL_REASON_DISCONNECT = "disconnect"
+
+
+class RunCancelledError(Exception):
+    """run 已被取消，用于中断同步执行中的 graph 和模型流"""
+
+    def __init__(self, run_id: str, reason: str):
+        self.run_id = run_id
+        self.reason = reason
+        super().__init__(f"Run {run_id} cancelled: {reason}")
+
+
+@dataclass
+class CancellationStats:
+    """取消统计，tokens_avoided 为按输出速率估算的节省量"""
+    cancellations: Dict[str, int] = field(default_factory=dict)  # reason -> 次数
+    tokens_emitted: int = 0  # 取消前已生成的 token 数
+    tokens_after_cancel: int = 0  # 发出取消信号后到上游真正中断前又收到的 token 数
+    tokens_avoided: int = 0  # 估算避免生成的 token 数
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "cancellations": dict(self.cancellations),
+            "tokens_emitted": self.tokens_emitted,
+            "tokens_after_cancel": self.tokens_after_cancel,
+            "tokens_avoided": self.tokens_avoided,
+        }
+
+
+@dataclass
+class StreamProfile:
+    """已完成的流式模型调用的输出时长与速率（EWMA），用于估算被中断调用的剩余输出"""
+    samples: int = 0
+    seconds_ewma: float = 0.0
+    rate_ewma: float = 0.0  # token/秒
+
+    def record(self, tokens: int, seconds: float):
+        if tokens <= 0 or seconds <= 0:
+            return
+        rate = tokens / seconds
+        if self.samples == 0:
+            self.seconds_ewma, self.rate_ewma = seconds, rate
+        else:
+            self.seconds_ewma = 0.8 * self.seconds_ewma + 0.2 * seconds
+            self.rate_ewma = 0.8 * self.rate_ewma + 0.2 * rate
+        self.samples += 1
+
+
+@dataclass
+class _LlmRun:
+    started_at: float
+    max_tokens: Optional[int]
+    emitted: int = 0
+    first_token_at: Optional[float] = None
+
+    def estimate_remaining(self, profile: StreamProfile, now: float) -> Optional[int]:
+        """按本次调用的输出速率（尚无输出时用历史速率）× 预计剩余时长估算，无法估算时返回 None"""
+        remaining = None
+        if profile.samples:
+            if self.first_token_at is not None and now > self.first_token_at:
+                elapsed = now - self.first_token_at
+                rate = self.emitted / elapsed
+            else:
+                elapsed, rate = 0.0, profile.rate_ewma
+            remaining = int(rate * max(profile.seconds_ewma - elapsed, 0.0))
+        if self.max_tokens:
+            left = max(self.max_tokens - self.emitted, 0)
+            remaining = left if remaining is None else min(remaining, left)
+        return remaining
+
+
+_stats = CancellationStats()
+_profile = StreamProfile()
+_stats_lock = threading.Lock()
+
+
+def get_cancellation_stats() -> CancellationStats:
+    return _stats
+
+
+class CancellationToken:
+    def __init__(self, run_id: str):
+        self.run_id = run_id
+        self.reason = ""
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._finished = False
+        # 当前进行中的模型调用
+        self._llm_runs: Dict[uuid.UUID, _LlmRun] = {}
+        self.tokens_emitted = 0
+        self.tokens_after_cancel = 0
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self, reason: str = CANCEL_REASON_USER) -> bool:
+        """发出取消信号，重复调用只生效一次"""
+        with self._lock:
+            if self._event.is_set():
+                return False
+            self.reason = reason
+            self._event.set()
+        logger.info(f"Cancellation signalled for run_id: {self.run_id}, reason: {reason}")
+        return True
+
+    def raise_if_cancelled(self):
+        if self._event.is_set():
+            raise RunCancelledError(self.run_id, self.reason)
+
+    def on_llm_start(self, llm_run_id: uuid.UUID, max_tokens: Optional[int]):
+        with self._lock:
+            self._llm_runs[llm_run_id] = _LlmRun(time.monotonic(), max_tokens)
+
+    def on_llm_token(self, llm_run_id: uuid.UUID):
+        with self._lock:
+            self.tokens_emitted += 1
+            if self._event.is_set():
+                self.tokens_after_cancel += 1
+            run = self._llm_runs.get(llm_run_id)
+            if run is not None:
+                if run.first_token_at is None:
+                    run.first_token_at = time.monotonic()
+                run.emitted += 1
+
+    def on_llm_end(self, llm_run_id: uuid.UUID, completed: bool = True):
+        with self._lock:
+            run = self._llm_runs.pop(llm_run_id, None)
+        if completed and run is not None and run.first_token_at is not None:
+            with _stats_lock:
+                _profile.record(run.emitted, time.monotonic() - run.first_token_at)
+
+    def finish(self):
+        """run 结束时调用：若发生过取消，上报本次取消节省的 token"""
+        with self._lock:
+            if self._finished:
+                return
+            self._finished = True
+            if not self._event.is_set():
+                return
+            runs = list(self._llm_runs.values())
+            self._llm_runs.clear()
+
+        now = time.monotonic()
+        avoided = 0
+        known = False
+        with _stats_lock:
+            # 被中断的模型调用按输出速率估算剩余 token
+            for run in runs:
+                remaining = run.estimate_remaining(_profile, now)
+                if remaining is not None:
+                    known = True
+                    avoided += remaining
+            _stats.cancellations[self.reason] = _stats.cancellations.get(self.reason, 0) + 1
+            _stats.tokens_emitted += self.tokens_emitted
+            _stats.tokens_after_cancel += self.tokens_after_cancel
+            _stats.tokens_avoided += avoided
+
+        logger.info(
+            f"Run cancelled: run_id={self.run_id}, reason={self.reason}, "
+            f"tokens_emitted={self.tokens_emitted}, tokens_after_cancel={self.tokens_after_cancel}, "
+            f"tokens_avoided={avoided if known else 'unknown'}"
+        )
+
+
+class CancellationCallbackHandler(BaseCallbackHandler):
+    """把 CancellationToken 接入 LangChain 回调，在节点和模型流中检查取消"""
+
+    raise_error = True
+    run_inline = True
+
+    def __init__(self, token: CancellationToken):
+        self.token = token
+
+    def on_chain_start(self, serialized, inputs, *, run_id, **kwargs: Any) -> Any:
+        self.token.raise_if_cancelled()
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs: Any) -> Any:
+        self._on_model_start(run_id, kwargs)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs: Any) -> Any:
+        self._on_model_start(run_id, kwargs)
+
+    def _on_model_start(self, run_id: uuid.UUID, kwargs: Dict[str, Any]):
+        self.token.raise_if_cancelled()
+        params = kwargs.get("invocation_params") or {}
+        max_tokens = params.get("max_completion_tokens") or params.get("max_tokens")
+        self.token.on_llm_start(run_id, max_tokens if isinstance(max_tokens, int) else None)
+
+    def on_llm_new_token(self, token: str, *, run_id, **kwargs: Any) -> Any:
+        self.token.on_llm_token(run_id)
+        # 在模型流式读取循环内抛出，中断并关闭上游 HTTP 流
+        self.token.raise_if_cancelled()
+
+    def on_llm_end(self, response, *, run_id, **kwargs: Any) -> Any:
+        self.token.on_llm_end(run_id)
+
+    def on_llm_error(self, error, *, run_id, **kwargs: Any) -> Any:
+        # 被取消中断的调用保留在 token 中，用于估算节省的 token
+        if not isinstance(error, (RunCancelledError, asyncio.CancelledError)) and not self.token.cancelled:
+            self.token.on_llm_end(run_id, completed=False)
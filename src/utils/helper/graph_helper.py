@@ -1,10 +1,15 @@
 import os
+import json
+import hashlib
 import inspect
 import importlib
+import threading
 import ast
 import textwrap
+import logging
+from dataclasses import dataclass
 from pydantic import BaseModel
-from typing import get_type_hints,Type,Optional,get_origin,Union,get_args
+from typing import get_type_hints,Type,Optional,get_origin,Union,get_args,Any,Dict
 from langgraph.graph.state import CompiledStateGraph
 from langgraph.graph import START, END
 
@@ -16,10 +21,96 @@ def get_graph_instance(module_name):
             return obj
     return None
 
+logger = logging.getLogger(__name__)
+
+
 def get_agent_instance(module_name, ctx):
     module = importlib.import_module(module_name)
     return module.build_agent(ctx)
 
+
+@dataclass
+class _AgentEntry:
+    config_path: str
+    mtime_ns: int
+    digest: str
+    agent: Any
+
+
+class AgentRegistry:
+    """
+    进程级的已编译 Agent 缓存
+
+    - 按 (模块名, 配置内容哈希) 复用 create_agent 编译结果和 LLM 客户端
+    - 每次获取只做一次 os.stat，配置文件 mtime 变化时重新读取并校验哈希，
+      内容变化才重新编译
+    - 模块需提供 get_config_path() 和 build_agent_from_config(cfg)，
+      请求级参数(如 default_headers)通过 RunnableConfig 的 configurable 传入
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: Dict[str, _AgentEntry] = {}
+
+    def get(self, module_name: str):
+        module = importlib.import_module(module_name)
+        config_path = module.get_config_path()
+        mtime_ns = os.stat(config_path).st_mtime_ns
+
+        entry = self._entries.get(module_name)
+        if entry is not None and entry.config_path == config_path and entry.mtime_ns == mtime_ns:
+            return entry.agent
+
+        with self._lock:
+            entry = self._entries.get(module_name)
+            if entry is not None and entry.config_path == config_path and entry.mtime_ns == mtime_ns:
+                return entry.agent
+
+            with open(config_path, 'rb') as f:
+                raw = f.read()
+            digest = hashlib.sha256(raw).hexdigest()
+            if entry is not None and entry.config_path == config_path and entry.digest == digest:
+                # 仅 mtime 变化（如 touch），内容未变，继续复用
+                entry.mtime_ns = mtime_ns
+                return entry.agent
+
+            cfg = json.loads(raw.decode('utf-8'))
+            agent = module.build_agent_from_config(cfg)
+            self._entries[module_name] = _AgentEntry(
+                config_path=config_path,
+                mtime_ns=mtime_ns,
+                digest=digest,
+                agent=agent,
+            )
+            logger.info(f"Compiled agent cached: module={module_name}, config={config_path}, digest={digest[:12]}")
+            return agent
+
+    def invalidate(self, module_name: Optional[str] = None):
+        with self._lock:
+            if module_name is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(module_name, None)
+
+
+_agent_registry = AgentRegistry()
+
+
+def get_cached_agent_instance(module_name, ctx):
+    """获取缓存的已编译 Agent，模块未实现 build_agent_from_config 时退化为每次构建"""
+    module = importlib.import_module(module_name)
+    if not hasattr(module, "build_agent_from_config") or not hasattr(module, "get_config_path"):
+        return module.build_agent(ctx)
+    return _agent_registry.get(module_name)
+
+
+def get_agent_run_configurable(module_name, ctx) -> Dict[str, Any]:
+    """获取 Agent 的请求级 configurable 参数"""
+    module = importlib.import_module(module_name)
+    if hasattr(module, "run_configurable"):
+        return module.run_configurable(ctx)
+    return {}
+
 # return: func, input_class, output_class
 def get_graph_node_func_with_inout(graph, node_name):
     for node_id, node in graph.nodes.items():
@@ -45,6 +136,97 @@ def get_graph_node_func_with_inout(graph, node_name):
 
     return None, None, None
 
+@dataclass
+class NodeSpec:
+    node_id: str
+    func: Any
+    input_cls: Any
+    output_cls: Any
+    metadata: Dict[str, Any]
+    graph: CompiledStateGraph  # 只包含该节点的已编译 graph
+    input_schema: Dict[str, Any]
+    output_schema: Dict[str, Any]
+
+
+def _model_json_schema(cls) -> Dict[str, Any]:
+    if isinstance(cls, type) and issubclass(cls, BaseModel):
+        return cls.model_json_schema()
+    return {}
+
+
+class NodeRegistry:
+    """
+    单节点运行注册表，启动时为 graph 的每个节点构建一次：
+    入参/出参类、节点 metadata、只包含该节点的已编译 graph 和 JSON Schema，
+    /node_run 与 /graph_parameter 只做字典查找
+    """
+
+    def __init__(self, graph: CompiledStateGraph):
+        from utils.log.parser import get_parser
+
+        self._specs: Dict[str, NodeSpec] = {}
+        self._errors: Dict[str, Exception] = {}
+        parser = get_parser(graph)
+        for node_id, node in parser.graph.nodes.items():
+            if node_id == START or node_id == END or not node.data:
+                continue
+            # 取不到 func 的节点以 node_id 登记失败，同样只影响该节点的 /node_run
+            name = node_id
+            try:
+                name = node.data.func.__name__
+                if name in self._specs or name in self._errors:
+                    continue
+                self._specs[name] = self._build(name, parser)
+            except Exception as e:
+                # 构建失败的节点在调用时再抛出，不影响其他节点
+                logger.warning(f"Failed to prepare node '{name}' for single-node run: {e}")
+                self._errors[name] = e
+
+        graph_input = graph.get_input_schema()
+        graph_output = graph.get_output_schema()
+        self.graph_schema = {
+            "input_schema": graph_input.model_json_schema(),
+            "output_schema": graph_output.model_json_schema(),
+        }
+        logger.info(f"Node registry built: {len(self._specs)} nodes, {len(self._errors)} failed")
+
+    @staticmethod
+    def _build(name: str, parser) -> NodeSpec:
+        from langgraph.graph import StateGraph
+
+        func, input_cls, output_cls = get_graph_node_func_with_inout(parser.graph, name)
+        if func is None or input_cls is None:
+            raise KeyError(f"node_id '{name}' has no input class")
+        metadata = parser.get_node_metadata(name) or {}
+
+        _g = StateGraph(input_cls, input_schema=input_cls, output_schema=output_cls)
+        _g.add_node("sn", func, metadata=metadata)
+        _g.set_entry_point("sn")
+        _g.add_edge("sn", END)
+        return NodeSpec(
+            node_id=name,
+            func=func,
+            input_cls=input_cls,
+            output_cls=output_cls,
+            metadata=metadata,
+            graph=_g.compile(),
+            input_schema=_model_json_schema(input_cls),
+            output_schema=_model_json_schema(output_cls),
+        )
+
+    def get(self, node_id: str) -> NodeSpec:
+        spec = self._specs.get(node_id)
+        if spec is not None:
+            return spec
+        error = self._errors.get(node_id)
+        if error is not None and not isinstance(error, KeyError):
+            raise error
+        raise KeyError(f"node_id '{node_id}' not found")
+
+    def node_ids(self):
+        return list(self._specs.keys())
+
+
 def is_agent_proj() -> bool:
     return os.getenv("COZE_PROJECT_TYPE", "workflow") == "agent"
 
@@ -0,0 +1,156 @@
+"""
+幂等键与进行中请求合并（single-flight）
+
+- 请求携带 Idempotency-Key 头，或通过 X-Idempotency-Mode: payload 选择按规范化请求体哈希去重
+- 相同键的请求在执行中时，后到的请求附着到已在 running_tasks 中的任务上，不再重复执行；
+  首个请求仍在准入排队时，后到的请求等待其开始执行（或被拒绝）后再决定附着还是重新执行
+- 执行成功的结果按 TTL 保存在有界缓存中，重试直接返回
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, Mapping, Optional
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_KEY_HEADER = "idempotency-key"
+IDEMPOTENCY_MODE_HEADER = "x-idempotency-mode"
+IDEMPOTENCY_MODE_PAYLOAD = "payload"
+
+# 已完成结果的保留时间（秒）
+IDEMPOTENCY_TTL_SECONDS = float(os.getenv("IDEMPOTENCY_TTL_SECONDS", "600"))
+# 最多保留的键数量
+IDEMPOTENCY_MAX_ENTRIES = int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", "10000"))
+
+_NO_RESULT = object()
+
+
+def payload_digest(payload: Any) -> str:
+    """规范化（键排序、紧凑分隔符）后的请求体 sha256"""
+    canonical = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def idempotency_key(headers: Mapping[str, str], endpoint: str, payload: Any) -> Optional[str]:
+    """从请求头得到幂等键，未携带 Idempotency-Key 且未选择 payload 模式时返回 None"""
+    key = headers.get(IDEMPOTENCY_KEY_HEADER)
+    if key:
+        return f"{endpoint}:key:{key}"
+    if (headers.get(IDEMPOTENCY_MODE_HEADER) or "").lower() == IDEMPOTENCY_MODE_PAYLOAD:
+        return f"{endpoint}:payload:{payload_digest(payload)}"
+    return None
+
+
+@dataclass
+class IdempotencyEntry:
+    run_id: str
+    finished: bool = False
+    expires_at: float = 0.0
+    result: Any = _NO_RESULT
+    # None: 仍在准入排队；True: 任务已登记；False: 未能开始（被拒绝/失败），键已删除
+    started: Optional[bool] = None
+    _settled: asyncio.Event = field(default_factory=asyncio.Event, repr=False)
+
+    @property
+    def has_result(self) -> bool:
+        return self.result is not _NO_RESULT
+
+    def settle(self, started: bool):
+        if self.started is None:
+            self.started = started
+            self._settled.set()
+
+    async def wait_started(self, timeout: float) -> bool:
+        """等待原请求通过准入并登记任务，超时或原请求未能开始时返回 False"""
+        if self.started is None:
+            try:
+                await asyncio.wait_for(self._settled.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                return False
+        return bool(self.started)
+
+
+@dataclass
+class IdempotencyStats:
+    misses: int = 0
+    inflight_hits: int = 0
+    cached_hits: int = 0
+
+    def to_dict(self) -> Dict[str, int]:
+        return {"misses": self.misses, "inflight_hits": self.inflight_hits, "cached_hits": self.cached_hits}
+
+
+class IdempotencyRegistry:
+    """幂等键 -> run_id（执行中）/ 结果（已完成），任务本身仍由 GraphService.running_tasks 管理"""
+
+    def __init__(self, ttl_seconds: float = IDEMPOTENCY_TTL_SECONDS, max_entries: int = IDEMPOTENCY_MAX_ENTRIES):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, IdempotencyEntry]" = OrderedDict()
+        self.stats = IdempotencyStats()
+
+    def lookup(self, key: str) -> Optional[IdempotencyEntry]:
+        entry = self._entries.get(key)
+        if entry is not None and entry.finished and entry.expires_at < time.time():
+            del self._entries[key]
+            entry = None
+        if entry is None:
+            self.stats.misses += 1
+        elif entry.finished:
+            self.stats.cached_hits += 1
+        else:
+            self.stats.inflight_hits += 1
+        return entry
+
+    def register(self, key: str, run_id: str) -> IdempotencyEntry:
+        self._evict()
+        entry = IdempotencyEntry(run_id=run_id)
+        self._entries[key] = entry
+        return entry
+
+    def mark_started(self, key: str, run_id: str):
+        """任务已登记到 running_tasks（流式请求为回放缓冲区已创建），唤醒等待附着的重复请求"""
+        entry = self._entries.get(key)
+        if entry is not None and entry.run_id == run_id:
+            entry.settle(True)
+
+    def complete(self, key: str, run_id: str, result: Any = _NO_RESULT):
+        """run 成功结束，保留 TTL 供重试复用"""
+        entry = self._entries.get(key)
+        if entry is None or entry.run_id != run_id:
+            return
+        entry.settle(True)
+        entry.finished = True
+        entry.expires_at = time.time() + self.ttl_seconds
+        entry.result = result
+        self._entries.move_to_end(key)
+
+    def release(self, key: str, run_id: str):
+        """run 结束但未 complete（失败/取消/超时）：删除键，允许重试重新执行"""
+        entry = self._entries.get(key)
+        if entry is not None and entry.run_id == run_id and not entry.finished:
+            del self._entries[key]
+            entry.settle(False)
+
+    def _evict(self):
+        now = time.time()
+        expired = [k for k, e in self._entries.items() if e.finished and e.expires_at < now]
+        for k in expired:
+            del self._entries[k]
+        # 超出上限时淘汰最早完成的结果，执行中的键保留
+        if len(self._entries) >= self.max_entries:
+            for k in [k for k, e in self._entries.items() if e.finished]:
+                if len(self._entries) < self.max_entries:
+                    break
+                del self._entries[k]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+idempotency_registry = IdempotencyRegistry()
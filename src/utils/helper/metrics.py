@@ -0,0 +1,206 @@
+"""
+Prometheus 文本格式的运行指标
+
+- 计数器和直方图按线程分片：每个线程只写自己的分片字典，写入路径不加锁；
+  抓取时合并所有分片（dict.copy 在 GIL 下是原子操作），代价落在低频的 /metrics 请求上
+- 请求量和耗时由 ASGI 中间件按路由模板（如 /node_run/{node_id}）统计，流式响应按整个流的时长计算
+- 其余组件已有的统计（准入、取消、日志写入、线程池等）在抓取时通过 collector 读取，不重复计数
+- 指标为进程内数据，多 worker 模式下每个 worker 各自统计
+"""
+import bisect
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() in ("1", "true", "yes")
+METRICS_PREFIX = os.getenv("METRICS_PREFIX", "graph_service")
+# 请求耗时直方图的分桶上界（秒）
+LATENCY_BUCKETS: Tuple[float, ...] = tuple(
+    float(b) for b in os.getenv(
+        "METRICS_LATENCY_BUCKETS", "0.05,0.1,0.25,0.5,1,2.5,5,10,30,60,120,300,900"
+    ).split(",")
+)
+
+Labels = Tuple[Tuple[str, str], ...]
+Sample = Tuple[str, Dict[str, Any], float]
+
+COUNTER = "counter"
+GAUGE = "gauge"
+HISTOGRAM = "histogram"
+
+
+class _Shard:
+    __slots__ = ("values", "histograms")
+
+    def __init__(self):
+        self.values: Dict[Tuple[str, Labels], float] = {}
+        # (name, labels) -> [各分桶计数..., +Inf 计数, sum]
+        self.histograms: Dict[Tuple[str, Labels], List[float]] = {}
+
+
+class MetricsRegistry:
+    def __init__(self, prefix: str = METRICS_PREFIX):
+        self.prefix = prefix
+        self._local = threading.local()
+        self._shards: List[_Shard] = []
+        self._shards_lock = threading.Lock()
+        self._types: Dict[str, str] = {}
+        self._help: Dict[str, str] = {}
+        self._buckets: Dict[str, Tuple[float, ...]] = {}
+        self._collectors: List[Callable[[], Iterable[Tuple[str, str, Iterable[Sample]]]]] = []
+
+    def _shard(self) -> _Shard:
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = _Shard()
+            self._local.shard = shard
+            # 只在线程首次写入时加锁登记分片
+            with self._shards_lock:
+                self._shards.append(shard)
+        return shard
+
+    def describe(self, name: str, metric_type: str, help_text: str = "",
+                 buckets: Optional[Tuple[float, ...]] = None):
+        self._types[name] = metric_type
+        self._help[name] = help_text
+        if metric_type == HISTOGRAM:
+            self._buckets[name] = tuple(sorted(buckets or LATENCY_BUCKETS))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        """计数器加值；value 为负时可作为可增减的 gauge 使用"""
+        values = self._shard().values
+        key = (name, tuple(sorted(labels.items())))
+        values[key] = values.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        histograms = self._shard().histograms
+        key = (name, tuple(sorted(labels.items())))
+        buckets = self._buckets.get(name, LATENCY_BUCKETS)
+        hist = histograms.get(key)
+        if hist is None:
+            hist = [0.0] * (len(buckets) + 2)
+            histograms[key] = hist
+        hist[bisect.bisect_left(buckets, value)] += 1
+        hist[-1] += value
+
+    def register_collector(self, collector: Callable[[], Iterable[Tuple[str, str, Iterable[Sample]]]]):
+        """collector 返回 (指标名, 类型, [(后缀, 标签, 值), ...]) 列表，在抓取时调用"""
+        self._collectors.append(collector)
+
+    def _merged(self) -> Tuple[Dict[Tuple[str, Labels], float], Dict[Tuple[str, Labels], List[float]]]:
+        with self._shards_lock:
+            shards = list(self._shards)
+        values: Dict[Tuple[str, Labels], float] = {}
+        histograms: Dict[Tuple[str, Labels], List[float]] = {}
+        for shard in shards:
+            for key, value in shard.values.copy().items():
+                values[key] = values.get(key, 0) + value
+            for key, hist in shard.histograms.copy().items():
+                hist = list(hist)
+                merged = histograms.get(key)
+                if merged is None:
+                    histograms[key] = hist
+                else:
+                    for i, v in enumerate(hist):
+                        merged[i] += v
+        return values, histograms
+
+    def render(self) -> str:
+        values, histograms = self._merged()
+        families: Dict[str, List[str]] = {}
+
+        for (name, labels), value in sorted(values.items()):
+            families.setdefault(name, []).append(f"{self._full(name)}{_labels(labels)} {_num(value)}")
+
+        for (name, labels), hist in sorted(histograms.items()):
+            buckets = self._buckets.get(name, LATENCY_BUCKETS)
+            lines = families.setdefault(name, [])
+            cumulative = 0.0
+            for bound, count in zip(buckets, hist):
+                cumulative += count
+                lines.append(f"{self._full(name)}_bucket{_labels(labels + (('le', _num(bound)),))} {_num(cumulative)}")
+            cumulative += hist[len(buckets)]
+            lines.append(f"{self._full(name)}_bucket{_labels(labels + (('le', '+Inf'),))} {_num(cumulative)}")
+            lines.append(f"{self._full(name)}_sum{_labels(labels)} {_num(hist[-1])}")
+            lines.append(f"{self._full(name)}_count{_labels(labels)} {_num(cumulative)}")
+
+        for collector in self._collectors:
+            for name, metric_type, samples in collector():
+                self._types.setdefault(name, metric_type)
+                lines = families.setdefault(name, [])
+                for suffix, labels, value in samples:
+                    if value is None:
+                        continue
+                    lines.append(f"{self._full(name)}{suffix}{_labels(tuple(sorted(labels.items())))} {_num(value)}")
+
+        out: List[str] = []
+        for name, lines in families.items():
+            if not lines:
+                continue
+            if self._help.get(name):
+                out.append(f"# HELP {self._full(name)} {self._help[name]}")
+            out.append(f"# TYPE {self._full(name)} {self._types.get(name, 'untyped')}")
+            out.extend(lines)
+        return "\n".join(out) + "\n"
+
+    def _full(self, name: str) -> str:
+        return f"{self.prefix}_{name}" if self.prefix else name
+
+
+def _labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    parts = []
+    for key, value in labels:
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        parts.append(f'{key}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def _num(value: float) -> str:
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class MetricsMiddleware:
+    """纯 ASGI 中间件：按路由模板统计请求数、状态码和耗时（不包装响应体，流式响应不受影响）"""
+
+    def __init__(self, app, registry: "MetricsRegistry" = None, routes: Optional[Iterable[str]] = None):
+        self.app = app
+        self.registry = registry or get_metrics()
+        self.routes = set(routes) if routes is not None else None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not METRICS_ENABLED:
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = getattr(scope.get("route"), "path", None)
+            if route is not None and (self.routes is None or route in self.routes):
+                self.registry.inc("http_requests_total", route=route, status=str(status))
+                self.registry.observe("http_request_duration_seconds", time.perf_counter() - start, route=route)
+
+
+_metrics = MetricsRegistry()
+_metrics.describe("http_requests_total", COUNTER, "HTTP requests by route and status")
+_metrics.describe("http_request_duration_seconds", HISTOGRAM, "HTTP request duration including streamed body")
+_metrics.describe("active_streams", GAUGE, "Streams currently being produced")
+
+
+def get_metrics() -> MetricsRegistry:
+    return _metrics
@@ -0,0 +1,134 @@
+"""
+多 worker 预派生（prefork）HTTP 服务
+
+uvicorn 自带的 workers=N 通过 spawn 启动子进程，每个 worker 重新 import 应用、重新加载 graph/agent 模块。
+这里由父进程先导入应用并完成预加载、绑定监听 socket，再 fork 出 N 个 worker 共享同一 socket：
+- 已加载的模块和 graph 通过写时复制在 worker 间共享（fork 前 gc.freeze 避免 GC 触碰引用计数页）
+- fork 后执行 register_post_fork 注册的钩子，重建不能跨进程复用的资源（上报客户端、连接等）
+- worker 异常退出时自动补齐，收到 SIGTERM/SIGINT 时转发给所有 worker 并等待退出
+"""
+import gc
+import logging
+import os
+import signal
+import socket
+import time
+from typing import Callable, Dict, List, Optional
+
+import uvicorn
+
+logger = logging.getLogger(__name__)
+
+# 同一 worker 槽位短时间内反复退出时，重启前的等待时间（秒）
+_RESPAWN_BACKOFF_SECONDS = 1.0
+
+_post_fork_hooks: List[Callable[[], None]] = []
+_worker_exit_hooks: List[Callable[[int], None]] = []
+
+
+def register_post_fork(hook: Callable[[], None]):
+    """登记在每个 worker fork 后、开始服务前执行的钩子"""
+    _post_fork_hooks.append(hook)
+
+
+def register_worker_exit(hook: Callable[[int], None]):
+    """登记在父进程回收 worker 后执行的钩子，参数为 worker pid"""
+    _worker_exit_hooks.append(hook)
+
+
+def _bind_socket(host: str, port: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def _run_worker(app, sock: socket.socket, config_kwargs: Dict) -> int:
+    # 恢复默认信号处理，由 uvicorn.Server 安装自己的优雅退出处理
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    for hook in _post_fork_hooks:
+        try:
+            hook()
+        except Exception as e:
+            logger.error(f"Post-fork hook {getattr(hook, '__name__', hook)} failed: {e}", exc_info=True)
+    config = uvicorn.Config(app, **config_kwargs)
+    server = uvicorn.Server(config)
+    server.run(sockets=[sock])
+    return 0
+
+
+def _spawn(app, sock: socket.socket, config_kwargs: Dict) -> int:
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            code = _run_worker(app, sock, config_kwargs)
+        except BaseException:
+            logger.exception("Worker crashed")
+        finally:
+            os._exit(code)
+    return pid
+
+
+def serve_prefork(app, host: str, port: int, workers: int, **config_kwargs):
+    """父进程：绑定 socket、fork worker 并监督其存活，直到收到退出信号"""
+    sock = _bind_socket(host, port)
+    # 预加载完成后的对象不再参与 GC 扫描，减少 fork 后的写时复制
+    gc.collect()
+    gc.freeze()
+
+    children: Dict[int, float] = {}
+    shutting_down = False
+
+    def on_signal(signum, frame):
+        nonlocal shutting_down
+        shutting_down = True
+        for child in list(children):
+            try:
+                os.kill(child, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+
+    for _ in range(workers):
+        children[_spawn(app, sock, config_kwargs)] = time.monotonic()
+    logger.info(f"Started {workers} workers on {host}:{port}: {sorted(children)}")
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        started_at = children.pop(pid, None)
+        if started_at is None:
+            continue
+        for hook in _worker_exit_hooks:
+            try:
+                hook(pid)
+            except Exception as e:
+                logger.warning(f"Worker exit hook failed for pid {pid}: {e}")
+        if shutting_down:
+            continue
+        logger.error(f"Worker {pid} exited with status {os.waitstatus_to_exitcode(status)}, respawning")
+        if time.monotonic() - started_at < _RESPAWN_BACKOFF_SECONDS:
+            time.sleep(_RESPAWN_BACKOFF_SECONDS)
+        children[_spawn(app, sock, config_kwargs)] = time.monotonic()
+
+    sock.close()
+    logger.info("All workers exited")
+
+
+def resolve_workers(value: Optional[int]) -> int:
+    """worker 数：命令行参数优先，其次 HTTP_WORKERS 环境变量；0 表示按 CPU 核数"""
+    if value is None:
+        value = int(os.getenv("HTTP_WORKERS", "1"))
+    if value <= 0:
+        value = os.cpu_count() or 1
+    return value
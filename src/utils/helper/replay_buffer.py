@@ -0,0 +1,223 @@
+"""
+可续传的 SSE 流
+
+- 每条事件的 SSE id 取自 sequence_id，格式为 "<run_id>:<sequence_id>"，
+  遇到不递增的 sequence_id（如取消/错误帧固定为 1）时顺延，保证同一 run 内单调递增
+- 开启续传时，流在后台任务中执行并写入按 run_id 索引的有界回放缓冲区；
+  客户端断线后携带 Last-Event-ID 重连，只收到缺失的事件，不会重新触发模型生成
+- 所有订阅者断开超过 grace 时间仍未重连，才取消后台执行；
+  结束后的缓冲区保留 TTL 秒供晚到的重连使用
+- 缓冲区数量达到上限时先淘汰已结束的；仍超限则按无订阅者优先、创建先后淘汰未结束的，
+  并取消其执行，避免卡住的 run 无限占用内存
+"""
+import asyncio
+import bisect
+import logging
+import os
+import time
+from collections import OrderedDict, deque
+from typing import Any, AsyncIterator, Callable, Deque, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+SSE_REPLAY_ENABLED = os.getenv("SSE_REPLAY_ENABLED", "false").lower() in ("1", "true", "yes")
+# 每个 run 最多保留的事件数
+SSE_REPLAY_MAX_EVENTS = int(os.getenv("SSE_REPLAY_MAX_EVENTS", "4096"))
+# 同时保留的 run 缓冲区数量上限（含未结束的 run）
+SSE_REPLAY_MAX_RUNS = int(os.getenv("SSE_REPLAY_MAX_RUNS", "1000"))
+# run 结束后缓冲区保留时间（秒）
+SSE_REPLAY_TTL_SECONDS = float(os.getenv("SSE_REPLAY_TTL_SECONDS", "300"))
+# 所有订阅者断开后等待重连的时间（秒），超时则取消执行
+SSE_REPLAY_GRACE_SECONDS = float(os.getenv("SSE_REPLAY_GRACE_SECONDS", "30"))
+
+# 订阅者落后太多、所需事件已被淘汰时发送的事件类型
+REPLAY_GAP_EVENT = "replay_gap"
+
+
+def _sequence_id(data: Any) -> int:
+    if isinstance(data, dict):
+        seq = data.get("sequence_id")
+    else:
+        seq = getattr(data, "sequence_id", None)
+    return seq if isinstance(seq, int) else 0
+
+
+def parse_last_event_id(value: Optional[str], run_id: Optional[str] = None) -> Optional[Tuple[str, int]]:
+    """
+    解析 Last-Event-ID，支持 "<run_id>:<seq>"，或纯数字 seq 配合单独传入的 run_id
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if ":" in value:
+        rid, _, seq = value.rpartition(":")
+    else:
+        rid, seq = run_id or "", value
+    if not rid or not seq.isdigit():
+        return None
+    return rid, int(seq)
+
+
+class EventIdAllocator:
+    """按 sequence_id 分配单调递增的 SSE 事件 id"""
+
+    def __init__(self, run_id: str):
+        self.run_id = run_id
+        self.last_id = 0
+
+    def next(self, data: Any) -> int:
+        seq = _sequence_id(data)
+        self.last_id = seq if seq > self.last_id else self.last_id + 1
+        return self.last_id
+
+    def frame(self, wire, data: Any) -> bytes:
+        event_id = self.next(data)
+        return wire.frame(data, event_id=f"{self.run_id}:{event_id}")
+
+
+class ReplayBuffer:
+    def __init__(self, run_id: str, wire, max_events: int = SSE_REPLAY_MAX_EVENTS):
+        self.run_id = run_id
+        self.wire = wire
+        self._ids = EventIdAllocator(run_id)
+        self._event_ids: Deque[int] = deque(maxlen=max_events)
+        self._frames: Deque[bytes] = deque(maxlen=max_events)
+        self._changed = asyncio.Event()
+        self.finished = False
+        self.finished_at: Optional[float] = None
+        self.subscribers = 0
+        # 最近一次订阅者全部断开的时间
+        self.detached_at: Optional[float] = None
+        # 所有订阅者都断开时回调（用于 grace 超时后取消执行）
+        self.on_abandoned: Optional[Callable[["ReplayBuffer"], None]] = None
+        # 未结束时被注册表淘汰的回调（用于取消执行）
+        self.on_evicted: Optional[Callable[[str], None]] = None
+
+    def append(self, data: Any):
+        event_id = self._ids.next(data)
+        self._event_ids.append(event_id)
+        self._frames.append(self.wire.frame(data, event_id=f"{self.run_id}:{event_id}"))
+        self._notify()
+
+    def finish(self):
+        self.finished = True
+        self.finished_at = time.time()
+        self._notify()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def can_resume_from(self, last_event_id: int) -> bool:
+        """缓冲区是否仍包含 last_event_id 之后的全部事件"""
+        if not self._event_ids:
+            return True
+        return last_event_id >= self._event_ids[0] - 1
+
+    def gap_frame(self, after_id: int) -> bytes:
+        """订阅位置之后的事件已被淘汰时发送的提示帧，id 取被跳过的最后一条，续传从其后开始"""
+        first = self._event_ids[0]
+        return self.wire.frame(
+            {"type": REPLAY_GAP_EVENT, "run_id": self.run_id, "missed_from": after_id + 1, "missed_to": first - 1},
+            event_id=f"{self.run_id}:{first - 1}",
+        )
+
+    async def subscribe(self, after_id: int = 0) -> AsyncIterator[bytes]:
+        self.subscribers += 1
+        try:
+            cursor = after_id
+            while True:
+                # 每次按事件 id 二分定位：yield 期间可能有新事件追加，或旧事件从队首淘汰导致下标移动
+                changed = self._changed
+                if self._event_ids and cursor < self._event_ids[0] - 1:
+                    yield self.gap_frame(cursor)
+                    cursor = self._event_ids[0] - 1
+                    continue
+                i = bisect.bisect_right(self._event_ids, cursor)
+                if i < len(self._event_ids):
+                    cursor = self._event_ids[i]
+                    yield self._frames[i]
+                    continue
+                # 已读到末尾后才检查结束标记，finish 前追加的事件不会丢失
+                if self.finished:
+                    return
+                await changed.wait()
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.finished:
+                self.detached_at = time.time()
+                if self.on_abandoned is not None:
+                    self.on_abandoned(self)
+
+
+class ReplayRegistry:
+    def __init__(
+            self,
+            max_runs: int = SSE_REPLAY_MAX_RUNS,
+            ttl_seconds: float = SSE_REPLAY_TTL_SECONDS,
+            grace_seconds: float = SSE_REPLAY_GRACE_SECONDS,
+    ):
+        self.max_runs = max_runs
+        self.ttl_seconds = ttl_seconds
+        self.grace_seconds = grace_seconds
+        self._buffers: "OrderedDict[str, ReplayBuffer]" = OrderedDict()
+
+    def create(self, run_id: str, wire, on_expired: Callable[[str], None]) -> ReplayBuffer:
+        """
+        创建 run 的回放缓冲区，所有订阅者断开 grace_seconds 后仍未重连，
+        或未结束时因数量上限被淘汰，调用 on_expired(run_id)
+        """
+        self._evict(make_room=True)
+        buffer = ReplayBuffer(run_id, wire)
+
+        def abandoned(buf: ReplayBuffer):
+            detached_at = buf.detached_at
+
+            def check():
+                # 期间有重连（即使之后再次断开）则以最近一次断开重新计时
+                if buf.subscribers == 0 and not buf.finished and buf.detached_at == detached_at:
+                    logger.info(f"No subscriber reattached within {self.grace_seconds}s, run_id: {buf.run_id}")
+                    on_expired(buf.run_id)
+            asyncio.get_running_loop().call_later(self.grace_seconds, check)
+
+        buffer.on_abandoned = abandoned
+        buffer.on_evicted = on_expired
+        self._buffers[run_id] = buffer
+        return buffer
+
+    def get(self, run_id: str) -> Optional[ReplayBuffer]:
+        self._evict()
+        return self._buffers.get(run_id)
+
+    def _evict(self, make_room: bool = False):
+        now = time.time()
+        expired = [
+            rid for rid, buf in self._buffers.items()
+            if buf.finished and buf.subscribers == 0 and now - (buf.finished_at or now) > self.ttl_seconds
+        ]
+        for rid in expired:
+            del self._buffers[rid]
+        # 超出数量上限时，优先淘汰最早创建且已结束的缓冲区
+        if len(self._buffers) >= self.max_runs:
+            for rid in [rid for rid, buf in self._buffers.items() if buf.finished]:
+                if len(self._buffers) < self.max_runs:
+                    break
+                del self._buffers[rid]
+        # 创建新缓冲区时仍超限：淘汰未结束的缓冲区并取消执行，无订阅者的优先（sorted 稳定，同类按创建先后）
+        if make_room and len(self._buffers) >= self.max_runs:
+            for rid in sorted(self._buffers, key=lambda r: self._buffers[r].subscribers > 0):
+                if len(self._buffers) < self.max_runs:
+                    break
+                buf = self._buffers.pop(rid)
+                logger.warning(f"Replay buffer limit {self.max_runs} reached, evicting unfinished run_id: {rid}")
+                if buf.on_evicted is not None:
+                    try:
+                        buf.on_evicted(rid)
+                    except Exception as e:
+                        logger.warning(f"Failed to cancel evicted run_id {rid}: {e}")
+
+    def __len__(self) -> int:
+        return len(self._buffers)
+
+
+replay_registry = ReplayRegistry()
@@ -0,0 +1,226 @@
+"""
+跨 worker 的 run 登记与取消转发
+
+多 worker 模式下 running_tasks 只包含本进程的任务，/cancel/{run_id} 可能落到其他 worker。
+这里用本机 SQLite（WAL）作为共享登记表：
+- 每个 worker 登记自己正在执行的 run_id 和 pid
+- 收到取消请求但本地没有该任务时，写入 cancel_requests
+- 各 worker 后台轮询属于自己的取消请求，交给本地 cancel_run 执行
+- 登记/注销在每个请求上发生，只入队，由后台线程按批在一个事务中写入，不在事件循环上等待 SQLite
+单 worker 模式下不启用，get_run_registry() 返回 None
+"""
+import asyncio
+import logging
+import os
+import queue
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+RUN_REGISTRY_PATH = os.getenv(
+    "RUN_REGISTRY_PATH", os.path.join(tempfile.gettempdir(), f"demand_agent_runs_{os.getpid()}.db")
+)
+# 取消请求轮询间隔（毫秒）
+RUN_REGISTRY_POLL_MS = int(os.getenv("RUN_REGISTRY_POLL_MS", "200"))
+# SQLite 锁等待上限（毫秒）
+RUN_REGISTRY_BUSY_TIMEOUT_MS = 1000
+# 后台写入线程每批最多处理的登记/注销操作数
+RUN_REGISTRY_BATCH_SIZE = 256
+
+_REGISTER = "register"
+_UNREGISTER = "unregister"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY,
+    pid INTEGER NOT NULL,
+    started_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_pid ON runs(pid);
+CREATE TABLE IF NOT EXISTS cancel_requests (
+    run_id TEXT PRIMARY KEY,
+    reason TEXT NOT NULL,
+    requested_at REAL NOT NULL
+);
+"""
+
+
+class RunRegistry:
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._conn_pid = 0
+        # 事件循环线程、轮询线程与写入线程共用同一连接
+        self._lock = threading.Lock()
+        # 待写入的 (操作, run_id, pid, 时间)，由本进程的写入线程消费；线程不会随 fork 复制，按 pid 惰性启动
+        self._writes: "queue.Queue" = queue.Queue()
+        self._writer: Optional[threading.Thread] = None
+        self._writer_pid = 0
+        self._writer_lock = threading.Lock()
+
+    def _db(self) -> sqlite3.Connection:
+        # 连接不能跨 fork 使用，按进程惰性创建
+        pid = os.getpid()
+        if self._conn is None or self._conn_pid != pid:
+            conn = sqlite3.connect(
+                self.path, timeout=RUN_REGISTRY_BUSY_TIMEOUT_MS / 1000.0, isolation_level=None,
+                check_same_thread=False,
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn = conn
+            self._conn_pid = pid
+        return self._conn
+
+    def setup(self):
+        """父进程 fork 前调用：建表并清空上次运行遗留的记录"""
+        with self._lock:
+            db = self._db()
+            db.executescript(_SCHEMA)
+            db.execute("DELETE FROM runs")
+            db.execute("DELETE FROM cancel_requests")
+            db.close()
+            self._conn = None
+
+    def register(self, run_id: str):
+        self._enqueue(_REGISTER, run_id)
+
+    def unregister(self, run_id: str):
+        self._enqueue(_UNREGISTER, run_id)
+
+    def flush(self, timeout: float = 5.0) -> bool:
+        """等待已入队的登记/注销写入完成，返回是否在超时前完成"""
+        if self._writer is None or self._writer_pid != os.getpid():
+            return True
+        deadline = time.monotonic() + timeout
+        while self._writes.unfinished_tasks:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.005)
+        return True
+
+    def _enqueue(self, op: str, run_id: str):
+        pid = os.getpid()
+        if self._writer is None or self._writer_pid != pid:
+            with self._writer_lock:
+                if self._writer is None or self._writer_pid != pid:
+                    # fork 出的子进程继承了父进程队列中未写完的操作，丢弃后重新开始
+                    self._writes = queue.Queue()
+                    self._writer = threading.Thread(target=self._run_writer, name="run-registry", daemon=True)
+                    self._writer_pid = pid
+                    self._writer.start()
+        self._writes.put((op, run_id, pid, time.time()))
+
+    def _run_writer(self):
+        writes = self._writes
+        while True:
+            batch = [writes.get()]
+            while len(batch) < RUN_REGISTRY_BATCH_SIZE:
+                try:
+                    batch.append(writes.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write_batch(batch)
+            except sqlite3.Error as e:
+                logger.warning(f"Failed to write {len(batch)} run registry updates: {e}")
+            finally:
+                for _ in batch:
+                    writes.task_done()
+
+    def _write_batch(self, batch: List[Tuple[str, str, int, float]]):
+        # 按入队顺序执行，同一 run 的登记与注销不会颠倒
+        with self._lock:
+            db = self._db()
+            db.execute("BEGIN")
+            try:
+                for op, run_id, pid, ts in batch:
+                    if op == _REGISTER:
+                        db.execute(
+                            "INSERT OR REPLACE INTO runs (run_id, pid, started_at) VALUES (?, ?, ?)",
+                            (run_id, pid, ts),
+                        )
+                    else:
+                        db.execute("DELETE FROM runs WHERE run_id = ? AND pid = ?", (run_id, pid))
+                        db.execute("DELETE FROM cancel_requests WHERE run_id = ?", (run_id,))
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+
+    def owner(self, run_id: str) -> Optional[int]:
+        with self._lock:
+            row = self._db().execute("SELECT pid FROM runs WHERE run_id = ?", (run_id,)).fetchone()
+        return row[0] if row else None
+
+    def request_cancel(self, run_id: str, reason: str) -> Optional[int]:
+        """run 在其他 worker 上执行时登记取消请求，返回所属 worker 的 pid，不存在返回 None"""
+        try:
+            pid = self.owner(run_id)
+            if pid is None:
+                return None
+            with self._lock:
+                self._db().execute(
+                    "INSERT OR REPLACE INTO cancel_requests (run_id, reason, requested_at) VALUES (?, ?, ?)",
+                    (run_id, reason, time.time()),
+                )
+            return pid
+        except sqlite3.Error as e:
+            logger.warning(f"Failed to forward cancel for run {run_id}: {e}")
+            return None
+
+    def take_cancel_requests(self) -> List[Tuple[str, str]]:
+        """取出属于本 worker 的取消请求"""
+        with self._lock:
+            db = self._db()
+            rows = db.execute(
+                "SELECT c.run_id, c.reason FROM cancel_requests c JOIN runs r ON c.run_id = r.run_id "
+                "WHERE r.pid = ?",
+                (os.getpid(),),
+            ).fetchall()
+            if rows:
+                db.executemany("DELETE FROM cancel_requests WHERE run_id = ?", [(run_id,) for run_id, _ in rows])
+        return rows
+
+    def purge_worker(self, pid: int):
+        """worker 退出后清理它遗留的记录"""
+        try:
+            with self._lock:
+                db = self._db()
+                db.execute(
+                    "DELETE FROM cancel_requests WHERE run_id IN (SELECT run_id FROM runs WHERE pid = ?)", (pid,)
+                )
+                db.execute("DELETE FROM runs WHERE pid = ?", (pid,))
+        except sqlite3.Error as e:
+            logger.warning(f"Failed to purge runs of worker {pid}: {e}")
+
+    async def poll_cancels(self, on_cancel: Callable[[str, str], None], interval_ms: int = RUN_REGISTRY_POLL_MS):
+        """worker 内的后台轮询任务"""
+        while True:
+            try:
+                for run_id, reason in await asyncio.to_thread(self.take_cancel_requests):
+                    logger.info(f"Received forwarded cancel for run_id: {run_id}, reason: {reason}")
+                    on_cancel(run_id, reason)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Cancel request polling failed: {e}")
+            await asyncio.sleep(interval_ms / 1000.0)
+
+
+_registry: Optional[RunRegistry] = None
+
+
+def enable_run_registry(path: str = RUN_REGISTRY_PATH) -> RunRegistry:
+    global _registry
+    _registry = RunRegistry(path)
+    _registry.setup()
+    return _registry
+
+
+def get_run_registry() -> Optional[RunRegistry]:
+    return _registry
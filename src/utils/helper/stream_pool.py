@@ -0,0 +1,140 @@
+"""
+同步流式执行的有界工作线程池
+
+graph 只支持同步 stream 时，GraphService.astream 退化到这里执行：
+- 线程数有上限，超出的流在池内排队，不再每个请求新建一个线程
+- 每个流使用有界队列回传结果，客户端读得慢时阻塞生产者线程
+- 消费端退出（取消/断开）后通知生产者停止，并关闭同步迭代器
+"""
+import asyncio
+import concurrent.futures
+import contextvars
+import logging
+import os
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+STREAM_WORKERS = int(os.getenv("STREAM_WORKERS", "32"))
+STREAM_QUEUE_SIZE = int(os.getenv("STREAM_QUEUE_SIZE", "64"))
+
+# 生产者阻塞在 put 上时，检查消费端是否已退出的间隔（秒）
+_PUT_POLL_SECONDS = 0.5
+
+_END = object()
+
+
+class _ProducerError:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+class StreamWorkerPool:
+    def __init__(self, max_workers: int = STREAM_WORKERS, queue_size: int = STREAM_QUEUE_SIZE):
+        self.max_workers = max_workers
+        self.queue_size = queue_size
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="graph-stream")
+        self._lock = threading.Lock()
+        self._submitted = 0
+        self._active = 0
+        self._completed = 0
+        self._queues: "weakref.WeakSet[asyncio.Queue]" = weakref.WeakSet()
+
+    async def iterate(self, produce: Callable[[], Iterable[Any]]) -> AsyncIterator[Any]:
+        """
+        在工作线程中迭代 produce() 返回的同步迭代器，并异步地逐个产出
+
+        produce 在提交时的 contextvars 上下文中执行；迭代中的异常会在消费端重新抛出
+        """
+        loop = asyncio.get_running_loop()
+        q: asyncio.Queue = asyncio.Queue(maxsize=self.queue_size)
+        stopped = threading.Event()
+        context = contextvars.copy_context()
+        self._queues.add(q)
+
+        def put(item: Any) -> bool:
+            try:
+                fut = asyncio.run_coroutine_threadsafe(q.put(item), loop)
+            except RuntimeError:
+                # 事件循环已关闭
+                return False
+            while True:
+                try:
+                    fut.result(timeout=_PUT_POLL_SECONDS)
+                    return True
+                except concurrent.futures.TimeoutError:
+                    if stopped.is_set():
+                        fut.cancel()
+                        return False
+
+        def worker():
+            with self._lock:
+                self._active += 1
+            iterator = None
+            try:
+                # 在池内排队期间消费端已退出（取消/断开）：不再启动 graph，直接结束
+                if stopped.is_set():
+                    return
+                iterator = iter(produce())
+                for item in iterator:
+                    if stopped.is_set() or not put(item):
+                        break
+            except BaseException as ex:
+                put(_ProducerError(ex))
+            finally:
+                close = getattr(iterator, "close", None)
+                if close is not None:
+                    try:
+                        close()
+                    except Exception as ex:
+                        logger.warning(f"Failed to close stream iterator: {ex}")
+                put(_END)
+                with self._lock:
+                    self._active -= 1
+                    self._completed += 1
+
+        with self._lock:
+            self._submitted += 1
+        self._executor.submit(context.run, worker)
+
+        try:
+            while True:
+                item = await q.get()
+                if item is _END:
+                    break
+                if isinstance(item, _ProducerError):
+                    raise item.error
+                yield item
+        finally:
+            stopped.set()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            submitted, active, completed = self._submitted, self._active, self._completed
+        queues = list(self._queues)
+        return {
+            "max_workers": self.max_workers,
+            "queue_size": self.queue_size,
+            "active": active,
+            "pending": max(submitted - active - completed, 0),
+            "completed": completed,
+            "streams": len(queues),
+            "queued_items": sum(q.qsize() for q in queues),
+        }
+
+
+_stream_pool: Optional[StreamWorkerPool] = None
+_stream_pool_lock = threading.Lock()
+
+
+def get_stream_pool() -> StreamWorkerPool:
+    """获取全局同步流工作线程池"""
+    global _stream_pool
+    if _stream_pool is None:
+        with _stream_pool_lock:
+            if _stream_pool is None:
+                _stream_pool = StreamWorkerPool()
+    return _stream_pool
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""
+测试脚本：准入控制的并发上限、排队唤醒、超时与取消时的槽位归还
+"""
+
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+# 添加src目录到路径
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from utils.helper.admission import (
+    LANE_BATCH,
+    LANE_INTERACTIVE,
+    AdmissionController,
+    AdmissionRejected,
+    EndpointPolicy,
+)
+
+
+def _controller(limit: int = 2, timeout: float = 1.0, **kwargs) -> AdmissionController:
+    policies = (
+        EndpointPolicy("stream_run", LANE_INTERACTIVE, limit, timeout),
+        EndpointPolicy("run", LANE_BATCH, limit, timeout),
+    )
+    kwargs.setdefault("max_concurrency", 100)
+    kwargs.setdefault("interactive_reserved", 0)
+    return AdmissionController(policies, **kwargs)
+
+
+def _active(controller: AdmissionController, endpoint: str) -> int:
+    return controller.stats()["endpoints"][endpoint]["active"]
+
+
+def test_limit_then_queue_then_wake_on_release():
+    async def run():
+        controller = _controller(limit=2)
+        first = await controller.acquire("run")
+        second = await controller.acquire("run")
+        waiter = asyncio.create_task(controller.acquire("run"))
+        await asyncio.sleep(0.01)
+        assert not waiter.done()
+        first.release()
+        third = await asyncio.wait_for(waiter, 1)
+        assert _active(controller, "run") == 2
+        second.release()
+        third.release()
+        # 重复 release 不影响计数
+        third.release()
+        assert _active(controller, "run") == 0
+
+    asyncio.run(run())
+
+
+def test_queue_timeout_rejects_with_retry_after():
+    async def run():
+        controller = _controller(limit=1, timeout=0.05)
+        ticket = await controller.acquire("run")
+        with pytest.raises(AdmissionRejected) as info:
+            await controller.acquire("run")
+        assert info.value.reason == "queue_timeout"
+        assert info.value.retry_after >= 1
+        ticket.release()
+        assert controller.stats()["endpoints"]["run"]["queued"] == 0
+
+    asyncio.run(run())
+
+
+def test_queue_full_rejects_immediately():
+    async def run():
+        controller = _controller(limit=1, max_queue=1)
+        ticket = await controller.acquire("run")
+        waiter = asyncio.create_task(controller.acquire("run"))
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected) as info:
+            await controller.acquire("run")
+        assert info.value.reason == "queue_full"
+        ticket.release()
+        (await waiter).release()
+
+    asyncio.run(run())
+
+
+def test_cancelled_waiter_returns_granted_slot():
+    async def run():
+        controller = _controller(limit=1)
+        ticket = await controller.acquire("run")
+        waiter = asyncio.create_task(controller.acquire("run"))
+        await asyncio.sleep(0)
+        # 槽位分配给 waiter 后、waiter 恢复执行前取消
+        ticket.release()
+        waiter.cancel()
+        try:
+            granted = await waiter
+        except asyncio.CancelledError:
+            granted = None
+        if granted is not None:
+            granted.release()
+        assert _active(controller, "run") == 0
+
+    asyncio.run(run())
+
+
+def test_cancelled_while_queued_is_skipped():
+    async def run():
+        controller = _controller(limit=1)
+        ticket = await controller.acquire("run")
+        cancelled = asyncio.create_task(controller.acquire("run"))
+        waiting = asyncio.create_task(controller.acquire("run"))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.sleep(0)
+        ticket.release()
+        (await asyncio.wait_for(waiting, 1)).release()
+        assert cancelled.cancelled()
+        assert _active(controller, "run") == 0
+
+    asyncio.run(run())
+
+
+class _GrantOnTimeoutController(AdmissionController):
+    """排队超时的同时槽位被分配：处理超时前先释放占用者，使 future 已被 _dispatch 完成"""
+
+    holder = None
+
+    def _discard_waiter(self, endpoint, project_id, fut):
+        if self.holder is not None:
+            self.holder.release()
+            self.holder = None
+        return super()._discard_waiter(endpoint, project_id, fut)
+
+
+def test_slot_granted_at_timeout_is_not_leaked():
+    async def run():
+        controller = _GrantOnTimeoutController(
+            (EndpointPolicy("run", LANE_BATCH, 1, 0.01),), max_concurrency=100, interactive_reserved=0,
+        )
+        controller.holder = await controller.acquire("run")
+        granted = await controller.acquire("run")
+        assert _active(controller, "run") == 1
+        granted.release()
+        assert _active(controller, "run") == 0
+
+    asyncio.run(run())
+
+
+def test_batch_cannot_use_interactive_reserve():
+    async def run():
+        controller = _controller(limit=10, timeout=0, max_concurrency=2, interactive_reserved=1)
+        batch = await controller.acquire("run")
+        with pytest.raises(AdmissionRejected):
+            await controller.acquire("run")
+        (await controller.acquire("stream_run")).release()
+        batch.release()
+
+    asyncio.run(run())
+
+
+def test_interactive_woken_before_batch():
+    async def run():
+        controller = _controller(limit=10, max_concurrency=1)
+        ticket = await controller.acquire("stream_run")
+        queued_batch = asyncio.create_task(controller.acquire("run"))
+        await asyncio.sleep(0)
+        queued_interactive = asyncio.create_task(controller.acquire("stream_run"))
+        await asyncio.sleep(0)
+        ticket.release()
+        woken = await asyncio.wait_for(queued_interactive, 1)
+        assert not queued_batch.done()
+        woken.release()
+        (await asyncio.wait_for(queued_batch, 1)).release()
+
+    asyncio.run(run())
+
+
+def test_projects_woken_round_robin():
+    async def run():
+        controller = _controller(limit=1)
+        ticket = await controller.acquire("run", "a")
+        order = []
+
+        async def wait(project_id: str):
+            granted = await controller.acquire("run", project_id)
+            order.append(project_id)
+            await asyncio.sleep(0)
+            granted.release()
+
+        waiters = [asyncio.create_task(wait(p)) for p in ("a", "a", "a", "b", "b")]
+        await asyncio.sleep(0)
+        ticket.release()
+        await asyncio.wait_for(asyncio.gather(*waiters), 1)
+        assert order == ["a", "b", "a", "b", "a"]
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, "-q"]))
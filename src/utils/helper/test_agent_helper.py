@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+测试脚本：流式消息转换在 run 被取消令牌中断时以取消码结束，出错时按错误分类结束，用量写入节点日志
+"""
+
+import asyncio
+import json
+import sys
+from pathlib import Path
+
+import pytest
+
+# 添加src目录到路径
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+for module in ("langchain_core", "requests", "chardet", "pptx", "pydantic"):
+    pytest.importorskip(module)
+
+from langchain_core.messages import AIMessageChunk
+
+from utils.helper import agent_helper
+from utils.helper.agent_helper import aiter_server_messages, iter_server_messages
+from utils.helper.cancellation import CANCEL_REASON_USER, CancellationToken
+from utils.messages.server import (
+    MESSAGE_END_CODE_CANCELED,
+    MESSAGE_END_CODE_SUCCESS,
+    MESSAGE_TYPE_ANSWER,
+    MESSAGE_TYPE_MESSAGE_END,
+)
+
+# autouse fixture 替换前的原函数
+_log_stream_usage = agent_helper._log_stream_usage
+
+_IDS = dict(session_id="s", query_msg_id="q", local_msg_id="l", run_id="run-1", log_id="log")
+
+
+def _items(token: CancellationToken = None, fail: Exception = None):
+    yield AIMessageChunk(content="hello", id="m1"), {}
+    if token is not None:
+        # 模拟 /cancel：令牌被取消后，CancellationCallbackHandler 在下一次回调中抛出 RunCancelledError
+        token.cancel(CANCEL_REASON_USER)
+        token.raise_if_cancelled()
+    if fail is not None:
+        raise fail
+    yield AIMessageChunk(content=" world", id="m1"), {}
+
+
+async def _aitems(token: CancellationToken = None, fail: Exception = None):
+    for item in _items(token, fail):
+        yield item
+
+
+def _collect_async(items):
+    async def run():
+        return [m async for m in aiter_server_messages(items, **_IDS)]
+
+    return asyncio.run(run())
+
+
+@pytest.fixture(autouse=True)
+def usage_logs(monkeypatch):
+    # 不写日志文件，只记录写入节点日志的用量
+    calls = []
+    monkeypatch.setattr(agent_helper, "_log_stream_usage", lambda *args: calls.append(args))
+    return calls
+
+
+def _end(messages):
+    end = messages[-1]
+    assert end.type == MESSAGE_TYPE_MESSAGE_END
+    return end.content.message_end
+
+
+def test_completed_stream_ends_with_success():
+    messages = _collect_async(_aitems())
+    assert [m.content.answer for m in messages if m.type == MESSAGE_TYPE_ANSWER] == ["hello", " world"]
+    assert _end(messages).code == MESSAGE_END_CODE_SUCCESS
+
+
+def test_cancelled_run_ends_with_cancel_code():
+    token = CancellationToken("run-1")
+    messages = _collect_async(_aitems(token))
+    end = _end(messages)
+    assert end.code == MESSAGE_END_CODE_CANCELED
+    assert CANCEL_REASON_USER in end.message
+    # 取消前已发出的增量保留，序号连续
+    assert [m.sequence_id for m in messages] == list(range(1, len(messages) + 1))
+
+
+def test_cancelled_sync_stream_ends_with_cancel_code():
+    token = CancellationToken("run-1")
+    assert _end(list(iter_server_messages(_items(token), **_IDS))).code == MESSAGE_END_CODE_CANCELED
+
+
+def test_error_is_classified_not_cancelled():
+    end = _end(_collect_async(_aitems(fail=RuntimeError("boom"))))
+    assert end.code not in (MESSAGE_END_CODE_SUCCESS, MESSAGE_END_CODE_CANCELED)
+
+
+def test_usage_logged_with_end_code(usage_logs):
+    _collect_async(_aitems())
+    _collect_async(_aitems(CancellationToken("run-1")))
+    assert [(run_id, code, log_id) for run_id, _, _, code, log_id in usage_logs] == [
+        ("run-1", MESSAGE_END_CODE_SUCCESS, "log"), ("run-1", MESSAGE_END_CODE_CANCELED, "log"),
+    ]
+    assert {"input_tokens", "output_tokens", "total_tokens"} <= set(usage_logs[0][1])
+
+
+def test_usage_written_through_node_log(monkeypatch):
+    for module in ("openai", "langgraph", "coze_coding_utils"):
+        pytest.importorskip(module)
+    from utils.log import node_log
+
+    entries = []
+    monkeypatch.setattr(node_log, "write_log", entries.append)
+    _log_stream_usage("run-1", {"output_tokens": 2, "ttft_ms": 5}, 42, MESSAGE_END_CODE_CANCELED, "log")
+    assert len(entries) == 1
+    entry = entries[0]
+    assert entry["type"] == "stream_usage" and entry["execute_id"] == "run-1" and entry["log_id"] == "log"
+    assert entry["latency"] == 42 and entry["error_code"] == MESSAGE_END_CODE_CANCELED
+    assert json.loads(entry["token"]) == {"output_tokens": 2, "ttft_ms": 5}
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, "-q"]))
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+测试脚本：已编译 Agent 按配置 mtime/内容哈希复用，配置内容变化才重新编译；
+单节点注册表中构建失败的节点只影响自身
+"""
+
+import json
+import os
+import sys
+import threading
+from pathlib import Path
+
+import pytest
+
+# 添加src目录到路径
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+pytest.importorskip("langgraph")
+
+from langgraph.graph import END, START, StateGraph
+from pydantic import BaseModel, ConfigDict
+
+from utils.helper import graph_helper
+from utils.helper.graph_helper import AgentRegistry, NodeRegistry
+
+_AGENT_MODULE = '''
+import json
+import os
+
+CONFIG_PATH = {config_path!r}
+builds = []
+
+
+def get_config_path():
+    return CONFIG_PATH
+
+
+def build_agent_from_config(cfg):
+    builds.append(cfg)
+    return {{"agent": len(builds), "cfg": cfg}}
+
+
+def build_agent(ctx):
+    return {{"uncached": ctx}}
+'''
+
+
+@pytest.fixture
+def agent_module(tmp_path, monkeypatch):
+    config = tmp_path / "agent.json"
+    config.write_text(json.dumps({"model": "a"}), encoding="utf-8")
+    name = f"fake_agent_{tmp_path.name}"
+    (tmp_path / f"{name}.py").write_text(_AGENT_MODULE.format(config_path=str(config)), encoding="utf-8")
+    monkeypatch.syspath_prepend(str(tmp_path))
+    module = __import__(name)
+    yield name, module, config
+    sys.modules.pop(name, None)
+
+
+def _bump_mtime(path: Path):
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+
+def test_same_config_reuses_compiled_agent(agent_module):
+    name, module, _ = agent_module
+    registry = AgentRegistry()
+    first = registry.get(name)
+    assert registry.get(name) is first
+    assert len(module.builds) == 1
+
+
+def test_touch_without_content_change_reuses_agent(agent_module):
+    name, module, config = agent_module
+    registry = AgentRegistry()
+    first = registry.get(name)
+    _bump_mtime(config)
+    assert registry.get(name) is first
+    assert len(module.builds) == 1
+    # mtime 已更新，之后的获取不再读取文件
+    assert registry._entries[name].mtime_ns == os.stat(config).st_mtime_ns
+
+
+def test_content_change_recompiles(agent_module):
+    name, module, config = agent_module
+    registry = AgentRegistry()
+    first = registry.get(name)
+    config.write_text(json.dumps({"model": "b"}), encoding="utf-8")
+    _bump_mtime(config)
+    second = registry.get(name)
+    assert second is not first and second["cfg"] == {"model": "b"}
+    assert len(module.builds) == 2
+
+
+def test_invalidate_forces_rebuild(agent_module):
+    name, module, _ = agent_module
+    registry = AgentRegistry()
+    first = registry.get(name)
+    registry.invalidate(name)
+    assert registry.get(name) is not first
+    registry.invalidate()
+    assert registry._entries == {}
+
+
+def test_concurrent_first_get_compiles_once(agent_module):
+    name, module, _ = agent_module
+    registry = AgentRegistry()
+    barrier = threading.Barrier(8)
+    agents = []
+
+    def get():
+        barrier.wait()
+        agents.append(registry.get(name))
+
+    threads = [threading.Thread(target=get) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(module.builds) == 1
+    assert all(agent is agents[0] for agent in agents)
+
+
+def test_module_without_config_hooks_builds_per_request(agent_module, monkeypatch):
+    name, module, _ = agent_module
+    monkeypatch.delattr(module, "build_agent_from_config")
+    assert graph_helper.get_cached_agent_instance(name, "ctx") == {"uncached": "ctx"}
+    assert module.builds == []
+
+
+class _Opaque:
+    pass
+
+
+class GraphState(BaseModel):
+    text: str = ""
+    count: int = 0
+
+
+class CountInput(BaseModel):
+    text: str = ""
+
+
+class CountOutput(BaseModel):
+    count: int = 0
+
+
+class OpaqueInput(BaseModel):
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+    text: str = ""
+    raw: _Opaque = None
+
+
+def count(state: CountInput) -> CountOutput:
+    return CountOutput(count=len(state.text))
+
+
+def opaque(state: OpaqueInput) -> CountOutput:
+    return CountOutput()
+
+
+def _graph():
+    sub = StateGraph(GraphState)
+    sub.add_node("count", count)
+    sub.add_edge(START, "count")
+    sub.add_edge("count", END)
+
+    builder = StateGraph(GraphState)
+    builder.add_node("count", count)
+    builder.add_node("opaque", opaque)
+    # 子图节点没有 func，以 node_id 登记失败
+    builder.add_node("subgraph", sub.compile())
+    builder.add_edge(START, "count")
+    builder.add_edge("count", "opaque")
+    builder.add_edge("opaque", "subgraph")
+    builder.add_edge("subgraph", END)
+    return builder.compile()
+
+
+def test_node_registry_isolates_failed_nodes():
+    registry = NodeRegistry(_graph())
+    assert registry.node_ids() == ["count"]
+    spec = registry.get("count")
+    assert spec.input_cls is CountInput and spec.output_cls is CountOutput
+    assert spec.input_schema == CountInput.model_json_schema()
+    assert spec.graph.invoke({"text": "abc"}) == {"count": 3}
+    assert set(registry.graph_schema) == {"input_schema", "output_schema"}
+
+
+def test_node_registry_raises_build_error_on_use():
+    registry = NodeRegistry(_graph())
+    # 输入类无法生成 JSON Schema：调用该节点时抛出构建时的异常
+    with pytest.raises(Exception, match="JsonSchema"):
+        registry.get("opaque")
+    with pytest.raises(AttributeError):
+        registry.get("subgraph")
+    with pytest.raises(KeyError):
+        registry.get("missing")
+    # 失败节点不影响其他节点
+    assert registry.get("count").node_id == "count"
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, "-q"]))
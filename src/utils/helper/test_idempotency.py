@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+测试脚本：幂等键计算、进行中请求的附着等待（single-flight）与结果缓存
+"""
+
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+# 添加src目录到路径
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from utils.helper.idempotency import (
+    IDEMPOTENCY_KEY_HEADER,
+    IDEMPOTENCY_MODE_HEADER,
+    IdempotencyRegistry,
+    idempotency_key,
+)
+
+
+def test_key_from_header_or_payload():
+    assert idempotency_key({}, "run", {"a": 1}) is None
+    assert idempotency_key({IDEMPOTENCY_KEY_HEADER: "abc"}, "run", {}) == "run:key:abc"
+    headers = {IDEMPOTENCY_MODE_HEADER: "payload"}
+    # 键顺序不同的相同请求体得到相同的键
+    assert idempotency_key(headers, "run", {"a": 1, "b": [1, 2]}) == \
+        idempotency_key(headers, "run", {"b": [1, 2], "a": 1})
+    assert idempotency_key(headers, "run", {"a": 1}) != idempotency_key(headers, "stream_run", {"a": 1})
+
+
+def test_duplicate_waits_until_original_starts():
+    async def run():
+        registry = IdempotencyRegistry()
+        registry.register("k", "run-1")
+        # 原请求仍在准入排队，后到的请求看到的是未开始的条目
+        entry = registry.lookup("k")
+        waiter = asyncio.create_task(entry.wait_started(timeout=1))
+        await asyncio.sleep(0.01)
+        assert not waiter.done()
+        registry.mark_started("k", "run-1")
+        assert await waiter is True
+        assert registry.stats.inflight_hits == 1
+
+    asyncio.run(run())
+
+
+def test_duplicate_released_when_original_rejected():
+    async def run():
+        registry = IdempotencyRegistry()
+        registry.register("k", "run-1")
+        entry = registry.lookup("k")
+        waiter = asyncio.create_task(entry.wait_started(timeout=1))
+        await asyncio.sleep(0)
+        # 原请求被准入拒绝：键删除，等待者按新请求执行
+        registry.release("k", "run-1")
+        assert await waiter is False
+        assert registry.lookup("k") is None
+
+    asyncio.run(run())
+
+
+def test_concurrent_duplicates_coalesce_to_one_execution():
+    async def run():
+        registry = IdempotencyRegistry()
+        executions = []
+
+        async def request(run_id: str):
+            entry = registry.lookup("k")
+            if entry is not None and await entry.wait_started(timeout=1):
+                return entry.run_id
+            registry.register("k", run_id)
+            await asyncio.sleep(0.01)  # 准入排队
+            executions.append(run_id)
+            registry.mark_started("k", run_id)
+            await asyncio.sleep(0.01)
+            registry.complete("k", run_id, {"status": "ok"})
+            return run_id
+
+        results = await asyncio.gather(*(request(f"run-{i}") for i in range(10)))
+        assert executions == ["run-0"]
+        assert set(results) == {"run-0"}
+
+    asyncio.run(run())
+
+
+def test_completed_result_cached_until_ttl():
+    registry = IdempotencyRegistry(ttl_seconds=0.05)
+    registry.register("k", "run-1")
+    registry.complete("k", "run-1", {"status": "ok"})
+    entry = registry.lookup("k")
+    assert entry.finished and entry.result == {"status": "ok"}
+    # 已完成的键不会被迟到的 release 删除
+    registry.release("k", "run-1")
+    assert registry.lookup("k") is not None
+    time.sleep(0.06)
+    assert registry.lookup("k") is None
+
+
+def test_stale_release_does_not_drop_newer_run():
+    registry = IdempotencyRegistry()
+    registry.register("k", "run-1")
+    registry.register("k", "run-2")
+    registry.release("k", "run-1")
+    assert registry.lookup("k").run_id == "run-2"
+
+
+def test_max_entries_evicts_finished_first():
+    registry = IdempotencyRegistry(max_entries=3)
+    registry.register("done", "run-1")
+    registry.complete("done", "run-1", {})
+    registry.register("a", "run-2")
+    registry.register("b", "run-3")
+    registry.register("c", "run-4")
+    assert registry.lookup("done") is None
+    assert {registry.lookup(k).run_id for k in ("a", "b", "c")} == {"run-2", "run-3", "run-4"}
+
+
+if __name__ == "__main__":
+    import pytest
+
+    sys.exit(pytest.main([__file__, "-q"]))
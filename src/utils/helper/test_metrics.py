@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+测试脚本：按线程分片的计数器/直方图在抓取时正确合并，输出 Prometheus 文本格式
+"""
+
+import asyncio
+import sys
+import threading
+from pathlib import Path
+
+import pytest
+
+# 添加src目录到路径
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from utils.helper.metrics import COUNTER, GAUGE, HISTOGRAM, MetricsMiddleware, MetricsRegistry
+
+
+def _lines(registry: MetricsRegistry):
+    return registry.render().splitlines()
+
+
+def _value(registry: MetricsRegistry, series: str) -> float:
+    for line in _lines(registry):
+        name, _, value = line.rpartition(" ")
+        if name == series:
+            return float(value)
+    raise KeyError(series)
+
+
+def _run_threads(count: int, target):
+    barrier = threading.Barrier(count)
+
+    def run(i):
+        barrier.wait()
+        target(i)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def test_counters_merged_across_thread_shards():
+    registry = MetricsRegistry(prefix="svc")
+    registry.describe("requests_total", COUNTER, "Requests")
+
+    def work(i):
+        for _ in range(1000):
+            registry.inc("requests_total", route="/run", status="200")
+        registry.inc("requests_total", route="/run", status="500" if i % 2 else "429")
+
+    _run_threads(8, work)
+    assert len(registry._shards) == 8
+    assert _value(registry, 'svc_requests_total{route="/run",status="200"}') == 8000
+    assert _value(registry, 'svc_requests_total{route="/run",status="500"}') == 4
+    assert _lines(registry)[:2] == ["# HELP svc_requests_total Requests", "# TYPE svc_requests_total counter"]
+
+
+def test_gauge_via_negative_inc():
+    registry = MetricsRegistry(prefix="")
+    registry.describe("active_streams", GAUGE)
+    registry.inc("active_streams")
+    _run_threads(2, lambda i: registry.inc("active_streams", -1 if i else 1))
+    registry.inc("active_streams", -1)
+    assert _value(registry, "active_streams") == 0
+    assert "# TYPE active_streams gauge" in _lines(registry)
+
+
+def test_histograms_merged_with_cumulative_buckets():
+    registry = MetricsRegistry(prefix="")
+    registry.describe("latency", HISTOGRAM, buckets=(1, 0.1))
+
+    def work(i):
+        registry.observe("latency", [0.05, 0.1, 0.5, 5][i], route="/r")
+
+    _run_threads(4, work)
+    assert _value(registry, 'latency_bucket{route="/r",le="0.1"}') == 2
+    assert _value(registry, 'latency_bucket{route="/r",le="1"}') == 3
+    assert _value(registry, 'latency_bucket{route="/r",le="+Inf"}') == 4
+    assert _value(registry, 'latency_count{route="/r"}') == 4
+    assert _value(registry, 'latency_sum{route="/r"}') == pytest.approx(5.65)
+
+
+def test_render_while_writing_is_consistent():
+    registry = MetricsRegistry(prefix="")
+    stop = threading.Event()
+    totals = []
+
+    def scrape():
+        while not stop.is_set():
+            try:
+                totals.append(_value(registry, "n"))
+            except KeyError:
+                continue
+
+    scraper = threading.Thread(target=scrape)
+    scraper.start()
+    _run_threads(4, lambda i: [registry.inc("n") for _ in range(20000)])
+    stop.set()
+    scraper.join()
+    # 计数只增不减：抓取结果单调，最终值完整
+    assert totals == sorted(totals)
+    assert _value(registry, "n") == 80000
+
+
+def test_collectors_and_label_escaping():
+    registry = MetricsRegistry(prefix="p")
+    registry.register_collector(lambda: [
+        ("queue_depth", GAUGE, [("", {"path": 'a"b\\c\nd'}, 3), ("", {"path": "skip"}, None)]),
+    ])
+    lines = _lines(registry)
+    assert "# TYPE p_queue_depth gauge" in lines
+    assert 'p_queue_depth{path="a\\"b\\\\c\\nd"} 3' in lines
+    assert not any("skip" in line for line in lines)
+
+
+def test_middleware_records_route_template_and_status():
+    registry = MetricsRegistry(prefix="")
+
+    class _Route:
+        path = "/node_run/{node_id}"
+
+    async def app(scope, receive, send):
+        scope["route"] = _Route()
+        await send({"type": "http.response.start", "status": 202})
+        await send({"type": "http.response.body", "body": b"ok"})
+
+    async def failing(scope, receive, send):
+        scope["route"] = _Route()
+        raise RuntimeError("boom")
+
+    async def send(message):
+        pass
+
+    async def run():
+        await MetricsMiddleware(app, registry)({"type": "http"}, None, send)
+        with pytest.raises(RuntimeError):
+            await MetricsMiddleware(failing, registry)({"type": "http"}, None, send)
+        # 不在白名单中的路由不统计
+        await MetricsMiddleware(app, registry, routes=["/run"])({"type": "http"}, None, send)
+
+    asyncio.run(run())
+    assert _value(registry, 'http_requests_total{route="/node_run/{node_id}",status="202"}') == 1
+    assert _value(registry, 'http_requests_total{route="/node_run/{node_id}",status="500"}') == 1
+    assert _value(registry, 'http_request_duration_seconds_count{route="/node_run/{node_id}"}') == 2
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, "-q"]))
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+测试脚本：回放缓冲区的订阅顺序、结束与淘汰行为，注册表的数量上限
+"""
+
+import asyncio
+import json
+import sys
+from pathlib import Path
+
+# 添加src目录到路径
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from utils.helper.replay_buffer import REPLAY_GAP_EVENT, ReplayBuffer, ReplayRegistry, parse_last_event_id
+from utils.messages.codec import SseWire
+
+
+def _decode(frame: bytes):
+    """解析 SSE 帧，返回 (事件 id, 数据)"""
+    lines = frame.decode("utf-8").strip().split("\n")
+    event_id = parse_last_event_id(lines[0][len("id: "):])[1]
+    return event_id, json.loads(lines[-1][len("data: "):])
+
+
+async def _collect(buffer: ReplayBuffer, after_id: int = 0, delay: float = 0):
+    frames = []
+    async for frame in buffer.subscribe(after_id):
+        frames.append(_decode(frame))
+        if delay:
+            await asyncio.sleep(delay)
+    return frames
+
+
+def test_slow_subscriber_receives_tail_after_finish():
+    async def run():
+        buffer = ReplayBuffer("run", SseWire())
+        consumer = asyncio.create_task(_collect(buffer, delay=0.01))
+        await asyncio.sleep(0)
+        for seq in range(1, 11):
+            buffer.append({"sequence_id": seq})
+        buffer.finish()
+        return await consumer
+
+    frames = asyncio.run(run())
+    assert [event_id for event_id, _ in frames] == list(range(1, 11))
+
+
+def test_append_during_consumption_keeps_order():
+    async def run():
+        buffer = ReplayBuffer("run", SseWire(), max_events=64)
+
+        async def produce():
+            for seq in range(1, 41):
+                buffer.append({"sequence_id": seq})
+                if seq % 3 == 0:
+                    await asyncio.sleep(0)
+            buffer.finish()
+
+        consumer = asyncio.create_task(_collect(buffer))
+        await produce()
+        return await consumer
+
+    frames = asyncio.run(run())
+    assert [event_id for event_id, _ in frames] == list(range(1, 41))
+
+
+def test_evicted_position_sends_gap_then_continues():
+    async def run():
+        buffer = ReplayBuffer("run", SseWire(), max_events=8)
+        consumer = asyncio.create_task(_collect(buffer, delay=0.001))
+        await asyncio.sleep(0)
+        for seq in range(1, 41):
+            buffer.append({"sequence_id": seq})
+            if seq % 4 == 0:
+                await asyncio.sleep(0)
+        buffer.finish()
+        return await consumer
+
+    frames = asyncio.run(run())
+    ids = [event_id for event_id, _ in frames]
+    # 事件 id 严格递增，每次跳跃前都有一条 gap 事件说明缺失范围
+    assert ids == sorted(set(ids))
+    assert ids[-1] == 40
+    expected = 0
+    for event_id, data in frames:
+        if data.get("type") == REPLAY_GAP_EVENT:
+            assert data["missed_from"] == expected + 1
+            assert data["missed_to"] == event_id
+        else:
+            assert event_id == expected + 1
+        expected = event_id
+
+
+def test_resume_after_eviction_starts_with_gap():
+    async def run():
+        buffer = ReplayBuffer("run", SseWire(), max_events=8)
+        for seq in range(1, 21):
+            buffer.append({"sequence_id": seq})
+        buffer.finish()
+        return await _collect(buffer, after_id=3)
+
+    frames = asyncio.run(run())
+    assert frames[0] == (12, {"type": REPLAY_GAP_EVENT, "run_id": "run", "missed_from": 4, "missed_to": 12})
+    assert [event_id for event_id, _ in frames[1:]] == list(range(13, 21))
+
+
+def test_registry_evicts_finished_before_unfinished():
+    expired = []
+    registry = ReplayRegistry(max_runs=3)
+    for rid in ("a", "b", "c"):
+        registry.create(rid, SseWire(), on_expired=expired.append)
+    registry.get("b").finish()
+    registry.create("d", SseWire(), on_expired=expired.append)
+    assert registry.get("b") is None and expired == []
+    assert len(registry) == 3
+
+
+def test_registry_caps_unfinished_oldest_first_and_cancels():
+    async def run():
+        expired = []
+        registry = ReplayRegistry(max_runs=3)
+        for rid in ("a", "b", "c"):
+            registry.create(rid, SseWire(), on_expired=expired.append)
+        # a 仍有订阅者，b、c 无人订阅：先淘汰无订阅者中最早的 b
+        subscriber = registry.get("a").subscribe()
+        waiting = asyncio.create_task(subscriber.__anext__())
+        await asyncio.sleep(0)
+        registry.create("d", SseWire(), on_expired=expired.append)
+        assert expired == ["b"]
+        registry.create("e", SseWire(), on_expired=expired.append)
+        assert expired == ["b", "c"]
+        assert list(registry._buffers) == ["a", "d", "e"]
+        # 全部有订阅者时按创建先后淘汰
+        for rid in ("d", "e"):
+            registry.get(rid).subscribers += 1
+        registry.create("f", SseWire(), on_expired=expired.append)
+        assert expired == ["b", "c", "a"]
+        assert len(registry) == 3 and registry.get("a") is None
+        waiting.cancel()
+
+    asyncio.run(run())
+
+
+def test_registry_get_does_not_evict_unfinished():
+    expired = []
+    registry = ReplayRegistry(max_runs=2)
+    registry.create("a", SseWire(), on_expired=expired.append)
+    registry.create("b", SseWire(), on_expired=expired.append)
+    assert registry.get("a") is not None and registry.get("b") is not None
+    assert expired == []
+
+
+def test_failing_cancel_does_not_block_create():
+    def fail(rid):
+        raise RuntimeError("cancel failed")
+
+    registry = ReplayRegistry(max_runs=1)
+    registry.create("a", SseWire(), on_expired=fail)
+    assert registry.create("b", SseWire(), on_expired=fail) is registry.get("b")
+    assert len(registry) == 1
+
+
+if __name__ == "__main__":
+    import pytest
+
+    sys.exit(pytest.main([__file__, "-q"]))
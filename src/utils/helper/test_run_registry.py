@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+测试脚本：跨 worker run 登记表的后台批量写入、登记/注销顺序与取消请求转发
+"""
+
+import os
+import sys
+from pathlib import Path
+
+# 添加src目录到路径
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from utils.helper.run_registry import RunRegistry
+
+
+def _registry(tmp_path) -> RunRegistry:
+    registry = RunRegistry(str(tmp_path / "runs.db"))
+    registry.setup()
+    return registry
+
+
+def test_register_written_in_background(tmp_path):
+    registry = _registry(tmp_path)
+    registry.register("run-1")
+    assert registry.flush()
+    assert registry.owner("run-1") == os.getpid()
+    registry.unregister("run-1")
+    assert registry.flush()
+    assert registry.owner("run-1") is None
+
+
+def test_batched_updates_keep_order(tmp_path):
+    registry = _registry(tmp_path)
+    for i in range(500):
+        registry.register(f"run-{i}")
+        if i % 2:
+            registry.unregister(f"run-{i}")
+    # 注销后重新登记的 run 仍然存在
+    registry.unregister("run-0")
+    registry.register("run-0")
+    assert registry.flush()
+    assert registry.owner("run-0") == os.getpid()
+    assert registry.owner("run-1") is None
+    assert registry.owner("run-498") == os.getpid()
+
+
+def test_cancel_request_forwarded_and_cleared(tmp_path):
+    registry = _registry(tmp_path)
+    registry.register("run-1")
+    registry.flush()
+    assert registry.request_cancel("run-1", "user") == os.getpid()
+    assert registry.request_cancel("missing", "user") is None
+    assert registry.take_cancel_requests() == [("run-1", "user")]
+    assert registry.take_cancel_requests() == []
+    registry.request_cancel("run-1", "user")
+    registry.unregister("run-1")
+    registry.flush()
+    assert registry.take_cancel_requests() == []
+
+
+if __name__ == "__main__":
+    import pytest
+
+    sys.exit(pytest.main([__file__, "-q"]))
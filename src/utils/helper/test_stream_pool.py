@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+测试脚本：同步流工作线程池的逐项回传、异常透传，以及排队中被取消的流不再启动
+"""
+
+import asyncio
+import sys
+import threading
+from pathlib import Path
+
+import pytest
+
+# 添加src目录到路径
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from utils.helper.stream_pool import StreamWorkerPool
+
+
+def test_items_and_errors_cross_thread():
+    pool = StreamWorkerPool(max_workers=1, queue_size=2)
+
+    def failing():
+        yield 1
+        raise RuntimeError("boom")
+
+    async def run():
+        assert [i async for i in pool.iterate(lambda: iter(range(5)))] == [0, 1, 2, 3, 4]
+        got = []
+        with pytest.raises(RuntimeError):
+            async for i in pool.iterate(failing):
+                got.append(i)
+        assert got == [1]
+
+    asyncio.run(run())
+
+
+def test_stream_cancelled_while_queued_never_produces():
+    pool = StreamWorkerPool(max_workers=1, queue_size=1)
+    release = threading.Event()
+    produced = []
+
+    def blocking():
+        release.wait(5)
+        yield "first"
+
+    def second():
+        produced.append("second")
+        yield "second"
+
+    async def run():
+        first = pool.iterate(blocking)
+        first_item = asyncio.create_task(first.__anext__())
+        queued = pool.iterate(second)
+        queued_item = asyncio.create_task(queued.__anext__())
+        await asyncio.sleep(0.05)
+        # 唯一的工作线程被占用，第二个流仍在池内排队；消费端先退出
+        queued_item.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await queued_item
+        await queued.aclose()
+        release.set()
+        assert await first_item == "first"
+        await first.aclose()
+        await asyncio.get_running_loop().run_in_executor(None, pool._executor.shutdown)
+
+    asyncio.run(run())
+    assert produced == []
+    assert pool.stats()["completed"] == 2
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, "-q"]))
@@ -0,0 +1,487 @@
+"""
+节点日志（create_log_entry 产生的 JSONL）离线分析
+
+用法（在 src 目录下）:
+    python -m utils.log.analytics /tmp/app/work/logs/bypass/app.log* [--index] [--json]
+
+- 按换行边界把文件切块，多进程 mmap 扫描；.gz / .zst 轮转分段各由一个进程流式解压，
+  所有文件的扫描任务先全部提交再按文件顺序合并，多个压缩分段并行解压
+- 只解析含 "execute_id" 的行，app.log 中混写的标准库日志行直接跳过
+- 节点耗时由同一 execute_id + node_name 的 node_start / node_end 时间戳配对得出；
+  跨块未配对的记录在合并时按文件顺序继续配对
+- 分位数使用对数分桶（相对误差约 2%），各块结果可直接合并，内存与日志量无关
+- --index：把每个文件已扫描部分的聚合结果写入索引目录（按设备号+inode 命名，轮转改名后仍可复用）；
+  日志只追加，再次查询时只扫描新增的尾部；压缩分段不再变化，索引大小与文件一致时整体复用
+"""
+import argparse
+import glob
+import gzip
+import hashlib
+import heapq
+import io
+import json
+import math
+import mmap
+import os
+import sys
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+try:
+    import orjson
+
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from utils.error.classifier import ErrorClassifier
+
+# 对数分桶的底数：相邻分桶上界相差 2%
+_BUCKET_BASE = 1.02
+_LOG_BASE = math.log(_BUCKET_BASE)
+
+MIN_CHUNK_BYTES = 8 * 1024 * 1024
+INDEX_VERSION = 2
+# 用文件头部内容校验 inode 是否被新文件复用
+_HEAD_BYTES = 4096
+
+_MARKER = b'"execute_id"'
+_START_TYPES = ("node_start",)
+_END_TYPES = ("node_end",)
+_ABORT_TYPES = ("error", "cancel")
+_RUN_END_TYPES = ("done", "test_run_done")
+
+
+def _bucket(ms: float) -> int:
+    return int(math.log(ms) / _LOG_BASE) if ms >= 1 else -1
+
+
+def _bucket_value(index: int) -> float:
+    return 0.0 if index < 0 else _BUCKET_BASE ** (index + 0.5)
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self.buckets: Counter = Counter()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, ms: float):
+        self.buckets[_bucket(ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def merge(self, other: "LatencyHistogram"):
+        self.buckets.update(other.buckets)
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return min(_bucket_value(index), self.max)
+        return self.max
+
+    def summary(self) -> Dict[str, float]:
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total / self.count, 2) if self.count else 0.0,
+            "p50_ms": round(self.percentile(0.5), 2),
+            "p90_ms": round(self.percentile(0.9), 2),
+            "p99_ms": round(self.percentile(0.99), 2),
+            "max_ms": round(self.max, 2),
+        }
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"buckets": {str(k): v for k, v in self.buckets.items()}, "count": self.count,
+                "total": self.total, "max": self.max}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "LatencyHistogram":
+        h = cls()
+        h.buckets = Counter({int(k): v for k, v in data["buckets"].items()})
+        h.count, h.total, h.max = data["count"], data["total"], data["max"]
+        return h
+
+
+class Partial:
+    """一段日志的聚合结果，可按文件顺序合并"""
+
+    def __init__(self, top: int, bucket_ms: int):
+        self.top = top
+        self.bucket_ms = bucket_ms
+        self.lines = 0
+        self.entries = 0
+        self.nodes: Dict[str, LatencyHistogram] = defaultdict(LatencyHistogram)
+        self.runs = LatencyHistogram()
+        # 最慢 run 的小顶堆: (latency_ms, execute_id, timestamp)
+        self.slowest: List[Tuple[float, str, int]] = []
+        self.errors: Counter = Counter()  # "error_code|node_name" -> 次数
+        self.throughput: Dict[int, Counter] = defaultdict(Counter)  # 时间桶 -> 事件类型计数
+        # 本段内未配对的 node_start / 结束事件，key 为 "execute_id\x00node_name"；
+        # 结束事件为 [timestamp, 是否计入耗时]，error / cancel 只结束节点、不计入耗时
+        self.open_starts: Dict[str, List[int]] = defaultdict(list)
+        self.orphan_ends: Dict[str, List[List[Any]]] = defaultdict(list)
+
+    def _node_done(self, key: str, ts: int, record: bool):
+        starts = self.open_starts.get(key)
+        if starts:
+            start = starts.pop(0)
+            if not starts:
+                del self.open_starts[key]
+            if record:
+                self.nodes[key.split("\x00", 1)[1]].add(max(ts - start, 0))
+        else:
+            # 对应的 node_start 可能在前一段，合并时再配对
+            self.orphan_ends[key].append([ts, record])
+
+    def add(self, entry: Dict[str, Any], line: bytes):
+        self.entries += 1
+        event = entry.get("type") or ""
+        ts = entry.get("timestamp") or 0
+        execute_id = entry.get("execute_id") or ""
+        node_name = entry.get("node_name") or ""
+        if ts:
+            self.throughput[ts // self.bucket_ms][event] += 1
+
+        if event in _START_TYPES:
+            self.open_starts[f"{execute_id}\x00{node_name}"].append(ts)
+        elif event in _END_TYPES:
+            self._node_done(f"{execute_id}\x00{node_name}", ts, True)
+        elif event in _ABORT_TYPES:
+            if node_name:
+                self._node_done(f"{execute_id}\x00{node_name}", ts, False)
+            code = entry.get("error_code") or ""
+            if not code:
+                parsed = ErrorClassifier.parse_error_from_log(line.decode("utf-8", errors="replace"))
+                code = str(parsed.code) if parsed is not None else event
+            self.errors[f"{code}|{node_name}"] += 1
+        elif event in _RUN_END_TYPES:
+            latency = entry.get("latency") or 0
+            self.runs.add(latency)
+            item = (latency, execute_id, ts)
+            if len(self.slowest) < self.top:
+                heapq.heappush(self.slowest, item)
+            elif item > self.slowest[0]:
+                heapq.heapreplace(self.slowest, item)
+
+    def merge(self, later: "Partial") -> "Partial":
+        """合并紧随其后的一段日志"""
+        self.lines += later.lines
+        self.entries += later.entries
+        # 后一段的孤立结束事件与前一段未结束的 node_start 配对
+        for key, ends in later.orphan_ends.items():
+            for ts, record in ends:
+                self._node_done(key, ts, record)
+        for key, starts in later.open_starts.items():
+            self.open_starts[key].extend(starts)
+        for name, hist in later.nodes.items():
+            self.nodes[name].merge(hist)
+        self.runs.merge(later.runs)
+        for item in later.slowest:
+            if len(self.slowest) < self.top:
+                heapq.heappush(self.slowest, item)
+            elif item > self.slowest[0]:
+                heapq.heapreplace(self.slowest, item)
+        self.errors.update(later.errors)
+        for bucket, counts in later.throughput.items():
+            self.throughput[bucket].update(counts)
+        return self
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "lines": self.lines,
+            "entries": self.entries,
+            "nodes": {k: v.to_dict() for k, v in self.nodes.items()},
+            "runs": self.runs.to_dict(),
+            "slowest": self.slowest,
+            "errors": dict(self.errors),
+            "throughput": {str(k): dict(v) for k, v in self.throughput.items()},
+            "open_starts": dict(self.open_starts),
+            "orphan_ends": dict(self.orphan_ends),
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any], top: int, bucket_ms: int) -> "Partial":
+        p = cls(top, bucket_ms)
+        p.lines, p.entries = data["lines"], data["entries"]
+        for k, v in data["nodes"].items():
+            p.nodes[k] = LatencyHistogram.from_dict(v)
+        p.runs = LatencyHistogram.from_dict(data["runs"])
+        p.slowest = [tuple(item) for item in data["slowest"]]
+        heapq.heapify(p.slowest)
+        p.errors = Counter(data["errors"])
+        for k, v in data["throughput"].items():
+            p.throughput[int(k)] = Counter(v)
+        p.open_starts.update(data["open_starts"])
+        p.orphan_ends.update(data["orphan_ends"])
+        return p
+
+
+def _scan_lines(lines: Iterable[bytes], partial: Partial) -> Partial:
+    for line in lines:
+        partial.lines += 1
+        if _MARKER not in line:
+            continue
+        try:
+            entry = _loads(line)
+        except ValueError:
+            continue
+        if isinstance(entry, dict):
+            partial.add(entry, line)
+    return partial
+
+
+def _iter_mmap_lines(mm: mmap.mmap, start: int, end: int) -> Iterator[bytes]:
+    pos = start
+    while pos < end:
+        nl = mm.find(b"\n", pos, end)
+        if nl < 0:
+            nl = end
+        if nl > pos:
+            yield mm[pos:nl]
+        pos = nl + 1
+
+
+def _scan_chunk(path: str, start: int, end: int, top: int, bucket_ms: int) -> Dict[str, Any]:
+    """子进程：扫描 [start, end) 字节范围（边界已对齐到行首）"""
+    partial = Partial(top, bucket_ms)
+    if end <= start:
+        return partial.to_dict()
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        _scan_lines(_iter_mmap_lines(mm, start, end), partial)
+    return partial.to_dict()
+
+
+_COMPRESSED_SUFFIXES = (".gz", ".zst")
+
+
+def _scan_compressed(path: str, top: int, bucket_ms: int) -> Dict[str, Any]:
+    if path.endswith(".zst"):
+        if zstandard is None:
+            raise RuntimeError(f"zstandard is required to read {path}")
+        with open(path, "rb") as raw, zstandard.ZstdDecompressor().stream_reader(raw) as reader:
+            lines = io.BufferedReader(reader)
+            return _scan_lines((line.rstrip(b"\n") for line in lines), Partial(top, bucket_ms)).to_dict()
+    with gzip.open(path, "rb") as f:
+        return _scan_lines((line.rstrip(b"\n") for line in f), Partial(top, bucket_ms)).to_dict()
+
+
+def _chunk_bounds(path: str, start: int, size: int, chunks: int) -> List[Tuple[int, int]]:
+    """把 [start, size) 切成 chunks 段，每段起点对齐到行首"""
+    if size <= start:
+        return []
+    step = max((size - start) // max(chunks, 1), MIN_CHUNK_BYTES)
+    bounds = [start]
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        pos = start + step
+        while pos < size:
+            nl = mm.find(b"\n", pos, size)
+            if nl < 0:
+                break
+            bounds.append(nl + 1)
+            pos = nl + 1 + step
+    bounds.append(size)
+    return [(a, b) for a, b in zip(bounds, bounds[1:]) if b > a]
+
+
+def _file_identity(path: str) -> Tuple[str, str]:
+    st = os.stat(path)
+    with open(path, "rb") as f:
+        head = hashlib.sha256(f.read(_HEAD_BYTES)).hexdigest()
+    return f"{st.st_dev}-{st.st_ino}", head
+
+
+def _complete_size(path: str, size: int) -> int:
+    """只统计到最后一个换行符为止，正在写入的半行留给下次查询"""
+    if size == 0:
+        return 0
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        nl = mm.rfind(b"\n", 0, size)
+    return nl + 1 if nl >= 0 else 0
+
+
+class LogIndex:
+    """按文件身份（设备号+inode，头部校验）缓存已扫描部分的聚合结果"""
+
+    def __init__(self, index_dir: str, top: int, bucket_ms: int):
+        self.index_dir = index_dir
+        self.top = top
+        self.bucket_ms = bucket_ms
+
+    def _path(self, identity: str) -> str:
+        return os.path.join(self.index_dir, f"{identity}.json")
+
+    def load(self, path: str) -> Tuple[int, Optional[Partial]]:
+        identity, head = _file_identity(path)
+        try:
+            with open(self._path(identity), "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return 0, None
+        if (data.get("version") != INDEX_VERSION or data.get("head") != head
+                or data.get("top") != self.top or data.get("bucket_ms") != self.bucket_ms
+                or data.get("size", 0) > os.path.getsize(path)):
+            return 0, None
+        return data["size"], Partial.from_dict(data["partial"], self.top, self.bucket_ms)
+
+    def save(self, path: str, size: int, partial: Partial):
+        identity, head = _file_identity(path)
+        data = {"version": INDEX_VERSION, "path": os.path.abspath(path), "head": head, "size": size,
+                "top": self.top, "bucket_ms": self.bucket_ms, "partial": partial.to_dict()}
+        try:
+            os.makedirs(self.index_dir, exist_ok=True)
+            tmp = self._path(identity) + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            os.replace(tmp, self._path(identity))
+        except OSError as e:
+            print(f"Warning: failed to write index for {path}: {e}", file=sys.stderr)
+
+
+def analyze(paths: List[str], workers: int = 0, top: int = 20, bucket_seconds: int = 60,
+            index_dir: Optional[str] = None) -> Partial:
+    workers = workers or os.cpu_count() or 1
+    bucket_ms = bucket_seconds * 1000
+    index = LogIndex(index_dir, top, bucket_ms) if index_dir else None
+    # 轮转文件按从旧到新的顺序合并：app.log.5 ... app.log.1（或 app.log.{毫秒时间戳}）, app.log
+    paths = sorted(paths, key=_rotation_order)
+
+    result = Partial(top, bucket_ms)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # 先提交所有文件的扫描任务，再按文件顺序收集合并
+        pending = []
+        for path in paths:
+            start, cached = index.load(path) if index else (0, None)
+            if path.endswith(_COMPRESSED_SUFFIXES):
+                size = os.path.getsize(path)
+                if cached is not None and start == size:
+                    futures = []
+                else:
+                    start, cached = 0, None
+                    futures = [pool.submit(_scan_compressed, path, top, bucket_ms)]
+            else:
+                size = _complete_size(path, os.path.getsize(path))
+                futures = [pool.submit(_scan_chunk, path, a, b, top, bucket_ms)
+                           for a, b in _chunk_bounds(path, start, size, workers * 4)]
+            pending.append((path, start, size, cached, futures))
+
+        for path, start, size, cached, futures in pending:
+            file_partial = cached or Partial(top, bucket_ms)
+            for future in futures:
+                file_partial.merge(Partial.from_dict(future.result(), top, bucket_ms))
+            if index and size > start:
+                index.save(path, size, file_partial)
+            result.merge(file_partial)
+    return result
+
+
+def _rotation_order(path: str) -> Tuple[str, float]:
+    base = path
+    for suffix in _COMPRESSED_SUFFIXES:
+        if base.endswith(suffix):
+            base = base[:-len(suffix)]
+    stem, _, suffix = base.rpartition(".")
+    if suffix.isdigit():
+        # RotatingFileHandler 的序号越大越旧；RotatingSink 的毫秒时间戳越大越新
+        return stem, int(suffix) if len(suffix) >= 13 else -int(suffix)
+    return base, float("inf")
+
+
+def build_report(partial: Partial) -> Dict[str, Any]:
+    nodes = {name: hist.summary() for name, hist in partial.nodes.items()}
+    errors: Dict[str, Dict[str, int]] = defaultdict(dict)
+    for key, count in partial.errors.items():
+        code, _, node = key.partition("|")
+        errors[code][node or "-"] = count
+    return {
+        "lines": partial.lines,
+        "entries": partial.entries,
+        "runs": partial.runs.summary(),
+        "nodes": dict(sorted(nodes.items(), key=lambda item: item[1]["p90_ms"], reverse=True)),
+        "slowest_runs": [
+            {"execute_id": execute_id, "latency_ms": latency, "timestamp": ts}
+            for latency, execute_id, ts in sorted(partial.slowest, reverse=True)
+        ],
+        "errors": {code: dict(nodes) for code, nodes in sorted(errors.items(), key=lambda i: -sum(i[1].values()))},
+        "throughput": {
+            str(bucket * partial.bucket_ms): dict(counts) for bucket, counts in sorted(partial.throughput.items())
+        },
+        "unfinished_nodes": sum(len(v) for v in partial.open_starts.values()),
+    }
+
+
+def _print_report(report: Dict[str, Any], bucket_seconds: int):
+    print(f"扫描行数: {report['lines']}, 节点日志条目: {report['entries']}, "
+          f"未结束节点: {report['unfinished_nodes']}")
+    runs = report["runs"]
+    print(f"\n【流程耗时】count={runs['count']} avg={runs['avg_ms']}ms p50={runs['p50_ms']}ms "
+          f"p90={runs['p90_ms']}ms p99={runs['p99_ms']}ms max={runs['max_ms']}ms")
+
+    print("\n【节点耗时 (按 p90 排序)】")
+    print(f"  {'node':30s} {'count':>8s} {'avg':>10s} {'p50':>10s} {'p90':>10s} {'p99':>10s} {'max':>10s}")
+    for name, s in report["nodes"].items():
+        print(f"  {name[:30]:30s} {s['count']:8d} {s['avg_ms']:10.1f} {s['p50_ms']:10.1f} "
+              f"{s['p90_ms']:10.1f} {s['p99_ms']:10.1f} {s['max_ms']:10.1f}")
+
+    print("\n【最慢的运行】")
+    for run in report["slowest_runs"]:
+        print(f"  {run['execute_id']:40s} {run['latency_ms']:>10}ms  ts={run['timestamp']}")
+
+    print("\n【错误码分布】")
+    for code, nodes in report["errors"].items():
+        detail = ", ".join(f"{node}={count}" for node, count in sorted(nodes.items(), key=lambda i: -i[1]))
+        print(f"  {code:10s} {sum(nodes.values()):6d}  ({detail})")
+
+    print(f"\n【吞吐量 (每 {bucket_seconds}s)】")
+    for bucket, counts in report["throughput"].items():
+        detail = ", ".join(f"{event or '-'}={count}" for event, count in sorted(counts.items()))
+        print(f"  {bucket}: {detail}")
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="节点日志离线分析")
+    parser.add_argument("paths", nargs="+", help="日志文件，支持通配符和 .gz / .zst 轮转分段")
+    parser.add_argument("-w", "--workers", type=int, default=0, help="扫描进程数，默认 CPU 核数")
+    parser.add_argument("--top", type=int, default=20, help="最慢 run 的数量")
+    parser.add_argument("--bucket", type=int, default=60, help="吞吐量时间桶（秒）")
+    parser.add_argument("--index", action="store_true", help="使用磁盘索引，重复查询只扫描新增部分")
+    parser.add_argument("--index-dir", default=None, help="索引目录，默认为第一个日志文件所在目录下的 .log_index")
+    parser.add_argument("--json", action="store_true", help="输出 JSON")
+    args = parser.parse_args(argv)
+
+    paths: List[str] = []
+    for pattern in args.paths:
+        matched = glob.glob(pattern)
+        paths.extend(matched if matched else [pattern])
+    paths = [p for p in dict.fromkeys(paths) if os.path.isfile(p)]
+    if not paths:
+        parser.error("no log files found")
+
+    index_dir = None
+    if args.index or args.index_dir:
+        index_dir = args.index_dir or os.path.join(os.path.dirname(os.path.abspath(paths[0])), ".log_index")
+
+    report = build_report(analyze(paths, args.workers, args.top, args.bucket, index_dir))
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        _print_report(report, args.bucket)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+"""
+节点日志的异步批量写入（group commit）
+
+write_log 原先每条记录都 open + write + fsync，fsync 延迟直接落在 graph 回调的关键路径上。
+这里由后台线程负责落盘：
+- 调用方只把序列化好的行放入有界队列
+- 后台线程批量取出、一次 write，并按策略 fsync：
+  interval（每 N 毫秒）、records（每 N 条）、shutdown（仅退出时）
+- 通过 rotation.RotatingSink 写入：多进程间加锁串行，按大小/时间轮转，其他进程轮转后自动重新打开
+- 队列满时默认直接丢弃并计数；LOG_WRITER_BLOCK_MS > 0 时非事件循环线程最多阻塞该时长，
+  事件循环线程上始终不阻塞
+"""
+import asyncio
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, List
+
+from utils.log.rotation import get_sink
+
+logger = logging.getLogger(__name__)
+
+FSYNC_INTERVAL = "interval"
+FSYNC_RECORDS = "records"
+FSYNC_SHUTDOWN = "shutdown"
+
+LOG_WRITER_ENABLED = os.getenv("LOG_WRITER_ASYNC", "true").lower() in ("1", "true", "yes")
+LOG_WRITER_QUEUE_SIZE = int(os.getenv("LOG_WRITER_QUEUE_SIZE", "10000"))
+LOG_WRITER_BATCH_SIZE = int(os.getenv("LOG_WRITER_BATCH_SIZE", "512"))
+LOG_WRITER_FSYNC = os.getenv("LOG_WRITER_FSYNC", FSYNC_INTERVAL)
+LOG_WRITER_FSYNC_INTERVAL_MS = int(os.getenv("LOG_WRITER_FSYNC_INTERVAL_MS", "1000"))
+LOG_WRITER_FSYNC_RECORDS = int(os.getenv("LOG_WRITER_FSYNC_RECORDS", "1000"))
+# 队列满时调用方最多等待的时间（毫秒），0 表示直接丢弃；事件循环线程上不生效
+LOG_WRITER_BLOCK_MS = int(os.getenv("LOG_WRITER_BLOCK_MS", "0"))
+
+_STOP = object()
+
+
+@dataclass
+class WriterStats:
+    enqueued: int = 0
+    written: int = 0
+    dropped: int = 0
+    batches: int = 0
+    fsyncs: int = 0
+    max_batch: int = 0
+    write_errors: int = 0
+
+
+class AsyncLogWriter:
+    def __init__(
+            self,
+            path: str,
+            queue_size: int = LOG_WRITER_QUEUE_SIZE,
+            batch_size: int = LOG_WRITER_BATCH_SIZE,
+            fsync_policy: str = LOG_WRITER_FSYNC,
+            fsync_interval_ms: int = LOG_WRITER_FSYNC_INTERVAL_MS,
+            fsync_records: int = LOG_WRITER_FSYNC_RECORDS,
+            block_ms: int = LOG_WRITER_BLOCK_MS,
+    ):
+        if fsync_policy not in (FSYNC_INTERVAL, FSYNC_RECORDS, FSYNC_SHUTDOWN):
+            raise ValueError(f"Unknown fsync policy: {fsync_policy}")
+        self.path = str(path)
+        self.batch_size = batch_size
+        self.fsync_policy = fsync_policy
+        self.fsync_interval = fsync_interval_ms / 1000.0
+        self.fsync_records = fsync_records
+        self.block_seconds = block_ms / 1000.0
+        self.pid = os.getpid()
+        self.stats = WriterStats()
+        self.sink = get_sink(self.path)
+
+        self._queue: "queue.Queue" = queue.Queue(maxsize=queue_size)
+        self._unsynced = 0
+        self._last_fsync = time.monotonic()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+
+    def write(self, line: str) -> bool:
+        """放入一行（不含换行符），返回是否入队成功"""
+        if self._closed:
+            return False
+        try:
+            if self.block_seconds > 0 and not _on_event_loop():
+                self._queue.put(line, timeout=self.block_seconds)
+            else:
+                self._queue.put_nowait(line)
+        except queue.Full:
+            self.stats.dropped += 1
+            return False
+        self.stats.enqueued += 1
+        return True
+
+    def close(self, timeout: float = 5.0):
+        """写完队列中剩余的记录并 fsync"""
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            logger.warning("Log writer queue still full on shutdown, remaining records may be lost")
+            return
+        self._thread.join(timeout)
+
+    def snapshot(self) -> Dict[str, int]:
+        s = self.stats
+        return {
+            "queued": self._queue.qsize(),
+            "enqueued": s.enqueued,
+            "written": s.written,
+            "dropped": s.dropped,
+            "batches": s.batches,
+            "fsyncs": s.fsyncs,
+            "max_batch": s.max_batch,
+            "write_errors": s.write_errors,
+        }
+
+    def _run(self):
+        stop = False
+        while not stop:
+            timeout = self.fsync_interval if self.fsync_policy == FSYNC_INTERVAL and self._unsynced else None
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                self._fsync()
+                continue
+
+            batch: List[str] = []
+            while True:
+                if item is _STOP:
+                    stop = True
+                    break
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            if batch:
+                self._write_batch(batch)
+            self._maybe_fsync()
+
+        self._fsync()
+
+    def _write_batch(self, batch: List[str]):
+        try:
+            # 整批一次加锁写入
+            self.sink.write(("\n".join(batch) + "\n").encode("utf-8"))
+            self._unsynced += len(batch)
+            self.stats.written += len(batch)
+            self.stats.batches += 1
+            self.stats.max_batch = max(self.stats.max_batch, len(batch))
+        except Exception as e:
+            self.stats.write_errors += 1
+            print(f"Failed to write log batch of {len(batch)} records: {e}", flush=True)
+
+    def _maybe_fsync(self):
+        if not self._unsynced:
+            return
+        if self.fsync_policy == FSYNC_RECORDS and self._unsynced >= self.fsync_records:
+            self._fsync()
+        elif self.fsync_policy == FSYNC_INTERVAL and time.monotonic() - self._last_fsync >= self.fsync_interval:
+            self._fsync()
+
+    def _fsync(self):
+        if not self._unsynced:
+            return
+        try:
+            self.sink.fsync()
+            self.stats.fsyncs += 1
+        except OSError as e:
+            self.stats.write_errors += 1
+            print(f"Failed to fsync log file: {e}", flush=True)
+        self._unsynced = 0
+        self._last_fsync = time.monotonic()
+
+
+def _on_event_loop() -> bool:
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+_writers: Dict[str, AsyncLogWriter] = {}
+_writers_lock = threading.Lock()
+
+
+def get_log_writer(path: str) -> AsyncLogWriter:
+    """按路径获取进程内唯一的 writer；fork 出的子进程会重新创建（后台线程不会随 fork 复制）"""
+    path = str(path)
+    writer = _writers.get(path)
+    if writer is not None and writer.pid == os.getpid():
+        return writer
+    with _writers_lock:
+        writer = _writers.get(path)
+        if writer is None or writer.pid != os.getpid():
+            writer = AsyncLogWriter(path)
+            _writers[path] = writer
+    return writer
+
+
+def get_log_writer_stats() -> Dict[str, Dict[str, int]]:
+    pid = os.getpid()
+    return {path: w.snapshot() for path, w in _writers.items() if w.pid == pid}
+
+
+def close_log_writers():
+    pid = os.getpid()
+    for w in list(_writers.values()):
+        if w.pid == pid:
+            w.close()
+
+
+atexit.register(close_log_writers)
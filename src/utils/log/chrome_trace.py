@@ -0,0 +1,269 @@
+"""
+单次 run 的 Chrome trace-event 导出（可在 Perfetto / chrome://tracing 中查看）
+
+- 记录节点、模型调用、工具调用和日志序列化的嵌套耗时，root 结束时写入 {CHROME_TRACE_DIR}/{run_id}.json
+- 按 CHROME_TRACE_SAMPLE_RATE 采样，或请求携带 X-Chrome-Trace: 1 时强制记录
+- 并行分支会在时间上重叠，同一 tid 内的 span 必须严格嵌套，因此按父子关系分配 lane（tid）：
+  父 span 所在 lane 的栈顶是父 span 时沿用该 lane，否则使用空闲 lane
+- 未记录的中间 run（RunnableSequence、与节点同名的节点函数等）映射到最近的已记录祖先；
+  父 run 完全未知时按节点名和开始时间回退到包裹它的节点 span，避免模型调用成为顶层 span
+- 写文件在后台线程执行，不阻塞 run 结束
+"""
+import json
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+from utils.log.config import LOG_DIR
+
+logger = logging.getLogger(__name__)
+
+CHROME_TRACE_HEADER = "x-chrome-trace"
+CHROME_TRACE_SAMPLE_RATE = float(os.getenv("CHROME_TRACE_SAMPLE_RATE", "0"))
+CHROME_TRACE_DIR = os.getenv("CHROME_TRACE_DIR", os.path.join(str(LOG_DIR), "traces"))
+# 单个 trace 的事件数上限，超出后不再记录新的 span
+CHROME_TRACE_MAX_EVENTS = int(os.getenv("CHROME_TRACE_MAX_EVENTS", "100000"))
+
+_FALLBACK_TRACE_DIR = "/tmp/work/logs/bypass/traces"
+
+# 由 HTTP 路由按请求头设置，create_task 复制上下文后在 init_*_config 中读取
+chrome_trace_requested: ContextVar[bool] = ContextVar("chrome_trace_requested", default=False)
+
+_dump_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="chrome-trace")
+
+
+def header_requested(headers) -> bool:
+    value = headers.get(CHROME_TRACE_HEADER) if headers is not None else None
+    return value is not None and value.strip().lower() in ("1", "true", "yes")
+
+
+def should_record() -> bool:
+    if chrome_trace_requested.get():
+        return True
+    return CHROME_TRACE_SAMPLE_RATE > 0 and random.random() < CHROME_TRACE_SAMPLE_RATE
+
+
+class _Span:
+    __slots__ = ("name", "cat", "lane", "start_us", "args")
+
+    def __init__(self, name: str, cat: str, lane: int, start_us: int, args: Dict[str, Any]):
+        self.name = name
+        self.cat = cat
+        self.lane = lane
+        self.start_us = start_us
+        self.args = args
+
+
+class ChromeTraceRecorder:
+    """按 LangChain run_id 记录嵌套 span，root run 结束时导出"""
+
+    def __init__(self, run_id: str, trace_dir: str = CHROME_TRACE_DIR, max_events: int = CHROME_TRACE_MAX_EVENTS):
+        self.run_id = run_id
+        self.trace_dir = trace_dir
+        self.max_events = max_events
+        self.pid = os.getpid()
+        self._t0 = time.perf_counter_ns()
+        self._wall_t0 = time.time()
+        self._open: Dict[Any, _Span] = {}
+        # 未记录 span 的 run_id -> 最近的已记录祖先
+        self._aliases: Dict[Any, Any] = {}
+        self._lanes: List[List[Any]] = []
+        self._events: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+        self._dumped = False
+
+    def _now_us(self) -> int:
+        return (time.perf_counter_ns() - self._t0) // 1000
+
+    def _parent_span(self, parent_run_id: Any, metadata: Optional[Dict[str, Any]] = None) -> Any:
+        parent = self._aliases.get(parent_run_id, parent_run_id)
+        if parent is None or parent in self._open:
+            return parent
+        # 父链未记录：回退到同名（未知节点名时任意）最近开始的节点 span
+        node = (metadata or {}).get("langgraph_node")
+        best = None
+        for run_id, span in self._open.items():
+            if span.cat == "node" and (not node or span.name == node):
+                if best is None or span.start_us >= self._open[best].start_us:
+                    best = run_id
+        return best
+
+    def _lane_for(self, parent_run_id: Any) -> int:
+        parent = self._open.get(parent_run_id) if parent_run_id is not None else None
+        if parent is not None and self._lanes[parent.lane] and self._lanes[parent.lane][-1] == parent_run_id:
+            return parent.lane
+        for lane, stack in enumerate(self._lanes):
+            if not stack:
+                return lane
+        self._lanes.append([])
+        return len(self._lanes) - 1
+
+    def start(self, run_id: Any, parent_run_id: Any, name: str, cat: str, args: Optional[Dict[str, Any]] = None,
+              metadata: Optional[Dict[str, Any]] = None):
+        with self._lock:
+            if self._dumped or len(self._events) >= self.max_events or run_id in self._open:
+                return
+            lane = self._lane_for(self._parent_span(parent_run_id, metadata))
+            self._lanes[lane].append(run_id)
+            self._open[run_id] = _Span(name, cat, lane, self._now_us(), dict(args or {}))
+
+    def end(self, run_id: Any, args: Optional[Dict[str, Any]] = None, error: Optional[BaseException] = None):
+        with self._lock:
+            span = self._open.pop(run_id, None)
+            if span is None:
+                self._aliases.pop(run_id, None)
+                return
+            stack = self._lanes[span.lane]
+            if run_id in stack:
+                stack.remove(run_id)
+            if args:
+                span.args.update(args)
+            if error is not None:
+                span.args["error"] = f"{type(error).__name__}: {error}"
+            self._events.append({
+                "name": span.name,
+                "cat": span.cat,
+                "ph": "X",
+                "ts": span.start_us,
+                "dur": max(self._now_us() - span.start_us, 1),
+                "pid": self.pid,
+                "tid": span.lane,
+                "args": span.args,
+            })
+
+    @contextmanager
+    def span(self, name: str, cat: str, parent_run_id: Any = None, args: Optional[Dict[str, Any]] = None):
+        """记录非 LangChain 回调的耗时段（如日志序列化），挂在 parent_run_id 对应的 span 下"""
+        key = object()
+        self.start(key, parent_run_id, name, cat, args)
+        try:
+            yield
+        finally:
+            self.end(key)
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            events = list(self._events)
+            lanes = len(self._lanes)
+        meta = [{"name": "process_name", "ph": "M", "pid": self.pid, "args": {"name": f"run {self.run_id}"}}]
+        meta.extend(
+            {"name": "thread_name", "ph": "M", "pid": self.pid, "tid": lane, "args": {"name": f"lane {lane}"}}
+            for lane in range(lanes)
+        )
+        return {
+            "traceEvents": meta + events,
+            "displayTimeUnit": "ms",
+            "otherData": {"run_id": self.run_id, "start_time": self._wall_t0},
+        }
+
+    def dump(self):
+        """root run 结束时调用：在后台线程写入 trace 文件"""
+        with self._lock:
+            if self._dumped:
+                return
+            self._dumped = True
+        _dump_executor.submit(self._write)
+
+    def _write(self):
+        data = json.dumps(self.to_dict(), ensure_ascii=False, default=str)
+        for trace_dir in (self.trace_dir, _FALLBACK_TRACE_DIR):
+            try:
+                os.makedirs(trace_dir, exist_ok=True)
+                path = os.path.join(trace_dir, f"{self.run_id}.json")
+                with open(path, "w", encoding="utf-8") as f:
+                    f.write(data)
+                logger.info(f"Chrome trace written: {path}")
+                return
+            except OSError as e:
+                logger.warning(f"Failed to write chrome trace to {trace_dir}: {e}")
+
+    # LangChain 回调到 span 的转换，Logger 与 ChromeTraceCallbackHandler 共用
+
+    def chain_start(self, run_id, parent_run_id, name: Optional[str], metadata: Optional[Dict[str, Any]]):
+        # 只记录 graph 根和节点，跳过节点内部的 RunnableSequence / ChannelWrite 等
+        metadata = metadata or {}
+        if parent_run_id is None:
+            self.start(run_id, None, name or "graph", "graph", {"run_id": self.run_id})
+            return
+        with self._lock:
+            parent = self._parent_span(parent_run_id, metadata)
+            span = self._open.get(parent)
+            # 节点函数与节点同名时 LangGraph 会再上报一层同名 run，与节点 span 重复
+            duplicate = span is not None and span.cat == "node" and span.name == name
+            if not name or name != metadata.get("langgraph_node") or duplicate:
+                if parent is not None:
+                    self._aliases[run_id] = parent
+                return
+        self.start(run_id, parent, name, "node", {"step": metadata.get("langgraph_step")})
+
+    def chain_end(self, run_id, parent_run_id, error: Optional[BaseException] = None):
+        self.end(run_id, error=error)
+        if parent_run_id is None:
+            self.dump()
+
+    def llm_start(self, run_id, parent_run_id, serialized: Optional[Dict[str, Any]],
+                  metadata: Optional[Dict[str, Any]]):
+        metadata = metadata or {}
+        model = metadata.get("ls_model_name") or ((serialized or {}).get("kwargs") or {}).get("model", "")
+        self.start(run_id, parent_run_id, f"llm {model}".strip(), "llm", {"model": model}, metadata)
+
+    def llm_end(self, run_id, response: Any = None, error: Optional[BaseException] = None):
+        args: Dict[str, Any] = {}
+        for generations in getattr(response, "generations", None) or []:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+                if usage:
+                    args["usage"] = dict(usage)
+        self.end(run_id, args, error=error)
+
+    def tool_start(self, run_id, parent_run_id, serialized: Optional[Dict[str, Any]],
+                   metadata: Optional[Dict[str, Any]] = None):
+        name = (serialized or {}).get("name", "tool")
+        self.start(run_id, parent_run_id, f"tool {name}", "tool", {"tool": name}, metadata)
+
+
+class ChromeTraceCallbackHandler(BaseCallbackHandler):
+    """没有 Logger 的场景（agent 模式）使用的独立回调"""
+
+    def __init__(self, recorder: ChromeTraceRecorder):
+        self.recorder = recorder
+
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, tags=None, metadata=None, **kwargs):
+        self.recorder.chain_start(run_id, parent_run_id, kwargs.get("name"), metadata)
+
+    def on_chain_end(self, outputs, *, run_id, parent_run_id=None, **kwargs):
+        self.recorder.chain_end(run_id, parent_run_id)
+
+    def on_chain_error(self, error, *, run_id, parent_run_id=None, **kwargs):
+        self.recorder.chain_end(run_id, parent_run_id, error=error)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, parent_run_id=None, tags=None, metadata=None,
+                            **kwargs):
+        self.recorder.llm_start(run_id, parent_run_id, serialized, metadata)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, parent_run_id=None, tags=None, metadata=None, **kwargs):
+        self.recorder.llm_start(run_id, parent_run_id, serialized, metadata)
+
+    def on_llm_end(self, response, *, run_id, parent_run_id=None, **kwargs):
+        self.recorder.llm_end(run_id, response)
+
+    def on_llm_error(self, error, *, run_id, parent_run_id=None, **kwargs):
+        self.recorder.llm_end(run_id, error=error)
+
+    def on_tool_start(self, serialized, input_str, *, run_id, parent_run_id=None, tags=None, metadata=None,
+                      **kwargs):
+        self.recorder.tool_start(run_id, parent_run_id, serialized, metadata)
+
+    def on_tool_end(self, output, *, run_id, parent_run_id=None, **kwargs):
+        self.recorder.end(run_id)
+
+    def on_tool_error(self, error, *, run_id, parent_run_id=None, **kwargs):
+        self.recorder.end(run_id, error=error)
@@ -4,6 +4,8 @@ from cozeloop.integration.langchain.trace_callback import LoopTracer
 from langchain_core.runnables import RunnableConfig
 from utils.log.common import get_execute_mode
 from utils.log.node_log import Logger
+from utils.log.trace_flusher import get_trace_flusher
+from utils.log.chrome_trace import ChromeTraceRecorder, ChromeTraceCallbackHandler, should_record
 
 space_id = os.getenv("COZE_PROJECT_SPACE_ID", "YOUR_SPACE_ID")
 api_token = os.getenv("COZE_LOOP_API_TOKEN", "YOUR_LOOP_API_TOKEN")
@@ -18,46 +20,57 @@ cozeloopTracer = cozeloop.new_client(
 cozeloop.set_default_client(cozeloopTracer)
 
 
-def init_run_config(graph, ctx):
-    tracer = Logger(graph, ctx)
-    tracer.on_chain_start = tracer.on_chain_start_graph  # 非必须
-    tracer.on_chain_end = tracer.on_chain_end_graph
-    trace_callback_handler = LoopTracer.get_callback_handler(
+def reinit_tracer():
+    """fork 后重建 cozeloop 客户端：父进程客户端的上报线程和连接不会带入子进程"""
+    global cozeloopTracer
+    cozeloopTracer = cozeloop.new_client(
+        workspace_id=space_id,
+        api_token=api_token,
+        api_base_url=base_url,
+    )
+    cozeloop.set_default_client(cozeloopTracer)
+
+
+def _trace_sampled(ctx) -> bool:
+    return get_trace_flusher().should_trace(ctx.run_id, ctx.method or "", ctx.project_id or "")
+
+
+def _trace_callback_handler(ctx, **kwargs):
+    return LoopTracer.get_callback_handler(
         cozeloopTracer,
-        add_tags_fn=tracer.get_node_tags,
-        modify_name_fn=tracer.get_node_name,
         tags={
             "project_id": ctx.project_id,
             "execute_mode": get_execute_mode(),
             "log_id": ctx.logid,
             "commit_hash": commit_hash,
-        }
+        },
+        **kwargs
     )
-    config = RunnableConfig(
-        callbacks=[
-            tracer,
-            trace_callback_handler
-        ],
-    )
-    return config
+
+
+def init_run_config(graph, ctx):
+    recorder = ChromeTraceRecorder(ctx.run_id) if should_record() else None
+    tracer = Logger(graph, ctx, recorder=recorder)
+    tracer.on_chain_start = tracer.on_chain_start_graph  # 非必须
+    tracer.on_chain_end = tracer.on_chain_end_graph
+    callbacks = [tracer]
+    # 未被采样的请求不挂载 trace 回调；采样的请求结束后需调用 get_trace_flusher().finish(run_id)
+    if _trace_sampled(ctx):
+        callbacks.append(_trace_callback_handler(
+            ctx,
+            add_tags_fn=tracer.get_node_tags,
+            modify_name_fn=tracer.get_node_name,
+        ))
+    return RunnableConfig(callbacks=callbacks)
 
 
 def init_agent_config(graph, ctx):
-    config = RunnableConfig(
-        callbacks=[
-            LoopTracer.get_callback_handler(
-                cozeloopTracer,
-                tags={
-                    "project_id": ctx.project_id,
-                    "execute_mode": get_execute_mode(),
-                    "log_id": ctx.logid,
-                    "commit_hash": commit_hash,
-                }
-                )
-        ]
-    )
-    print("config", config)
-    return config
+    callbacks = []
+    if should_record():
+        callbacks.append(ChromeTraceCallbackHandler(ChromeTraceRecorder(ctx.run_id)))
+    if _trace_sampled(ctx):
+        callbacks.append(_trace_callback_handler(ctx))
+    return RunnableConfig(callbacks=callbacks)
 
 
 # 保留add_trace_tags函数，作为对trace.set_tags的简单包装
@@ -12,7 +12,19 @@ import sys
 import json
 from typing import Dict, Optional, Any
 from pydantic import BaseModel
-from utils.log.parser import LangGraphParser
+from utils.log.parser import get_parser
+from utils.helper.cancellation import RunCancelledError
+from utils.log.async_writer import LOG_WRITER_ENABLED, get_log_writer
+from utils.log.rotation import get_sink
+from utils.messages.usage import UsageMeter
+from utils.log.chrome_trace import ChromeTraceRecorder
+from utils.log.serializer import (
+    LOG_PAYLOAD_MODE,
+    PAYLOAD_MODE_FULL,
+    PayloadTooLarge,
+    event_payload,
+    serialize_capped,
+)
 import asyncio
 
 
@@ -49,6 +61,9 @@ logging.basicConfig(
     ]
 )
 
+# 载荷超过 LOG_PAYLOAD_MAX_CHARS 时记录的提示
+PAYLOAD_TRUNCATED = "数据长度超过上限，已截断"
+
 # 获取logger实例（仅用于控制台输出）
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -56,7 +71,8 @@ logger.setLevel(logging.INFO)
 
 def write_log(log_entry):
     """
-    直接使用文件操作写入JSON格式日志，确保立即刷新到磁盘
+    写入JSON格式日志：默认交给后台 writer 批量落盘（fsync 策略见 async_writer），
+    LOG_WRITER_ASYNC=false 时直接写文件并 fsync
     :param log_entry: 符合要求格式的日志字典
     """
     try:
@@ -65,12 +81,13 @@ def write_log(log_entry):
             return None
         log_json = json.dumps(log_entry, ensure_ascii=False)
 
-        # 修改为行缓冲模式（buffering=1）而不是无缓冲模式
-        with open(LOG_FILE, 'a', encoding='utf-8', buffering=1) as f:  # 行缓冲模式
-            f.write(log_json + '\n')
-            # 显式调用flush和fsync确保数据写入磁盘
-            f.flush()
-            os.fsync(f.fileno())
+        if LOG_WRITER_ENABLED:
+            get_log_writer(LOG_FILE).write(log_json)
+        else:
+            # 与 setup_logging 共用同一个 sink，加锁写入，不与轮转冲突
+            sink = get_sink(LOG_FILE)
+            sink.write((log_json + '\n').encode('utf-8'))
+            sink.fsync()
 
         # 同时输出到控制台以便调试
         level = log_entry.get('level', 'info').lower()
@@ -214,7 +231,7 @@ def log_workflow_end(execution_id, output=None, total_time=None, status="success
         level=level,
         message=message,
         latency=int(total_time * 1000) if total_time else 0,
-        output_data=_serialize_data(output),
+        output_data=_event_data(output, "run_end"),
         execute_mode=execute_mode,
         event_type="test_run_done" if is_test_run else "done",
         token=str(token_consumed) if token_consumed else "",
@@ -228,15 +245,60 @@ def log_workflow_end(execution_id, output=None, total_time=None, status="success
     write_log(log_entry)
 
 
+def log_stream_usage(execution_id, usage, latency_ms=0, error_code="", log_id="", method=""):
+    """
+    记录 agent 模式流式回复的用量（token、TTFT、ITL），与节点日志写入同一文件
+    :param execution_id: 执行唯一ID
+    :param usage: UsageMeter.to_dict() 的结果
+    :param latency_ms: 流式回复总耗时（毫秒）
+    :param error_code: 未成功结束时 message_end 的结束码
+    :param log_id: 日志ID
+    :param method: 方法名称
+    """
+    log_entry = create_log_entry(
+        level="info",
+        message=f"Stream usage (ID: {execution_id})",
+        latency=latency_ms,
+        execute_mode=get_execute_mode(),
+        token=json.dumps(usage),
+        error_code=error_code,
+        event_type="stream_usage",
+        execution_id=execution_id,
+        log_id=log_id,
+        method=method,
+    )
+    write_log(log_entry)
+
+
+# 单个 run 内同时在途的节点 run_id 数量上限
+RUN_ID_MAP_MAX_SIZE = 10000
+
+
 class Logger(BaseCallbackHandler):
-    def __init__(self, graph, ctx: Context):
+    def __init__(self, graph, ctx: Context, recorder: Optional[ChromeTraceRecorder] = None):
         self.root_run_id = None
         self.graph = graph
         self.runtime_ctx = ctx
         self.start_time = time.time()
-        self.parser = LangGraphParser(graph)
-
-    run_id_map: Dict[uuid.UUID, str] = {}
+        self.parser = get_parser(graph)
+        # 节点 run_id -> 节点名，仅属于本次 run，根节点结束时清空
+        self.run_id_map: Dict[uuid.UUID, str] = {}
+        # 本次 run 内所有模型调用的 token 用量和 TTFT，随流程结束日志输出
+        self.usage = UsageMeter(self.start_time)
+        # 采样或请求头指定时记录节点/模型/工具/序列化的 Chrome trace
+        self.recorder = recorder
+
+    def _payload(self, data: Any, event_type: str, run_id: uuid.UUID) -> str:
+        if self.recorder is None:
+            return _event_data(data, event_type)
+        with self.recorder.span(f"serialize {event_type}", "serialize", run_id):
+            return _event_data(data, event_type)
+
+    def _remember_node(self, run_id: uuid.UUID, node_name: str):
+        if len(self.run_id_map) >= RUN_ID_MAP_MAX_SIZE:
+            # 未收到 end/error 回调的节点，淘汰最早的记录
+            self.run_id_map.pop(next(iter(self.run_id_map)))
+        self.run_id_map[run_id] = node_name
 
     def on_chain_start_graph(
             self,
@@ -253,8 +315,10 @@ class Logger(BaseCallbackHandler):
             metadata = {}
         node_name_value = kwargs.get("name")
         node_name: str | None = node_name_value if isinstance(node_name_value, str) else None
+        if self.recorder is not None:
+            self.recorder.chain_start(run_id, parent_run_id, node_name, metadata)
         if node_name:
-            self.run_id_map[run_id] = node_name
+            self._remember_node(run_id, node_name)
         if parent_run_id is None:
             self._on_graph_start(inputs)  # workflow 开始
         node_info = self.parser.nodes.get(node_name) if node_name is not None else None
@@ -265,7 +329,7 @@ class Logger(BaseCallbackHandler):
                 log_entry = create_log_entry(
                     level="info",
                     message=f"Condition node '{node_name}' started",
-                    input_data=_serialize_data(inputs),
+                    input_data=self._payload(inputs, "node_start", run_id),
                     node_name=self.parser.condition_funcs[node_name]["cond_node_name"],  # 前端的条件节点名
                     execution_id=self.runtime_ctx.run_id,
                     execute_mode=get_execute_mode(),
@@ -281,7 +345,7 @@ class Logger(BaseCallbackHandler):
         log_entry = create_log_entry(
             level="info",
             message=f"Node '{node_info.name}' started",
-            input_data=_serialize_data(inputs),
+            input_data=self._payload(inputs, "node_start", run_id),
             node_id=node_info.node_id,
             node_type=node_info.node_type,
             node_title=node_info.title,
@@ -302,8 +366,17 @@ class Logger(BaseCallbackHandler):
             parent_run_id: uuid.UUID | None = None,
             **kwargs: Any,
     ) -> Any:
+        try:
+            self._on_node_end(outputs, run_id, parent_run_id)
+        finally:
+            if self.recorder is not None:
+                # 节点日志（含序列化）写完后再结束 span
+                self.recorder.chain_end(run_id, parent_run_id)
+
+    def _on_node_end(self, outputs: dict[str, Any], run_id: uuid.UUID, parent_run_id: uuid.UUID | None):
         node_name = self.run_id_map.pop(run_id, None)
         if parent_run_id is None:  # 根节点
+            self.run_id_map.clear()
             self._on_graph_end(outputs)
         elif node_name:
             # Node end
@@ -315,7 +388,7 @@ class Logger(BaseCallbackHandler):
                     log_entry = create_log_entry(
                         level="info",
                         message=f"Condition node '{node_name}' ended",
-                        output_data=_serialize_data(outputs),
+                        output_data=self._payload(outputs, "node_end", run_id),
                         node_name=self.parser.condition_funcs[node_name]["cond_node_name"],  # 前端的条件节点名
                         execution_id=self.runtime_ctx.run_id,
                         execute_mode=get_execute_mode(),
@@ -331,7 +404,7 @@ class Logger(BaseCallbackHandler):
             log_entry = create_log_entry(
                 level="info",
                 message=f"Node '{node_info.name}' ended",
-                output_data=_serialize_data(outputs),
+                output_data=self._payload(outputs, "node_end", run_id),
                 node_id=node_info.node_id,  # 注册的时候使用的function name，前端用来流转
                 node_type=node_info.node_type,
                 node_title=node_info.title,
@@ -344,6 +417,46 @@ class Logger(BaseCallbackHandler):
             )
             write_log(log_entry)
 
+    def on_chat_model_start(self, serialized: dict[str, Any], messages: Any, *, run_id: uuid.UUID,
+                            parent_run_id: uuid.UUID | None = None, metadata: dict[str, Any] | None = None,
+                            **kwargs: Any) -> Any:
+        if self.recorder is not None:
+            self.recorder.llm_start(run_id, parent_run_id, serialized, metadata)
+
+    def on_llm_start(self, serialized: dict[str, Any], prompts: Any, *, run_id: uuid.UUID,
+                     parent_run_id: uuid.UUID | None = None, metadata: dict[str, Any] | None = None,
+                     **kwargs: Any) -> Any:
+        if self.recorder is not None:
+            self.recorder.llm_start(run_id, parent_run_id, serialized, metadata)
+
+    def on_llm_new_token(self, token: str, *, chunk: Any = None, **kwargs: Any) -> Any:
+        if token or getattr(getattr(chunk, "message", None), "tool_call_chunks", None):
+            self.usage.mark_token()
+
+    def on_llm_end(self, response: Any, *, run_id: uuid.UUID, **kwargs: Any) -> Any:
+        for generations in getattr(response, "generations", None) or []:
+            for generation in generations:
+                self.usage.add_usage(getattr(getattr(generation, "message", None), "usage_metadata", None))
+        if self.recorder is not None:
+            self.recorder.llm_end(run_id, response)
+
+    def on_llm_error(self, error: BaseException, *, run_id: uuid.UUID, **kwargs: Any) -> Any:
+        if self.recorder is not None:
+            self.recorder.llm_end(run_id, error=error)
+
+    def on_tool_start(self, serialized: dict[str, Any], input_str: str, *, run_id: uuid.UUID,
+                      parent_run_id: uuid.UUID | None = None, **kwargs: Any) -> Any:
+        if self.recorder is not None:
+            self.recorder.tool_start(run_id, parent_run_id, serialized, kwargs.get("metadata"))
+
+    def on_tool_end(self, output: Any, *, run_id: uuid.UUID, **kwargs: Any) -> Any:
+        if self.recorder is not None:
+            self.recorder.end(run_id)
+
+    def on_tool_error(self, error: BaseException, *, run_id: uuid.UUID, **kwargs: Any) -> Any:
+        if self.recorder is not None:
+            self.recorder.end(run_id, error=error)
+
     def _on_graph_start(self, inputs: Dict[str, Any]):
         # Workflow start
         project_id = os.getenv("COZE_PROJECT_ID", "")
@@ -353,7 +466,7 @@ class Logger(BaseCallbackHandler):
             commit_id=commit_id,
             log_id=str(self.runtime_ctx.logid),
             execute_id=self.runtime_ctx.run_id,
-            input_data=_serialize_data(inputs),
+            input_data=_event_data(inputs, "run_start"),
             method=self.runtime_ctx.method,
         )
 
@@ -365,6 +478,7 @@ class Logger(BaseCallbackHandler):
             output=outputs,
             total_time=total_time,
             status="success",
+            token_consumed=json.dumps(self.usage.to_dict()),
             log_id=self.runtime_ctx.logid,
             is_test_run=not is_prod(),
             method=self.runtime_ctx.method,
@@ -381,11 +495,13 @@ class Logger(BaseCallbackHandler):
         event_type = "error"
 
         # 如果是取消操作，事件类型改为取消
-        if isinstance(error, asyncio.CancelledError):
+        if isinstance(error, (asyncio.CancelledError, RunCancelledError)):
             logger.info(f"Task cancelled for run_id: {run_id}")
             event_type = "cancel"
         # 记录节点失败日志
         node_name = self.run_id_map.pop(run_id, "")
+        if parent_run_id is None:
+            self.run_id_map.clear()
         # Node end
         node_id = ""
         node_title = ""
@@ -412,6 +528,8 @@ class Logger(BaseCallbackHandler):
             method=self.runtime_ctx.method,
         )
         write_log(error_log_entry)
+        if self.recorder is not None:
+            self.recorder.chain_end(run_id, parent_run_id, error=error)
 
     def get_node_tags(self, node_name: str) -> dict[str, str]:
         node_tags = {}
@@ -447,41 +565,33 @@ def _serialize_data(data: Any) -> str:
     - 字典/列表等基础类型
     - 自定义对象（通过 __dict__ 序列化）
     - 特殊字符（保证 ASCII 编码）
+    边遍历边输出，超过 LOG_PAYLOAD_MAX_CHARS 立即停止并返回截断提示
     """
+    try:
+        return serialize_capped(data)
+    except PayloadTooLarge:
+        return PAYLOAD_TRUNCATED
+    except Exception as e:
+        return _fallback_data(data, e)
 
-    def _recursive_serialize(item: Any):
-        """递归序列化单个元素"""
-        # 处理 Pydantic 模型
-        if isinstance(item, BaseModel):
-            return item.model_dump()  # 先转字典再序列化
-
-        # 处理列表/元组
-        elif isinstance(item, (list, tuple)):
-            return [_recursive_serialize(sub_item) for sub_item in item]
-
-        # 处理字典
-        elif isinstance(item, dict):
-            return {key: _recursive_serialize(value) for key, value in item.items()}
 
-        # 处理自定义对象（有 __dict__ 属性的）
-        elif hasattr(item, '__dict__') and not isinstance(item, (str, int, float, bool, type(None))):
-            return _recursive_serialize(item.__dict__)
+def _fallback_data(data: Any, e: Exception) -> str:
+    logger.error(f"Error serializing data: {e}", exc_info=True)
+    # 降级处理：返回字符串表示
+    if len(str(data)) > 1000:
+        # 避免bytes类型返回过大，打挂线程
+        logger.info(f"Data too large and truncated, len={len(str(data))}")
+        return ""
+    return str(data)
 
-        # 基础类型直接返回
-        else:
-            return item
 
+def _event_data(data: Any, event_type: str) -> str:
+    """节点事件的入参/出参：按 LOG_PAYLOAD_MODE 和采样率决定记录 JSON、摘要或不记录"""
     try:
-        # 先递归处理数据为可序列化的基础类型
-        serialized_data = _recursive_serialize(data)
-        # 最终序列化为 JSON 字符串
-        return json.dumps(serialized_data, ensure_ascii=False, indent=None)
-
+        payload, too_large = event_payload(data, event_type)
     except Exception as e:
-        logger.error(f"Error serializing data: {e}", exc_info=True)
-        # 降级处理：返回字符串表示
-        if len(str(data)) > 1000:
-            # 避免bytes类型返回过大，打挂线程
-            logger.info(f"Data too large and truncated, len={len(str(data))}")
-            return ""
-        return str(data)
+        if LOG_PAYLOAD_MODE == PAYLOAD_MODE_FULL:
+            return _fallback_data(data, e)
+        logger.error(f"Error digesting data: {e}", exc_info=True)
+        return ""
+    return PAYLOAD_TRUNCATED if too_large else payload
@@ -1,4 +1,6 @@
 import inspect
+import threading
+import weakref
 from dataclasses import dataclass
 from typing import Dict, Optional, Any, Callable, cast
 from langgraph.graph.state import CompiledStateGraph
@@ -75,8 +77,8 @@ class NodeInfo:
 
 class LangGraphParser:
     def __init__(self, app: CompiledStateGraph):
-        # 从LangGraph中获取图结构
-        self.graph_app = app
+        # 从LangGraph中获取图结构；只弱引用 graph，便于按 graph 缓存解析结果
+        self._graph_app_ref = weakref.ref(app)
         self.graph = app.get_graph()
         # 从图中构建节点信息
         self.nodes: Dict[str, NodeInfo] = {}  # NodeId -> NodeInfo
@@ -84,6 +86,10 @@ class LangGraphParser:
         self._build_node_info()
         self.condition_funcs = self._pre_process_conditional_fork_node_info()  # 跟踪condition节点的判断函数，因为中间会插入哑结点和condition节点
 
+    @property
+    def graph_app(self) -> Optional[CompiledStateGraph]:
+        return self._graph_app_ref()
+
     def _is_agent_node(self, node_id: str) -> bool:
         """
         判断是否为Agent节点，当前是模型节点，通过add_node的metadata注入标记
@@ -253,3 +259,23 @@ class LangGraphParser:
                 conditional_funcs[check_func_name] = {
                     "cond_node_name": "cond_" + parent_id} # 拼成前端的条件节点名
         return conditional_funcs
+
+
+# 已编译 graph 不可变，解析结果按 graph 缓存，graph 被回收时一并清理
+_parsers: Dict[int, LangGraphParser] = {}
+_parsers_lock = threading.Lock()
+
+
+def get_parser(app: CompiledStateGraph) -> LangGraphParser:
+    key = id(app)
+    parser = _parsers.get(key)
+    if parser is not None and parser.graph_app is app:
+        return parser
+    with _parsers_lock:
+        parser = _parsers.get(key)
+        if parser is not None and parser.graph_app is app:
+            return parser
+        parser = LangGraphParser(app)
+        _parsers[key] = parser
+        weakref.finalize(app, _parsers.pop, key, None)
+    return parser
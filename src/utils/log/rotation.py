@@ -0,0 +1,397 @@
+"""
+多进程安全的日志文件写入与轮转
+
+app.log 同时由标准库 logging 和 node_log.write_log 写入，prefork 模式下还有多个 worker 进程。
+RotatingFileHandler 只在单进程内串行，其他进程仍持有旧文件句柄继续写入，轮转时会丢日志或写错文件。这里：
+- 每次写入在 {path}.lock 上加 flock（进程间）和线程锁（进程内），以 O_APPEND 写入完整的行
+- 持锁时检查 inode：其他进程轮转后立即重新打开新文件
+- 按大小（setup_logging 的 max_bytes）和时间（LOG_ROTATE_INTERVAL_SECONDS）轮转，
+  轮转出的分段命名为 {path}.{毫秒时间戳}，不需要依次改名，也不会与后台压缩冲突
+- 后台线程把分段压缩为 .gz（或安装了 zstandard 时的 .zst），压缩前先改名认领，避免多个进程重复压缩
+- 按分段数（backup_count）和总大小（LOG_MAX_TOTAL_BYTES）清理最旧的分段
+- fork 出的子进程重建线程锁并关闭继承的文件描述符，不会因父进程 fork 时持有的锁而死锁
+- 非 POSIX 平台（如 Windows）没有 flock：get_sink 返回只在进程内加锁、每次追加后关闭文件的 PlainSink，
+  轮转交回 setup_logging 的 RotatingFileHandler（该平台也没有 prefork 多进程）
+"""
+import glob
+import gzip
+import logging
+import os
+import queue
+import re
+import shutil
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple, Union
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESS_GZIP = "gzip"
+COMPRESS_ZSTD = "zstd"
+COMPRESS_NONE = "none"
+
+LOG_ROTATE_INTERVAL_SECONDS = int(os.getenv("LOG_ROTATE_INTERVAL_SECONDS", "0"))
+LOG_ROTATE_COMPRESS = os.getenv("LOG_ROTATE_COMPRESS", COMPRESS_GZIP)
+LOG_ROTATE_COMPRESS_LEVEL = int(os.getenv("LOG_ROTATE_COMPRESS_LEVEL", "6"))
+# 当前文件与所有分段的总大小上限，0 表示只按分段数清理
+LOG_MAX_TOTAL_BYTES = int(os.getenv("LOG_MAX_TOTAL_BYTES", "0"))
+
+_CLAIM_SUFFIX = ".compressing"
+
+
+@dataclass
+class SinkStats:
+    writes: int = 0
+    bytes: int = 0
+    rotations: int = 0
+    reopens: int = 0
+    compressed: int = 0
+    removed: int = 0
+    errors: int = 0
+
+
+class RotatingSink:
+    def __init__(
+            self,
+            path: str,
+            max_bytes: int = 100 * 1024 * 1024,
+            backup_count: int = 5,
+            interval_seconds: int = LOG_ROTATE_INTERVAL_SECONDS,
+            compress: str = LOG_ROTATE_COMPRESS,
+            max_total_bytes: int = LOG_MAX_TOTAL_BYTES,
+    ):
+        if compress == COMPRESS_ZSTD and zstandard is None:
+            compress = COMPRESS_GZIP
+        if compress not in (COMPRESS_GZIP, COMPRESS_ZSTD, COMPRESS_NONE):
+            raise ValueError(f"Unknown compression: {compress}")
+        self.path = os.path.abspath(str(path))
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.interval_seconds = interval_seconds
+        self.compress = compress
+        self.max_total_bytes = max_total_bytes
+        self.stats = SinkStats()
+        self._segment_re = re.compile(re.escape(os.path.basename(self.path)) + r"\.(\d{13})(\.gz|\.zst)?$")
+
+        self._lock = threading.Lock()
+        self._pid = 0
+        self._fd = -1
+        self._lock_fd = -1
+        self._inode = 0
+        self._rollover_at = 0.0
+        self._compress_queue: Optional[queue.Queue] = None
+
+    def configure(self, max_bytes: int, backup_count: int):
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+
+    def write(self, data: bytes):
+        """写入一段完整的行（以换行结尾），多进程间不会交错"""
+        with self._lock:
+            self._ensure_process()
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+            try:
+                self._check_file()
+                if self._should_rotate(len(data)):
+                    self._rotate()
+                os.write(self._fd, data)
+                self.stats.writes += 1
+                self.stats.bytes += len(data)
+            finally:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def fsync(self):
+        with self._lock:
+            if self._fd >= 0 and self._pid == os.getpid():
+                os.fsync(self._fd)
+
+    def close(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            for fd in (self._fd, self._lock_fd):
+                if fd >= 0:
+                    os.close(fd)
+            self._fd = self._lock_fd = -1
+            self._pid = 0
+
+    def _after_fork(self):
+        """子进程中调用：fork 时其他线程可能正持有线程锁，直接替换；继承的描述符与父进程共享 flock，关闭后重新打开"""
+        self._lock = threading.Lock()
+        self._close_inherited()
+
+    def _close_inherited(self):
+        for fd in (self._fd, self._lock_fd):
+            if fd >= 0:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+        self._fd = self._lock_fd = -1
+        self._pid = 0
+        self._compress_queue = None
+
+    def snapshot(self) -> Dict[str, int]:
+        s = self.stats
+        return {
+            "writes": s.writes, "bytes": s.bytes, "rotations": s.rotations, "reopens": s.reopens,
+            "compressed": s.compressed, "removed": s.removed, "errors": s.errors,
+            "compress_pending": self._compress_queue.qsize() if self._compress_queue is not None else 0,
+        }
+
+    # 以下方法在持有线程锁（以及 flock）时调用
+
+    def _ensure_process(self):
+        # flock 属于打开的文件描述，fork 后父子进程共享同一把锁，子进程必须重新打开
+        if self._pid == os.getpid():
+            return
+        self._close_inherited()
+        self._pid = os.getpid()
+        self._inode = 0
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._lock_fd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+
+    def _check_file(self):
+        try:
+            inode = os.stat(self.path).st_ino
+        except FileNotFoundError:
+            inode = 0
+        if self._fd >= 0 and inode == self._inode:
+            return
+        if self._fd >= 0:
+            os.close(self._fd)
+            self.stats.reopens += 1
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._inode = os.fstat(self._fd).st_ino
+        self._rollover_at = self._read_rollover_at()
+
+    def _read_rollover_at(self) -> float:
+        """下次按时间轮转的时刻记录在锁文件中，由执行轮转的进程写入，所有进程共享"""
+        if self.interval_seconds <= 0:
+            return 0.0
+        try:
+            raw = os.pread(self._lock_fd, 64, 0).split(b"\n", 1)[0]
+            rollover_at = float(raw) if raw else 0.0
+        except (OSError, ValueError):
+            rollover_at = 0.0
+        if rollover_at <= 0:
+            rollover_at = time.time() + self.interval_seconds
+            self._write_rollover_at(rollover_at)
+        return rollover_at
+
+    def _write_rollover_at(self, rollover_at: float):
+        os.ftruncate(self._lock_fd, 0)
+        os.pwrite(self._lock_fd, f"{rollover_at:.3f}\n".encode(), 0)
+
+    def _should_rotate(self, incoming: int) -> bool:
+        if self.interval_seconds > 0 and time.time() >= self._rollover_at:
+            return os.fstat(self._fd).st_size > 0
+        if self.max_bytes <= 0:
+            return False
+        size = os.fstat(self._fd).st_size
+        return size > 0 and size + incoming > self.max_bytes
+
+    def _rotate(self):
+        segment = f"{self.path}.{int(time.time() * 1000):013d}"
+        while os.path.exists(segment):
+            segment = f"{self.path}.{int(segment.rsplit('.', 1)[1]) + 1:013d}"
+        os.rename(self.path, segment)
+        os.close(self._fd)
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._inode = os.fstat(self._fd).st_ino
+        if self.interval_seconds > 0:
+            self._rollover_at = time.time() + self.interval_seconds
+            self._write_rollover_at(self._rollover_at)
+        self.stats.rotations += 1
+        if self.compress != COMPRESS_NONE:
+            self._compressor().put(segment)
+        else:
+            self._enforce_retention()
+
+    def _compressor(self) -> queue.Queue:
+        if self._compress_queue is None:
+            self._compress_queue = queue.Queue()
+            threading.Thread(target=self._compress_loop, args=(self._compress_queue,),
+                             name="log-compress", daemon=True).start()
+            # 上次退出时未压缩完的分段
+            for segment, suffix in self._segments():
+                if suffix is None:
+                    self._compress_queue.put(segment)
+        return self._compress_queue
+
+    # 后台压缩线程
+
+    def _compress_loop(self, q: queue.Queue):
+        while True:
+            segment = q.get()
+            try:
+                self._compress_segment(segment)
+            except Exception as e:
+                self.stats.errors += 1
+                print(f"Failed to compress log segment {segment}: {e}", flush=True)
+            try:
+                with self._lock:
+                    self._enforce_retention()
+            except Exception as e:
+                self.stats.errors += 1
+                print(f"Failed to clean up log segments: {e}", flush=True)
+
+    def _compress_segment(self, segment: str):
+        claimed = segment + _CLAIM_SUFFIX
+        try:
+            # 改名认领：同一分段只会被一个进程压缩
+            os.rename(segment, claimed)
+        except FileNotFoundError:
+            return
+        target = segment + (".zst" if self.compress == COMPRESS_ZSTD else ".gz")
+        tmp = target + ".tmp"
+        with open(claimed, "rb") as src, open(tmp, "wb") as raw:
+            if self.compress == COMPRESS_ZSTD:
+                cctx = zstandard.ZstdCompressor(level=LOG_ROTATE_COMPRESS_LEVEL)
+                with cctx.stream_writer(raw, closefd=False) as dst:
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
+            else:
+                with gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=LOG_ROTATE_COMPRESS_LEVEL) as dst:
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
+        os.replace(tmp, target)
+        os.unlink(claimed)
+        self.stats.compressed += 1
+
+    def _segments(self) -> List[Tuple[str, Optional[str]]]:
+        """已轮转的分段，按时间从旧到新"""
+        found = []
+        for name in glob.glob(glob.escape(self.path) + ".*"):
+            match = self._segment_re.search(name)
+            if match:
+                found.append((match.group(1), name, match.group(2)))
+        found.sort()
+        return [(name, suffix) for _, name, suffix in found]
+
+    def _enforce_retention(self):
+        segments = [name for name, _ in self._segments()]
+        sizes = {}
+        for name in segments:
+            try:
+                sizes[name] = os.path.getsize(name)
+            except FileNotFoundError:
+                sizes[name] = 0
+        total = sum(sizes.values())
+        if self.max_total_bytes > 0:
+            try:
+                total += os.path.getsize(self.path)
+            except FileNotFoundError:
+                pass
+        while segments and (len(segments) > self.backup_count
+                            or (self.max_total_bytes > 0 and total > self.max_total_bytes)):
+            oldest = segments.pop(0)
+            try:
+                os.unlink(oldest)
+                self.stats.removed += 1
+            except FileNotFoundError:
+                pass
+            total -= sizes[oldest]
+
+
+class PlainSink:
+    """
+    没有 flock 时的退化实现：只在进程内加锁，每次追加后关闭文件，不做轮转。
+    不长期持有句柄，RotatingFileHandler 轮转改名时不会因文件被占用而失败
+    """
+
+    def __init__(self, path: str):
+        self.path = os.path.abspath(str(path))
+        self.stats = SinkStats()
+        self._lock = threading.Lock()
+
+    def configure(self, max_bytes: int, backup_count: int):
+        pass
+
+    def write(self, data: bytes):
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, "ab") as f:
+                f.write(data)
+            self.stats.writes += 1
+            self.stats.bytes += len(data)
+
+    def fsync(self):
+        with self._lock:
+            try:
+                with open(self.path, "ab") as f:
+                    os.fsync(f.fileno())
+            except FileNotFoundError:
+                pass
+
+    def close(self):
+        pass
+
+    def snapshot(self) -> Dict[str, int]:
+        s = self.stats
+        return {
+            "writes": s.writes, "bytes": s.bytes, "rotations": s.rotations, "reopens": s.reopens,
+            "compressed": s.compressed, "removed": s.removed, "errors": s.errors, "compress_pending": 0,
+        }
+
+
+_sinks: Dict[str, Union[RotatingSink, PlainSink]] = {}
+_sinks_lock = threading.Lock()
+
+
+def multiprocess_safe() -> bool:
+    """是否支持多进程安全的加锁写入与轮转；为 False 时 setup_logging 使用 RotatingFileHandler"""
+    return fcntl is not None
+
+
+def get_sink(path: str, max_bytes: Optional[int] = None,
+             backup_count: Optional[int] = None) -> Union[RotatingSink, PlainSink]:
+    """按路径获取进程内唯一的 sink，setup_logging 和 node_log 写同一文件时共用"""
+    path = os.path.abspath(str(path))
+    with _sinks_lock:
+        sink = _sinks.get(path)
+        if sink is None:
+            sink = RotatingSink(path) if multiprocess_safe() else PlainSink(path)
+            _sinks[path] = sink
+        if max_bytes is not None and backup_count is not None:
+            sink.configure(max_bytes, backup_count)
+    return sink
+
+
+def get_sink_stats() -> Dict[str, Dict[str, int]]:
+    return {path: sink.snapshot() for path, sink in _sinks.items()}
+
+
+def _reinit_after_fork():
+    global _sinks_lock
+    _sinks_lock = threading.Lock()
+    for sink in _sinks.values():
+        if isinstance(sink, RotatingSink):
+            sink._after_fork()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reinit_after_fork)
+
+
+class SinkHandler(logging.Handler):
+    """把格式化后的日志行写入 RotatingSink 的 logging handler"""
+
+    terminator = "\n"
+
+    def __init__(self, sink: Union[RotatingSink, PlainSink]):
+        super().__init__()
+        self.sink = sink
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            self.sink.write((self.format(record) + self.terminator).encode("utf-8", errors="replace"))
+        except Exception:
+            self.handleError(record)
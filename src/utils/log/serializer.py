@@ -0,0 +1,145 @@
+"""
+节点日志入参/出参的流式序列化
+
+- 边遍历边输出 JSON 片段，累计长度超过预算立即停止，不再先完整序列化再判断长度
+- 超长字符串在编码前按长度直接判定超限
+- digest 模式只流式计算 sha256 和长度，不拼接完整字符串
+- 按事件类型采样，未被采样的事件不记录载荷
+"""
+import hashlib
+import json
+import os
+import random
+import sys
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+from pydantic import BaseModel
+
+PAYLOAD_MODE_FULL = "full"
+PAYLOAD_MODE_DIGEST = "digest"
+PAYLOAD_MODE_NONE = "none"
+
+# 单个载荷的字符数上限（与原 create_log_entry 的 1MB 判断一致）
+LOG_PAYLOAD_MAX_CHARS = int(os.getenv("LOG_PAYLOAD_MAX_CHARS", str(1024 * 1024)))
+# full: 记录 JSON；digest: 只记录 sha256 + 长度；none: 不记录
+LOG_PAYLOAD_MODE = os.getenv("LOG_PAYLOAD_MODE", PAYLOAD_MODE_FULL)
+# 默认采样率
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "1.0"))
+# 按事件类型覆盖采样率，如 "node_start=0.1,node_end=0.5"
+LOG_PAYLOAD_SAMPLING = os.getenv("LOG_PAYLOAD_SAMPLING", "")
+
+_encode_str = json.encoder.encode_basestring  # ensure_ascii=False 时 json.dumps 使用的字符串编码
+
+
+def _parse_sampling(spec: str) -> Dict[str, float]:
+    rates: Dict[str, float] = {}
+    for part in spec.split(","):
+        if "=" not in part:
+            continue
+        event, _, rate = part.partition("=")
+        try:
+            rates[event.strip()] = float(rate)
+        except ValueError:
+            continue
+    return rates
+
+
+_SAMPLING = _parse_sampling(LOG_PAYLOAD_SAMPLING)
+
+
+class PayloadTooLarge(Exception):
+    def __init__(self, limit: int):
+        self.limit = limit
+        super().__init__(f"Payload exceeds {limit} chars")
+
+
+def _iter_json(item: Any, limit: int) -> Iterator[str]:
+    """按 json.dumps(ensure_ascii=False) 的格式逐段输出，对象类型的处理与原 _serialize_data 一致"""
+    if isinstance(item, str):
+        if len(item) + 2 > limit:
+            raise PayloadTooLarge(limit)
+        yield _encode_str(item)
+    elif item is None or isinstance(item, (bool, int, float)):
+        yield json.dumps(item)
+    elif isinstance(item, BaseModel):
+        # 逐字段遍历，避免 model_dump 先复制整棵对象
+        yield from _iter_object(((name, getattr(item, name)) for name in type(item).model_fields), limit)
+    elif isinstance(item, dict):
+        yield from _iter_object(item.items(), limit)
+    elif isinstance(item, (list, tuple)):
+        yield "["
+        first = True
+        for value in item:
+            if not first:
+                yield ", "
+            first = False
+            yield from _iter_json(value, limit)
+        yield "]"
+    elif hasattr(item, "__dict__"):
+        yield from _iter_object(item.__dict__.items(), limit)
+    else:
+        raise TypeError(f"Object of type {type(item).__name__} is not JSON serializable")
+
+
+def _iter_object(pairs, limit: int) -> Iterator[str]:
+    yield "{"
+    first = True
+    for key, value in pairs:
+        if not first:
+            yield ", "
+        first = False
+        if isinstance(key, str):
+            yield _encode_str(key)
+        elif key is None or isinstance(key, (bool, int, float)):
+            yield _encode_str(json.dumps(key))
+        else:
+            raise TypeError(f"keys must be str, int, float, bool or None, not {type(key).__name__}")
+        yield ": "
+        yield from _iter_json(value, limit)
+    yield "}"
+
+
+def serialize_capped(data: Any, limit: int = LOG_PAYLOAD_MAX_CHARS) -> str:
+    """序列化为 JSON，超过 limit 个字符时抛出 PayloadTooLarge"""
+    parts = []
+    size = 0
+    for piece in _iter_json(data, limit):
+        size += len(piece)
+        if size > limit:
+            raise PayloadTooLarge(limit)
+        parts.append(piece)
+    return "".join(parts)
+
+
+def payload_digest(data: Any) -> str:
+    """流式计算 JSON 的 sha256 与字符长度"""
+    h = hashlib.sha256()
+    length = 0
+    for piece in _iter_json(data, sys.maxsize):
+        length += len(piece)
+        h.update(piece.encode("utf-8"))
+    return json.dumps({"sha256": h.hexdigest(), "length": length})
+
+
+def sampled(event_type: str, rate: Optional[float] = None) -> bool:
+    if rate is None:
+        rate = _SAMPLING.get(event_type, LOG_PAYLOAD_SAMPLE_RATE)
+    if rate >= 1.0:
+        return True
+    return rate > 0 and random.random() < rate
+
+
+def event_payload(data: Any, event_type: str, mode: str = LOG_PAYLOAD_MODE,
+                  limit: int = LOG_PAYLOAD_MAX_CHARS) -> Tuple[str, bool]:
+    """
+    按模式和采样得到事件载荷，返回 (载荷, 是否超限)
+    未采样或 none 模式返回空字符串，full 模式超过 limit 时返回 ("", True)
+    """
+    if mode == PAYLOAD_MODE_NONE or not sampled(event_type):
+        return "", False
+    if mode == PAYLOAD_MODE_DIGEST:
+        return payload_digest(data), False
+    try:
+        return serialize_capped(data, limit), False
+    except PayloadTooLarge:
+        return "", True
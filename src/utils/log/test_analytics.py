@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+测试脚本：节点日志离线分析的跨块配对、error/cancel 结束未完成节点、磁盘索引增量扫描与轮转分段顺序
+"""
+
+import gzip
+import json
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+# 添加src目录到路径
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from utils.log import analytics
+from utils.log.analytics import Partial, analyze, build_report
+
+
+def _line(event: str, execute_id: str, node: str = "", ts: int = 0, **extra) -> bytes:
+    entry = {"type": event, "execute_id": execute_id, "node_name": node, "timestamp": ts, **extra}
+    return json.dumps(entry).encode("utf-8")
+
+
+def _partial(*lines: bytes) -> Partial:
+    return analytics._scan_lines(lines, Partial(top=5, bucket_ms=60000))
+
+
+def test_start_and_end_in_different_chunks():
+    first = _partial(_line("node_start", "e1", "llm", 1000))
+    second = _partial(_line("node_end", "e1", "llm", 1300))
+    assert first.open_starts and second.orphan_ends
+    merged = first.merge(second)
+    assert merged.nodes["llm"].count == 1 and merged.nodes["llm"].max == 300
+    assert build_report(merged)["unfinished_nodes"] == 0
+
+
+def test_abort_in_later_chunk_closes_earlier_start():
+    first = _partial(_line("node_start", "e1", "llm", 1000), _line("node_start", "e2", "llm", 1000))
+    second = _partial(
+        _line("error", "e1", "llm", 1500, error_code="500"),
+        _line("cancel", "e2", "llm", 1600, error_code="1"),
+    )
+    merged = first.merge(second)
+    # 中断的节点不计入耗时，也不再算作未结束
+    assert "llm" not in merged.nodes
+    assert build_report(merged)["unfinished_nodes"] == 0
+    assert merged.errors == {"500|llm": 1, "1|llm": 1}
+
+
+def test_abort_then_rerun_pairs_in_order():
+    first = _partial(_line("node_start", "e1", "llm", 0))
+    second = _partial(
+        _line("error", "e1", "llm", 100, error_code="500"),
+        _line("node_start", "e1", "llm", 200),
+        _line("node_end", "e1", "llm", 250),
+    )
+    merged = first.merge(second)
+    assert merged.nodes["llm"].count == 1 and merged.nodes["llm"].max == 50
+    assert not merged.open_starts
+
+
+def test_partial_round_trips_through_dict():
+    partial = _partial(_line("node_start", "e1", "a", 10), _line("error", "e2", "b", 20, error_code="9"))
+    restored = Partial.from_dict(json.loads(json.dumps(partial.to_dict())), 5, 60000)
+    merged = restored.merge(_partial(_line("node_end", "e1", "a", 30), _line("node_start", "e2", "b", 5)))
+    assert merged.nodes["a"].max == 20
+    assert restored.orphan_ends["e2\x00b"] == [[20, False]]
+
+
+def _write(path: Path, lines, mode: str = "wb"):
+    with open(path, mode) as f:
+        f.write(b"".join(line + b"\n" for line in lines))
+
+
+def _run_lines(i: int, ts: int):
+    execute_id = f"run-{i}"
+    return [
+        _line("node_start", execute_id, "llm", ts, pad="x" * 200),
+        _line("node_end", execute_id, "llm", ts + 10 + i % 7, pad="x" * 200),
+        _line("done", execute_id, "", ts + 20, latency=20 + i),
+    ]
+
+
+def test_index_rescans_only_appended_tail(tmp_path):
+    log = tmp_path / "app.log"
+    index_dir = str(tmp_path / "index")
+    _write(log, [line for i in range(50) for line in _run_lines(i, i * 100)])
+    first = build_report(analyze([str(log)], workers=1, index_dir=index_dir))
+    assert first["runs"]["count"] == 50
+    assert len(os.listdir(index_dir)) == 1
+
+    # 已索引部分（头部校验之后）被改写：索引命中时不会重新扫描这部分
+    with open(log, "r+b") as f:
+        f.seek(8192)
+        f.write(b"-" * 100)
+    _write(log, [line for i in range(50, 60) for line in _run_lines(i, i * 100)], mode="ab")
+    second = build_report(analyze([str(log)], workers=1, index_dir=index_dir))
+    assert second["runs"]["count"] == 60
+    assert second["nodes"]["llm"]["count"] == 60
+
+    # 不使用索引时全量扫描，被改写的行解析失败
+    full = build_report(analyze([str(log)], workers=1))
+    assert full["entries"] < second["entries"] == 180
+
+
+def test_index_ignores_partial_last_line(tmp_path):
+    log = tmp_path / "app.log"
+    index_dir = str(tmp_path / "index")
+    _write(log, _run_lines(0, 0))
+    with open(log, "ab") as f:
+        f.write(_line("node_start", "run-1", "llm", 100)[:20])
+    assert build_report(analyze([str(log)], workers=1, index_dir=index_dir))["entries"] == 3
+    with open(log, "ab") as f:
+        f.write(_line("node_start", "run-1", "llm", 100)[20:] + b"\n")
+    report = build_report(analyze([str(log)], workers=1, index_dir=index_dir))
+    assert report["entries"] == 4 and report["unfinished_nodes"] == 1
+
+
+@pytest.mark.parametrize("names", [
+    ["app.log.2", "app.log.1", "app.log"],
+    ["app.log.1700000000000.gz", "app.log.1700000001000", "app.log"],
+])
+def test_rotated_segments_merged_oldest_first(tmp_path, names):
+    assert sorted(reversed(names), key=analytics._rotation_order) == names
+    # 节点开始于最旧的分段，结束于当前文件；按错误顺序合并时无法配对
+    segments = [
+        [_line("node_start", "e1", "llm", 1000)],
+        [_line("node_start", "e2", "tool", 1100)],
+        [_line("node_end", "e2", "tool", 1150), _line("node_end", "e1", "llm", 1400)],
+    ]
+    paths = []
+    for name, lines in zip(names, segments):
+        path = tmp_path / name
+        data = b"".join(line + b"\n" for line in lines)
+        path.write_bytes(gzip.compress(data) if name.endswith(".gz") else data)
+        paths.append(str(path))
+    report = build_report(analyze(list(reversed(paths)), workers=2))
+    assert report["nodes"]["llm"]["max_ms"] == 400
+    assert report["nodes"]["tool"]["max_ms"] == 50
+    assert report["unfinished_nodes"] == 0
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, "-q"]))
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+测试脚本：Chrome trace 中模型调用挂在所属节点下，与节点同名的函数 run 不重复记录
+"""
+
+import sys
+import uuid
+from pathlib import Path
+
+import pytest
+
+# 添加src目录到路径
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+pytest.importorskip("langchain_core")
+
+from utils.log.chrome_trace import ChromeTraceCallbackHandler, ChromeTraceRecorder
+
+# LangGraph 1.0 对两个节点上报的回调顺序（见 test_recorded_graph_run）：
+# agent 节点是 RunnableLambda(agent, name="agent")，会再上报一层同名 run；
+# seq 节点内部调用 prompt | model | lambda，模型调用的父 run 是未记录的 RunnableSequence
+RECORDED = [
+    ("chain_start", "root", None, "LangGraph", None),
+    ("chain_start", "agent", "root", "agent", "agent"),
+    ("chain_start", "agent_func", "agent", "agent", "agent"),
+    ("llm_start", "llm1", "agent_func", None, "agent"),
+    ("llm_end", "llm1"),
+    ("chain_end", "agent_func", "agent"),
+    ("chain_end", "agent", "root"),
+    ("chain_start", "seq", "root", "seq", "seq"),
+    ("chain_start", "sequence", "seq", "RunnableSequence", "seq"),
+    ("chain_start", "prompt", "sequence", "ChatPromptTemplate", "seq"),
+    ("chain_end", "prompt", "sequence"),
+    ("llm_start", "llm2", "sequence", None, "seq"),
+    ("llm_end", "llm2"),
+    ("chain_start", "lambda", "sequence", "RunnableLambda", "seq"),
+    ("chain_end", "lambda", "sequence"),
+    ("chain_end", "sequence", "seq"),
+    ("chain_end", "seq", "root"),
+    ("chain_end", "root", None),
+]
+
+
+def _replay(recorder: ChromeTraceRecorder, events):
+    handler = ChromeTraceCallbackHandler(recorder)
+    ids = {}
+
+    def rid(key):
+        return None if key is None else ids.setdefault(key, uuid.uuid4())
+
+    for event in events:
+        kind, run_id = event[0], rid(event[1])
+        if kind == "chain_start":
+            metadata = {"langgraph_node": event[4]} if event[4] else {}
+            handler.on_chain_start({}, {}, run_id=run_id, parent_run_id=rid(event[2]), name=event[3],
+                                   metadata=metadata)
+        elif kind == "chain_end":
+            handler.on_chain_end({}, run_id=run_id, parent_run_id=rid(event[2]))
+        elif kind == "llm_start":
+            handler.on_chat_model_start({}, [], run_id=run_id, parent_run_id=rid(event[2]),
+                                        metadata={"langgraph_node": event[4], "ls_model_name": "fake"})
+        elif kind == "llm_end":
+            handler.on_llm_end(None, run_id=run_id)
+
+
+def _spans(recorder: ChromeTraceRecorder):
+    return [e for e in recorder.to_dict()["traceEvents"] if e["ph"] == "X"]
+
+
+def _assert_nested(child, parent):
+    assert child["tid"] == parent["tid"]
+    assert parent["ts"] <= child["ts"] and child["ts"] + child["dur"] <= parent["ts"] + parent["dur"]
+
+
+def _check_trace(spans, llm_name: str):
+    by_cat = {}
+    for span in spans:
+        by_cat.setdefault(span["cat"], []).append(span)
+    assert sorted(s["name"] for s in by_cat["node"]) == ["agent", "seq"]
+    assert len(by_cat["graph"]) == 1
+    nodes = {s["name"]: s for s in by_cat["node"]}
+    llms = sorted(by_cat["llm"], key=lambda s: s["ts"])
+    assert [s["name"] for s in llms] == [llm_name, llm_name]
+    _assert_nested(llms[0], nodes["agent"])
+    _assert_nested(llms[1], nodes["seq"])
+    for node in nodes.values():
+        _assert_nested(node, by_cat["graph"][0])
+    # 串行执行的 run 只占用一个 lane
+    assert {s["tid"] for s in spans} == {0}
+
+
+def test_recorded_sequence_nests_llm_under_node(tmp_path):
+    recorder = ChromeTraceRecorder("run-1", trace_dir=str(tmp_path))
+    _replay(recorder, RECORDED)
+    _check_trace(_spans(recorder), "llm fake")
+    assert recorder._aliases == {}
+
+
+def test_unknown_parent_falls_back_to_open_node(tmp_path):
+    recorder = ChromeTraceRecorder("run-1", trace_dir=str(tmp_path))
+    events = [e for e in RECORDED if e[:2] != ("chain_start", "sequence")]
+    # 父链完全未上报（如节点内用独立 callbacks 调用），只能按节点名回退
+    _replay(recorder, events)
+    _check_trace(_spans(recorder), "llm fake")
+
+
+def test_recorded_graph_run(tmp_path):
+    pytest.importorskip("langgraph")
+    from langchain_core.language_models.fake_chat_models import FakeListChatModel
+    from langchain_core.prompts import ChatPromptTemplate
+    from langchain_core.runnables import RunnableConfig, RunnableLambda
+    from langgraph.graph import END, START, StateGraph
+    from pydantic import BaseModel
+
+    model = FakeListChatModel(responses=["a", "b"])
+    chain = ChatPromptTemplate.from_messages([("user", "{text}")]) | model | RunnableLambda(
+        lambda m: {"text": m.content})
+
+    class State(BaseModel):
+        text: str = ""
+
+    def agent(state: State, config: RunnableConfig):
+        return {"text": model.invoke(state.text, config).content}
+
+    def seq(state: State, config: RunnableConfig):
+        return chain.invoke({"text": state.text}, config)
+
+    builder = StateGraph(State)
+    builder.add_node("agent", RunnableLambda(agent, name="agent"))
+    builder.add_node("seq", seq)
+    builder.add_edge(START, "agent")
+    builder.add_edge("agent", "seq")
+    builder.add_edge("seq", END)
+    recorder = ChromeTraceRecorder("run-1", trace_dir=str(tmp_path))
+    builder.compile().invoke({"text": "q"}, {"callbacks": [ChromeTraceCallbackHandler(recorder)]})
+    _check_trace(_spans(recorder), "llm")
+    assert recorder._aliases == {}
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, "-q"]))
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+测试脚本：Logger 的 run_id_map 与 get_parser 缓存在大量 run 后不会增长
+"""
+
+import gc
+import sys
+import tracemalloc
+import uuid
+from pathlib import Path
+
+import pytest
+
+# 添加src目录到路径
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+pytest.importorskip("langgraph")
+pytest.importorskip("coze_coding_utils")
+
+from coze_coding_utils.runtime_ctx.context import new_context
+from langgraph.graph import END, START, StateGraph
+from pydantic import BaseModel
+
+from utils.log import node_log, parser as log_parser
+
+RUNS = 10000
+
+
+class State(BaseModel):
+    text: str
+
+
+def first(state: State) -> State:
+    return state
+
+
+def second(state: State) -> State:
+    return state
+
+
+def _build_graph():
+    builder = StateGraph(State)
+    builder.add_node("first", first)
+    builder.add_node("second", second)
+    builder.add_edge(START, "first")
+    builder.add_edge("first", "second")
+    builder.add_edge("second", END)
+    return builder.compile()
+
+
+def _simulate_run(handler: node_log.Logger, fail: bool = False):
+    """按 LangGraph 的回调顺序模拟一次 run；second 节点只有 start 没有 end（如被中断）"""
+    root = uuid.uuid4()
+    handler.on_chain_start_graph({}, {"text": "hi"}, run_id=root, name="LangGraph")
+    node = uuid.uuid4()
+    handler.on_chain_start_graph({}, {"text": "hi"}, run_id=node, parent_run_id=root, name="first")
+    handler.on_chain_end_graph({"text": "hi"}, run_id=node, parent_run_id=root)
+    handler.on_chain_start_graph({}, {"text": "hi"}, run_id=uuid.uuid4(), parent_run_id=root, name="second")
+    if fail:
+        handler.on_chain_error(RuntimeError("boom"), run_id=root)
+    else:
+        handler.on_chain_end_graph({"text": "hi"}, run_id=root)
+
+
+@pytest.fixture(autouse=True)
+def no_log_io(monkeypatch):
+    # 只关心内存，不写日志文件
+    monkeypatch.setattr(node_log, "write_log", lambda entry: None)
+
+
+def test_run_id_map_cleared_when_root_ends():
+    graph = _build_graph()
+    handler = node_log.Logger(graph, new_context(method="run"))
+    for i in range(RUNS):
+        _simulate_run(handler, fail=i % 2 == 1)
+        assert handler.run_id_map == {}
+
+
+def test_run_id_map_capped_without_end_callbacks(monkeypatch):
+    monkeypatch.setattr(node_log, "RUN_ID_MAP_MAX_SIZE", 100)
+    handler = node_log.Logger(_build_graph(), new_context(method="run"))
+    for _ in range(RUNS):
+        handler.on_chain_start_graph({}, {}, run_id=uuid.uuid4(), parent_run_id=uuid.uuid4(), name="first")
+    assert len(handler.run_id_map) == 100
+
+
+def test_memory_flat_across_runs():
+    graph = _build_graph()
+
+    def run_many(count: int):
+        for _ in range(count):
+            handler = node_log.Logger(graph, new_context(method="run"))
+            _simulate_run(handler)
+
+    # 预热：首次解析 graph、导入惰性模块
+    run_many(500)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        run_many(RUNS)
+        gc.collect()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    growth = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    assert growth < 512 * 1024, f"memory grew by {growth} bytes over {RUNS} runs"
+    assert sum(1 for p in log_parser._parsers.values() if p.graph_app is graph) == 1
+
+
+def test_parser_cache_released_with_graph():
+    graph = _build_graph()
+    parser = log_parser.get_parser(graph)
+    assert log_parser.get_parser(graph) is parser
+    key = id(graph)
+    del graph, parser
+    gc.collect()
+    assert key not in log_parser._parsers
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, "-q"]))
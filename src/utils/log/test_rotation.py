@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+测试脚本：多进程写入同一日志文件、轮转与 fork 后的锁状态，以及没有 flock 时的退化写入
+"""
+
+import os
+import subprocess
+import sys
+import textwrap
+import threading
+from pathlib import Path
+
+import pytest
+
+# 添加src目录到路径
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from utils.log import rotation
+from utils.log.rotation import COMPRESS_NONE, PlainSink, RotatingSink, get_sink
+
+requires_fork = pytest.mark.skipif(not hasattr(os, "fork"), reason="requires os.fork")
+
+
+def _read_all_lines(path: str):
+    lines = []
+    for name in sorted(os.listdir(os.path.dirname(path))):
+        if name.startswith(os.path.basename(path)) and not name.endswith(".lock"):
+            with open(os.path.join(os.path.dirname(path), name), "rb") as f:
+                lines.extend(f.read().splitlines())
+    return lines
+
+
+def _wait_child(pid: int, timeout: float = 10.0) -> int:
+    """等待子进程退出，超时（死锁）时杀掉并返回 -1"""
+    done = threading.Event()
+    status = []
+
+    def wait():
+        status.append(os.waitpid(pid, 0)[1])
+        done.set()
+
+    threading.Thread(target=wait, daemon=True).start()
+    if not done.wait(timeout):
+        os.kill(pid, 9)
+        done.wait()
+        return -1
+    return os.waitstatus_to_exitcode(status[0])
+
+
+def test_rotation_keeps_every_line(tmp_path):
+    path = str(tmp_path / "app.log")
+    sink = RotatingSink(path, max_bytes=2000, backup_count=100, compress=COMPRESS_NONE)
+    for i in range(500):
+        sink.write(f"line-{i:04d}\n".encode())
+    sink.close()
+    lines = _read_all_lines(path)
+    assert sorted(lines) == [f"line-{i:04d}".encode() for i in range(500)]
+    assert sink.stats.rotations > 0
+
+
+@requires_fork
+def test_processes_append_whole_lines(tmp_path):
+    path = str(tmp_path / "app.log")
+    sink = RotatingSink(path, max_bytes=4096, backup_count=1000, compress=COMPRESS_NONE)
+    sink.write(b"parent-start\n")
+    children = []
+    for n in range(4):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                for i in range(200):
+                    sink.write(f"child{n}-{i:03d}-{'x' * 40}\n".encode())
+                sink.close()
+            except BaseException:
+                code = 1
+            os._exit(code)
+        children.append(pid)
+    assert [_wait_child(pid) for pid in children] == [0, 0, 0, 0]
+    sink.close()
+    lines = _read_all_lines(path)
+    assert len(lines) == 1 + 4 * 200
+    assert all(line == b"parent-start" or line.endswith(b"x" * 40) for line in lines)
+
+
+@requires_fork
+def test_fork_while_lock_held_does_not_deadlock(tmp_path):
+    path = str(tmp_path / "app.log")
+    sink = get_sink(path)
+    sink.write(b"before-fork\n")
+    inherited_fd = sink._lock_fd
+
+    # 另一个线程持有 sink 的线程锁时 fork，子进程不能继承到已加锁的状态
+    locked = threading.Event()
+    release = threading.Event()
+
+    def hold():
+        with sink._lock:
+            locked.set()
+            release.wait()
+
+    holder = threading.Thread(target=hold)
+    holder.start()
+    locked.wait()
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            get_sink(path).write(b"from-child\n")
+            # 继承的描述符已关闭，子进程使用自己重新打开的描述符
+            if sink._lock_fd == inherited_fd and sink._pid != os.getpid():
+                code = 2
+            sink.close()
+        except BaseException:
+            code = 1
+        os._exit(code)
+    try:
+        assert _wait_child(pid) == 0
+    finally:
+        release.set()
+        holder.join()
+    sink.write(b"after-fork\n")
+    sink.close()
+    assert _read_all_lines(path) == [b"before-fork", b"from-child", b"after-fork"]
+
+
+def test_import_without_fcntl_or_register_at_fork(tmp_path):
+    # 模拟非 POSIX 平台：fcntl 无法导入，os 没有 register_at_fork
+    script = textwrap.dedent(f"""
+        import os, sys
+        sys.modules["fcntl"] = None
+        del os.register_at_fork
+        sys.path.insert(0, {str(Path(__file__).parent.parent.parent)!r})
+        from utils.log import rotation
+        assert not rotation.multiprocess_safe()
+        sink = rotation.get_sink({str(tmp_path / "app.log")!r})
+        assert isinstance(sink, rotation.PlainSink)
+        sink.write(b"a\\n")
+        sink.fsync()
+    """)
+    subprocess.run([sys.executable, "-c", script], check=True, timeout=60)
+    assert (tmp_path / "app.log").read_bytes() == b"a\n"
+
+
+def test_plain_sink_appends_without_holding_file(tmp_path):
+    path = tmp_path / "logs" / "app.log"
+    sink = PlainSink(str(path))
+    threads = [threading.Thread(target=lambda n=n: [sink.write(f"t{n}-{i}\n".encode()) for i in range(100)])
+               for n in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    # 不持有句柄：外部改名（RotatingFileHandler 轮转）后写入新文件
+    os.rename(path, str(path) + ".1")
+    sink.write(b"after-rename\n")
+    sink.fsync()
+    assert len(Path(str(path) + ".1").read_bytes().splitlines()) == 400
+    assert path.read_bytes() == b"after-rename\n"
+    assert sink.snapshot()["writes"] == 401
+
+
+def test_setup_logging_falls_back_to_rotating_file_handler(tmp_path, monkeypatch):
+    pytest.importorskip("coze_coding_utils")
+    import logging
+    import logging.handlers
+
+    from utils.log import write_log
+
+    monkeypatch.setattr(rotation, "fcntl", None)
+    root = logging.getLogger()
+    saved = (list(root.handlers), root.level)
+    path = str(tmp_path / "app.log")
+    try:
+        write_log.setup_logging(path, max_bytes=1024, backup_count=2, console_output=False)
+        handlers = write_log._listener.handlers
+        assert any(isinstance(h, logging.handlers.RotatingFileHandler) for h in handlers)
+        # node_log 走 PlainSink 追加到同一文件
+        assert isinstance(get_sink(path), PlainSink)
+        get_sink(path).write(b'{"type": "node_start"}\n')
+        logging.getLogger("test.rotation").info("from logging")
+    finally:
+        write_log.stop_logging()
+        for handler in write_log._handlers:
+            handler.close()
+        root.handlers[:] = saved[0]
+        root.setLevel(saved[1])
+        rotation._sinks.pop(os.path.abspath(path), None)
+    content = Path(path).read_text(encoding="utf-8")
+    assert '"type": "node_start"' in content and "from logging" in content
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, "-q"]))
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+测试脚本：流式序列化在未超限时与原 json.dumps 载荷一致，超限时记录截断提示
+"""
+
+import json
+import sys
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import pytest
+
+# 添加src目录到路径
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+pytest.importorskip("pydantic")
+
+from pydantic import BaseModel
+
+from utils.log import serializer
+from utils.log.serializer import (
+    PAYLOAD_MODE_DIGEST,
+    PAYLOAD_MODE_FULL,
+    PAYLOAD_MODE_NONE,
+    PayloadTooLarge,
+    event_payload,
+    serialize_capped,
+)
+
+
+def _previous(data: Any) -> str:
+    """流式序列化之前 _serialize_data 的实现：先递归转成基础类型，再整体 json.dumps"""
+
+    def _recursive(item: Any):
+        if isinstance(item, BaseModel):
+            return item.model_dump()
+        elif isinstance(item, (list, tuple)):
+            return [_recursive(sub_item) for sub_item in item]
+        elif isinstance(item, dict):
+            return {key: _recursive(value) for key, value in item.items()}
+        elif hasattr(item, '__dict__') and not isinstance(item, (str, int, float, bool, type(None))):
+            return _recursive(item.__dict__)
+        return item
+
+    return json.dumps(_recursive(data), ensure_ascii=False, indent=None)
+
+
+class Message(BaseModel):
+    role: str
+    content: str
+    tokens: Optional[int] = None
+
+
+class State(BaseModel):
+    messages: List[Message]
+    meta: Dict[str, Any] = {}
+
+
+class Plain:
+    def __init__(self):
+        self.name = "节点"
+        self.items = (1, 2.5, None)
+
+
+PAYLOADS = [
+    None,
+    True,
+    0,
+    -3.25,
+    "",
+    "中文\n\t\"quoted\" \\   emoji 😀",
+    [],
+    {},
+    [1, "a", [None, False], {"k": ()}],
+    {"text": "hi", 7: "int key", 2.5: "float key", True: "bool key", None: "none key"},
+    {"nested": {"deep": [{"x": 1}, {"y": [1.0, 1e20, -0.0]}]}},
+    Plain(),
+    {"obj": Plain(), "list": [Plain()]},
+]
+
+
+@pytest.mark.parametrize("data", PAYLOADS, ids=lambda d: type(d).__name__)
+def test_uncapped_matches_previous_payload(data):
+    assert serialize_capped(data, limit=1 << 30) == _previous(data)
+
+
+def test_pydantic_model_matches_previous_payload():
+    state = State(messages=[Message(role="user", content="你好"), Message(role="ai", content="hi", tokens=3)],
+                  meta={"step": 1, "tags": ["a", "b"]})
+    assert serialize_capped(state, limit=1 << 30) == _previous(state)
+    assert serialize_capped({"state": state}, limit=1 << 30) == _previous({"state": state})
+
+
+def test_limit_is_inclusive():
+    data = {"text": "x" * 100}
+    size = len(_previous(data))
+    assert serialize_capped(data, limit=size) == _previous(data)
+    with pytest.raises(PayloadTooLarge):
+        serialize_capped(data, limit=size - 1)
+
+
+def test_long_string_rejected_before_encoding():
+    with pytest.raises(PayloadTooLarge):
+        serialize_capped(["x" * 1000], limit=100)
+
+
+def test_unserializable_raises_type_error():
+    with pytest.raises(TypeError):
+        serialize_capped({"raw": {1, 2}})
+
+
+def test_event_payload_full_mode_reports_truncation():
+    assert event_payload({"a": 1}, "node_start", PAYLOAD_MODE_FULL, limit=10) == ('{"a": 1}', False)
+    assert event_payload({"a": "x" * 100}, "node_start", PAYLOAD_MODE_FULL, limit=10) == ("", True)
+
+
+def test_event_payload_modes_and_sampling(monkeypatch):
+    data = {"a": "中文"}
+    digest = json.loads(event_payload(data, "node_end", PAYLOAD_MODE_DIGEST)[0])
+    assert digest["length"] == len(_previous(data))
+    assert event_payload(data, "node_end", PAYLOAD_MODE_NONE) == ("", False)
+    monkeypatch.setattr(serializer, "_SAMPLING", serializer._parse_sampling("node_start=0, bad, node_end=x"))
+    assert event_payload(data, "node_start", PAYLOAD_MODE_FULL) == ("", False)
+    assert event_payload(data, "node_end", PAYLOAD_MODE_FULL) == (_previous(data), False)
+
+
+def test_node_log_records_truncation_marker():
+    for module in ("openai", "langgraph", "langchain_core", "coze_coding_utils"):
+        pytest.importorskip(module)
+    from utils.log import node_log
+
+    assert node_log._event_data({"a": 1}, "node_start") == '{"a": 1}'
+    too_large = {"a": "x" * serializer.LOG_PAYLOAD_MAX_CHARS}
+    assert node_log._event_data(too_large, "node_start") == node_log.PAYLOAD_TRUNCATED
+    # 无法序列化的对象按原逻辑降级为字符串表示
+    assert node_log._event_data({1, 2}, "node_start") == str({1, 2})
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, "-q"]))
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+测试脚本：trace 头部采样的优先级与上限、结束登记后按数量/间隔在后台上报
+"""
+
+import sys
+import threading
+from pathlib import Path
+
+import pytest
+
+# 添加src目录到路径
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+pytest.importorskip("cozeloop")
+
+from utils.log import trace_flusher
+from utils.log.trace_flusher import TraceFlusher, sample_rate
+
+
+@pytest.fixture
+def flushed(monkeypatch):
+    """替换 cozeloop.flush，返回上报时置位的 Event"""
+    event = threading.Event()
+    monkeypatch.setattr(trace_flusher.cozeloop, "flush", event.set)
+    return event
+
+
+@pytest.fixture
+def rates(monkeypatch):
+    monkeypatch.setattr(trace_flusher, "TRACE_SAMPLE_RATE", 1.0)
+    monkeypatch.setattr(trace_flusher, "_ENDPOINT_RATES", trace_flusher._parse_rates("stream_run=0.1, node_run=0, bad"))
+    monkeypatch.setattr(trace_flusher, "_PROJECT_RATES", trace_flusher._parse_rates("p1=1,p2=0"))
+
+
+def _flusher(**kwargs) -> TraceFlusher:
+    kwargs.setdefault("interval_ms", 60_000)
+    kwargs.setdefault("batch", 100)
+    kwargs.setdefault("max_pending", 100)
+    return TraceFlusher(**kwargs)
+
+
+def test_project_rate_overrides_endpoint(rates):
+    assert sample_rate("run") == 1.0
+    assert sample_rate("stream_run") == 0.1
+    assert sample_rate("stream_run", "p1") == 1.0
+    assert sample_rate("run", "p2") == 0
+    assert sample_rate("stream_run", "other") == 0.1
+
+
+def test_head_sampling(rates, flushed, monkeypatch):
+    flusher = _flusher()
+    try:
+        assert not flusher.should_trace("r1", "node_run")
+        monkeypatch.setattr(trace_flusher.random, "random", lambda: 0.5)
+        assert not flusher.should_trace("r2", "stream_run")
+        monkeypatch.setattr(trace_flusher.random, "random", lambda: 0.05)
+        assert flusher.should_trace("r3", "stream_run")
+        assert flusher.should_trace("r4", "node_run", "p1")
+        snapshot = flusher.snapshot()
+        assert (snapshot["sampled"], snapshot["unsampled"], snapshot["active"]) == (2, 2, 2)
+    finally:
+        flusher.close()
+
+
+def test_max_pending_caps_sampled_runs(rates, flushed):
+    flusher = _flusher(max_pending=2)
+    try:
+        assert flusher.should_trace("r1", "run")
+        assert flusher.should_trace("r2", "run")
+        assert not flusher.should_trace("r3", "run")
+        # 结束但未上报的 run 同样占用名额
+        flusher.finish("r1")
+        assert not flusher.should_trace("r4", "run")
+        assert flusher.snapshot()["dropped"] == 2
+        flusher.flush()
+        assert flusher.should_trace("r5", "run")
+    finally:
+        flusher.close()
+
+
+def test_batch_wakes_background_flush(rates, flushed):
+    flusher = _flusher(batch=3)
+    try:
+        for i in range(3):
+            assert flusher.should_trace(f"r{i}", "run")
+        flusher.finish("r0")
+        flusher.finish("r1")
+        # 未采样的 run 结束不计入待上报
+        flusher.finish("unknown")
+        assert not flushed.wait(0.1)
+        flusher.finish("r2")
+        assert flushed.wait(2)
+        assert flusher.snapshot()["pending"] == 0
+    finally:
+        flusher.close()
+
+
+def test_interval_flushes_active_runs(rates, flushed):
+    flusher = _flusher(interval_ms=20)
+    try:
+        assert not flushed.wait(0.1)
+        # 执行中的 run 也按间隔上报
+        flusher.should_trace("r1", "run")
+        assert flushed.wait(2)
+    finally:
+        flusher.close()
+
+
+def test_close_flushes_and_counts_errors(rates, monkeypatch):
+    flusher = _flusher()
+
+    def fail():
+        raise RuntimeError("export failed")
+
+    monkeypatch.setattr(trace_flusher.cozeloop, "flush", fail)
+    flusher.should_trace("r1", "run")
+    flusher.finish("r1")
+    flusher.close()
+    assert not flusher._thread.is_alive()
+    assert flusher.snapshot()["flush_errors"] == 1
+    # 重复 close 不再上报
+    flusher.close()
+    assert flusher.snapshot()["flush_errors"] == 1
+
+
+def test_flusher_singleton_per_process(flushed, monkeypatch):
+    monkeypatch.setattr(trace_flusher, "_flusher", None)
+    flusher = trace_flusher.get_trace_flusher()
+    try:
+        assert trace_flusher.get_trace_flusher() is flusher
+        # 模拟 fork 后的子进程：pid 不同时重新创建
+        flusher.pid = -1
+        child = trace_flusher.get_trace_flusher()
+        assert child is not flusher
+        child.close()
+    finally:
+        flusher.close()
+
+
+def test_unsampled_run_gets_no_loop_tracer(monkeypatch):
+    pytest.importorskip("coze_coding_utils")
+    from coze_coding_utils.runtime_ctx.context import new_context
+    from utils.log import loop_trace
+
+    decisions = []
+
+    class _Flusher:
+        def should_trace(self, run_id, endpoint, project_id=""):
+            decisions.append(endpoint)
+            return endpoint == "stream_run"
+
+    monkeypatch.setattr(loop_trace, "get_trace_flusher", lambda: _Flusher())
+    monkeypatch.setattr(loop_trace, "should_record", lambda: False)
+    assert loop_trace.init_agent_config(None, new_context(method="run"))["callbacks"] == []
+    assert len(loop_trace.init_agent_config(None, new_context(method="stream_run"))["callbacks"]) == 1
+    assert decisions == ["run", "stream_run"]
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, "-q"]))
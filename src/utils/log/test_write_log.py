@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+测试脚本：日志经 QueueListener 在后台线程写文件，调用线程注入上下文并求值消息，队列满时丢弃计数
+"""
+
+import json
+import logging
+import queue
+import sys
+import threading
+from pathlib import Path
+
+import pytest
+
+# 添加src目录到路径
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+pytest.importorskip("coze_coding_utils")
+
+from coze_coding_utils.runtime_ctx.context import new_context
+
+from utils.log import write_log
+from utils.log.write_log import SamplingFilter, request_context, setup_logging, stop_logging
+
+
+@pytest.fixture
+def log_file(tmp_path):
+    root = logging.getLogger()
+    saved = (list(root.handlers), root.level)
+    path = setup_logging(str(tmp_path / "app.log"), console_output=False)
+    yield path
+    stop_logging()
+    root.handlers[:] = saved[0]
+    root.setLevel(saved[1])
+
+
+def _records(path: str):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def test_records_written_by_listener_thread(log_file):
+    threads = []
+
+    class _ThreadRecorder(logging.Handler):
+        def emit(self, record):
+            threads.append(threading.current_thread())
+
+    write_log._listener.handlers += (_ThreadRecorder(),)
+    logging.getLogger("test.write_log").info("hello %s", "world")
+    stop_logging()
+    messages = [r["message"] for r in _records(log_file)]
+    assert "hello world" in messages
+    assert threads and all(t is not threading.current_thread() for t in threads)
+
+
+def test_context_and_message_captured_at_call_time(log_file):
+    ctx = new_context(method="stream_run")
+    token = request_context.set(ctx)
+    try:
+        args = {"step": 1}
+        logging.getLogger("test.write_log").info("state %s", args, extra={"node": "a"})
+        # 入队后修改参数不影响已记录的消息
+        args["step"] = 2
+    finally:
+        request_context.reset(token)
+    logging.getLogger("test.write_log").info("no context")
+    stop_logging()
+    records = {r["message"]: r for r in _records(log_file)}
+    record = records["state {'step': 1}"]
+    assert record["log_id"] == ctx.logid and record["method"] == "stream_run" and record["node"] == "a"
+    assert records["no context"]["log_id"] == ""
+
+
+def test_exception_formatted_by_listener(log_file):
+    try:
+        raise ValueError("boom")
+    except ValueError:
+        logging.getLogger("test.write_log").exception("failed")
+    stop_logging()
+    record = next(r for r in _records(log_file) if r["message"] == "failed")
+    assert "ValueError: boom" in record["exc_info"]
+
+
+def test_setup_twice_keeps_single_queue_handler(log_file):
+    setup_logging(log_file, console_output=False)
+    root = logging.getLogger()
+    assert sum(isinstance(h, write_log._ContextQueueHandler) for h in root.handlers) == 1
+
+
+def test_full_queue_drops_and_counts():
+    handler = write_log._ContextQueueHandler(queue.Queue(maxsize=2))
+    logger = logging.getLogger("test.write_log.drop")
+    for i in range(5):
+        handler.handle(logger.makeRecord(logger.name, logging.INFO, __file__, 0, "m%d", (i,), None))
+    assert handler.queue.qsize() == 2 and handler.dropped == 3
+    assert [handler.queue.get_nowait().msg for _ in range(2)] == ["m0", "m1"]
+
+
+def test_sampling_filter_by_prefix(monkeypatch):
+    sampling = SamplingFilter("httpx=0, uvicorn.access=0.5, bad")
+    logger = logging.getLogger("x")
+
+    def record(name, level=logging.INFO):
+        return logger.makeRecord(name, level, __file__, 0, "m", None, None)
+
+    assert not sampling.filter(record("httpx"))
+    assert not sampling.filter(record("httpx.client"))
+    assert sampling.filter(record("httpxy"))
+    # WARNING 及以上不采样
+    assert sampling.filter(record("httpx", logging.WARNING))
+    monkeypatch.setattr(write_log.random, "random", lambda: 0.7)
+    assert not sampling.filter(record("uvicorn.access"))
+    monkeypatch.setattr(write_log.random, "random", lambda: 0.3)
+    assert sampling.filter(record("uvicorn.access"))
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, "-q"]))
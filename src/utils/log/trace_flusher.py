@@ -0,0 +1,178 @@
+"""
+cozeloop trace 的后台上报与头部采样
+
+原先每个请求结束时在 finally 中同步调用 cozeloop.flush()，响应要等 trace 导出完成。这里改为：
+- 请求开始时按端点和 project_id 做头部采样，未采样的请求不创建 LoopTracer 回调，不产生导出开销
+- 请求结束时只登记为待上报，由后台线程按间隔（TRACE_FLUSH_INTERVAL_MS）或
+  待上报数量（TRACE_FLUSH_BATCH）触发 cozeloop.flush()
+- 已采样但尚未上报的请求数有上限（TRACE_MAX_PENDING），导出跟不上时新请求不再采样并计数
+"""
+import atexit
+import logging
+import os
+import random
+import threading
+from dataclasses import dataclass
+from typing import Dict, Set
+
+import cozeloop
+
+logger = logging.getLogger(__name__)
+
+# 默认采样率
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))
+# 按端点覆盖采样率，如 "stream_run=0.1,node_run=1"
+TRACE_SAMPLING = os.getenv("TRACE_SAMPLING", "")
+# 按 project_id 覆盖采样率，优先于端点，如 "7412345=0.05"
+TRACE_PROJECT_SAMPLING = os.getenv("TRACE_PROJECT_SAMPLING", "")
+TRACE_FLUSH_INTERVAL_MS = int(os.getenv("TRACE_FLUSH_INTERVAL_MS", "2000"))
+TRACE_FLUSH_BATCH = int(os.getenv("TRACE_FLUSH_BATCH", "64"))
+TRACE_MAX_PENDING = int(os.getenv("TRACE_MAX_PENDING", "1024"))
+
+
+def _parse_rates(spec: str) -> Dict[str, float]:
+    rates: Dict[str, float] = {}
+    for part in spec.split(","):
+        if "=" not in part:
+            continue
+        key, _, rate = part.partition("=")
+        try:
+            rates[key.strip()] = float(rate)
+        except ValueError:
+            continue
+    return rates
+
+
+_ENDPOINT_RATES = _parse_rates(TRACE_SAMPLING)
+_PROJECT_RATES = _parse_rates(TRACE_PROJECT_SAMPLING)
+
+
+def sample_rate(endpoint: str, project_id: str = "") -> float:
+    if project_id and project_id in _PROJECT_RATES:
+        return _PROJECT_RATES[project_id]
+    return _ENDPOINT_RATES.get(endpoint, TRACE_SAMPLE_RATE)
+
+
+@dataclass
+class TraceFlusherStats:
+    sampled: int = 0
+    unsampled: int = 0
+    dropped: int = 0
+    flushes: int = 0
+    flush_errors: int = 0
+
+
+class TraceFlusher:
+    def __init__(
+            self,
+            interval_ms: int = TRACE_FLUSH_INTERVAL_MS,
+            batch: int = TRACE_FLUSH_BATCH,
+            max_pending: int = TRACE_MAX_PENDING,
+    ):
+        self.interval = interval_ms / 1000.0
+        self.batch = batch
+        self.max_pending = max_pending
+        self.pid = os.getpid()
+        self.stats = TraceFlusherStats()
+
+        # 已采样、尚未结束的 run
+        self._active: Set[str] = set()
+        # 已结束、尚未上报的 run 数
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="trace-flusher", daemon=True)
+        self._thread.start()
+
+    def should_trace(self, run_id: str, endpoint: str, project_id: str = "") -> bool:
+        """头部采样：决定该 run 是否挂载 trace 回调，采样通过的 run 需在结束时调用 finish"""
+        rate = sample_rate(endpoint, project_id)
+        if rate <= 0 or (rate < 1.0 and random.random() >= rate):
+            self.stats.unsampled += 1
+            return False
+        with self._lock:
+            if len(self._active) + self._pending >= self.max_pending:
+                self.stats.dropped += 1
+                return False
+            self._active.add(run_id)
+        self.stats.sampled += 1
+        return True
+
+    def finish(self, run_id: str):
+        """run 结束：已采样的登记为待上报，数量达到 batch 时立即唤醒后台线程"""
+        with self._lock:
+            if run_id not in self._active:
+                return
+            self._active.discard(run_id)
+            self._pending += 1
+            pending = self._pending
+        if pending >= self.batch:
+            self._wake.set()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                self._pending = 0
+            try:
+                cozeloop.flush()
+                self.stats.flushes += 1
+            except Exception as e:
+                self.stats.flush_errors += 1
+                logger.warning(f"Trace flush failed: {e}")
+
+    def close(self, timeout: float = 5.0):
+        """停止后台线程并上报剩余的 trace"""
+        if self._closed:
+            return
+        self._closed = True
+        self._wake.set()
+        self._thread.join(timeout)
+        self.flush()
+
+    def snapshot(self) -> Dict[str, int]:
+        s = self.stats
+        return {
+            "active": len(self._active),
+            "pending": self._pending,
+            "sampled": s.sampled,
+            "unsampled": s.unsampled,
+            "dropped": s.dropped,
+            "flushes": s.flushes,
+            "flush_errors": s.flush_errors,
+        }
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            if self._closed:
+                break
+            # 仍在执行的 run 也会陆续产生 span，按间隔一并上报
+            if self._pending or self._active:
+                self.flush()
+
+
+_flusher: TraceFlusher = None
+_flusher_lock = threading.Lock()
+
+
+def get_trace_flusher() -> TraceFlusher:
+    """进程内唯一的 flusher；fork 出的子进程会重新创建（后台线程不会随 fork 复制）"""
+    global _flusher
+    flusher = _flusher
+    if flusher is not None and flusher.pid == os.getpid():
+        return flusher
+    with _flusher_lock:
+        if _flusher is None or _flusher.pid != os.getpid():
+            _flusher = TraceFlusher()
+        return _flusher
+
+
+def close_trace_flusher():
+    if _flusher is not None and _flusher.pid == os.getpid():
+        _flusher.close()
+
+
+atexit.register(close_trace_flusher)
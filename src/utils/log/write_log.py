@@ -1,16 +1,63 @@
+import atexit
+import copy
 import logging
 import logging.handlers
 import json
 import os
+import queue
+import random
 from contextvars import ContextVar
-from typing import Optional
+from typing import Dict, List, Optional, Tuple
 from pathlib import Path
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 from coze_coding_utils.runtime_ctx.context import Context
 from utils.log.config import LOG_DIR
+from utils.log.rotation import SinkHandler, get_sink, multiprocess_safe
 
 request_context: ContextVar[Optional[Context]] = ContextVar('request_context', default=None)
 
+# 日志队列长度，满时丢弃并计数，不阻塞调用线程
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# 按 logger 名前缀采样 INFO 及以下级别，如 "httpx=0.1,uvicorn.access=0.01"
+LOG_SAMPLING = os.getenv("LOG_SAMPLING", "")
+# 请求体日志预览的最大字节数
+LOG_BODY_PREVIEW_BYTES = int(os.getenv("LOG_BODY_PREVIEW_BYTES", "2048"))
+
+# LogRecord 自带及 ContextFilter 注入的字段，不作为额外字段输出
+_RESERVED_KEYS = frozenset([
+    'name', 'msg', 'args', 'created', 'filename', 'funcName',
+    'levelname', 'levelno', 'lineno', 'module', 'msecs',
+    'message', 'pathname', 'process', 'processName', 'relativeCreated',
+    'thread', 'threadName', 'exc_info', 'exc_text', 'stack_info',
+    'log_id', 'run_id', 'space_id', 'project_id', 'method',
+    'x_tt_env', 'rpc_persist_rec_rec_biz_scene',
+    'rpc_persist_coze_record_root_id', 'rpc_persist_rec_root_entity_type',
+    'rpc_persist_rec_root_entity_id',
+])
+
+if orjson is not None:
+    def _dumps(data) -> str:
+        try:
+            return orjson.dumps(data, default=str).decode('utf-8')
+        except TypeError:
+            # orjson 不支持的值（如超过 64 位的整数）退回标准库
+            return json.dumps(data, ensure_ascii=False, default=str)
+else:
+    def _dumps(data) -> str:
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+def body_preview(raw: bytes, limit: int = LOG_BODY_PREVIEW_BYTES) -> str:
+    """请求体日志预览：只解码前 limit 字节"""
+    if len(raw) <= limit:
+        return raw.decode('utf-8', errors='replace')
+    return f"{raw[:limit].decode('utf-8', errors='ignore')}...(truncated, {len(raw)} bytes)"
+
 
 class ContextFilter(logging.Filter):
     
@@ -45,6 +92,117 @@ class APSchedulerFilter(logging.Filter):
         return True
 
 
+class SamplingFilter(logging.Filter):
+    """按 logger 名前缀采样 INFO 及以下级别的日志，WARNING 及以上始终保留"""
+
+    def __init__(self, spec: str = LOG_SAMPLING):
+        super().__init__()
+        rates: List[Tuple[str, float]] = []
+        for part in spec.split(','):
+            name, sep, rate = part.partition('=')
+            if not sep:
+                continue
+            try:
+                rates.append((name.strip(), float(rate)))
+            except ValueError:
+                continue
+        # 最长前缀优先匹配
+        self.rates = sorted(rates, key=lambda item: len(item[0]), reverse=True)
+        self._cache: Dict[str, float] = {}
+
+    def _rate(self, name: str) -> float:
+        rate = self._cache.get(name)
+        if rate is None:
+            rate = 1.0
+            for prefix, value in self.rates:
+                if name == prefix or name.startswith(prefix + '.'):
+                    rate = value
+                    break
+            self._cache[name] = rate
+        return rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not self.rates or record.levelno >= logging.WARNING:
+            return True
+        rate = self._rate(record.name)
+        return rate >= 1.0 or random.random() < rate
+
+
+class _ContextQueueHandler(logging.handlers.QueueHandler):
+    """
+    在调用线程只做上下文注入和消息求值，格式化与文件 I/O 交给 QueueListener 线程；
+    队列满时丢弃并计数
+    """
+
+    def __init__(self, q: queue.Queue):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # 保留 exc_info 交给各 handler 的 formatter 处理，只提前求值消息
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_queue_handler: Optional[_ContextQueueHandler] = None
+_handlers: List[logging.Handler] = []
+
+
+def _start_listener():
+    global _listener, _queue_handler
+    q: queue.Queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    queue_handler = _ContextQueueHandler(q)
+    queue_handler.addFilter(ContextFilter())
+    queue_handler.addFilter(APSchedulerFilter())
+    queue_handler.addFilter(SamplingFilter())
+
+    root_logger = logging.getLogger()
+    if _queue_handler is not None:
+        root_logger.removeHandler(_queue_handler)
+    root_logger.addHandler(queue_handler)
+
+    _listener = logging.handlers.QueueListener(q, *_handlers, respect_handler_level=True)
+    _listener.start()
+    _queue_handler = queue_handler
+
+
+def _restart_listener_after_fork():
+    # QueueListener 的线程不会随 fork 复制，子进程需要新的队列和线程
+    global _listener
+    if _listener is None:
+        return
+    _listener = None
+    _start_listener()
+
+
+def stop_logging():
+    """停止后台线程并写完队列中剩余的日志"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def get_logging_stats() -> Dict[str, int]:
+    if _queue_handler is None:
+        return {"queued": 0, "dropped": 0}
+    return {"queued": _queue_handler.queue.qsize(), "dropped": _queue_handler.dropped}
+
+
+atexit.register(stop_logging)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_restart_listener_after_fork)
+
+
 class JsonFormatter(logging.Formatter):
     
     def format(self, record: logging.LogRecord) -> str:
@@ -67,17 +225,10 @@ class JsonFormatter(logging.Formatter):
             log_data['exc_info'] = self.formatException(record.exc_info)
         
         for key, value in record.__dict__.items():
-            if key not in ['name', 'msg', 'args', 'created', 'filename', 'funcName', 
-                          'levelname', 'levelno', 'lineno', 'module', 'msecs', 
-                          'message', 'pathname', 'process', 'processName', 'relativeCreated',
-                          'thread', 'threadName', 'exc_info', 'exc_text', 'stack_info',
-                          'log_id', 'run_id', 'space_id', 'project_id', 'method',
-                          'x_tt_env', 'rpc_persist_rec_rec_biz_scene', 
-                          'rpc_persist_coze_record_root_id', 'rpc_persist_rec_root_entity_type',
-                          'rpc_persist_rec_root_entity_id']:
+            if key not in _RESERVED_KEYS:
                 log_data[key] = value
         
-        return json.dumps(log_data, ensure_ascii=False)
+        return _dumps(log_data)
 
 
 class PlainTextFormatter(logging.Formatter):
@@ -102,17 +253,10 @@ class PlainTextFormatter(logging.Formatter):
             log_data['exc_info'] = self.formatException(record.exc_info)
         
         for key, value in record.__dict__.items():
-            if key not in ['name', 'msg', 'args', 'created', 'filename', 'funcName', 
-                          'levelname', 'levelno', 'lineno', 'module', 'msecs', 
-                          'message', 'pathname', 'process', 'processName', 'relativeCreated',
-                          'thread', 'threadName', 'exc_info', 'exc_text', 'stack_info',
-                          'log_id', 'run_id', 'space_id', 'project_id', 'method',
-                          'x_tt_env', 'rpc_persist_rec_rec_biz_scene', 
-                          'rpc_persist_coze_record_root_id', 'rpc_persist_rec_root_entity_type',
-                          'rpc_persist_rec_root_entity_id']:
+            if key not in _RESERVED_KEYS:
                 log_data[key] = value
         
-        return json.dumps(log_data, ensure_ascii=False)
+        return _dumps(log_data)
 
 
 def setup_logging(
@@ -135,20 +279,25 @@ def setup_logging(
             log_file = str(fallback_log_dir / 'app.log')
             print(f"Warning: Using fallback log directory: {fallback_log_dir}, due to error: {e}", flush=True)
     
+    global _handlers
+    stop_logging()
     root_logger = logging.getLogger()
     root_logger.setLevel(getattr(logging, log_level.upper(), logging.INFO))
     
     root_logger.handlers.clear()
+    handlers: List[logging.Handler] = []
     
-    context_filter = ContextFilter()
-    apscheduler_filter = APSchedulerFilter()
-    
-    file_handler = logging.handlers.RotatingFileHandler(
-        filename=log_file,
-        maxBytes=max_bytes,
-        backupCount=backup_count,
-        encoding='utf-8'
-    )
+    if multiprocess_safe():
+        # 多进程安全的轮转写入，与 node_log.write_log 共用同一个 sink
+        file_handler = SinkHandler(get_sink(log_file, max_bytes=max_bytes, backup_count=backup_count))
+    else:
+        # 没有 flock 的平台：由 RotatingFileHandler 轮转，node_log 经 PlainSink 追加写入同一文件
+        file_handler = logging.handlers.RotatingFileHandler(
+            filename=log_file,
+            maxBytes=max_bytes,
+            backupCount=backup_count,
+            encoding='utf-8'
+        )
     file_handler.setLevel(getattr(logging, log_level.upper(), logging.INFO))
     
     if use_json_format:
@@ -160,9 +309,7 @@ def setup_logging(
         )
     
     file_handler.setFormatter(file_formatter)
-    file_handler.addFilter(context_filter)
-    file_handler.addFilter(apscheduler_filter)
-    root_logger.addHandler(file_handler)
+    handlers.append(file_handler)
     
     if console_output:
         console_handler = logging.StreamHandler()
@@ -173,13 +320,16 @@ def setup_logging(
             datefmt='%Y-%m-%d %H:%M:%S'
         )
         console_handler.setFormatter(console_formatter)
-        console_handler.addFilter(context_filter)
-        console_handler.addFilter(apscheduler_filter)
-        root_logger.addHandler(console_handler)
+        handlers.append(console_handler)
+    
+    # 调用线程只入队（上下文注入、过滤、采样在入队前完成），格式化和写文件在后台线程
+    _handlers = handlers
+    _start_listener()
     
     logging.info(f"Logging configured: file={log_file}, max_bytes={max_bytes}, backup_count={backup_count}")
     
     return log_file
 
 
-__all__ = ['setup_logging', 'request_context', 'ContextFilter', 'APSchedulerFilter', 'JsonFormatter', 'PlainTextFormatter']
+__all__ = ['setup_logging', 'request_context', 'ContextFilter', 'APSchedulerFilter', 'SamplingFilter', 'JsonFormatter',
+           'PlainTextFormatter', 'body_preview', 'stop_logging', 'get_logging_stats']
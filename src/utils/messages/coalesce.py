@@ -0,0 +1,145 @@
+"""
+SSE 流式回答合并
+
+模型每个 AIMessageChunk 都会变成一个 ServerMessage 并单独编码成一个 SSE 帧。
+这里在 agent_aiter_server_messages 与 _sse_event 之间合并同一 msg_id 的连续 answer 增量，
+按时间 (flush_ms) 或大小 (max_bytes) 触发输出：
+- 合并后的帧使用最后一个被合并增量的 sequence_id，序号仍单调递增
+- finish=True 的增量会立即连同缓冲一起输出
+- 非 answer 消息（tool_request/message_end 等）到达前先输出缓冲，保证顺序
+"""
+import asyncio
+import os
+from typing import Any, AsyncIterator, List, Optional
+
+from utils.messages.server import ServerMessage, MESSAGE_TYPE_ANSWER
+
+# 合并窗口（毫秒），0 表示关闭合并
+SSE_COALESCE_FLUSH_MS = int(os.getenv("SSE_COALESCE_FLUSH_MS", "0"))
+# 单帧合并的最大字节数（UTF-8）
+SSE_COALESCE_MAX_BYTES = int(os.getenv("SSE_COALESCE_MAX_BYTES", "4096"))
+# 上游与合并之间的缓冲队列长度，满时阻塞上游
+SSE_COALESCE_QUEUE_SIZE = 64
+
+
+def _is_answer_delta(item: Any) -> bool:
+    return (
+        isinstance(item, ServerMessage)
+        and item.type == MESSAGE_TYPE_ANSWER
+        and item.content is not None
+        and item.content.answer is not None
+    )
+
+
+class _AnswerBuffer:
+    def __init__(self, first: ServerMessage):
+        self.message = first
+        self.parts: List[str] = [first.content.answer]
+        self.size = len(first.content.answer.encode("utf-8"))
+
+    def add(self, delta: ServerMessage):
+        self.parts.append(delta.content.answer)
+        self.size += len(delta.content.answer.encode("utf-8"))
+        self.message.sequence_id = delta.sequence_id
+        self.message.finish = delta.finish
+
+    def build(self) -> ServerMessage:
+        self.message.content.answer = "".join(self.parts)
+        return self.message
+
+
+class _UpstreamError:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+_END = object()
+
+
+async def coalesce_answer_deltas(
+        items: AsyncIterator[Any],
+        flush_ms: int = SSE_COALESCE_FLUSH_MS,
+        max_bytes: int = SSE_COALESCE_MAX_BYTES,
+) -> AsyncIterator[Any]:
+    it = items.__aiter__()
+    if flush_ms <= 0:
+        try:
+            async for item in it:
+                yield item
+        finally:
+            await _aclose(it)
+        return
+
+    # 上游在单独的 pump 任务中完整迭代（保证 graph.astream 始终运行在同一任务和上下文中），
+    # 通过有界队列交给这里按时间窗口合并
+    q: asyncio.Queue = asyncio.Queue(maxsize=SSE_COALESCE_QUEUE_SIZE)
+    closing = False
+
+    async def pump():
+        try:
+            async for up in it:
+                await q.put(up)
+            await q.put(_END)
+        except BaseException as ex:
+            if closing:
+                raise
+            await q.put(_UpstreamError(ex))
+        finally:
+            await _aclose(it)
+
+    pump_task = asyncio.ensure_future(pump())
+    flush_seconds = flush_ms / 1000.0
+    loop = asyncio.get_running_loop()
+    buffer: Optional[_AnswerBuffer] = None
+    deadline = 0.0
+    try:
+        while True:
+            if buffer is not None:
+                try:
+                    item = await asyncio.wait_for(q.get(), timeout=max(deadline - loop.time(), 0))
+                except asyncio.TimeoutError:
+                    # 窗口到期，先输出已合并的内容
+                    yield buffer.build()
+                    buffer = None
+                    continue
+            else:
+                item = await q.get()
+
+            if item is _END:
+                break
+            if isinstance(item, _UpstreamError):
+                if buffer is not None:
+                    yield buffer.build()
+                    buffer = None
+                raise item.error
+
+            if _is_answer_delta(item):
+                if buffer is not None and buffer.message.msg_id == item.msg_id:
+                    buffer.add(item)
+                else:
+                    if buffer is not None:
+                        yield buffer.build()
+                    buffer = _AnswerBuffer(item)
+                    deadline = loop.time() + flush_seconds
+                if buffer.message.finish or buffer.size >= max_bytes:
+                    yield buffer.build()
+                    buffer = None
+            else:
+                if buffer is not None:
+                    yield buffer.build()
+                    buffer = None
+                yield item
+
+        if buffer is not None:
+            yield buffer.build()
+    finally:
+        if not pump_task.done():
+            closing = True
+            pump_task.cancel()
+            await asyncio.wait({pump_task})
+
+
+async def _aclose(it: Any):
+    aclose = getattr(it, "aclose", None)
+    if aclose is not None:
+        await aclose()
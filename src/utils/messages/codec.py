@@ -0,0 +1,98 @@
+"""
+消息编解码
+
+- JSON: orjson 可用时直接把 ServerMessage 等 dataclass 编码为 bytes（无需 asdict 深拷贝），
+  否则退化为标准库 json
+- 请求体只解析一次：loads(raw_body) 替代 request.json() 的二次解析
+- 输出帧格式可插拔：SSE 文本帧，或内部消费者使用的长度前缀 msgpack 帧（需 ormsgpack）
+"""
+import dataclasses
+import json
+import struct
+from typing import Any, Iterator, Optional
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ormsgpack
+except ImportError:
+    ormsgpack = None
+
+MEDIA_TYPE_SSE = "text/event-stream"
+MEDIA_TYPE_MSGPACK = "application/x-msgpack"
+
+if orjson is not None:
+    _ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS
+    JSONDecodeError = orjson.JSONDecodeError  # json.JSONDecodeError 的子类
+else:
+    JSONDecodeError = json.JSONDecodeError
+
+
+def _std_default(obj: Any) -> Any:
+    if dataclasses.is_dataclass(obj) and not isinstance(obj, type):
+        return dataclasses.asdict(obj)
+    return str(obj)
+
+
+def dumps(data: Any) -> bytes:
+    """编码为 UTF-8 JSON bytes，无法序列化的对象按 str 处理（与原 default=str 行为一致）"""
+    if orjson is not None:
+        return orjson.dumps(data, default=str, option=_ORJSON_OPTIONS)
+    return json.dumps(data, ensure_ascii=False, default=_std_default).encode("utf-8")
+
+
+def loads(raw: bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+class SseWire:
+    media_type = MEDIA_TYPE_SSE
+
+    _PREFIX = b"event: message\ndata: "
+    _SUFFIX = b"\n\n"
+
+    def frame(self, data: Any, event_id: Optional[str] = None) -> bytes:
+        body = self._PREFIX + dumps(data) + self._SUFFIX
+        if event_id is not None:
+            return b"id: " + event_id.encode("utf-8") + b"\n" + body
+        return body
+
+
+class MsgpackWire:
+    """
+    4 字节大端长度前缀 + msgpack 消息体，供内部服务间消费
+    """
+    media_type = MEDIA_TYPE_MSGPACK
+
+    _HEADER = struct.Struct(">I")
+
+    def frame(self, data: Any, event_id: Optional[str] = None) -> bytes:
+        body = ormsgpack.packb(data, default=str, option=ormsgpack.OPT_NON_STR_KEYS)
+        return self._HEADER.pack(len(body)) + body
+
+    @classmethod
+    def iter_frames(cls, buf: bytes) -> Iterator[Any]:
+        offset = 0
+        size = cls._HEADER.size
+        while offset + size <= len(buf):
+            (length,) = cls._HEADER.unpack_from(buf, offset)
+            offset += size
+            # 与 frame 一致，允许非字符串键
+            yield ormsgpack.unpackb(buf[offset:offset + length], option=ormsgpack.OPT_NON_STR_KEYS)
+            offset += length
+
+
+SSE_WIRE = SseWire()
+MSGPACK_WIRE = MsgpackWire()
+
+
+def select_wire(accept: Optional[str]):
+    """按 Accept 头选择输出帧格式，未安装 ormsgpack 时始终使用 SSE"""
+    if accept and MEDIA_TYPE_MSGPACK in accept and ormsgpack is not None:
+        return MSGPACK_WIRE
+    return SSE_WIRE
@@ -46,6 +46,10 @@ class MessageEndDetail:
 
     token_cost: Optional[TokenCost] = field(default=None)  # 消耗的token数量
     time_cost_ms: Optional[int] = field(default=None)  # 耗时，单位毫秒
+    ttft_ms: Optional[int] = field(default=None)  # 首 token 延迟，单位毫秒
+    avg_inter_token_ms: Optional[float] = field(default=None)  # 平均 token 间延迟，单位毫秒
+    max_inter_token_ms: Optional[float] = field(default=None)  # 最大 token 间延迟，单位毫秒
+    tokens_per_second: Optional[float] = field(default=None)  # 输出速度
 
 
 @dataclass
@@ -171,3 +175,16 @@ def create_message_error_dict(
         ),
         log_id=log_id,
     ).dict()
+
+
+def message_end_code(msg: Any) -> Optional[str]:
+    """返回 message_end 消息的 code（ServerMessage 或其 dict 形式），其他消息返回 None"""
+    if isinstance(msg, dict):
+        if msg.get("type") != MESSAGE_TYPE_MESSAGE_END:
+            return None
+        detail = (msg.get("content") or {}).get("message_end") or {}
+        return detail.get("code")
+    if getattr(msg, "type", None) != MESSAGE_TYPE_MESSAGE_END:
+        return None
+    detail = msg.content.message_end
+    return detail.code if detail is not None else None
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+测试脚本：SSE 回答增量按时间窗口/大小合并，且不改变消息顺序
+"""
+
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+# 添加src目录到路径
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from utils.messages.coalesce import coalesce_answer_deltas
+from utils.messages.server import (
+    MESSAGE_TYPE_ANSWER,
+    MESSAGE_TYPE_TOOL_REQUEST,
+    ServerMessage,
+    ServerMessageContent,
+)
+
+
+def _answer(msg_id: str, seq: int, text: str, finish: bool = False) -> ServerMessage:
+    return ServerMessage(type=MESSAGE_TYPE_ANSWER, msg_id=msg_id, sequence_id=seq, finish=finish,
+                         content=ServerMessageContent(answer=text))
+
+
+def _tool(seq: int) -> ServerMessage:
+    return ServerMessage(type=MESSAGE_TYPE_TOOL_REQUEST, msg_id="tool", sequence_id=seq)
+
+
+async def _source(items, delay: float = 0):
+    for item in items:
+        if delay:
+            await asyncio.sleep(delay)
+        yield item
+
+
+def _collect(items, **kwargs):
+    async def run():
+        return [m async for m in coalesce_answer_deltas(_source(items, kwargs.pop("delay", 0)), **kwargs)]
+
+    return asyncio.run(run())
+
+
+def test_disabled_passes_through():
+    items = [_answer("m", i, str(i)) for i in range(1, 6)]
+    assert _collect(items, flush_ms=0) == items
+
+
+def test_deltas_merged_until_finish():
+    items = [_answer("m", 1, "he"), _answer("m", 2, "ll"), _answer("m", 3, "o", finish=True)]
+    out = _collect(items, flush_ms=1000)
+    assert len(out) == 1
+    assert out[0].content.answer == "hello"
+    assert out[0].sequence_id == 3 and out[0].finish
+
+
+def test_non_answer_flushes_buffer_in_order():
+    items = [_answer("m", 1, "a"), _answer("m", 2, "b"), _tool(3), _answer("m", 4, "c")]
+    out = _collect(items, flush_ms=1000)
+    assert [(m.type, m.sequence_id) for m in out] == [
+        (MESSAGE_TYPE_ANSWER, 2), (MESSAGE_TYPE_TOOL_REQUEST, 3), (MESSAGE_TYPE_ANSWER, 4),
+    ]
+    assert [m.content.answer for m in out if m.type == MESSAGE_TYPE_ANSWER] == ["ab", "c"]
+
+
+def test_different_msg_ids_not_merged():
+    items = [_answer("m1", 1, "a"), _answer("m2", 2, "b")]
+    assert [m.content.answer for m in _collect(items, flush_ms=1000)] == ["a", "b"]
+
+
+def test_max_bytes_triggers_flush():
+    items = [_answer("m", i, "x" * 10) for i in range(1, 7)]
+    out = _collect(items, flush_ms=1000, max_bytes=25)
+    assert [len(m.content.answer) for m in out] == [30, 30]
+    assert [m.sequence_id for m in out] == [3, 6]
+
+
+def test_flush_window_expires():
+    items = [_answer("m", 1, "a"), _answer("m", 2, "b")]
+    out = _collect(items, flush_ms=5, delay=0.03)
+    assert [m.content.answer for m in out] == ["a", "b"]
+
+
+def test_upstream_error_flushes_then_raises():
+    async def failing():
+        yield _answer("m", 1, "partial")
+        raise RuntimeError("upstream failed")
+
+    async def run():
+        out = []
+        with pytest.raises(RuntimeError):
+            async for m in coalesce_answer_deltas(failing(), flush_ms=1000):
+                out.append(m)
+        return out
+
+    assert [m.content.answer for m in asyncio.run(run())] == ["partial"]
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, "-q"]))
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+测试脚本：按 Accept 头选择 SSE / msgpack 帧格式，两种编码与原 json.dumps 载荷一致且可往返
+"""
+
+import json
+import sys
+from dataclasses import asdict
+from pathlib import Path
+
+import pytest
+
+# 添加src目录到路径
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from utils.messages import codec
+from utils.messages.server import (
+    MESSAGE_TYPE_MESSAGE_END,
+    MessageEndDetail,
+    ServerMessage,
+    ServerMessageContent,
+    TokenCost,
+)
+
+
+def _message() -> ServerMessage:
+    detail = MessageEndDetail(code="0", message="完成", token_cost=TokenCost(1, 2, 3), time_cost_ms=12)
+    return ServerMessage(type=MESSAGE_TYPE_MESSAGE_END, session_id="s", msg_id="m", sequence_id=7, finish=True,
+                         content=ServerMessageContent(message_end=detail), log_id="log")
+
+
+class _Opaque:
+    def __str__(self):
+        return "opaque"
+
+
+def _payload():
+    return {"text": "中文 \"quoted\"", 1: "int key", "nested": [None, True, 1.5], "obj": _Opaque()}
+
+
+@pytest.fixture(params=["orjson", "json"])
+def json_backend(request, monkeypatch):
+    if request.param == "orjson":
+        pytest.importorskip("orjson")
+    else:
+        monkeypatch.setattr(codec, "orjson", None)
+    return request.param
+
+
+def test_dataclass_encoded_like_asdict(json_backend):
+    message = _message()
+    assert codec.loads(codec.dumps(message)) == asdict(message)
+    assert codec.loads(codec.dumps(message.dict())) == message.dict()
+
+
+def test_unserializable_values_fall_back_to_str(json_backend):
+    data = _payload()
+    expected = json.loads(json.dumps(data, ensure_ascii=False, default=str))
+    assert codec.loads(codec.dumps(data)) == expected
+
+
+def test_sse_frame_format(json_backend):
+    frame = codec.SSE_WIRE.frame({"a": "中"}, event_id="run-1:3")
+    assert frame.startswith(b"id: run-1:3\nevent: message\ndata: ")
+    assert frame.endswith(b"\n\n")
+    assert codec.loads(frame.split(b"data: ", 1)[1]) == {"a": "中"}
+    assert codec.SSE_WIRE.frame({}).startswith(b"event: message\ndata: ")
+
+
+def test_select_wire_by_accept(monkeypatch):
+    assert codec.select_wire(None) is codec.SSE_WIRE
+    assert codec.select_wire("text/event-stream") is codec.SSE_WIRE
+    monkeypatch.setattr(codec, "ormsgpack", None)
+    # 未安装 ormsgpack 时即使请求 msgpack 也退回 SSE
+    assert codec.select_wire(codec.MEDIA_TYPE_MSGPACK) is codec.SSE_WIRE
+
+
+def test_msgpack_frames_round_trip():
+    pytest.importorskip("ormsgpack")
+    wire = codec.select_wire(f"{codec.MEDIA_TYPE_MSGPACK}, text/event-stream;q=0.5")
+    assert wire is codec.MSGPACK_WIRE and wire.media_type == codec.MEDIA_TYPE_MSGPACK
+    messages = [_message().dict(), _payload(), {"empty": ""}]
+    buf = b"".join(wire.frame(m) for m in messages)
+    expected = [json.loads(json.dumps(m, ensure_ascii=False, default=str)) for m in messages]
+    # msgpack 保留非字符串键
+    expected[1][1] = expected[1].pop("1")
+    assert list(codec.MsgpackWire.iter_frames(buf)) == expected
+
+
+def test_msgpack_partial_frame_not_yielded():
+    pytest.importorskip("ormsgpack")
+    frame = codec.MSGPACK_WIRE.frame({"a": 1})
+    assert list(codec.MsgpackWire.iter_frames(frame + frame[:2])) == [{"a": 1}]
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, "-q"]))
@@ -0,0 +1,86 @@
+"""
+流式运行的 token 用量与延迟统计
+
+- 从模型输出（AIMessageChunk / AIMessage）的 usage_metadata 累加 token 用量，一次运行中多次模型调用合并计算
+- 首 token 延迟（TTFT）：从运行开始到第一个带内容的模型输出
+- token 间延迟：相邻两个带内容的模型输出之间的平均/最大间隔
+- 输出速度：输出 token 数 / 首 token 到末 token 的时长；模型未返回用量时按输出片段数估算
+"""
+import time
+from typing import Any, Dict, Mapping, Optional
+
+from utils.messages.server import MessageEndDetail, TokenCost
+
+
+class UsageMeter:
+    def __init__(self, t0: Optional[float] = None):
+        self.t0 = t0 if t0 is not None else time.time()
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.total_tokens = 0
+        self.has_usage = False
+        self.first_token_at: Optional[float] = None
+        self.last_token_at: Optional[float] = None
+        self.token_events = 0
+        self.max_gap = 0.0
+
+    def add_usage(self, usage: Optional[Mapping[str, Any]]):
+        if not usage:
+            return
+        input_tokens = int(usage.get("input_tokens") or 0)
+        output_tokens = int(usage.get("output_tokens") or 0)
+        self.input_tokens += input_tokens
+        self.output_tokens += output_tokens
+        self.total_tokens += int(usage.get("total_tokens") or (input_tokens + output_tokens))
+        self.has_usage = True
+
+    def mark_token(self, now: Optional[float] = None):
+        if now is None:
+            now = time.time()
+        if self.first_token_at is None:
+            self.first_token_at = now
+        elif self.last_token_at is not None:
+            self.max_gap = max(self.max_gap, now - self.last_token_at)
+        self.last_token_at = now
+        self.token_events += 1
+
+    def observe(self, chunk: Any):
+        """处理 messages 流中的一个模型输出"""
+        if getattr(chunk, "content", None) or getattr(chunk, "tool_call_chunks", None):
+            self.mark_token()
+        self.add_usage(getattr(chunk, "usage_metadata", None))
+
+    def token_cost(self) -> TokenCost:
+        return TokenCost(
+            input_tokens=self.input_tokens,
+            output_tokens=self.output_tokens,
+            total_tokens=self.total_tokens,
+        )
+
+    def metrics(self) -> Dict[str, Any]:
+        if self.first_token_at is None:
+            return {"ttft_ms": None, "avg_inter_token_ms": None, "max_inter_token_ms": None,
+                    "tokens_per_second": None}
+        span = self.last_token_at - self.first_token_at
+        avg_gap = span / (self.token_events - 1) if self.token_events > 1 else None
+        tokens = self.output_tokens if self.has_usage else self.token_events
+        return {
+            "ttft_ms": int((self.first_token_at - self.t0) * 1000),
+            "avg_inter_token_ms": round(avg_gap * 1000, 2) if avg_gap is not None else None,
+            "max_inter_token_ms": round(self.max_gap * 1000, 2) if self.token_events > 1 else None,
+            "tokens_per_second": round(tokens / span, 2) if span > 0 else None,
+        }
+
+    def fill(self, detail: MessageEndDetail) -> MessageEndDetail:
+        detail.token_cost = self.token_cost()
+        for key, value in self.metrics().items():
+            setattr(detail, key, value)
+        return detail
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "input_tokens": self.input_tokens,
+            "output_tokens": self.output_tokens,
+            "total_tokens": self.total_tokens,
+            **self.metrics(),
+        }